@@ -2,6 +2,8 @@
 #include <WiFi.h>
 #include <HTTPClient.h>
 #include <ArduinoJson.h>
+#include <PubSubClient.h>
+#include <time.h>
 
 // === CẤU HÌNH WIFI WOKWI ===
 const char* SSID = "Wokwi-GUEST";
@@ -11,6 +13,32 @@ const char* PASSWORD = "";
 const char *SERVER_IP = "192.168.21.212"; 
 const int SERVER_PORT = 5000;
 
+// === MQTT: nhận lệnh (retained) thay cho poll /api/config ===
+const char* MQTT_BROKER = "broker.hivemq.com";
+const int MQTT_PORT = 1883;
+const char* DEVICE_ID = "esp32";   // Mỗi zone 1 ID riêng
+String stateTopic = String("tuoicay/") + DEVICE_ID + "/state";
+String ackTopic = String("tuoicay/") + DEVICE_ID + "/ack";
+
+WiFiClient espClient;
+PubSubClient mqttClient(espClient);
+void onMqttMessage(char* topic, byte* payload, unsigned int length);
+
+// === STORE-AND-FORWARD: lưu reading khi mất mạng, gửi bù qua /api/report/bulk ===
+struct Reading {
+  uint32_t ts;      // epoch giây (NTP)
+  float soil;
+  uint8_t pump;
+  uint8_t autoMode;
+};
+const int BACKLOG_SIZE = 3600;                // 10 giờ nếu lưu mỗi 10 giây
+const unsigned long BACKLOG_INTERVAL = 10000; // Lưu 1 reading / 10 giây khi offline
+const int BULK_BATCH = 100;                   // Số reading / request gửi bù
+Reading backlog[BACKLOG_SIZE];
+int backlogHead = 0;    // Vị trí reading cũ nhất
+int backlogCount = 0;
+unsigned long lastBacklog = 0;
+
 #define DOAM_PIN 34
 #define PUMP_PIN 26
 
@@ -26,6 +54,12 @@ float soilPercent = 0;
 bool pumpState = false;
 bool autoMode = true;
 unsigned long lastUpdate = 0;
+// Nhịp gửi report do Server điều chỉnh ("report_interval" / 429 Retry-After)
+unsigned long reportInterval = 1000;  // ms giữa 2 report bình thường
+unsigned long reportWait = 1000;      // ms chờ tới report kế tiếp
+unsigned long lastReport = 0;
+unsigned long lastMqttRetry = 0;
+long lastSeq = -1;
 
 void setup() {
   Serial.begin(115200);
@@ -39,25 +73,149 @@ void setup() {
     Serial.print(".");
   }
   Serial.println("\n✅ WiFi Connected!");
+
+  // Đồng hồ thực (UTC) để gắn thời điểm đo cho dữ liệu gửi bù
+  configTime(0, 0, "pool.ntp.org", "time.google.com");
+
+  mqttClient.setServer(MQTT_BROKER, MQTT_PORT);
+  mqttClient.setCallback(onMqttMessage);
 }
 
-void sendReport() {
+// Trả về HTTP code (0 = không có mạng)
+int sendReport() {
   if (WiFi.status() == WL_CONNECTED) {
     HTTPClient http;
     String url = String("http://") + SERVER_IP + ":" + SERVER_PORT + "/api/report";
     http.begin(url);
     http.addHeader("Content-Type", "application/json");
+    const char* headerKeys[] = {"Retry-After"};
+    http.collectHeaders(headerKeys, 1);
     
     StaticJsonDocument<200> doc;
     doc["soil"] = soilPercent;
     doc["pump"] = pumpState ? 1 : 0;
     doc["auto"] = autoMode ? 1 : 0;
+    doc["device"] = DEVICE_ID;
     
     String json;
     serializeJson(doc, json);
     
-    http.POST(json);
+    int httpCode = http.POST(json);
+    if (httpCode == 200 || httpCode == 429) {
+      StaticJsonDocument<200> resp;
+      if (!deserializeJson(resp, http.getString())) {
+        float interval = resp["report_interval"] | 0.0;
+        if (interval > 0) reportInterval = (unsigned long)(interval * 1000);
+      }
+      reportWait = reportInterval;
+      if (httpCode == 429) {
+        // Server quá tải / gửi quá nhanh: chờ theo Retry-After, không gửi bù
+        unsigned long retry = http.header("Retry-After").toInt() * 1000UL;
+        reportWait = max(reportWait, retry);
+        Serial.printf("🚦 Server giới hạn, gửi lại sau %lu ms\n", reportWait);
+      }
+    }
     http.end();
+    return httpCode;
+  }
+  return 0;
+}
+
+// Lưu reading vào bộ đệm vòng (đầy thì ghi đè reading cũ nhất)
+void bufferReading() {
+  time_t nowTs = time(nullptr);
+  if (nowTs < 1577836800) return;  // Chưa đồng bộ NTP -> không có thời điểm đo
+  if (millis() - lastBacklog < BACKLOG_INTERVAL) return;
+  lastBacklog = millis();
+
+  int pos = (backlogHead + backlogCount) % BACKLOG_SIZE;
+  backlog[pos] = {(uint32_t)nowTs, soilPercent, (uint8_t)pumpState, (uint8_t)autoMode};
+  if (backlogCount < BACKLOG_SIZE) {
+    backlogCount++;
+  } else {
+    backlogHead = (backlogHead + 1) % BACKLOG_SIZE;
+  }
+}
+
+// Gửi bù 1 lô; Server ghi idempotent nên gửi lại khi lỗi không bị trùng
+void flushBacklog() {
+  if (backlogCount == 0 || WiFi.status() != WL_CONNECTED) return;
+
+  int n = min(backlogCount, BULK_BATCH);
+  DynamicJsonDocument doc(12288);
+  doc["device"] = DEVICE_ID;
+  JsonArray readings = doc.createNestedArray("readings");
+  for (int i = 0; i < n; i++) {
+    const Reading &r = backlog[(backlogHead + i) % BACKLOG_SIZE];
+    JsonObject o = readings.createNestedObject();
+    o["ts"] = r.ts;
+    o["soil"] = r.soil;
+    o["pump"] = r.pump;
+    o["auto"] = r.autoMode;
+  }
+
+  String json;
+  serializeJson(doc, json);
+
+  HTTPClient http;
+  String url = String("http://") + SERVER_IP + ":" + SERVER_PORT + "/api/report/bulk";
+  http.begin(url);
+  http.addHeader("Content-Type", "application/json");
+  int httpCode = http.POST(json);
+  http.end();
+
+  if (httpCode == 200) {
+    backlogHead = (backlogHead + n) % BACKLOG_SIZE;
+    backlogCount -= n;
+    Serial.printf("📦 Đã gửi bù %d reading (còn %d)\n", n, backlogCount);
+  }
+}
+
+// Áp dụng lệnh từ Server (dùng chung cho MQTT và HTTP)
+void applyCommand(int svPump, int svAuto) {
+  // Cập nhật chế độ
+  autoMode = (svAuto == 1);
+  
+  // QUAN TRỌNG: Chỉ nghe lệnh Server khi KHÔNG ở chế độ Auto
+  if (!autoMode) {
+    if (svPump == 1 && !pumpState) {
+      pumpState = true;
+      digitalWrite(PUMP_PIN, HIGH);
+      Serial.println("🎮 Server: BẬT BƠM");
+    } else if (svPump == 0 && pumpState) {
+      pumpState = false;
+      digitalWrite(PUMP_PIN, LOW);
+      Serial.println("🎮 Server: TẮT BƠM");
+    }
+  }
+}
+
+void onMqttMessage(char* topic, byte* payload, unsigned int length) {
+  StaticJsonDocument<200> doc;
+  if (deserializeJson(doc, payload, length)) return;
+
+  long seq = doc["seq"] | 0;
+  if (seq != lastSeq) {
+    applyCommand(doc["pump_cmd"] | 0, doc["auto"] | 1);
+    lastSeq = seq;
+  }
+
+  // Gửi ACK để Server không gửi lại
+  char ack[32];
+  snprintf(ack, sizeof(ack), "{\"seq\":%ld}", seq);
+  mqttClient.publish(ackTopic.c_str(), ack);
+}
+
+void ensureMqtt() {
+  if (mqttClient.connected() || WiFi.status() != WL_CONNECTED) return;
+  if (millis() - lastMqttRetry < 5000) return;
+  lastMqttRetry = millis();
+
+  String clientId = String("tuoicay-") + DEVICE_ID;
+  if (mqttClient.connect(clientId.c_str())) {
+    // Broker gửi ngay state retained mới nhất khi subscribe
+    mqttClient.subscribe(stateTopic.c_str(), 1);
+    Serial.println("✅ MQTT Connected");
   }
 }
 
@@ -76,28 +234,16 @@ void getConfig() {
       // Lấy giá trị từ Server
       int svPump = doc["pump_cmd"]; // 0 hoặc 1
       int svAuto = doc["auto"];     // 0 hoặc 1
-      
-      // Cập nhật chế độ
-      autoMode = (svAuto == 1);
-      
-      // QUAN TRỌNG: Chỉ nghe lệnh Server khi KHÔNG ở chế độ Auto
-      if (!autoMode) {
-        if (svPump == 1 && !pumpState) {
-          pumpState = true;
-          digitalWrite(PUMP_PIN, HIGH);
-          Serial.println("🎮 Server: BẬT BƠM");
-        } else if (svPump == 0 && pumpState) {
-          pumpState = false;
-          digitalWrite(PUMP_PIN, LOW);
-          Serial.println("🎮 Server: TẮT BƠM");
-        }
-      }
+      applyCommand(svPump, svAuto);
     }
     http.end();
   }
 }
 
 void loop() {
+  ensureMqtt();
+  mqttClient.loop();
+
   unsigned long now = millis();
   
   if (now - lastUpdate > 1000) { // Mỗi 1 giây
@@ -122,8 +268,17 @@ void loop() {
       // Ở giữa khoảng 45-60%: Giữ nguyên trạng thái cũ
     }
 
-    sendReport();
-    getConfig();
+    if (now - lastReport >= reportWait) {
+      lastReport = now;
+      int code = sendReport();
+      if (code == 200) {
+        flushBacklog();   // Có mạng lại -> gửi bù dần, mỗi report 1 lô
+      } else if (code != 429) {
+        bufferReading();
+      }
+    }
+    // Chỉ poll HTTP khi mất MQTT (dự phòng)
+    if (!mqttClient.connected()) getConfig();
     lastUpdate = now;
   }
 }
\ No newline at end of file
@@ -0,0 +1,190 @@
+import time
+import threading
+from collections import OrderedDict, namedtuple
+
+# ================= KIỂM SOÁT TẢI ĐẦU VÀO (ADMISSION CONTROL) =================
+# /api/report và MQTT tuoicay/report trước đây nhận mọi message: 1 ESP32 cấu
+# hình sai (delay() quá ngắn) hoặc 1 luồng MQTT bị phát lại có thể chiếm hết
+# append_log / Telegram của cả hệ thống. Ba lớp bảo vệ, đều trả lời ngay
+# (không xếp hàng, không chặn luồng khác):
+#   - Token bucket / thiết bị: `rate` report/giây, dồn tối đa `burst` report
+#     -> vượt thì 429 (HTTP) hoặc bỏ message (MQTT), thiết bị khác không bị ảnh hưởng
+#   - Giới hạn đồng thời toàn server: quá `concurrency` report đang xử lý
+#     -> 429 ngay thay vì để mọi request cùng chờ khoá SQLite
+#   - Gợi ý chu kỳ report (`report_interval`, giây) gửi lại cho thiết bị trong
+#     response HTTP hoặc topic tuoicay/<device>/throttle: tăng khi thiết bị
+#     vượt hạn mức hoặc server gần đầy -> thiết bị tự giãn nhịp gửi
+# Trạng thái nằm trong RAM của từng process (N worker gunicorn = N x hạn mức).
+
+THROTTLE_TOPIC = 'tuoicay/{device}/throttle'
+
+# ok=False: reason = 'throttled' (thiết bị vượt hạn mức) | 'overloaded' (server đầy)
+Decision = namedtuple('Decision', ['ok', 'reason', 'retry_after', 'report_interval'])
+
+
+class TokenBucket:
+    """Mỗi report lấy 1 token, token nạp lại `rate` / giây, tối đa `burst`"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = now
+
+    def take(self, now):
+        """Returns: 0 nếu lấy được token, ngược lại số giây phải chờ"""
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Admission:
+    """
+    Args:
+        rate: report / giây / thiết bị, 0 = không giới hạn
+        burst: số report dồn tối đa (thiết bị mất mạng rồi gửi liền)
+        concurrency: số report xử lý cùng lúc toàn process, 0 = không giới hạn
+        interval: chu kỳ report bình thường của ESP32 (settings.REPORT_INTERVAL)
+        alert_cooldown: giây tối thiểu giữa 2 cảnh báo Telegram cùng loại / thiết bị
+        max_devices: số bucket giữ trong RAM (device id giả mạo không làm đầy bộ nhớ)
+    """
+
+    def __init__(self, rate=2.0, burst=10, concurrency=16, interval=1.0, alert_cooldown=300,
+                 max_devices=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.concurrency = concurrency
+        self.interval = interval
+        self.alert_cooldown = alert_cooldown
+        self.max_devices = max_devices
+        self.clock = clock
+        self.in_flight = 0
+        self._buckets = OrderedDict()   # device -> TokenBucket (LRU)
+        self._alerts = OrderedDict()    # (device, kind) -> lần gửi cuối
+        self._hints = OrderedDict()     # device -> lần gửi gợi ý MQTT cuối
+        self._lock = threading.Lock()
+
+    def configure(self, **kwargs):
+        """Đổi hạn mức lúc chạy (create_app / test), xoá trạng thái cũ"""
+        with self._lock:
+            for k, v in kwargs.items():
+                setattr(self, k, v)
+            self.burst = max(1, self.burst)
+            self._buckets.clear()
+            self._alerts.clear()
+            self._hints.clear()
+
+    @staticmethod
+    def _touch(lru, key, value, limit):
+        lru[key] = value
+        lru.move_to_end(key)
+        if len(lru) > limit:
+            lru.popitem(last=False)
+
+    def load(self):
+        """Tỉ lệ slot đang dùng (0..1), 0 khi không giới hạn"""
+        return self.in_flight / self.concurrency if self.concurrency > 0 else 0.0
+
+    def report_interval(self, bucket=None):
+        """
+        Chu kỳ report gợi ý (giây): bình thường = interval, thiết bị đã tiêu
+        quá nửa burst -> theo đúng rate, server tải > 75% -> gấp đôi
+        """
+        interval = self.interval
+        if bucket is not None and bucket.tokens < bucket.burst / 2:
+            interval = max(interval, 1.0 / self.rate)
+        if self.load() >= 0.75:
+            interval *= 2
+        return round(interval, 3)
+
+    def admit(self, device):
+        """Lấy 1 token của thiết bị (không tính slot đồng thời) -> Decision"""
+        if self.rate <= 0:
+            return Decision(True, None, 0.0, self.report_interval())
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(device)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, now)
+            self._touch(self._buckets, device, bucket, self.max_devices)
+            wait = bucket.take(now)
+            interval = self.report_interval(bucket)
+        if wait:
+            return Decision(False, 'throttled', round(wait, 3), max(interval, round(1.0 / self.rate, 3)))
+        return Decision(True, None, 0.0, interval)
+
+    def acquire(self):
+        """Giữ 1 slot xử lý, False ngay nếu đã đủ `concurrency` (không chờ)"""
+        with self._lock:
+            if self.concurrency > 0 and self.in_flight >= self.concurrency:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def overloaded(self):
+        """Decision trả về khi acquire() thất bại"""
+        return Decision(False, 'overloaded', round(max(self.interval, 1.0), 3), self.report_interval())
+
+    def alert_allowed(self, device, kind):
+        """Cảnh báo Telegram: tối đa 1 tin / alert_cooldown giây / (thiết bị, loại)"""
+        now = self.clock()
+        key = (device, kind)
+        with self._lock:
+            last = self._alerts.get(key)
+            if last is not None and now - last < self.alert_cooldown:
+                return False
+            self._touch(self._alerts, key, now, self.max_devices)
+            return True
+
+    def hint_due(self, device, decision):
+        """
+        Có nên publish gợi ý MQTT không: tối đa 1 lần / retry_after của thiết bị
+        (message bị bỏ không sinh ra thêm 1 message gửi đi mỗi lần)
+        """
+        now = self.clock()
+        with self._lock:
+            last = self._hints.get(device)
+            if last is not None and now - last < max(decision.retry_after, decision.report_interval, 1.0):
+                return False
+            self._touch(self._hints, device, now, self.max_devices)
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {'devices': len(self._buckets), 'in_flight': self.in_flight,
+                    'rate': self.rate, 'burst': self.burst, 'concurrency': self.concurrency}
+
+
+def hint_payload(decision):
+    """Payload JSON cho tuoicay/<device>/throttle và body 429"""
+    return {'report_interval': decision.report_interval, 'retry_after': decision.retry_after,
+            'reason': decision.reason}
+
+
+# ================= USAGE EXAMPLE =================
+if __name__ == "__main__":
+    clock = [0.0]
+    gate = Admission(rate=2, burst=5, concurrency=2, interval=1, clock=lambda: clock[0])
+
+    # ESP32 lỗi gửi 20 report / giây, ESP32 bình thường gửi 1 / giây
+    accepted = {'noisy': 0, 'normal': 0}
+    for tick in range(100):             # 5 giây, bước 50ms
+        clock[0] = tick * 0.05
+        if gate.admit('noisy').ok:
+            accepted['noisy'] += 1
+        if tick % 20 == 0 and gate.admit('normal').ok:
+            accepted['normal'] += 1
+    print(f"📥 Noisy: nhận {accepted['noisy']}/100, normal: nhận {accepted['normal']}/5")
+    print(f"⏱️ Gợi ý cho noisy: {hint_payload(gate.admit('noisy'))}")
+
+    # Giới hạn đồng thời: slot thứ 3 bị từ chối ngay
+    print(f"🚦 Slot: {[gate.acquire() for _ in range(3)]} -> {hint_payload(gate.overloaded())}")
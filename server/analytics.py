@@ -0,0 +1,408 @@
+import time
+import sqlite3
+import threading
+from datetime import datetime
+import numpy as np
+from ring_buffer import Window
+from storage import Storage
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# ================= TRUY VẤN PHÂN TÍCH (DUCKDB, DẠNG CỘT) =================
+# Các job ML / báo cáo quét hàng chục ngày dữ liệu rồi resample, group by.
+# Chạy trên SQLite (pd.read_sql_query) thì tranh khoá với luồng ghi report
+# và tốn thời gian tạo DataFrame từng dòng.
+#
+# Analytics giữ 1 bản sao dạng cột của bảng logs trong DuckDB (RAM hoặc file):
+#   - sync(): chỉ đọc các dòng mới (id > watermark, range scan trên rowid),
+#     logs chia shard (storage.py) -> mỗi shard 1 watermark
+#   - resample / nội suy / group by chạy trong DuckDB (vectorized)
+#   - trả về numpy array cho code ML (không qua DataFrame)
+#
+# Tuỳ chọn: TUOI_ANALYTICS=1 và `pip install duckdb`. Không có duckdb ->
+# ML dùng lại đường pandas + SQLite như cũ.
+#
+#   python analytics.py --rows 500000    # benchmark so với đường pandas
+
+_COLUMNS = "id, device, ts_ms, soil, pump, auto, wifi_connected, wifi_rssi, device_ts"
+
+
+def _local_offset_ms():
+    """Lệch giờ địa phương (resample của pandas chia bucket theo giờ địa phương)"""
+    return int(datetime.now().astimezone().utcoffset().total_seconds() * 1000)
+
+
+def _gap_fill(columns, limit, interpolate=()):
+    """
+    Biểu thức SQL lấp các bucket trống trên lưới `k` (giống pandas):
+    cột trong `interpolate` -> interpolate(method='time', limit, limit_area='inside'),
+    cột còn lại -> ffill(limit); limit=None = không giới hạn
+    """
+    windows, values = [], []
+    for c in columns:
+        windows.append(f"last_value(CASE WHEN {c} IS NOT NULL THEN k END IGNORE NULLS) OVER prev AS {c}_k0")
+        windows.append(f"last_value({c} IGNORE NULLS) OVER prev AS {c}_v0")
+        if c in interpolate:
+            windows.append(f"first_value(CASE WHEN {c} IS NOT NULL THEN k END IGNORE NULLS) OVER next AS {c}_k1")
+            windows.append(f"first_value({c} IGNORE NULLS) OVER next AS {c}_v1")
+            values.append(f"""CASE WHEN k - {c}_k0 <= {limit} AND {c}_k1 IS NOT NULL THEN
+                {c}_v0 + ({c}_v1 - {c}_v0) * (k - {c}_k0) / CASE WHEN {c}_k1 = {c}_k0 THEN 1 ELSE {c}_k1 - {c}_k0 END
+                END AS {c}""")
+        elif limit is None:
+            values.append(f"{c}_v0 AS {c}")
+        else:
+            values.append(f"CASE WHEN k - {c}_k0 <= {limit} THEN {c}_v0 END AS {c}")
+    return ', '.join(windows), ', '.join(values)
+
+
+_WINDOWS = """WINDOW prev AS (ORDER BY k ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW),
+                  next AS (ORDER BY k ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING)"""
+
+
+# Báo cáo theo thiết bị: SQL chạy được trên cả DuckDB và SQLite (không có duckdb)
+# dt = thời gian đến dòng kế tiếp (tối đa max_gap, dài hơn = mất kết nối)
+# -> độ ẩm trung bình theo thời gian và số phút bơm đúng cả khi logs đã nén
+FLEET_SQL = """
+SELECT device,
+       COUNT(*) AS rows,
+       MIN(soil) AS soil_min,
+       MAX(soil) AS soil_max,
+       COALESCE(SUM((soil + soil_next) * dt) / 2.0 / NULLIF(SUM(dt), 0), AVG(soil)) AS soil_avg,
+       SUM(CASE WHEN pump = 1 THEN dt ELSE 0 END) / 60000.0 AS pump_minutes,
+       SUM(dt) / 60000.0 AS online_minutes,
+       SUM(CASE WHEN gap > ? THEN 1 ELSE 0 END) AS outages,
+       MAX(ts_ms) AS last_ms
+FROM (
+    SELECT device, ts_ms, soil, pump,
+           LEAD(soil) OVER w AS soil_next,
+           LEAD(ts_ms) OVER w - ts_ms AS gap,
+           CASE WHEN LEAD(ts_ms) OVER w - ts_ms <= ? THEN LEAD(ts_ms) OVER w - ts_ms ELSE 0 END AS dt
+    FROM logs
+    WHERE ts_ms >= ? AND device IS NOT NULL
+    WINDOW w AS (PARTITION BY device ORDER BY ts_ms)
+)
+GROUP BY device
+ORDER BY device
+"""
+
+
+def fleet_report(db_path, hours=24, analytics=None, max_gap=180):
+    """
+    Tổng hợp theo thiết bị trong `hours` giờ gần nhất
+
+    Returns:
+        list dict: device, rows, soil_min/max/avg, pump_minutes, online_pct, outages, last_seen
+    """
+    cutoff = int((time.time() - hours * 3600) * 1000)
+    params = (max_gap * 1000, max_gap * 1000, cutoff)
+    if analytics is not None:
+        rows = analytics.query(FLEET_SQL, params)
+    else:
+        # Mỗi thiết bị nằm trọn trong 1 shard -> chạy song song từng shard, trộn theo device
+        store = Storage(db_path)
+        try:
+            rows = store.fan_out(FLEET_SQL, params, key=lambda r: r[0])
+        finally:
+            store.close()
+    return [{
+        'device': device,
+        'rows': int(n),
+        'soil_min': round(float(lo), 1),
+        'soil_max': round(float(hi), 1),
+        'soil_avg': round(float(avg), 1),
+        'pump_minutes': round(float(pump), 1),
+        'online_pct': round(100.0 * float(online) / (hours * 60), 1),
+        'outages': int(outages),
+        'last_seen': datetime.fromtimestamp(last / 1000).isoformat(),
+    } for device, n, lo, hi, avg, pump, online, outages, last in rows]
+
+
+class Analytics:
+    """
+    Bản sao dạng cột (DuckDB) của bảng logs cho truy vấn phân tích
+
+    Mỗi process (worker ML) giữ 1 bản riêng -> không tranh khoá ghi của
+    DuckDB giữa các process. path=file .duckdb để giữ lại giữa các lần chạy.
+    """
+
+    CHUNK = 50000           # dòng / lần đọc SQLite
+    PRUNE_INTERVAL = 3600   # giây giữa 2 lần xoá dữ liệu quá hạn
+
+    def __init__(self, db_path, path=':memory:', retention_days=60):
+        if duckdb is None:
+            raise RuntimeError('duckdb chưa được cài (pip install duckdb)')
+        self.db_path = db_path
+        self.retention_days = retention_days
+        self.con = duckdb.connect(path)
+        self.con.execute('''CREATE TABLE IF NOT EXISTS logs(
+            id BIGINT, device VARCHAR, ts_ms BIGINT, soil DOUBLE,
+            pump TINYINT, auto TINYINT, wifi_connected TINYINT, wifi_rssi SMALLINT,
+            device_ts BIGINT
+        )''')
+        # id chỉ tăng dần trong 1 file SQLite -> 1 watermark / file logs (shard)
+        self.con.execute("CREATE TABLE IF NOT EXISTS watermarks(source VARCHAR PRIMARY KEY, id BIGINT)")
+        self.storage = Storage(db_path)
+        self.watermarks = dict(self.con.execute("SELECT source, id FROM watermarks").fetchall())
+        if not self.watermarks and not self.storage.sharded:
+            # Bản sao tạo trước khi có bảng watermarks: logs chỉ từ 1 file
+            self.watermarks[db_path] = self.con.execute("SELECT coalesce(max(id), 0) FROM logs").fetchone()[0]
+        self._pruned = 0
+        self._lock = threading.Lock()
+
+    # ================= ĐỒNG BỘ TỪ SQLITE =================
+    def sync(self):
+        """
+        Chép các dòng mới từ SQLite (id > watermark)
+
+        Returns: số dòng đã chép
+        """
+        cutoff = int((time.time() - self.retention_days * 86400) * 1000)
+        copied = 0
+        with self._lock:
+            for path in self.storage.sources():
+                copied += self._copy(path, cutoff)
+            if time.time() - self._pruned > self.PRUNE_INTERVAL:
+                self.con.execute("DELETE FROM logs WHERE ts_ms < ?", (cutoff,))
+                self._pruned = time.time()
+        return copied
+
+    def _copy(self, path, cutoff):
+        """Chép các dòng mới của 1 file logs (id > watermark của file đó)"""
+        import pandas as pd
+
+        # Chỉ đọc: không giữ khoá ghi, mỗi lần đọc tối đa CHUNK dòng
+        src = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        copied = 0
+        try:
+            while True:
+                rows = src.execute(
+                    f"SELECT {_COLUMNS} FROM logs WHERE id > ? AND ts_ms >= ? ORDER BY id LIMIT ?",
+                    (self.watermarks.get(path, 0), cutoff, self.CHUNK)).fetchall()
+                if not rows:
+                    break
+                batch = pd.DataFrame.from_records(rows, columns=_COLUMNS.split(', ')).astype({
+                    'soil': 'Float64', 'pump': 'Int8', 'auto': 'Int8', 'wifi_connected': 'Int8',
+                    'wifi_rssi': 'Int16', 'device_ts': 'Int64'})
+                self.con.register('batch', batch)
+                # Bản sửa từ bulk backfill được ghi lại với id mới -> bỏ bản cũ
+                self.con.execute('''DELETE FROM logs USING batch
+                    WHERE batch.device_ts IS NOT NULL
+                      AND logs.device = batch.device AND logs.device_ts = batch.device_ts''')
+                self.con.execute("INSERT INTO logs SELECT * FROM batch")
+                self.con.unregister('batch')
+                self.watermarks[path] = rows[-1][0]
+                self.con.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?)", (path, rows[-1][0]))
+                copied += len(rows)
+                if len(rows) < self.CHUNK:
+                    break
+        finally:
+            src.close()
+        return copied
+
+    def query(self, sql, params=()):
+        """SQL tuỳ ý trên bản sao (đã sync) -> list tuple"""
+        self.sync()
+        with self._lock:
+            return self.con.execute(sql, params).fetchall()
+
+    def _numpy(self, sql, params):
+        self.sync()
+        with self._lock:
+            return self.con.execute(sql, params).fetchnumpy()
+
+    # ================= TRUY VẤN CHO ML =================
+    def _reconstruct_sql(self, device):
+        """Lưới đều bước `step` ms: giống AnomalyDetector.reconstruct() (pandas)"""
+        windows, values = _gap_fill(('soil', 'wifi_rssi', 'pump', 'auto', 'wifi_connected'),
+                                    '$limit', interpolate=('soil', 'wifi_rssi'))
+        where = "ts_ms >= $cutoff" + (" AND device = $device" if device else "")
+        return f"""
+        WITH b AS (
+            SELECT (ts_ms + $offset) // $step AS k,
+                   avg(soil) AS soil, avg(wifi_rssi) AS wifi_rssi,
+                   arg_max(pump, ts_ms) AS pump, arg_max(auto, ts_ms) AS auto,
+                   arg_max(wifi_connected, ts_ms) AS wifi_connected
+            FROM logs WHERE {where}
+            GROUP BY k
+        ),
+        g AS (SELECT unnest(range(min(k), max(k) + 1)) AS k FROM b),
+        w AS (
+            SELECT g.k AS k, soil, wifi_rssi, pump, auto, wifi_connected
+            FROM g LEFT JOIN b USING (k)
+        ),
+        f AS (SELECT k, {windows} FROM w {_WINDOWS}),
+        r AS (SELECT k, {values} FROM f)
+        SELECT * FROM r
+        WHERE soil IS NOT NULL AND wifi_rssi IS NOT NULL AND pump IS NOT NULL
+          AND auto IS NOT NULL AND wifi_connected IS NOT NULL
+        """
+
+    def _params(self, hours, step, limit, device):
+        params = {
+            'cutoff': int((time.time() - hours * 3600) * 1000),
+            'offset': _local_offset_ms(),
+            'step': int(step * 1000),
+            'limit': limit,
+        }
+        if device:
+            params['device'] = device
+        return params
+
+    def reconstruct(self, hours=24, step=5, limit=36, device=None):
+        """
+        Chuỗi đều bước `step` giây trong `hours` giờ gần nhất (logs đã nén được
+        nội suy lại), cùng kết quả với AnomalyDetector.load_recent_data()
+
+        Returns:
+            dict numpy array: ts (datetime64 giờ địa phương), soil, pump, auto,
+            wifi_connected, wifi_rssi
+        """
+        params = self._params(hours, step, limit, device)
+        data = self._numpy(self._reconstruct_sql(device) + " ORDER BY k", params)
+        k = data.pop('k')
+        return dict(ts=(k * params['step']).astype('datetime64[ms]'), **{
+            name: np.asarray(data[name], dtype=np.float64)
+            for name in ('soil', 'pump', 'auto', 'wifi_connected', 'wifi_rssi')})
+
+    def isolation_features(self, hours=24 * 30, step=5, limit=36, device=None):
+        """
+        Ma trận feature cho IsolationForest (giống AnomalyDetector.isolation_features):
+        soil, pump, wifi_rssi, hour, trung bình / độ lệch chuẩn trượt 5 điểm
+        """
+        params = self._params(hours, step, limit, device)
+        data = self._numpy(f"""
+            WITH r AS ({self._reconstruct_sql(device)})
+            SELECT soil, pump, wifi_rssi,
+                   ((k * $step) // 3600000) % 24 AS hour,
+                   avg(soil) OVER roll AS soil_rolling_mean,
+                   stddev_samp(soil) OVER roll AS soil_rolling_std
+            FROM r
+            WINDOW roll AS (ORDER BY k ROWS BETWEEN 4 PRECEDING AND CURRENT ROW)
+            QUALIFY count(*) OVER roll = 5
+            ORDER BY k
+        """, params)
+        return np.column_stack([np.asarray(data[c], dtype=np.float64) for c in
+                                ('soil', 'pump', 'wifi_rssi', 'hour', 'soil_rolling_mean', 'soil_rolling_std')])
+
+    def hourly(self, days=30, device=None):
+        """
+        Trung bình theo giờ (giống SoilMoistureLSTM.load_data: lưới 1 phút,
+        nội suy tối đa 3 phút, trung bình giờ, ffill)
+
+        Returns:
+            ring_buffer.Window (ts epoch giây đầu giờ, soil, pump, auto, rssi)
+            -> dùng trực tiếp với SoilMoistureLSTM.features_from_hourly
+        """
+        columns = ('soil', 'pump', 'auto', 'wifi_rssi')
+        windows, values = _gap_fill(columns, 3, interpolate=columns)
+        params = self._params(days * 24, 60, 3, device)
+        params.pop('limit')
+        where = "ts_ms >= $cutoff" + (" AND device = $device" if device else "")
+        hour_windows, hour_values = _gap_fill(columns, None)
+        data = self._numpy(f"""
+            WITH b AS (
+                SELECT (ts_ms + $offset) // $step AS k,
+                       avg(soil) AS soil, avg(pump) AS pump, avg(auto) AS auto, avg(wifi_rssi) AS wifi_rssi
+                FROM logs WHERE {where}
+                GROUP BY k
+            ),
+            g AS (SELECT unnest(range(min(k), max(k) + 1)) AS k FROM b),
+            w AS (SELECT g.k AS k, soil, pump, auto, wifi_rssi FROM g LEFT JOIN b USING (k)),
+            f AS (SELECT k, {windows} FROM w {_WINDOWS}),
+            m AS (SELECT k, {values} FROM f),
+            h AS (
+                SELECT k // 60 AS hk, avg(soil) AS soil, avg(pump) AS pump,
+                       avg(auto) AS auto, avg(wifi_rssi) AS wifi_rssi
+                FROM m GROUP BY hk
+            ),
+            hw AS (SELECT hk AS k, soil, pump, auto, wifi_rssi FROM h),
+            hf AS (SELECT k, {hour_windows} FROM hw {_WINDOWS})
+            SELECT k, {hour_values} FROM hf ORDER BY k
+        """, params)
+        ts = (data['k'] * 3600000 - params['offset']) / 1000.0
+        return Window(ts, *(np.asarray(data[c], dtype=np.float64) for c in columns))
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+if __name__ == "__main__":
+    import os
+    import argparse
+    import tempfile
+    import migrations
+
+    ap = argparse.ArgumentParser(description='Benchmark DuckDB so với đường pandas + SQLite')
+    ap.add_argument('--rows', type=int, default=200000, help='số dòng logs giả lập (đã nén)')
+    ap.add_argument('--devices', type=int, default=5)
+    ap.add_argument('--days', type=int, default=30)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    db = os.path.join(tmp, 'bench.db')
+    migrations.migrate(db)
+
+    # Dữ liệu giống logs đã nén: khoảng cách 1s..120s, vài lần mất kết nối
+    rng = np.random.default_rng(0)
+    per_device = args.rows // args.devices
+    now = time.time()
+    con = sqlite3.connect(db)
+    for d in range(args.devices):
+        gaps = rng.integers(1, 120, per_device).astype(np.float64)
+        gaps[rng.random(per_device) < 0.001] = 1800
+        ts = now - args.days * 86400 + np.cumsum(gaps) * (args.days * 86400 / gaps.sum())
+        pump = ((ts // 3600) % 12 == 6).astype(int)
+        soil = np.clip(55 + np.cumsum(np.where(pump == 1, 0.3, -0.02)) % 30 + rng.normal(0, 0.2, per_device), 0, 100)
+        con.executemany(
+            "INSERT INTO logs(ts_ms,soil,pump,auto,wifi_connected,wifi_rssi,device) VALUES(?,?,?,1,1,?,?)",
+            [(int(t * 1000), float(s), int(p), int(r), f'esp32-{d}')
+             for t, s, p, r in zip(ts, soil, pump, rng.integers(-80, -40, per_device))])
+    con.commit()
+    con.close()
+    print(f"📦 {args.rows} dòng, {args.devices} thiết bị, {args.days} ngày")
+
+    def timed(fn):
+        t0 = time.perf_counter()
+        out = fn()
+        return out, (time.perf_counter() - t0) * 1000
+
+    from ml_models.anomaly_detection import AnomalyDetector
+    analytics = Analytics(db)
+    _, sync_ms = timed(analytics.sync)
+    print(f"🔄 sync lần đầu: {sync_ms:.0f} ms")
+
+    pandas_detector = AnomalyDetector(db)
+    duck_detector = AnomalyDetector(db, analytics=analytics)
+    hours = args.days * 24
+    print(f"\n{'truy vấn':<34}{'pandas (ms)':>14}{'duckdb (ms)':>14}{'khớp':>8}")
+
+    df, t_pd = timed(lambda: pandas_detector.load_recent_data(hours=hours))
+    rec, t_dk = timed(lambda: analytics.reconstruct(hours=hours))
+    same = len(df) == len(rec['soil']) and np.allclose(df['soil'].to_numpy(), rec['soil'])
+    print(f"{'reconstruct 5s (anomaly)':<34}{t_pd:>14.0f}{t_dk:>14.0f}{str(same):>8}")
+
+    X_pd, t_pd = timed(lambda: pandas_detector.isolation_features(pandas_detector.load_recent_data(hours=hours)))
+    X_dk, t_dk = timed(lambda: analytics.isolation_features(hours=hours))
+    same = X_pd.shape == X_dk.shape and np.allclose(X_pd, X_dk, atol=1e-6)
+    print(f"{'isolation features':<34}{t_pd:>14.0f}{t_dk:>14.0f}{str(same):>8}")
+
+    try:
+        from ml_models.soil_prediction import SoilMoistureLSTM
+        lstm = SoilMoistureLSTM(db)
+        hdf, t_pd = timed(lambda: lstm.load_data(days=args.days))
+        hw, t_dk = timed(lambda: analytics.hourly(days=args.days))
+        same = len(hdf) == len(hw.soil) and np.allclose(hdf['soil'].to_numpy(), hw.soil)
+        print(f"{'hourly (LSTM load_data)':<34}{t_pd:>14.0f}{t_dk:>14.0f}{str(same):>8}")
+    except ImportError:
+        hw, t_dk = timed(lambda: analytics.hourly(days=args.days))
+        print(f"{'hourly (LSTM load_data)':<34}{'(no TF)':>14}{t_dk:>14.0f}{'-':>8}")
+
+    fleet_sqlite, t_pd = timed(lambda: fleet_report(db, hours))
+    fleet_duck, t_dk = timed(lambda: fleet_report(db, hours, analytics))
+    print(f"{'fleet report (SQLite SQL)':<34}{t_pd:>14.0f}{t_dk:>14.0f}{str(fleet_sqlite == fleet_duck):>8}")
+    for r in fleet_duck[:3]:
+        print(f"   {r}")
@@ -1,69 +1,174 @@
+import os
 import json
+import math
+import atexit
 import sqlite3
 import time
 import requests
 import threading
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify
+from datetime import datetime, date
+from flask import Flask, Blueprint, Response, request, jsonify
 from flask_mqtt import Mqtt
+import settings
+import metrics
+import control
+import delivery
+import profiler
+import backfill
+import migrations
+import storage
+import export
+import zone_scheduler
+from logger import get_logger, fields
+from command_dispatcher import CommandDispatcher, ACK_WILDCARD, DEFAULT_DEVICE
+from ml_service import MLService, system_health
+from ml_models.fleet_anomaly import group_alerts
+from ring_buffer import RingStore
+from compression import Compressor
+from admission import Admission, THROTTLE_TOPIC, hint_payload
+from rules import RuleEngine
 
 # ================= CẤU HÌNH HỆ THỐNG =================
-DB = "tuoi.db"
-CHECK_INTERVAL = 5
+# Đọc từ biến môi trường (xem settings.py)
+DB = settings.DB
+CHECK_INTERVAL = settings.CHECK_INTERVAL
 
-# --- CẤU HÌNH TELEGRAM (Điền Token của bạn) ---
-TELEGRAM_TOKEN = "8308724139:AAEfo9b9MnrhExCvx1cjPJ-GuWgHSMyyk3M" 
-TELEGRAM_CHAT_ID = "5588486962"
+# --- CẤU HÌNH TELEGRAM ---
+TELEGRAM_TOKEN = settings.TELEGRAM_TOKEN
+TELEGRAM_CHAT_ID = settings.TELEGRAM_CHAT_ID
 
-app = Flask(__name__)
+bp = Blueprint("main", __name__)
+log = get_logger("app")
 
-# --- CẤU HÌNH MQTT ---
-app.config['MQTT_BROKER_URL'] = 'broker.hivemq.com'
-app.config['MQTT_BROKER_PORT'] = 1883
-app.config['MQTT_USERNAME'] = ''
-app.config['MQTT_PASSWORD'] = ''
-app.config['MQTT_KEEPALIVE'] = 5
-app.config['MQTT_TLS_ENABLED'] = False
+# logs theo thiết bị -> file shard (TUOI_SHARDS), nạp layout trong init_db
+log_store = storage.Storage(DB, paths=[])
+# MQTT client chỉ được kết nối trong process chạy background services
+mqtt = Mqtt()
+dispatcher = CommandDispatcher(DB, publish=None)
+# ML chạy trong process pool riêng, không chặn luồng report
+ml_service = MLService(DB, workers=settings.ML_WORKERS, timeout=settings.ML_TIMEOUT,
+                       min_refresh=settings.ML_MIN_REFRESH)
+# N reading gần nhất của mỗi thiết bị trong RAM (api_logs, scheduler, ML đọc từ đây)
+# Ring nhận reading gốc; dữ liệu nén đọc lại từ DB được nội suy về bước report
+ring_store = RingStore(capacity=settings.RING_CAPACITY,
+                       fill_step=settings.REPORT_INTERVAL,
+                       max_gap=settings.COMPRESS_HEARTBEAT * 1.5)
+# Chỉ ghi điểm quan trọng xuống logs (swinging door + heartbeat)
+compressor = Compressor(settings.COMPRESS_DEVIATION, settings.COMPRESS_HEARTBEAT)
+# Token bucket / thiết bị + giới hạn đồng thời cho report HTTP và MQTT
+gate = Admission(rate=settings.REPORT_RATE, burst=settings.REPORT_BURST,
+                 concurrency=settings.REPORT_CONCURRENCY, interval=settings.REPORT_INTERVAL,
+                 alert_cooldown=settings.ALERT_COOLDOWN)
+# Luật cảnh báo / ngưỡng trong bảng alert_rules (theo thiết bị / zone), tự nạp lại khi bảng đổi
+rule_engine = RuleEngine(DB, reload_interval=settings.RULES_RELOAD)
+# Số phiên /api/export đang chạy (mỗi phiên giữ 1 luồng worker tới khi client đọc xong)
+export_slots = threading.BoundedSemaphore(max(1, settings.EXPORT_CONCURRENCY))
+# CSS/JS có hash + vỏ HTML nén sẵn (nạp trong create_app)
+assets = delivery.AssetStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
 
-mqtt = Mqtt(app)
+# Lịch so le đã tính, theo (ngày, start, end, danh sách zone)
+_zone_plans = {}
+
+_services_started = False
+_services_lock = threading.Lock()
+_leader_lock_file = None
 
 # ================= DATABASE =================
 def init_db():
+    global log_store
     try:
-        con = sqlite3.connect(DB)
-        cur = con.cursor()
-        # Bảng cấu hình
-        cur.execute('''CREATE TABLE IF NOT EXISTS config(
-            id INTEGER PRIMARY KEY, 
-            auto INTEGER DEFAULT 1, 
-            use_schedule INTEGER DEFAULT 0,
-            start_time TEXT DEFAULT '06:00',
-            end_time TEXT DEFAULT '06:10',
-            pump_cmd INTEGER DEFAULT 0
-        )''')
-        cur.execute('INSERT OR IGNORE INTO config(id, auto) VALUES(1, 1)')
-        
-        # Bảng nhật ký
-        cur.execute('''CREATE TABLE IF NOT EXISTS logs(
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            ts TEXT, soil REAL, pump INTEGER, auto INTEGER, 
-            wifi_connected INTEGER DEFAULT 0, wifi_rssi INTEGER DEFAULT 0
-        )''')
-        con.commit()
-        con.close()
-        print("✅ Database initialized successfully!")
+        # Bảng config, logs, bảng ML: migration có version (migrations.py)
+        migrations.migrate(DB)
+        dispatcher.init_db()
+        rule_engine.reload(force=True)
+        log_store.close()
+        log_store = storage.ensure(DB, settings.SHARDS)
+        log.info("✅ Database initialized successfully!", extra=fields(db=DB, shards=len(log_store.paths) or 1))
     except Exception as e:
-        print(f"❌ DB Init Error: {e}")
+        log.error("❌ DB Init Error: %s", e)
 
-def append_log(soil, pump, auto, wifi_connected=1, wifi_rssi=-50):
+def _write_points(device, points, wifi_connected=1):
+    """Ghi các điểm (ts_epoch, soil, pump, auto, rssi) đã qua bộ nén"""
+    with metrics.DB_WRITE_SECONDS.time(op="append_log"):
+        log_store.insert([(int(round(ts * 1000)), soil, pump, auto, int(wifi_connected), rssi, device, None)
+                          for ts, soil, pump, auto, rssi in points])
+
+@profiler.traced("append_log")
+def append_log(soil, pump, auto, wifi_connected=1, wifi_rssi=-50, device=DEFAULT_DEVICE):
     try:
-        con = sqlite3.connect(DB)
-        con.execute("INSERT INTO logs(ts,soil,pump,auto,wifi_connected,wifi_rssi) VALUES(?,?,?,?,?,?)",
-                    (datetime.now().isoformat(), soil, int(pump), int(auto), int(wifi_connected), int(wifi_rssi)))
-        con.commit()
-        con.close()
-    except: pass
+        point = (datetime.now().timestamp(), float(soil), int(pump), int(auto), int(wifi_rssi))
+        points = compressor.add(device, point)
+        if points:
+            _write_points(device, points, wifi_connected)
+        metrics.INGEST_READINGS.inc(source="report")
+        metrics.INGEST_ROWS.inc(len(points), source="report")
+        if not _ring_from_db():
+            # Process khác cũng ghi logs: ring được đồng bộ từ DB trong _ring() để không bị lệch/trùng
+            ring_store.append(device, *point)
+        ml_service.notify_new_data()
+        return True
+    except Exception as e:
+        metrics.DB_ERRORS.inc(op="append_log")
+        log.error("❌ append_log lỗi: %s", e)
+        return False
+
+def append_bulk(device, readings):
+    """
+    Ghi 1 lô reading có thời điểm đo từ thiết bị (store-and-forward)
+
+    Idempotent theo (device, device_ts), 1 transaction. Dữ liệu đến trễ
+    được đưa vào ring buffer (rollup theo giờ tính lại nếu cần) và làm
+    mới cache ML (anomaly/predict).
+
+    Returns:
+        dict {inserted, updated, duplicates, rejected}
+    """
+    rows, rejected = backfill.normalize(readings)
+    metrics.INGEST_READINGS.inc(len(rows), source="bulk")
+    with metrics.DB_WRITE_SECONDS.time(op="append_bulk"):
+        con = log_store.connect(device)
+        try:
+            stats, applied = backfill.upsert(con, device, rows)
+        finally:
+            con.close()
+    stats["rejected"] = rejected
+    for result, key in (("inserted", "inserted"), ("updated", "updated"),
+                        ("duplicate", "duplicates"), ("rejected", "rejected")):
+        if stats[key]:
+            metrics.BULK_READINGS.inc(stats[key], result=result)
+
+    metrics.INGEST_ROWS.inc(len(applied), source="bulk")
+    if applied:
+        if not _ring_from_db():
+            ring_store.merge(log_store.path_for(device), device, [(ts / 1000, soil, pump, auto, rssi)
+                                          for ts, soil, pump, auto, rssi in applied])
+        ml_service.notify_new_data()
+    return stats
+
+def flush_compressor():
+    """Ghi các điểm bộ nén đang giữ (khi tắt server) -> không mất đoạn cuối"""
+    if not os.path.exists(DB):
+        return
+    for device, points in compressor.flush().items():
+        try:
+            _write_points(device, points)
+        except Exception as e:
+            log.error("❌ flush_compressor lỗi: %s", e, extra=fields(device=device))
+    log_store.close()
+
+atexit.register(flush_compressor)
 
+def _ring_from_db():
+    """Process khác cũng ghi logs (nhiều worker gunicorn / ingest_worker.py) -> ring đồng bộ từ DB"""
+    return settings.WORKERS > 1 or settings.INGEST == "worker"
+
+def _ring():
+    """RingStore đã cập nhật (nạp thêm các dòng do process khác ghi)"""
+    if _ring_from_db() and sum([ring_store.catch_up(path) for path in log_store.sources()]):
+        ml_service.notify_new_data()
+    return ring_store
+
+@profiler.traced("get_config")
 def get_config():
     con = sqlite3.connect(DB)
     cur = con.cursor()
@@ -80,6 +185,7 @@ def get_config():
         }
     return {"auto": 1, "pump_cmd": 0, "use_schedule": 0, "start": "06:00", "end": "06:10"}
 
+@metrics.timed(metrics.DB_WRITE_SECONDS, op="set_config")
 def set_config_db(**kwargs):
     con = sqlite3.connect(DB)
     for k, v in kwargs.items():
@@ -89,156 +195,646 @@ def set_config_db(**kwargs):
     con.close()
 
 # ================= TELEGRAM BOT =================
+def _post_telegram(url, data):
+    try:
+        with metrics.TELEGRAM_SECONDS.time():
+            r = requests.post(url, json=data, timeout=10)
+        metrics.TELEGRAM.inc(result="ok" if r.status_code == 200 else "http_error")
+    except Exception as e:
+        metrics.TELEGRAM.inc(result="error")
+        log.warning("⚠️ Telegram Error: %s", e)
+
 def send_telegram(message):
-    if "YOUR_BOT_TOKEN" in TELEGRAM_TOKEN: return
+    if "YOUR_BOT_TOKEN" in TELEGRAM_TOKEN:
+        metrics.TELEGRAM.inc(result="disabled")
+        return
     try:
         url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
         data = {"chat_id": TELEGRAM_CHAT_ID, "text": message, "parse_mode": "Markdown"}
         # Chạy trong thread riêng để không làm chậm server
-        threading.Thread(target=lambda: requests.post(url, json=data)).start()
+        threading.Thread(target=_post_telegram, args=(url, data), name="telegram", daemon=True).start()
     except Exception as e:
-        print(f"⚠️ Telegram Error: {e}")
+        metrics.TELEGRAM.inc(result="error")
+        log.warning("⚠️ Telegram Error: %s", e)
+
+# ================= ADMISSION CONTROL =================
+def _admit(source, device):
+    """Token bucket của thiết bị rồi tới slot đồng thời; ok -> phải gọi _release()"""
+    decision = gate.admit(device)
+    if decision.ok and not gate.acquire():
+        decision = gate.overloaded()
+    metrics.ADMISSION.inc(source=source, result=decision.reason or "accepted")
+    metrics.REPORTS_IN_FLIGHT.set(gate.in_flight)
+    return decision
+
+def _release():
+    gate.release()
+    metrics.REPORTS_IN_FLIGHT.set(gate.in_flight)
+
+def _too_many(decision):
+    """429 trả lời ngay, không chạm DB: thiết bị đọc Retry-After / report_interval rồi giãn nhịp"""
+    retry = str(max(1, math.ceil(decision.retry_after)))
+    return jsonify(dict(hint_payload(decision), status=decision.reason)), 429, {"Retry-After": retry}
+
+def _throttle_hint(device, decision):
+    """Báo thiết bị MQTT giãn nhịp gửi (tối đa 1 message / retry_after)"""
+    if mqtt.connected and gate.hint_due(device, decision):
+        mqtt.publish(THROTTLE_TOPIC.format(device=device), json.dumps(hint_payload(decision)))
+
+def _rule_alerts(device, reading):
+    # Luật alert khớp reading (rules.py), mỗi luật / thiết bị tối đa 1 tin Telegram / ALERT_COOLDOWN giây
+    for rule in rule_engine.evaluate(device, reading):
+        metrics.RULE_ALERTS.inc(severity=rule.rule.severity)
+        if gate.alert_allowed(device, rule.name):
+            send_telegram(rule_engine.message(rule, device, reading))
 
 # ================= MQTT HANDLERS =================
 @mqtt.on_connect()
 def handle_connect(client, userdata, flags, rc):
     if rc == 0:
-        print("✅ Connected to MQTT Broker")
-        mqtt.subscribe('tuoicay/report')
+        log.info("✅ Connected to MQTT Broker")
+        if settings.INGEST == "app":
+            # TUOI_INGEST=worker: report/bulk do ingest_worker.py nhận (shared subscription)
+            mqtt.subscribe('tuoicay/report')
+            mqtt.subscribe(backfill.BULK_WILDCARD, qos=1)
+        mqtt.subscribe(ACK_WILDCARD, qos=1)
+        # Gửi lại các lệnh chưa được ACK trong lúc mất kết nối
+        dispatcher.resend_unacked(timeout=0)
 
 @mqtt.on_message()
 def handle_mqtt_message(client, userdata, message):
     if message.topic == 'tuoicay/report':
+        with metrics.REPORT_SECONDS.time(source="mqtt"):
+            try:
+                data = json.loads(message.payload.decode())
+                if data.get('relay'):
+                    return  # report HTTP do chính server publish lại, đã ghi trong api_report
+                device = data.get('device', DEFAULT_DEVICE)
+                decision = _admit("mqtt", device)
+                if not decision.ok:
+                    _throttle_hint(device, decision)
+                    return  # vượt hạn mức: bỏ, không chạm DB / Telegram
+                try:
+                    reading = {'soil': float(data.get('soil', 0)), 'pump': int(data.get('pump', 0)),
+                               'auto': int(data.get('auto', 1))}
+                    ok = append_log(reading['soil'], reading['pump'], reading['auto'], device=device)
+                    dispatcher.register_device(device, defaults=get_config)
+                    _rule_alerts(device, reading)
+                finally:
+                    _release()
+                metrics.REPORTS.inc(source="mqtt", status="ok" if ok else "db_error")
+            except Exception as e:
+                metrics.MQTT_DROPPED.inc(topic="report")
+                metrics.REPORTS.inc(source="mqtt", status="dropped")
+                log.warning("⚠️ Bỏ MQTT report lỗi: %s", e, extra=fields(payload=message.payload[:100]))
+    elif message.topic.endswith('/bulk'):
+        device = message.topic.split('/')[1]
         try:
             data = json.loads(message.payload.decode())
-            append_log(data.get('soil', 0), data.get('pump', 0), data.get('auto', 1))
-        except: pass
+            readings = data.get('readings', []) if isinstance(data, dict) else data
+            stats = append_bulk(device, readings[:backfill.MAX_BATCH])
+            dispatcher.register_device(device, defaults=get_config)
+            # Thiết bị chỉ xoá dữ liệu đệm sau khi nhận bulk_ack
+            stats["batch"] = data.get("batch") if isinstance(data, dict) else None
+            mqtt.publish(backfill.BULK_ACK_TOPIC.format(device=device), json.dumps(stats), qos=1)
+        except Exception as e:
+            metrics.MQTT_DROPPED.inc(topic="bulk")
+            log.warning("⚠️ Bỏ MQTT bulk lỗi: %s", e, extra=fields(device=device))
+    elif message.topic.endswith('/ack'):
+        dispatcher.handle_ack(message.topic.split('/')[1], message.payload)
 
 # ================= SCHEDULER (ĐÃ CẬP NHẬT TELEGRAM) =================
+@metrics.timed(metrics.SCHEDULER_SECONDS)
+@profiler.traced("scheduler_tick")
+def scheduler_tick():
+    """1 lần kiểm tra tự động (Auto Moisture & Schedule)"""
+    cfg = get_config()
+    # Reading mới nhất (của thiết bị report gần nhất) lấy từ RAM, không query logs
+    latest = _ring().latest()
+    
+    current_soil = latest['soil'] if latest else 0
+
+    now = datetime.now().strftime("%H:%M")
+    if cfg['use_schedule'] == 1 and (settings.MAX_PUMPS or settings.MAX_FLOW):
+        # Nhiều zone chung nguồn nước: bật/tắt so le thay vì broadcast đồng loạt
+        staggered_schedule_tick(cfg)
+        dispatcher.resend_unacked()
+        return
+    # Ngưỡng bật / tắt bơm: luật pump_on / pump_off của thiết bị (mặc định SOIL_ON / SOIL_OFF)
+    decision = control.decide(cfg, current_soil, now, rule_engine.control_params(ring_store.last_device))
+
+    if decision is not None:
+        mode, val = decision
+        set_config_db(pump_cmd=val)
+        dispatcher.broadcast(pump_cmd=val)
+        metrics.SCHEDULER_DECISIONS.inc(mode=mode, action="on" if val else "off")
+
+        if mode == "schedule" and val:
+            log.info("⏰ Đến giờ hẹn (%s): BẬT BƠM", now)
+            send_telegram(f"⏰ *LỊCH HẸN*: Đã đến giờ tưới ({now}) -> **BẬT BƠM**")
+        elif mode == "schedule":
+            log.info("⏰ Hết giờ hẹn (%s): TẮT BƠM", now)
+            send_telegram(f"⏰ *LỊCH HẸN*: Đã hết giờ tưới ({now}) -> **TẮT BƠM**")
+        elif val:
+            log.info("🤖 Auto: Đất khô -> BẬT BƠM", extra=fields(soil=current_soil))
+            send_telegram(f"🤖 *AUTO*: Đất khô ({current_soil}%) -> **BẬT BƠM**")
+        else:
+            log.info("🤖 Auto: Đất ẩm -> TẮT BƠM", extra=fields(soil=current_soil))
+            send_telegram(f"🤖 *AUTO*: Đất đủ ẩm ({current_soil}%) -> **TẮT BƠM**")
+
+    # Gửi lại lệnh chưa được thiết bị ACK
+    dispatcher.resend_unacked()
+
+def _zone_plan(cfg, zone_ids, day):
+    """Lịch so le của 1 ngày (cache tới khi đổi giờ hẹn / danh sách zone)"""
+    key = (day, cfg['start'], cfg['end'], tuple(zone_ids))
+    plan = _zone_plans.get(key)
+    if plan is None:
+        start = zone_scheduler.to_minutes(cfg['start'])
+        duration = (zone_scheduler.to_minutes(cfg['end']) - start) % 1440
+        zones = [{"id": z, "duration": duration, "flow": settings.ZONE_FLOW,
+                  "earliest": start, "latest": start + settings.SCHEDULE_SPREAD} for z in zone_ids]
+        plan = zone_scheduler.schedule(zones, settings.MAX_PUMPS, settings.MAX_FLOW)
+        if plan.unscheduled:
+            log.warning("⚠️ %d zone không xếp được lịch", len(plan.unscheduled),
+                        extra=fields(day=str(day), unscheduled=len(plan.unscheduled)))
+        if len(_zone_plans) > 4:
+            _zone_plans.clear()
+        _zone_plans[key] = plan
+    return plan
+
+def staggered_schedule_tick(cfg):
+    """Bật/tắt từng zone theo lịch so le (giới hạn số bơm / lưu lượng)"""
+    zones = [d for d in dispatcher.devices() if d['use_schedule'] == 1]
+    if not zones:
+        return
+    zone_ids = [d['device_id'] for d in zones]
+    now = datetime.now()
+    minute = now.hour * 60 + now.minute
+    today = now.date()
+    yesterday = date.fromordinal(today.toordinal() - 1)
+    # Lịch của hôm qua có thể còn tràn sang hôm nay (qua đêm)
+    active = _zone_plan(cfg, zone_ids, today).active_at(minute) | \
+        _zone_plan(cfg, zone_ids, yesterday).active_at(minute + 1440)
+
+    turn_on = [d['device_id'] for d in zones if d['device_id'] in active and not d['pump_cmd']]
+    turn_off = [d['device_id'] for d in zones
+                if d['device_id'] not in active and d['pump_cmd'] and not d['auto']]
+    if turn_on:
+        dispatcher.set_state(turn_on, pump_cmd=1)
+        metrics.SCHEDULER_DECISIONS.inc(len(turn_on), mode="staggered", action="on")
+        log.info("⏰ Lịch so le: BẬT %d zone", len(turn_on), extra=fields(zones=turn_on[:20]))
+    if turn_off:
+        dispatcher.set_state(turn_off, pump_cmd=0)
+        metrics.SCHEDULER_DECISIONS.inc(len(turn_off), mode="staggered", action="off")
+        log.info("⏰ Lịch so le: TẮT %d zone", len(turn_off), extra=fields(zones=turn_off[:20]))
+
+    pump_cmd = 1 if active else 0
+    if pump_cmd != cfg['pump_cmd']:
+        set_config_db(pump_cmd=pump_cmd)
+        send_telegram(f"⏰ *LỊCH HẸN*: {'Bắt đầu' if pump_cmd else 'Kết thúc'} tưới so le "
+                      f"({len(zone_ids)} zone, tối đa {settings.MAX_PUMPS or '∞'} bơm cùng lúc)")
+
 def scheduler_loop():
     """Vòng lặp kiểm tra tự động (Auto Moisture & Schedule)"""
     while True:
         try:
-            cfg = get_config()
-            con = sqlite3.connect(DB)
-            cur = con.cursor()
-            cur.execute("SELECT soil FROM logs ORDER BY id DESC LIMIT 1")
-            row = cur.fetchone()
-            con.close()
-            
-            current_soil = row[0] if row else 0
-
-            # 1. Logic Hẹn Giờ (Ưu tiên cao nhất)
-            if cfg['use_schedule'] == 1:
-                now = datetime.now().strftime("%H:%M")
-                if cfg['start'] <= now <= cfg['end']:
-                    if cfg['pump_cmd'] == 0:
-                        print(f"⏰ Đến giờ hẹn ({now}): BẬT BƠM")
-                        set_config_db(pump_cmd=1)
-                        send_telegram(f"⏰ *LỊCH HẸN*: Đã đến giờ tưới ({now}) -> **BẬT BƠM**")
-                else:
-                    if cfg['pump_cmd'] == 1 and cfg['auto'] == 0: # Chỉ tắt nếu không phải auto moisture
-                        print(f"⏰ Hết giờ hẹn ({now}): TẮT BƠM")
-                        set_config_db(pump_cmd=0)
-                        send_telegram(f"⏰ *LỊCH HẸN*: Đã hết giờ tưới ({now}) -> **TẮT BƠM**")
-
-            # 2. Logic Tự Động Theo Độ Ẩm (Khi không dùng lịch)
-            elif cfg['auto'] == 1:
-                if current_soil < 45 and cfg['pump_cmd'] == 0:
-                    print("🤖 Auto: Đất khô -> BẬT BƠM")
-                    set_config_db(pump_cmd=1)
-                    send_telegram(f"🤖 *AUTO*: Đất khô ({current_soil}%) -> **BẬT BƠM**")
-                
-                elif current_soil > 60 and cfg['pump_cmd'] == 1:
-                    print("🤖 Auto: Đất ẩm -> TẮT BƠM")
-                    set_config_db(pump_cmd=0)
-                    send_telegram(f"🤖 *AUTO*: Đất đủ ẩm ({current_soil}%) -> **TẮT BƠM**")
-
+            scheduler_tick()
         except Exception as e:
-            print(f"Scheduler Error: {e}")
+            log.exception("Scheduler Error: %s", e)
         
         time.sleep(CHECK_INTERVAL)
 
 # ================= API =================
-@app.route("/")
+@bp.route("/")
 def index():
-    return render_template("index.html", config=get_config())
+    # Vỏ tĩnh, trạng thái lấy qua /api/config -> không query DB khi tải trang
+    return assets.page("index.html")
 
-@app.route("/ml")
+@bp.route("/ml")
 def ml_dashboard():
-    return render_template("ml_dashboard.html")
+    return assets.page("ml_dashboard.html")
 
-@app.route("/api/report", methods=["POST"])
+@bp.route("/static/<path:filename>")
+def static_file(filename):
+    return assets.static(filename)
+
+@bp.route("/api/report", methods=["POST"])
+@metrics.timed(metrics.REPORT_SECONDS, source="http")
 def api_report():
     try:
         data = request.json or request.form
+        device = data.get("device", DEFAULT_DEVICE)
+    except Exception as e:
+        metrics.REPORTS.inc(source="http", status="error")
+        log.warning("⚠️ Report lỗi: %s", e)
+        return jsonify({"status": "error"}), 500
+
+    decision = _admit("http", device)
+    if not decision.ok:
+        return _too_many(decision)
+    try:
         soil = float(data.get("soil", 0))
         pump = int(data.get("pump", 0))
         auto = int(data.get("auto", 0))
-        
-        append_log(soil, pump, auto, 1, int(data.get("wifi_rssi", -50)))
-        mqtt.publish('tuoicay/report', json.dumps(data))
-        print(f"📥 Wokwi: Soil {soil}% | Pump {pump}")
-        
-        # Cảnh báo khẩn cấp
-        if soil < 20 and pump == 0 and auto == 1:
-             send_telegram(f"🚨 *CẢNH BÁO*: Đất quá khô ({soil}%) mà bơm chưa bật! Kiểm tra ngay.")
+        rssi = int(data.get("wifi_rssi", -50))
+
+        ok = append_log(soil, pump, auto, 1, rssi, device=device)
+        dispatcher.register_device(device, defaults=get_config)
+        if mqtt.connected:
+            # Đánh dấu relay: ingestion (kể cả của server này) không ghi lại lần 2
+            mqtt.publish('tuoicay/report', json.dumps(dict(data, relay="http")))
+        metrics.REPORTS.inc(source="http", status="ok" if ok else "db_error")
+        log.debug("📥 Report", extra=fields(device=device, soil=soil, pump=pump))
 
-        return jsonify({"status": "ok"})
-    except: return jsonify({"status": "error"}), 500
+        _rule_alerts(device, {"soil": soil, "pump": pump, "auto": auto, "wifi_rssi": rssi})
+
+        # report_interval: chu kỳ gửi server muốn (giây), tăng khi thiết bị / server quá tải
+        return jsonify({"status": "ok", "report_interval": decision.report_interval})
+    except Exception as e:
+        metrics.REPORTS.inc(source="http", status="error")
+        log.warning("⚠️ Report lỗi: %s", e)
+        return jsonify({"status": "error"}), 500
+    finally:
+        _release()
+
+@bp.route("/api/report/bulk", methods=["POST"])
+@metrics.timed(metrics.REPORT_SECONDS, source="bulk")
+def api_report_bulk():
+    """ESP32 gửi các reading đã lưu trong lúc mất kết nối (kèm thời điểm đo)"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("readings"), list):
+        return jsonify({"status": "error", "error": "expected {device, readings: [...]}"}), 400
+    if len(data["readings"]) > backfill.MAX_BATCH:
+        return jsonify({"status": "error", "error": f"max {backfill.MAX_BATCH} readings / request"}), 413
+
+    device = data.get("device", DEFAULT_DEVICE)
+    # Gửi bù không tính token (1 lô / giây theo nhịp report) nhưng vẫn chiếm slot đồng thời
+    if not gate.acquire():
+        decision = gate.overloaded()
+        metrics.ADMISSION.inc(source="bulk", result=decision.reason)
+        return _too_many(decision)
+    metrics.REPORTS_IN_FLIGHT.set(gate.in_flight)
+    try:
+        stats = append_bulk(device, data["readings"])
+    except Exception as e:
+        metrics.DB_ERRORS.inc(op="append_bulk")
+        log.error("❌ append_bulk lỗi: %s", e, extra=fields(device=device))
+        return jsonify({"status": "error"}), 500
+    finally:
+        _release()
+    dispatcher.register_device(device, defaults=get_config)
+    log.info("📦 Bulk backfill", extra=fields(device=device, **stats))
+    return jsonify({"status": "ok", **stats})
 
-@app.route("/api/config", methods=["GET"])
+@bp.route("/api/config", methods=["GET"])
 def api_config():
     return jsonify(get_config())
 
-@app.route("/api/set", methods=["POST"])
+@bp.route("/api/devices", methods=["GET"])
+def api_devices():
+    return jsonify(dispatcher.devices(request.args.get("group")))
+
+@bp.route("/api/set", methods=["POST"])
 def api_set():
     data = request.json or request.form
-    mqtt_msg = {}
+    cmd = {}
     
     if 'pump_cmd' in data:
         val = int(data['pump_cmd'])
-        set_config_db(pump_cmd=val, auto=0, use_schedule=0)
-        mqtt_msg['pump'] = val
-        send_telegram(f"👨‍💻 *THỦ CÔNG*: Bạn đã **{'BẬT' if val else 'TẮT'}** bơm.")
+        cmd.update(pump_cmd=val, auto=0, use_schedule=0)
         
+    if 'auto' in data:
+        val = int(data['auto'])
+        cmd.update(auto=val, use_schedule=0)
+
+    if 'use_schedule' in data:
+        val = int(data['use_schedule'])
+        cmd.update(use_schedule=val, auto=0)
+
+    # Lệnh cho 1 nhóm / danh sách thiết bị: chỉ đổi state của các zone đó
+    if 'devices' in data or 'group' in data:
+        if 'group' in data:
+            changed = dispatcher.set_group(data['group'], **cmd)
+        else:
+            changed = dispatcher.set_state(data['devices'], **cmd)
+        return jsonify({"status": "ok", "changed": changed})
+
+    if 'pump_cmd' in data:
+        set_config_db(pump_cmd=cmd['pump_cmd'], auto=0, use_schedule=0)
+        send_telegram(f"👨‍💻 *THỦ CÔNG*: Bạn đã **{'BẬT' if cmd['pump_cmd'] else 'TẮT'}** bơm.")
+
     if 'auto' in data:
         val = int(data['auto'])
         set_config_db(auto=val, use_schedule=0)
-        mqtt_msg['auto'] = val
         send_telegram(f"⚙️ Chế độ: **{'TỰ ĐỘNG (Độ ẩm)' if val else 'THỦ CÔNG'}**")
 
     if 'use_schedule' in data:
         val = int(data['use_schedule'])
         set_config_db(use_schedule=val, auto=0)
         send_telegram(f"📅 Chế độ: **{'HẸN GIỜ' if val else 'THỦ CÔNG'}**")
-        
-    if mqtt_msg:
-        mqtt.publish('tuoicay/command', json.dumps(mqtt_msg))
 
-    return jsonify({"status": "ok"})
+    # Broadcast trạng thái mới (retained) cho toàn bộ thiết bị
+    changed = dispatcher.broadcast(**cmd) if cmd else []
+
+    return jsonify({"status": "ok", "changed": changed})
+
+@bp.route("/api/schedule/plan", methods=["POST"])
+def api_schedule_plan():
+    """
+    Xếp lịch so le cho danh sách zone (không gửi lệnh, chỉ trả timeline)
 
-@app.route("/api/logs", methods=["GET"])
+    Body: {"zones": [{id, duration | water_needed_mm, flow, earliest, latest, priority}],
+           "max_concurrent": 4, "max_flow": 40, "rain_skip": false}
+    """
+    data = request.get_json(silent=True) or {}
+    zones = data.get("zones")
+    if not isinstance(zones, list):
+        return jsonify({"status": "error", "error": "expected {zones: [...]}"}), 400
+    try:
+        plan = zone_scheduler.schedule(
+            zones,
+            max_concurrent=data.get("max_concurrent", settings.MAX_PUMPS),
+            max_flow=data.get("max_flow", settings.MAX_FLOW),
+            rain_skip=data.get("rain_skip", False))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"status": "error", "error": f"invalid zone: {e}"}), 400
+    return jsonify({"status": "success", **plan.to_dict()})
+
+@bp.route("/api/logs", methods=["GET"])
 def api_logs():
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
-    cur.execute("SELECT ts,soil,wifi_connected,wifi_rssi FROM logs ORDER BY id DESC LIMIT 50")
-    rows = list(reversed(cur.fetchall()))
-    con.close()
-    return jsonify([{"ts":r[0], "soil":r[1], "wifi_connected":1, "wifi_rssi":-50} for r in rows])
-
-# Placeholders
-@app.route("/api/ml/predict", methods=["GET"])
-def ml_predict(): return jsonify({"status": "success", "predictions": [], "summary": {"min":0,"max":0,"avg":0}})
-@app.route("/api/ml/recommendation", methods=["GET"])
-def ml_recommendation(): return jsonify({"status": "success", "recommendation": {"action": "NO_WATER", "reason": "Sim Mode", "confidence": 1.0}})
-@app.route("/api/ml/weather", methods=["GET"])
+    # 50 reading gần nhất của ?device= (mặc định: thiết bị report gần nhất), đọc từ RAM
+    w = _ring().window(request.args.get("device"), 50)
+    if w is None:
+        return jsonify([])
+    return jsonify([{"ts": datetime.fromtimestamp(t).isoformat(), "soil": s, "wifi_connected": 1, "wifi_rssi": -50}
+                    for t, s in zip(w.ts.tolist(), w.soil.tolist())])
+
+@bp.route("/api/export", methods=["GET"])
+def api_export():
+    """
+    Xuất lịch sử logs dạng stream (export.py), bộ nhớ cố định, không chặn luồng ghi
+
+    ?format=csv|ndjson|arrow  ?device=a&device=b | ?group=<nhóm zone>  (mặc định: mọi thiết bị)
+    ?start= / ?end=  epoch ms hoặc ISO ('2025-11-01', giờ địa phương), khoảng [start, end)
+    """
+    fmt = request.args.get("format", "csv")
+    if not export.available(fmt):
+        return jsonify({"status": "error", "error": f"format must be one of "
+                        f"{', '.join(f for f in export.FORMATS if export.available(f))}"}), 400
+    try:
+        start, end = export.parse_time(request.args.get("start")), export.parse_time(request.args.get("end"))
+    except ValueError as e:
+        return jsonify({"status": "error", "error": f"invalid start/end: {e}"}), 400
+    devices = [d for value in request.args.getlist("device") for d in value.split(",") if d]
+    if "group" in request.args:
+        devices += [d["device_id"] for d in dispatcher.devices(request.args["group"])]
+        if not devices:
+            return jsonify({"status": "error", "error": "group has no devices"}), 404
+
+    if not export_slots.acquire(blocking=False):
+        return jsonify({"status": "busy", "error": "too many exports running"}), 429, {"Retry-After": "30"}
+    session = export.Export(log_store, devices or None, start, end, settings.EXPORT_CHUNK)
+
+    def done():
+        # Gọi khi response đóng: đọc hết, client ngắt giữa chừng, hoặc chưa kịp đọc
+        session.close()
+        export_slots.release()
+        metrics.EXPORT_ROWS.inc(session.rows, format=fmt)
+        log.info("📤 Export", extra=fields(format=fmt, rows=session.rows, devices=len(devices) or "all"))
+
+    _, mimetype, ext = export.FORMATS[fmt]
+    response = Response(export.stream(session, fmt), mimetype=mimetype,
+                        headers={"Content-Disposition": f"attachment; filename=tuoi-logs.{ext}"})
+    response.call_on_close(done)
+    return response
+
+@bp.route("/metrics", methods=["GET"])
+def api_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
+# ================= LUẬT CẢNH BÁO =================
+@bp.route("/api/rules", methods=["GET"])
+def api_rules():
+    """Luật trong DB + luật mặc định (DEFAULT_RULES, bị ghi đè bởi luật cùng scope/target/name)"""
+    return jsonify({"status": "success", "rules": rule_engine.rules(),
+                    "defaults": rule_engine.defaults(), "stats": rule_engine.stats()})
+
+@bp.route("/api/rules", methods=["POST"])
+def api_rules_save():
+    """
+    Thêm / sửa 1 luật, có hiệu lực ngay (worker khác nạp lại sau TUOI_RULES_RELOAD giây)
+
+    Body: {"name": "dry", "scope": "device", "target": "zone-1",
+           "condition": "soil < 30 and pump == 0 and auto == 1", "action": "alert",
+           "severity": "CRITICAL", "message": "Đất khô ({soil}%) ở {device}", "enabled": 1}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "error": "expected {name, condition, ...}"}), 400
+    try:
+        rule = rule_engine.save(data)
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    log.info("📏 Lưu luật", extra=fields(rule=rule["id"], name=rule["name"], scope=rule["scope"]))
+    return jsonify({"status": "success", "rule": rule})
+
+@bp.route("/api/rules/<int:rule_id>", methods=["DELETE"])
+def api_rules_delete(rule_id):
+    if not rule_engine.delete(rule_id):
+        return jsonify({"status": "error", "error": "rule not found"}), 404
+    return jsonify({"status": "success"})
+
+# ================= ML (process pool) =================
+def _ml_window(kind, device):
+    """Dữ liệu đầu vào cho job ML lấy từ RingStore (None -> job tự đọc SQLite)"""
+    ring = _ring()
+    if kind == "anomaly":
+        return ring.window(device, copy=True) if ring.size(device) else None
+    # LSTM cần đủ sequence_length (24) giờ, chưa đủ thì đọc lịch sử từ DB
+    return ring.hourly(device, 24, copy=True) if ring.hours(device) >= 24 else None
+
+def _group_fleet_alerts(device, result):
+    """Alert của thiết bị đã nằm trong sự cố chung (cả site mất mạng, mưa...) -> gom thành 1"""
+    fleet, _, _ = ml_service.get("fleet_anomaly", 24)
+    if not fleet or not fleet["events"]:
+        return result
+    anomalies = group_alerts(device, result["anomalies"], fleet["events"])
+    return dict(result, anomalies=anomalies, system_health=system_health(anomalies))
+
+def _ml_response(kind, fallback):
+    """
+    Lấy kết quả từ MLService; nếu chưa có model / đang tính lần đầu
+    thì trả fallback (Sim Mode) để dashboard vẫn hiển thị được.
+    """
+    device = request.args.get("device") or ring_store.last_device
+    result, error, state = ml_service.get(kind, device, data=lambda: _ml_window(kind, device))
+    if kind == "anomaly" and result is not None:
+        result = _group_fleet_alerts(device, result)
+    body = dict(fallback if result is None else result)
+    body["status"] = "success"
+    body["ml_state"] = state
+    if error:
+        body["ml_error"] = error
+    return jsonify(body), (202 if state == "pending" else 200)
+
+@bp.route("/api/ml/predict", methods=["GET"])
+@metrics.timed(metrics.ML_SECONDS, endpoint="predict")
+def ml_predict():
+    return _ml_response("predict", {"predictions": [], "summary": {"min":0,"max":0,"avg":0}})
+
+@bp.route("/api/ml/recommendation", methods=["GET"])
+@metrics.timed(metrics.ML_SECONDS, endpoint="recommendation")
+def ml_recommendation():
+    return _ml_response("recommendation", {"recommendation": {"action": "NO_WATER", "reason": "Sim Mode", "suggested_duration": "0 phút", "confidence": 1.0}})
+
+# Placeholder
+@bp.route("/api/ml/weather", methods=["GET"])
+@metrics.timed(metrics.ML_SECONDS, endpoint="weather")
 def ml_weather(): return jsonify({"status": "success", "current": {"temp": 30, "humidity": 70}, "irrigation_impact": {"should_skip": False, "reason": "OK"}})
-@app.route("/api/ml/anomaly", methods=["GET"])
-def ml_anomaly(): return jsonify({"status": "success", "anomalies": [], "system_health": "GOOD"})
+@bp.route("/api/ml/anomaly", methods=["GET"])
+@metrics.timed(metrics.ML_SECONDS, endpoint="anomaly")
+def ml_anomaly():
+    return _ml_response("anomaly", {"anomalies": [], "system_health": "GOOD"})
 
-if __name__ == "__main__":
+@bp.route("/api/ml/fleet/anomaly", methods=["GET"])
+@metrics.timed(metrics.ML_SECONDS, endpoint="fleet_anomaly")
+def ml_fleet_anomaly():
+    """Sự cố chung nhiều thiết bị theo site: mất kết nối, WiFi yếu, mưa"""
+    hours = min(max(request.args.get("hours", 24, type=int), 1), 24 * 7)
+    result, error, state = ml_service.get("fleet_anomaly", hours)
+    body = dict(result or {"events": [], "offline": [], "summary": {}})
+    body.update(status="success", hours=hours, ml_state=state)
+    if error:
+        body["ml_error"] = error
+    return jsonify(body), (202 if state == "pending" else 200)
+
+@bp.route("/api/report/fleet", methods=["GET"])
+@metrics.timed(metrics.ML_SECONDS, endpoint="fleet")
+def report_fleet():
+    """Tổng hợp theo thiết bị (chạy trong ML pool, DuckDB nếu TUOI_ANALYTICS=1)"""
+    hours = min(max(request.args.get("hours", 24, type=int), 1), 24 * settings.ANALYTICS_DAYS)
+    result, error, state = ml_service.get("fleet", hours)
+    body = dict(result or {"devices": []})
+    body.update(status="success", hours=hours, ml_state=state)
+    if error:
+        body["ml_error"] = error
+    return jsonify(body), (202 if state == "pending" else 200)
+
+# ================= ADMIN: PROFILER =================
+@bp.route("/api/admin/profile", methods=["POST"])
+def api_admin_profile():
+    """
+    Lấy mẫu stack mọi thread trong ?seconds= (mặc định 10, tối đa 60) ở ?hz=
+
+    ?format=collapsed -> text cho flamegraph.pl / speedscope, json (mặc định) -> thống kê + timing
+    """
+    if not settings.ADMIN_TOKEN or request.headers.get("X-Admin-Token") != settings.ADMIN_TOKEN:
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    session = profiler.profile(request.args.get("seconds", settings.PROFILE_SECONDS, type=float),
+                               request.args.get("hz", settings.PROFILE_HZ, type=int))
+    if session is None:
+        return jsonify({"status": "error", "message": "Đang có phiên profile khác"}), 409
+    if request.args.get("format") == "collapsed":
+        return Response(session.collapsed(), mimetype="text/plain")
+    return jsonify(dict(session.summary(), status="success"))
+
+# ================= APP FACTORY =================
+def create_app(config=None):
+    """
+    Tạo Flask app (dùng cho wsgi.py / gunicorn / dev server)
+
+    Args:
+        config: dict ghi đè app.config (vd {"TUOI_DB": "test.db", "TUOI_START_SERVICES": False})
+    """
+    global DB
+
+    # static/ do AssetStore phục vụ (hash + nén sẵn), không dùng route mặc định của Flask
+    app = Flask(__name__, static_folder=None)
+    app.config.from_mapping(settings.flask_config())
+    app.config.update(config or {})
+
+    DB = app.config["TUOI_DB"]
+    dispatcher.db_path = DB
+    ml_service.db_path = DB
+    rule_engine.db_path = DB
+
+    app.register_blueprint(bp)
+    app.after_request(lambda response: delivery.compress_json(response, settings.GZIP_MIN_SIZE))
+    assets.load(app)
     init_db()
-    threading.Thread(target=scheduler_loop, daemon=True).start()
+    _load_ring()
+
+    if app.config["TUOI_START_SERVICES"]:
+        start_background_services(app)
+    _install_profile_signal()
+
+    return app
+
+def _install_profile_signal():
+    """`kill -USR2 <pid>` -> profile PROFILE_SECONDS giây, ghi vào PROFILE_DIR"""
+    import signal
+    signum = getattr(signal, settings.PROFILE_SIGNAL, None) if settings.PROFILE_SIGNAL else None
+    if signum is None or threading.current_thread() is not threading.main_thread():
+        return
+    profiler.install_signal(signum, settings.PROFILE_DIR, settings.PROFILE_SECONDS, settings.PROFILE_HZ)
+
+def _load_ring():
+    """Nạp N reading gần nhất của mỗi thiết bị từ DB vào RingStore"""
+    try:
+        ring_store.clear()
+        # Mỗi file logs (shard) nạp các thiết bị của nó, watermark riêng từng file
+        for path in log_store.sources():
+            con = sqlite3.connect(path)
+            devices = [r[0] for r in con.execute("SELECT DISTINCT device FROM logs")]  # idx_logs_device_time
+            con.close()
+            ring_store.load_from_db(path, devices)
+        log.info("✅ Ring buffer loaded", extra=fields(devices=len(ring_store.devices()), rows=len(ring_store)))
+    except Exception as e:
+        log.error("❌ Ring buffer load error: %s", e)
+
+def _acquire_leader_lock(path):
+    """
+    Chỉ 1 process (trong N worker gunicorn) được chạy scheduler + MQTT.
+    Dùng file lock của OS, tự nhả khi process chết.
+    """
+    global _leader_lock_file
+    try:
+        import fcntl
+    except ImportError:
+        return True  # Windows: chỉ chạy 1 process
+
+    f = open(path, "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _leader_lock_file = f
+    return True
+
+def start_background_services(app):
+    """Khởi động scheduler + MQTT client đúng 1 lần"""
+    global _services_started
+
+    with _services_lock:
+        if _services_started:
+            return False
+        _services_started = True
+
+        if not _acquire_leader_lock(os.path.abspath(DB) + ".services.lock"):
+            # Worker phụ: lệnh được ghi vào device_state, leader sẽ publish
+            log.info("ℹ️ Worker %s: scheduler/MQTT đang chạy ở process khác", os.getpid())
+            return False
+
+        mqtt.init_app(app)
+        dispatcher.publish = mqtt.publish
+        threading.Thread(target=scheduler_loop, name="scheduler", daemon=True).start()
+        log.info("🚀 Scheduler & MQTT đang chạy (pid %s)", os.getpid())
+        return True
+
+if __name__ == "__main__":
+    # Dev server (debug). Production: python wsgi.py hoặc gunicorn (xem README)
+    app = create_app()
     print("🚀 Server & Telegram Bot đang chạy...")
-    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
\ No newline at end of file
+    app.run(host=settings.HOST, port=settings.PORT, debug=True, use_reloader=False)
\ No newline at end of file
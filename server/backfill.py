@@ -0,0 +1,118 @@
+import time
+from datetime import datetime
+
+# ================= BULK BACKFILL (STORE-AND-FORWARD) =================
+# ESP32 lưu reading khi mất WiFi, khi có mạng lại gửi cả lô kèm thời điểm đo
+# (device_ts). Ghi idempotent theo (device, device_ts): gửi lại 1 lô nhiều lần
+# (retry HTTP, MQTT QoS 1 redelivery) không tạo dòng trùng.
+# Không nén swinging door: kết quả nén phụ thuộc cách chia lô -> gửi lại theo
+# lô khác sẽ thêm dòng mới, mất tính idempotent. 1 reading = 1 dòng.
+
+BULK_TOPIC = 'tuoicay/{device}/bulk'
+BULK_WILDCARD = 'tuoicay/+/bulk'
+BULK_ACK_TOPIC = 'tuoicay/{device}/bulk_ack'
+
+MAX_BATCH = 5000          # reading / request
+MAX_FUTURE = 300          # giây: cho phép lệch đồng hồ thiết bị
+MIN_TS = 1577836800       # 2020-01-01: trước đó = ESP32 chưa đồng bộ NTP
+_CHUNK = 500              # số tham số cho 1 câu IN (...) (giới hạn của SQLite)
+
+
+def parse_ts(value):
+    """
+    Thời điểm đo từ thiết bị -> epoch milliseconds
+
+    Nhận epoch giây (int/float), epoch ms (> 1e11) hoặc chuỗi ISO 8601
+    """
+    if isinstance(value, bool) or value is None:
+        raise ValueError('missing ts')
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+        if seconds > 1e11:
+            seconds /= 1000
+    else:
+        seconds = datetime.fromisoformat(str(value)).timestamp()
+    if not MIN_TS <= seconds <= time.time() + MAX_FUTURE:
+        raise ValueError(f'ts out of range: {value}')
+    return int(round(seconds * 1000))
+
+
+def normalize(readings):
+    """
+    Kiểm tra + chuẩn hoá 1 lô reading
+
+    Returns:
+        (rows, rejected): rows = [(device_ts_ms, soil, pump, auto, rssi)] đã sắp
+        theo thời gian, trùng device_ts trong cùng lô thì giữ bản cuối
+    """
+    by_ts = {}
+    rejected = 0
+    for r in readings:
+        try:
+            ts = parse_ts(r.get('ts'))
+            soil = float(r.get('soil', 0))
+            if not 0 <= soil <= 100:
+                raise ValueError('soil out of range')
+            by_ts[ts] = (ts, soil, int(r.get('pump', 0)), int(r.get('auto', 1)), int(r.get('wifi_rssi', -50)))
+        except (AttributeError, TypeError, ValueError):
+            rejected += 1
+    return [by_ts[ts] for ts in sorted(by_ts)], rejected
+
+
+def upsert(con, device, rows):
+    """
+    Ghi 1 lô vào logs trong 1 transaction
+
+    - Chưa có (device, device_ts) -> INSERT
+    - Đã có, giá trị khác -> UPDATE (thiết bị gửi bản sửa)
+    - Đã có, giống hệt -> bỏ qua (gửi lại)
+
+    Returns:
+        (stats, applied): applied = các dòng thực sự thêm/sửa (theo thời gian)
+    """
+    stats = {'inserted': 0, 'updated': 0, 'duplicates': 0}
+    applied = []
+    if not rows:
+        return stats, applied
+
+    cur = con.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        existing = {}
+        keys = [r[0] for r in rows]
+        for i in range(0, len(keys), _CHUNK):
+            chunk = keys[i:i + _CHUNK]
+            cur.execute(
+                f"SELECT device_ts, soil, pump, auto, wifi_rssi FROM logs "
+                f"WHERE device=? AND device_ts IN ({','.join('?' * len(chunk))})", [device] + chunk)
+            for ts, *values in cur.fetchall():
+                existing[ts] = tuple(values)
+
+        inserts, updates = [], []
+        for row in rows:
+            old = existing.get(row[0])
+            if old is None:
+                inserts.append(row)
+            elif old != row[1:]:
+                updates.append(row)
+            else:
+                stats['duplicates'] += 1
+                continue
+            applied.append(row)
+
+        # Bản sửa: xoá rồi ghi lại -> có id mới, worker khác thấy qua RingStore.catch_up
+        cur.executemany("DELETE FROM logs WHERE device=? AND device_ts=?",
+                        [(device, r[0]) for r in updates])
+        cur.executemany(
+            "INSERT INTO logs(ts_ms,soil,pump,auto,wifi_connected,wifi_rssi,device,device_ts) "
+            "VALUES(?,?,?,?,1,?,?,?) ON CONFLICT(device, device_ts) DO NOTHING",
+            [(ts, soil, pump, auto, rssi, device, ts)
+             for ts, soil, pump, auto, rssi in applied])
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+    stats['inserted'] = len(inserts)
+    stats['updated'] = len(updates)
+    return stats, applied
@@ -0,0 +1,343 @@
+"""
+Backtest walk-forward (rolling origin) cho các model dự đoán độ ẩm
+
+- Mỗi zone: các mốc cắt cách nhau --step giờ; tại mỗi mốc model fit trên dữ
+  liệu TRƯỚC mốc, dự đoán --horizon giờ tới, so với thực tế (chỉ tính các giờ
+  trước lần bơm kế tiếp, giống ZoneForecaster - model giả định không tưới thêm)
+- Mọi model dùng chung các mốc -> so sánh công bằng
+- Ma trận feature theo giờ lấy 1 lần từ FeatureStore, cache ra .npz theo
+  watermark id của logs -> chạy lại / đổi model không đọc lại SQLite;
+  mỗi worker nhận ma trận 1 lần (initializer), task chỉ gửi tên zone
+- Song song: mỗi task = (model, zone) chạy hết các mốc của zone đó
+- Báo cáo MAE / RMSE theo từng giờ dự đoán, CPU ms fit + dự đoán, bộ nhớ
+  đỉnh (tracemalloc), và xếp hạng độ chính xác theo chi phí CPU (Pareto)
+
+Model: tên trong ml_models.forecasters.MODELS (+ lstm nếu có TensorFlow và
+models/lstm_best.h5 - model đã train sẵn, không fit lại theo mốc), tham số
+qua `tên:khoá=giá trị,...`.
+
+    python backtest.py --synthetic 30 --zones 40
+    python backtest.py --db tuoi.db --days 30 --models persistence holt:phi=0.8 lag_boosting:max_iter=120
+    python backtest.py --db tuoi.db --cache bt_features.npz --save bt.json --workers 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from ml_models.feature_store import HOURLY_FEATURES
+from ml_models.forecasters import MODELS, HORIZON, horizon_errors, pump_free_steps
+import migrations
+import settings
+import storage
+
+DEFAULT_MODELS = ('persistence', 'holt', 'drying_curve', 'lag_boosting')
+
+
+# ================= MODEL =================
+def parse_spec(spec):
+    """'lag_boosting:max_iter=120,max_depth=4' -> ('lag_boosting', {'max_iter': 120, 'max_depth': 4})"""
+    name, _, rest = spec.partition(':')
+    if name not in MODELS and name != 'lstm':
+        raise ValueError(f"Model không tồn tại: {name} (có: {', '.join([*MODELS, 'lstm'])})")
+    kwargs = {}
+    for item in filter(None, rest.split(',')):
+        key, _, value = item.partition('=')
+        try:
+            kwargs[key] = literal_eval(value)
+        except (ValueError, SyntaxError):
+            kwargs[key] = value
+    return name, kwargs
+
+
+def make_model(spec, db_path=None):
+    name, kwargs = parse_spec(spec)
+    if name == 'lstm':
+        from ml_models.forecasters import LSTMTier
+        from ml_models.soil_prediction import SoilMoistureLSTM
+        model = _WORKER.get('lstm')
+        if model is None:
+            model = _WORKER['lstm'] = LSTMTier(SoilMoistureLSTM(db_path=db_path or 'tuoi.db', **kwargs))
+        return model
+    return MODELS[name](**kwargs)
+
+
+# ================= DỮ LIỆU =================
+def list_zones(db_path):
+    con = storage.connect(db_path)
+    try:
+        return [r[0] for r in con.execute(
+            "SELECT DISTINCT device FROM logs WHERE device IS NOT NULL ORDER BY device")]
+    finally:
+        con.close()
+
+
+def _watermark(db_path):
+    # Có shard: MAX(id) / COUNT(*) trên view gộp, đủ để biết logs đã đổi
+    con = storage.connect(db_path)
+    try:
+        return con.execute("SELECT COALESCE(MAX(id), 0), COUNT(*) FROM logs").fetchone()
+    finally:
+        con.close()
+
+
+def load_windows(db_path, days=30, zones=None, cache=None):
+    """
+    zone -> ma trận HOURLY_FEATURES `days` ngày cuối (FeatureStore)
+
+    cache: file .npz; dùng lại nếu cùng db, số ngày và watermark (MAX(id), COUNT) của logs
+    """
+    key = json.dumps([os.path.abspath(db_path), days, list(_watermark(db_path))])
+    if cache and not cache.endswith('.npz'):
+        cache += '.npz'
+    if cache and os.path.exists(cache):
+        with np.load(cache, allow_pickle=False) as data:
+            if str(data['__key__']) == key:
+                windows = {k: data[k] for k in data.files if k != '__key__'}
+                if zones is None or all(z in windows for z in zones):
+                    print(f"📦 Feature cache: {cache}")
+                    return {z: windows[z] for z in (zones or windows)}
+
+    from ml_models.feature_store import FeatureStore
+    store = FeatureStore(db_path, hourly_days=days)
+    windows = {}
+    for zone in zones or list_zones(db_path):
+        _, X = store.hourly(zone, days=days)
+        if len(X):
+            windows[zone] = np.array(X)
+    if cache:
+        np.savez(cache, __key__=np.array(key), **windows)
+        print(f"💾 Feature cache: {cache}")
+    return windows
+
+
+def synthetic_windows(days=30, zones=20, seed=42):
+    """Zone giả lập: khô dần (nhanh hơn buổi trưa, tốc độ khác nhau), tưới lúc 6h khi < 45%"""
+    rng = np.random.default_rng(seed)
+    hours = int(days * 24)
+    hour = np.arange(hours) % 24
+    day = np.arange(hours) // 24 % 7
+    windows = {}
+    for z in range(zones):
+        rate = rng.uniform(0.3, 1.2)
+        soil, pump = np.empty(hours), np.zeros(hours)
+        value = rng.uniform(50, 70)
+        for t in range(hours):
+            pump[t] = hour[t] == 6 and value < 45
+            value += 20.0 if pump[t] else -rate * (0.5 + np.sin(np.pi * max(hour[t] - 6, 0) / 12) ** 2)
+            value = min(max(value + rng.normal(0, 0.3), 0), 100)
+            soil[t] = value
+        windows[f'zone-{z:02d}'] = np.column_stack([
+            soil, pump, np.ones(hours), rng.normal(-60, 3, hours), hour, day, day >= 5]).astype(np.float64)
+    return windows
+
+
+def cutoffs(X, horizon=HORIZON, step=24, count=None, min_train=72):
+    """Các mốc cắt (chỉ số giờ) từ mới về cũ; bỏ mốc mà giờ đầu tiên đã bơm (không có gì để chấm)"""
+    out = []
+    for origin in range(len(X) - horizon, min_train - 1, -step):
+        if pump_free_steps(X[origin:origin + horizon]) > 0:
+            out.append(origin)
+            if count and len(out) >= count:
+                break
+    return out
+
+
+# ================= CHẠY (TRONG WORKER) =================
+_WORKER = {}
+
+
+def _init(windows, db_path):
+    # 1 thread / worker: OpenMP của sklearn không tranh CPU giữa các worker,
+    # CPU ms đo được là chi phí thật của 1 model
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    _WORKER.update(windows=windows, db_path=db_path)
+
+
+def evaluate(spec, X, origins, horizon=HORIZON, db_path=None):
+    """
+    Chạy 1 model trên các mốc của 1 zone
+
+    Returns: dict errors (mốc x giờ, NaN = không chấm), cpu_ms / wall_ms từng mốc, peak_kb
+    """
+    errors = np.full((len(origins), horizon), np.nan)
+    cpu, wall, peak = [], [], 0
+    for i, origin in enumerate(origins):
+        model = make_model(spec, db_path)
+        if origin < model.min_rows:
+            continue
+        history = X[:origin]
+        # tracemalloc làm chậm -> chỉ đo bộ nhớ ở mốc đầu, thời gian ở các mốc còn lại
+        traced = not peak
+        if traced:
+            tracemalloc.start()
+        c0, w0 = time.process_time(), time.perf_counter()
+        predicted = model.fit(history).forecast(history, horizon)
+        c1, w1 = time.process_time(), time.perf_counter()
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if not traced or len(origins) == 1:
+            cpu.append((c1 - c0) * 1000)
+            wall.append((w1 - w0) * 1000)
+        errors[i] = horizon_errors(predicted, X[origin:origin + horizon])
+    return {'errors': errors, 'cpu_ms': cpu, 'wall_ms': wall, 'peak_kb': peak / 1024}
+
+
+def _run(task):
+    spec, zone, origins, horizon = task
+    return spec, zone, evaluate(spec, _WORKER['windows'][zone], origins, horizon, _WORKER['db_path'])
+
+
+def run(windows, specs, horizon=HORIZON, step=24, count=None, min_train=72, workers=None, db_path=None):
+    """Chạy mọi (model, zone) song song -> {spec: [(zone, kết quả evaluate)]}"""
+    tasks = []
+    for zone, X in windows.items():
+        origins = cutoffs(X, horizon, step, count, min_train)
+        if origins:
+            tasks.extend((spec, zone, origins, horizon) for spec in specs)
+    results = {spec: [] for spec in specs}
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks) or 1))
+    if workers == 1:
+        _init(windows, db_path)
+        outputs = map(_run, tasks)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(windows, db_path))
+        # Task nặng (lag_boosting, lstm) trước -> không còn 1 task dài chạy một mình ở cuối
+        tasks.sort(key=lambda t: -getattr(MODELS.get(parse_spec(t[0])[0]), 'cost', 9))
+        outputs = pool.map(_run, tasks, chunksize=max(1, len(tasks) // (workers * 8)))
+    try:
+        for spec, zone, result in outputs:
+            results[spec].append((zone, result))
+    finally:
+        if workers > 1:
+            pool.shutdown()
+    return results
+
+
+# ================= BÁO CÁO =================
+def summarize(results):
+    """MAE / RMSE theo giờ dự đoán + chi phí của từng model, đánh dấu Pareto (không model nào vừa rẻ hơn vừa đúng hơn)"""
+    report = {}
+    for spec, parts in results.items():
+        if not parts:
+            continue
+        errors = np.vstack([r['errors'] for _, r in parts])
+        valid = np.isfinite(errors)
+        count = valid.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mae_h = np.nansum(np.abs(errors), axis=0) / count
+            rmse_h = np.sqrt(np.nansum(errors ** 2, axis=0) / count)
+        cpu = [c for _, r in parts for c in r['cpu_ms']]
+        wall = [w for _, r in parts for w in r['wall_ms']]
+        report[spec] = {
+            'forecasts': int(valid.any(axis=1).sum()),
+            'mae': round(float(np.nanmean(np.abs(errors))), 3) if valid.any() else None,
+            'rmse': round(float(np.sqrt(np.nanmean(errors ** 2))), 3) if valid.any() else None,
+            'mae_by_hour': [None if n == 0 else round(float(v), 3) for v, n in zip(mae_h, count)],
+            'rmse_by_hour': [None if n == 0 else round(float(v), 3) for v, n in zip(rmse_h, count)],
+            'count_by_hour': count.tolist(),
+            'cpu_ms': round(float(np.mean(cpu)), 3) if cpu else None,
+            'wall_ms': round(float(np.mean(wall)), 3) if wall else None,
+            'peak_kb': round(max(r['peak_kb'] for _, r in parts), 1),
+            'zones': {zone: round(float(np.nanmean(np.abs(r['errors']))), 3)
+                      for zone, r in parts if np.isfinite(r['errors']).any()},
+        }
+    scored = [(s, r) for s, r in report.items() if r['mae'] is not None and r['cpu_ms'] is not None]
+    for spec, r in scored:
+        r['pareto'] = not any(o['mae'] <= r['mae'] and o['cpu_ms'] <= r['cpu_ms'] and
+                              (o['mae'] < r['mae'] or o['cpu_ms'] < r['cpu_ms']) for _, o in scored)
+    return report
+
+
+def recommend(report, target_mae):
+    """Giống ZoneForecaster: model rẻ nhất đạt target, không có thì MAE thấp nhất"""
+    scored = [(s, r) for s, r in report.items() if r['mae'] is not None and r['cpu_ms'] is not None]
+    if not scored:
+        return None
+    ok = [(s, r) for s, r in scored if r['mae'] <= target_mae]
+    if ok:
+        return min(ok, key=lambda x: x[1]['cpu_ms'])[0]
+    return min(scored, key=lambda x: x[1]['mae'])[0]
+
+
+def print_report(report, horizon, hours=(1, 3, 6, 12, 24)):
+    hours = [h for h in hours if h <= horizon]
+    head = ''.join(f"{f'MAE h{h}':>9}" for h in hours)
+    print(f"\n{'model':<32}{'dự đoán':>8}{'MAE':>8}{'RMSE':>8}{head}{'CPU ms':>10}{'wall ms':>10}{'peak KB':>10}")
+    for spec, r in sorted(report.items(), key=lambda x: (x[1]['cpu_ms'] is None, x[1]['cpu_ms'] or 0)):
+        by_hour = ''.join(f"{'-' if r['mae_by_hour'][h - 1] is None else r['mae_by_hour'][h - 1]:>9}" for h in hours)
+        mark = ' ★' if r.get('pareto') else ''
+        print(f"{spec + mark:<32}{r['forecasts']:>8}{r['mae'] if r['mae'] is not None else '-':>8}"
+              f"{r['rmse'] if r['rmse'] is not None else '-':>8}{by_hour}"
+              f"{r['cpu_ms'] if r['cpu_ms'] is not None else '-':>10}"
+              f"{r['wall_ms'] if r['wall_ms'] is not None else '-':>10}{r['peak_kb']:>10}")
+    print("★ = Pareto: không model nào vừa rẻ hơn vừa chính xác hơn")
+
+
+# ================= CLI =================
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--db', help='đọc logs từ database này')
+    ap.add_argument('--synthetic', type=float, help='dùng dữ liệu giả lập N ngày')
+    ap.add_argument('--zones', nargs='*', help='tên thiết bị (mặc định: tất cả); với --synthetic: số zone')
+    ap.add_argument('--days', type=float, default=30, help='lịch sử N ngày cuối của mỗi zone')
+    ap.add_argument('--models', nargs='*', default=list(DEFAULT_MODELS), help='vd holt:phi=0.8 lag_boosting:max_iter=120')
+    ap.add_argument('--horizon', type=int, default=HORIZON, help='số giờ dự đoán')
+    ap.add_argument('--step', type=int, default=11, help='khoảng cách giữa 2 mốc cắt (giờ, lệch giờ trong ngày)')
+    ap.add_argument('--cutoffs', type=int, help='tối đa N mốc / zone (mới nhất)')
+    ap.add_argument('--min-train', type=int, default=72, help='số giờ lịch sử tối thiểu trước mốc đầu')
+    ap.add_argument('--target-mae', type=float, default=settings.FORECAST_MAE, help='MAE chấp nhận được (%%)')
+    ap.add_argument('--cache', help='file .npz cache feature theo giờ')
+    ap.add_argument('--workers', type=int, help='số process (mặc định = số CPU)')
+    ap.add_argument('--save', help='ghi báo cáo JSON')
+    ap.add_argument('--seed', type=int, default=42)
+    args = ap.parse_args(argv)
+
+    for spec in args.models:
+        parse_spec(spec)
+    t0 = time.perf_counter()
+    if args.db:
+        if not os.path.exists(args.db):
+            ap.error(f"không tìm thấy {args.db}")
+        migrations.migrate(args.db)
+        windows = load_windows(args.db, args.days, args.zones or None, args.cache)
+    else:
+        count = int(args.zones[0]) if args.zones else 20
+        windows = synthetic_windows(args.synthetic or args.days, count, args.seed)
+    hours = sum(len(X) for X in windows.values())
+    print(f"📼 {len(windows)} zone, {hours} giờ dữ liệu ({time.perf_counter() - t0:.2f}s), {len(args.models)} model")
+
+    t0 = time.perf_counter()
+    results = run(windows, args.models, args.horizon, args.step, args.cutoffs, args.min_train, args.workers, args.db)
+    wall = time.perf_counter() - t0
+    report = summarize(results)
+    if not report:
+        print("⚠️ Không đủ dữ liệu cho mốc cắt nào (giảm --min-train / --horizon?)")
+        return 1
+
+    print_report(report, args.horizon)
+    best = recommend(report, args.target_mae)
+    if best is not None:
+        reached = report[best]['mae'] <= args.target_mae
+        print(f"\n💡 {'Rẻ nhất đạt' if reached else 'Không model nào đạt'} MAE <= {args.target_mae}: "
+              f"{best if reached else 'chính xác nhất là ' + best} (MAE {report[best]['mae']}, "
+              f"{report[best]['cpu_ms']} ms CPU / lần)")
+    print(f"⚡ {sum(r['forecasts'] for r in report.values())} lần dự đoán trong {wall:.2f}s wall")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'models': report, 'recommended': best, 'target_mae': args.target_mae,
+                       'horizon': args.horizon, 'step': args.step, 'zones': sorted(windows),
+                       'features': list(HOURLY_FEATURES), 'wall_s': round(wall, 3)}, f, indent=2)
+        print(f"💾 Saved {args.save}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,394 @@
+"""
+Benchmark tải cho đường ingestion và API
+
+Giả lập:
+- Đội ESP32: N thiết bị, mỗi thiết bị report mỗi `interval` giây
+  (một phần gửi qua HTTP /api/report, phần còn lại qua MQTT tuoicay/report)
+- Người xem dashboard: poll /api/logs + /api/config
+- Broker MQTT giả lập (local_broker.LocalBroker), không cần mạng
+
+Báo cáo: throughput, latency p50/p99, write amplification của DB, bộ nhớ,
+và micro-benchmark append_log / get_config / scheduler_tick.
+
+    python benchmark.py --devices 50 --interval 1 --viewers 5 --duration 20
+    python benchmark.py --save bench.json
+    python benchmark.py --compare bench.json --tolerance 0.2   # exit 1 nếu chậm hơn 20%
+"""
+import io
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Không gửi Telegram / không kết nối broker thật khi benchmark
+os.environ["TELEGRAM_TOKEN"] = "YOUR_BOT_TOKEN"
+os.environ["TUOI_START_SERVICES"] = "0"
+os.environ.setdefault("TUOI_LOG_LEVEL", "WARNING")
+
+import storage
+from compression import Compressor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# ================= ĐO ĐẠC =================
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class Recorder:
+    """Gom latency theo loại thao tác (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, op, seconds, ok=True):
+        with self._lock:
+            self.latencies.setdefault(op, []).append(seconds)
+            if not ok:
+                self.errors[op] = self.errors.get(op, 0) + 1
+
+    def summary(self, elapsed):
+        result = {}
+        for op, values in sorted(self.latencies.items()):
+            result[op] = {
+                'count': len(values),
+                'errors': self.errors.get(op, 0),
+                'throughput': round(len(values) / elapsed, 1),
+                'p50_ms': round(percentile(values, 50) * 1000, 3),
+                'p99_ms': round(percentile(values, 99) * 1000, 3),
+                'max_ms': round(max(values) * 1000, 3)
+            }
+        return result
+
+
+def rss_mb():
+    """RSS hiện tại (Linux) hoặc peak RSS"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024, 1)
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return None
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def written_bytes():
+    """
+    Tổng byte process đã ghi qua write() (wchar trong /proc/self/io), None nếu không có.
+    Đếm cả file DB lẫn rollback journal / WAL: so kích thước file trước/sau thì
+    ghi đè trang cũ (UPDATE, trang index) và journal đã xoá sau commit đều bằng 0.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            return int(dict(line.split(': ') for line in f.read().splitlines())['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def count_rows(path):
+    """Số dòng logs, cộng qua mọi shard (TUOI_SHARDS > 1)"""
+    store = storage.Storage(path)
+    try:
+        return sum(n for n, in store.fan_out('SELECT COUNT(*) FROM logs'))
+    finally:
+        store.close()
+
+
+# ================= MÔI TRƯỜNG TEST =================
+def build_server(db_path):
+    """Tạo app trong process + nối MQTT vào broker giả lập"""
+    import app as server
+    from local_broker import LocalBroker
+
+    broker = LocalBroker()
+    client = broker.client('server')
+    client.on_message = server.handle_mqtt_message
+    client.subscribe('tuoicay/report')
+
+    flask_app = server.create_app({'TUOI_DB': db_path, 'TUOI_START_SERVICES': False})
+    # Route / scheduler dùng biến global `mqtt` và dispatcher.publish
+    server.mqtt = client
+    server.dispatcher.publish = client.publish
+    return server, flask_app, broker
+
+
+def seed_db(server, rows):
+    """Nạp sẵn dữ liệu lịch sử để truy vấn có kích thước thực tế"""
+    if rows <= 0:
+        return
+    now = time.time()
+    # Qua log_store: có shard thì dòng nằm đúng file của thiết bị
+    server.log_store.insert([(int((now - rows + i) * 1000), 50 + 10 * random.random(), 0, 1, 1, -60,
+                              server.DEFAULT_DEVICE, None) for i in range(rows)])
+
+
+# ================= KỊCH BẢN TẢI =================
+def run_load(server, flask_app, broker, args):
+    rec = Recorder()
+    local = threading.local()
+
+    def http_client():
+        if not hasattr(local, 'client'):
+            if args.url:
+                import requests
+                local.client = requests.Session()
+            else:
+                local.client = flask_app.test_client()
+        return local.client
+
+    def call(method, path, body=None):
+        c = http_client()
+        if args.url:
+            r = c.request(method, args.url.rstrip('/') + path, json=body, timeout=10)
+            return r.status_code
+        r = c.open(path, method=method, json=body)
+        return r.status_code
+
+    def device_report(dev, via_mqtt, scheduled):
+        payload = {'device': dev, 'soil': round(30 + 40 * random.random(), 1),
+                   'pump': random.randint(0, 1), 'auto': 1, 'wifi_rssi': random.randint(-85, -40)}
+        if via_mqtt:
+            broker.client(dev).publish('tuoicay/report', json.dumps(payload))
+            rec.record('mqtt_report', time.perf_counter() - scheduled)
+        else:
+            code = call('POST', '/api/report', payload)
+            rec.record('http_report', time.perf_counter() - scheduled, code == 200)
+        return len(json.dumps(payload))
+
+    def viewer_poll(scheduled):
+        code = call('GET', '/api/logs')
+        rec.record('dashboard_logs', time.perf_counter() - scheduled, code == 200)
+        code = call('GET', '/api/config')
+        rec.record('dashboard_config', time.perf_counter() - scheduled, code == 200)
+        return 0
+
+    def config_poll(scheduled):
+        code = call('GET', '/api/config')
+        rec.record('device_config_poll', time.perf_counter() - scheduled, code == 200)
+        return 0
+
+    # Lịch sự kiện: (thời điểm, id, hàm, interval)
+    start = time.perf_counter()
+    events = []
+    seq = 0
+    n_mqtt = int(args.devices * args.mqtt_share)
+    for i in range(args.devices):
+        dev = f'bench-{i:04d}'
+        via_mqtt = i < n_mqtt
+        offset = random.random() * args.interval
+        events.append((start + offset, seq, lambda t, d=dev, m=via_mqtt: device_report(d, m, t), args.interval))
+        seq += 1
+        if args.config_poll > 0:
+            events.append((start + offset, seq, config_poll, args.config_poll))
+            seq += 1
+    for i in range(args.viewers):
+        events.append((start + random.random() * args.viewer_interval, seq, viewer_poll, args.viewer_interval))
+        seq += 1
+    heapq.heapify(events)
+
+    logical_bytes = [0]
+    lock = threading.Lock()
+
+    def run(fn, scheduled):
+        try:
+            n = fn(scheduled)
+        except Exception:
+            rec.record('exception', 0, False)
+            return
+        if n:
+            with lock:
+                logical_bytes[0] += n
+
+    deadline = start + args.duration
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while events:
+            t, sid, fn, interval = heapq.heappop(events)
+            if t >= deadline:
+                break
+            delay = t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # Latency tính từ thời điểm LẼ RA phải gửi (tránh coordinated omission)
+            pool.submit(run, fn, t)
+            heapq.heappush(events, (t + interval, sid, fn, interval))
+
+    elapsed = time.perf_counter() - start
+    return rec, elapsed, logical_bytes[0]
+
+
+def run_micro(server, iterations):
+    """Micro-benchmark các hàm nóng"""
+    results = {}
+
+    def bench(name, fn, n):
+        samples = []
+        for _ in range(n):
+            t0 = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - t0)
+        results[name] = {
+            'count': n,
+            'p50_ms': round(percentile(samples, 50) * 1000, 3),
+            'p99_ms': round(percentile(samples, 99) * 1000, 3),
+            'ops_per_s': round(n / sum(samples), 1)
+        }
+
+    # append_log: mỗi lần gọi đều ghi SQLite (tắt nén); append_log_compressed: nén theo
+    # TUOI_COMPRESS_DEVIATION, độ ẩm không đổi -> gần như chỉ đo Compressor.add
+    compressor = server.compressor
+    server.compressor = Compressor(0)
+    try:
+        bench('append_log', lambda: server.append_log(50.0, 0, 1, 1, -60), iterations)
+    finally:
+        server.compressor = compressor
+    if compressor.enabled:
+        bench('append_log_compressed', lambda: server.append_log(50.0, 0, 1, 1, -60), iterations)
+    bench('get_config', server.get_config, iterations)
+    bench('scheduler_tick', server.scheduler_tick, max(1, iterations // 10))
+    return results
+
+
+def compare(current, baseline, tolerance):
+    """So sánh với kết quả lưu trước, trả về list regression"""
+    regressions = []
+    for section in ('load', 'micro'):
+        for op, cur in current.get(section, {}).items():
+            base = baseline.get(section, {}).get(op)
+            if not base:
+                continue
+            if base.get('p99_ms') and cur['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+                regressions.append(f"{section}.{op}: p99 {base['p99_ms']}ms -> {cur['p99_ms']}ms")
+            for key in ('throughput', 'ops_per_s'):
+                if base.get(key) and cur.get(key, 0) < base[key] * (1 - tolerance):
+                    regressions.append(f"{section}.{op}: {key} {base[key]} -> {cur[key]}")
+    return regressions
+
+
+def print_report(result):
+    print("\n📊 LOAD")
+    print(f"   {'operation':<20}{'count':>8}{'err':>6}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for op, r in result['load'].items():
+        print(f"   {op:<20}{r['count']:>8}{r['errors']:>6}{r['throughput']:>10}{r['p50_ms']:>10}{r['p99_ms']:>10}")
+
+    print("\n⏱️ MICRO")
+    for op, r in result['micro'].items():
+        print(f"   {op:<20}{r['ops_per_s']:>10} ops/s   p50 {r['p50_ms']} ms   p99 {r['p99_ms']} ms")
+
+    db = result['db']
+    print("\n💾 DB")
+    print(f"   rows/report: {db['rows_per_report']}   bytes/row: {db['bytes_per_row']}")
+    if db['write_amplification'] is None:
+        print("   write amplification: n/a (cần /proc/self/io, chỉ đo được khi chạy in-process)")
+    else:
+        print(f"   write amplification: {db['write_amplification']}x (byte ghi DB + journal/WAL / byte payload)")
+    print(f"\n🧠 Memory: RSS {result['memory']['rss_start_mb']} -> {result['memory']['rss_end_mb']} MB")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--devices', type=int, default=50, help='số ESP32 giả lập')
+    p.add_argument('--interval', type=float, default=1.0, help='chu kỳ report của mỗi thiết bị (s)')
+    p.add_argument('--mqtt-share', type=float, default=0.5, help='tỉ lệ thiết bị report qua MQTT')
+    p.add_argument('--config-poll', type=float, default=0, help='thiết bị poll /api/config mỗi X s (0 = tắt)')
+    p.add_argument('--viewers', type=int, default=5, help='số dashboard đang mở')
+    p.add_argument('--viewer-interval', type=float, default=1.0)
+    p.add_argument('--duration', type=float, default=10.0, help='thời gian chạy (s)')
+    p.add_argument('--workers', type=int, default=16, help='số thread gửi request')
+    p.add_argument('--seed-rows', type=int, default=10000, help='số dòng logs nạp sẵn')
+    p.add_argument('--micro', type=int, default=500, help='số lần lặp micro-benchmark')
+    p.add_argument('--url', help='benchmark server đang chạy (HTTP) thay vì in-process')
+    p.add_argument('--save', help='lưu kết quả JSON')
+    p.add_argument('--compare', help='so với file JSON baseline')
+    p.add_argument('--tolerance', type=float, default=0.2)
+    p.add_argument('--seed', type=int, default=42)
+    args = p.parse_args(argv)
+    random.seed(args.seed)
+    if args.url and args.mqtt_share > 0:
+        # Report MQTT chỉ đi qua broker giả lập trong process, không tới server ở --url
+        print(f"ℹ️ --url: bỏ tải MQTT (--mqtt-share {args.mqtt_share} -> 0), mọi thiết bị report qua HTTP")
+        args.mqtt_share = 0
+
+    tmp = tempfile.mkdtemp(prefix='tuoi-bench-')
+    db_path = os.path.join(tmp, 'bench.db')
+    try:
+        # Ẩn log print() trên hot path để không đo tốc độ terminal; gom vào bộ nhớ
+        # (không phải /dev/null) để write() duy nhất trong lúc đo là của SQLite
+        with contextlib.redirect_stdout(io.StringIO()):
+            server, flask_app, broker = build_server(db_path)
+            seed_db(server, args.seed_rows)
+
+            rss_start = rss_mb()
+            rows_before = count_rows(db_path)
+            bytes_before = written_bytes()
+
+            rec, elapsed, logical = run_load(server, flask_app, broker, args)
+
+            rows_after = count_rows(db_path)
+            bytes_after = written_bytes()
+            micro = run_micro(server, args.micro)
+            rss_end = rss_mb()
+
+        load = rec.summary(elapsed)
+        reports = sum(load.get(op, {}).get('count', 0) for op in ('http_report', 'mqtt_report'))
+        rows = rows_after - rows_before
+        # --url: DB nằm ở server khác, byte ghi của process này không liên quan
+        written = None if args.url or bytes_before is None else bytes_after - bytes_before
+        result = {
+            'params': {k: v for k, v in vars(args).items() if k not in ('save', 'compare')},
+            'elapsed_s': round(elapsed, 2),
+            'load': load,
+            'micro': micro,
+            'db': {
+                'rows_written': rows,
+                'rows_per_report': round(rows / reports, 2) if reports else 0,
+                'bytes_written': written,
+                'bytes_per_row': round(written / rows, 1) if rows and written is not None else None,
+                'write_amplification': round(written / logical, 2) if logical and written is not None else None
+            },
+            'memory': {'rss_start_mb': rss_start, 'rss_end_mb': rss_end}
+        }
+
+        print_report(result)
+
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump(result, f, indent=2)
+            print(f"\n💾 Saved {args.save}")
+
+        if args.compare:
+            with open(args.compare) as f:
+                regressions = compare(result, json.load(f), args.tolerance)
+            if regressions:
+                print("\n❌ REGRESSION:")
+                for r in regressions:
+                    print(f"   {r}")
+                return 1
+            print("\n✅ Không có regression")
+        return 0
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+import metrics
+from logger import get_logger
+
+log = get_logger('dispatcher')
+
+# Topic cho từng thiết bị
+STATE_TOPIC = 'tuoicay/{device}/state'   # Server -> ESP32 (retained, QoS 1)
+ACK_TOPIC = 'tuoicay/{device}/ack'       # ESP32 -> Server {"seq": n}
+ACK_WILDCARD = 'tuoicay/+/ack'
+
+DEFAULT_DEVICE = 'esp32'
+DEFAULT_GROUP = 'default'
+STATE_FIELDS = ('pump_cmd', 'auto', 'use_schedule')
+
+
+class CommandDispatcher:
+    """
+    Gửi lệnh điều khiển xuống ESP32 qua MQTT
+
+    - Mỗi thiết bị có 1 topic state riêng, publish retained + QoS 1
+      -> thiết bị kết nối lại sẽ nhận ngay trạng thái mới nhất
+    - Chỉ publish khi trạng thái THAY ĐỔI (có số seq tăng dần)
+    - Lệnh theo nhóm / broadcast: cập nhật nhiều zone trong 1 transaction
+    - Theo dõi ACK: thiết bị trả {"seq": n} trên tuoicay/<device>/ack,
+      lệnh chưa ACK sẽ được gửi lại sau ACK_TIMEOUT giây
+    """
+
+    ACK_TIMEOUT = 15  # seconds
+
+    def __init__(self, db_path='tuoi.db', publish=None):
+        """
+        Args:
+            db_path: Đường dẫn database SQLite
+            publish: Hàm publish(topic, payload, qos, retain) -> (rc, mid),
+                     ví dụ mqtt.publish. None = chỉ lưu DB, process có MQTT
+                     sẽ gửi qua resend_unacked().
+        """
+        self.db_path = db_path
+        self.publish = publish
+        self._lock = threading.Lock()
+        self._known = set()
+
+    # ================= DATABASE =================
+    def init_db(self):
+        con = sqlite3.connect(self.db_path)
+        con.execute('''CREATE TABLE IF NOT EXISTS device_state(
+            device_id TEXT PRIMARY KEY,
+            group_name TEXT DEFAULT 'default',
+            pump_cmd INTEGER DEFAULT 0,
+            auto INTEGER DEFAULT 1,
+            use_schedule INTEGER DEFAULT 0,
+            seq INTEGER DEFAULT 0,
+            acked_seq INTEGER DEFAULT 0,
+            published_at TEXT,
+            acked_at TEXT
+        )''')
+        con.execute('CREATE INDEX IF NOT EXISTS idx_device_state_group ON device_state(group_name)')
+        con.commit()
+        con.close()
+
+    def _rows(self, con, where='', params=()):
+        cur = con.execute(
+            f'SELECT device_id, group_name, pump_cmd, auto, use_schedule, seq, acked_seq, '
+            f'published_at, acked_at FROM device_state {where}', params)
+        keys = ('device_id', 'group', 'pump_cmd', 'auto', 'use_schedule', 'seq',
+                'acked_seq', 'published_at', 'acked_at')
+        return [dict(zip(keys, r)) for r in cur.fetchall()]
+
+    # ================= THIẾT BỊ =================
+    def register_device(self, device_id, group=None, defaults=None):
+        """
+        Ghi nhận thiết bị mới (gọi từ luồng report).
+        Thiết bị đã biết thì không chạm DB -> không tốn chi phí trên hot path.
+        """
+        if device_id in self._known and group is None:
+            return False
+
+        # defaults có thể là hàm (vd get_config) -> chỉ gọi khi thật sự cần
+        defaults = (defaults() if callable(defaults) else defaults) or {}
+        with self._lock:
+            con = sqlite3.connect(self.db_path)
+            cur = con.execute(
+                'INSERT OR IGNORE INTO device_state(device_id, group_name, pump_cmd, auto, use_schedule, seq, '
+                'published_at) VALUES(?,?,?,?,?,1,?)',
+                (device_id, group or DEFAULT_GROUP, int(defaults.get('pump_cmd', 0)),
+                 int(defaults.get('auto', 1)), int(defaults.get('use_schedule', 0)),
+                 datetime.now().isoformat() if self.publish else None))
+            created = cur.rowcount > 0
+            if group is not None and not created:
+                con.execute('UPDATE device_state SET group_name=? WHERE device_id=?', (group, device_id))
+            con.commit()
+            rows = self._rows(con, 'WHERE device_id=?', (device_id,)) if created else []
+            con.close()
+            self._known.add(device_id)
+
+        if created:
+            log.info("🆕 Thiết bị mới: %s (nhóm %s)", device_id, group or DEFAULT_GROUP)
+            self._publish_rows(rows)
+        return created
+
+    def devices(self, group=None):
+        con = sqlite3.connect(self.db_path)
+        if group is None:
+            rows = self._rows(con, 'ORDER BY device_id')
+        else:
+            rows = self._rows(con, 'WHERE group_name=? ORDER BY device_id', (group,))
+        con.close()
+        for r in rows:
+            r['acked'] = r['acked_seq'] >= r['seq']
+        return rows
+
+    # ================= GỬI LỆNH =================
+    def set_state(self, device_ids, **fields):
+        """Cập nhật trạng thái cho danh sách thiết bị, trả về list thiết bị đã thay đổi"""
+        device_ids = list(device_ids)
+        if not device_ids:
+            return []
+        placeholders = ','.join('?' * len(device_ids))
+        return self._apply(f'WHERE device_id IN ({placeholders})', device_ids, fields)
+
+    def set_group(self, group, **fields):
+        """Fan-out 1 lệnh cho cả nhóm zone"""
+        return self._apply('WHERE group_name=?', (group,), fields)
+
+    def broadcast(self, **fields):
+        """Fan-out 1 lệnh cho toàn bộ thiết bị"""
+        return self._apply('', (), fields)
+
+    def _apply(self, where, params, fields):
+        fields = {k: int(v) for k, v in fields.items() if k in STATE_FIELDS}
+        if not fields:
+            return []
+
+        # Không có MQTT (worker phụ) -> published_at=NULL, process leader sẽ gửi
+        now = datetime.now().isoformat() if self.publish else None
+        with self._lock:
+            con = sqlite3.connect(self.db_path)
+            rows = self._rows(con, where, params)
+            changed = []
+            for r in rows:
+                if any(r[k] != v for k, v in fields.items()):
+                    r.update(fields)
+                    r['seq'] += 1
+                    r['published_at'] = now
+                    changed.append(r)
+
+            # Ghi tất cả trong 1 transaction
+            con.executemany(
+                'UPDATE device_state SET pump_cmd=?, auto=?, use_schedule=?, seq=?, published_at=? '
+                'WHERE device_id=?',
+                [(r['pump_cmd'], r['auto'], r['use_schedule'], r['seq'], now, r['device_id'])
+                 for r in changed])
+            con.commit()
+            con.close()
+
+        self._publish_rows(changed)
+        return [r['device_id'] for r in changed]
+
+    def _publish_rows(self, rows):
+        if self.publish is None:
+            return
+
+        failed = []
+        for r in rows:
+            payload = json.dumps({
+                'device': r['device_id'],
+                'seq': r['seq'],
+                'pump_cmd': r['pump_cmd'],
+                'auto': r['auto'],
+                'use_schedule': r['use_schedule']
+            })
+            try:
+                with metrics.MQTT_PUBLISH_SECONDS.time(topic='state'):
+                    rc, _ = self.publish(STATE_TOPIC.format(device=r['device_id']), payload, 1, True)
+            except Exception as e:
+                log.warning("⚠️ MQTT publish error (%s): %s", r['device_id'], e)
+                rc = -1
+            metrics.MQTT_PUBLISH.inc(topic='state', result='ok' if rc == 0 else 'error')
+            if rc != 0:
+                failed.append(r['device_id'])
+
+        # Publish lỗi (mất kết nối broker) -> xoá published_at để resend ngay
+        if failed:
+            placeholders = ','.join('?' * len(failed))
+            con = sqlite3.connect(self.db_path)
+            con.execute(f'UPDATE device_state SET published_at=NULL WHERE device_id IN ({placeholders})', failed)
+            con.commit()
+            con.close()
+
+    # ================= ACK =================
+    def handle_ack(self, device_id, payload):
+        """Xử lý ACK từ thiết bị: {"seq": n}"""
+        try:
+            seq = int(json.loads(payload).get('seq', 0))
+        except (ValueError, TypeError, AttributeError):
+            return False
+
+        con = sqlite3.connect(self.db_path)
+        cur = con.execute(
+            'UPDATE device_state SET acked_seq=?, acked_at=? WHERE device_id=? AND acked_seq < ?',
+            (seq, datetime.now().isoformat(), device_id, seq))
+        con.commit()
+        con.close()
+        return cur.rowcount > 0
+
+    def pending(self):
+        """Các thiết bị chưa ACK trạng thái mới nhất"""
+        con = sqlite3.connect(self.db_path)
+        rows = self._rows(con, 'WHERE seq > acked_seq ORDER BY device_id')
+        con.close()
+        return rows
+
+    def resend_unacked(self, timeout=None):
+        """Gửi lại state cho thiết bị chưa ACK quá `timeout` giây (gọi định kỳ)"""
+        timeout = self.ACK_TIMEOUT if timeout is None else timeout
+        cutoff = (datetime.now() - timedelta(seconds=timeout)).isoformat()
+
+        with self._lock:
+            con = sqlite3.connect(self.db_path)
+            rows = self._rows(con, 'WHERE seq > acked_seq AND (published_at IS NULL OR published_at <= ?)',
+                              (cutoff,))
+            if rows:
+                now = datetime.now().isoformat()
+                con.executemany('UPDATE device_state SET published_at=? WHERE device_id=?',
+                                [(now, r['device_id']) for r in rows])
+                con.commit()
+            con.close()
+
+        self._publish_rows(rows)
+        return len(rows)
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    from local_broker import LocalBroker
+
+    db = os.path.join(tempfile.mkdtemp(), 'demo.db')
+    broker = LocalBroker()
+    server = broker.client('server')
+    dispatcher = CommandDispatcher(db, publish=server.publish)
+    dispatcher.init_db()
+
+    # Thiết bị giả lập: nhận state và trả ACK
+    def make_device(name):
+        dev = broker.client(name)
+
+        def on_message(client, userdata, msg):
+            state = json.loads(msg.payload)
+            print(f"   📟 {name} nhận seq={state['seq']} pump={state['pump_cmd']}")
+            client.publish(ACK_TOPIC.format(device=name), json.dumps({'seq': state['seq']}), 1)
+
+        dev.on_message = on_message
+        dev.subscribe(STATE_TOPIC.format(device=name), 1)
+        return dev
+
+    server.on_message = lambda c, u, m: dispatcher.handle_ack(m.topic.split('/')[1], m.payload)
+    server.subscribe(ACK_WILDCARD, 1)
+
+    for i in range(3):
+        dispatcher.register_device(f'zone-{i}', group='vuon-rau')
+    devices = [make_device(f'zone-{i}') for i in range(3)]
+
+    print("📡 Broadcast BẬT BƠM:", dispatcher.broadcast(pump_cmd=1, auto=0))
+    print("📡 Gửi lại lệnh giống hệt (không đổi):", dispatcher.broadcast(pump_cmd=1, auto=0))
+    print("⏳ Chưa ACK:", [r['device_id'] for r in dispatcher.pending()])
@@ -0,0 +1,193 @@
+import threading
+import numpy as np
+
+# ================= NÉN DỮ LIỆU LÚC GHI (SWINGING DOOR) =================
+# ESP32 report mỗi giây, độ ẩm gần như không đổi -> phần lớn dòng trong logs
+# là dư thừa. Chỉ lưu các điểm "quan trọng":
+#   - Swinging door: bỏ điểm nếu đường thẳng giữa 2 điểm được lưu đi qua mọi
+#     điểm bị bỏ với sai số <= deviation (% độ ẩm)
+#   - Pump / auto đổi trạng thái: lưu chính xác điểm cuối trước và điểm đầu sau
+#   - Heartbeat: ít nhất 1 điểm mỗi `heartbeat` giây (phân biệt với mất kết nối)
+# Reader dựng lại chuỗi bằng nội suy tuyến tính (soil, rssi) và giữ giá trị
+# (pump, auto) - xem reconstruct().
+
+# Point = (ts_epoch, soil, pump, auto, rssi)
+
+
+class SwingingDoor:
+    """Trạng thái nén của 1 thiết bị"""
+
+    def __init__(self, deviation=0.5, heartbeat=120):
+        self.deviation = deviation
+        self.heartbeat = heartbeat
+        self.archived = None   # điểm được lưu gần nhất
+        self.held = None       # điểm mới nhất chưa lưu
+        self.upper = None      # độ dốc lớn nhất / nhỏ nhất còn hợp lệ
+        self.lower = None
+
+    def _open(self, origin, point):
+        dt = point[0] - origin[0]
+        self.upper = (point[1] + self.deviation - origin[1]) / dt
+        self.lower = (point[1] - self.deviation - origin[1]) / dt
+
+    def _fit(self, point):
+        """
+        Điểm sẽ lưu: nếu độ dốc từ điểm đã lưu nằm ngoài "cửa" thì kéo soil
+        về mép cửa (lệch <= deviation so với giá trị thật) -> mọi điểm bị bỏ
+        đều cách đường nội suy không quá deviation
+        """
+        if self.upper is None:
+            return point
+        dt = point[0] - self.archived[0]
+        slope = (point[1] - self.archived[1]) / dt
+        fitted = min(max(slope, self.lower), self.upper)
+        if fitted == slope:
+            return point
+        return (point[0], self.archived[1] + fitted * dt) + tuple(point[2:])
+
+    def _archive(self, point):
+        self.archived, self.held = point, None
+        self.upper = self.lower = None
+
+    def add(self, point):
+        """Returns: list điểm cần ghi xuống DB (0, 1 hoặc 2 điểm)"""
+        if self.deviation <= 0:
+            return [point]
+        if self.archived is None:
+            self._archive(point)
+            return [point]
+        if point[0] <= self.archived[0] or (self.held and point[0] <= self.held[0]):
+            return []  # trùng / lùi thời gian
+
+        last = self.held or self.archived
+        if point[2:4] != last[2:4]:
+            # Bơm / chế độ đổi: giữ chính xác thời điểm chuyển trạng thái
+            out = [self._fit(self.held)] if self.held else []
+            self._archive(point)
+            return out + [point]
+
+        out = []
+        if self.held is None:
+            self._open(self.archived, point)
+        else:
+            dt = point[0] - self.archived[0]
+            upper = min(self.upper, (point[1] + self.deviation - self.archived[1]) / dt)
+            lower = max(self.lower, (point[1] - self.deviation - self.archived[1]) / dt)
+            if upper < lower:
+                # Cửa đóng: lưu điểm trước đó, mở cửa mới từ điểm đó
+                fitted = self._fit(self.held)
+                out.append(fitted)
+                self._archive(fitted)
+                self._open(fitted, point)
+            else:
+                self.upper, self.lower = upper, lower
+        self.held = point
+
+        if point[0] - self.archived[0] >= self.heartbeat:
+            fitted = self._fit(point)
+            out.append(fitted)
+            self._archive(fitted)
+        return out
+
+    def flush(self):
+        """Điểm đang giữ (gọi khi tắt server)"""
+        if self.held is None:
+            return []
+        fitted = self._fit(self.held)
+        self._archive(fitted)
+        return [fitted]
+
+
+class Compressor:
+    """Swinging door cho nhiều thiết bị (thread-safe)"""
+
+    def __init__(self, deviation=0.5, heartbeat=120):
+        self.deviation = deviation
+        self.heartbeat = heartbeat
+        self._doors = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.deviation > 0
+
+    def add(self, device, point):
+        with self._lock:
+            door = self._doors.get(device)
+            if door is None:
+                door = self._doors[device] = SwingingDoor(self.deviation, self.heartbeat)
+            return door.add(point)
+
+    def held(self, device):
+        """Điểm mới nhất của thiết bị chưa được ghi (None nếu không có)"""
+        with self._lock:
+            door = self._doors.get(device)
+            return door.held if door is not None else None
+
+    def flush(self):
+        """Returns: {device: [điểm]} các điểm đang giữ của mọi thiết bị"""
+        with self._lock:
+            return {device: points for device, door in self._doors.items()
+                    for points in [door.flush()] if points}
+
+
+def compress_batch(points, deviation=0.5, heartbeat=120):
+    """Nén 1 lô đã sắp theo thời gian (bulk backfill). Kết quả chỉ phụ thuộc vào lô."""
+    door = SwingingDoor(deviation, heartbeat)
+    out = []
+    for p in points:
+        out.extend(door.add(p))
+    return out + door.flush()
+
+
+def reconstruct(ts, soil, pump, auto, rssi, step, max_gap):
+    """
+    Dựng lại chuỗi đều bước `step` giây từ các điểm đã nén
+
+    soil, rssi nội suy tuyến tính; pump, auto giữ giá trị điểm trước.
+    Khoảng trống > max_gap giây (mất kết nối thật) không được lấp.
+
+    Returns:
+        (ts, soil, pump, auto, rssi) numpy arrays
+    """
+    ts = np.asarray(ts, dtype=np.float64)
+    if len(ts) < 2:
+        return ts, np.asarray(soil, dtype=np.float64), np.asarray(pump), np.asarray(auto), np.asarray(rssi)
+
+    gaps = np.diff(ts)
+    fill = (gaps > step) & (gaps <= max_gap)
+    # Số điểm chèn thêm vào mỗi khoảng (điểm gốc luôn được giữ)
+    extra = np.where(fill, np.ceil(gaps / step).astype(np.int64) - 1, 0)
+    seg = np.repeat(np.arange(len(gaps)), extra)
+    offset = np.arange(len(seg)) - np.repeat(np.cumsum(extra) - extra, extra) + 1
+    grid = np.sort(np.concatenate([ts, ts[seg] + offset * step]), kind='stable')
+
+    idx = np.clip(np.searchsorted(ts, grid, side='right') - 1, 0, len(ts) - 1)
+    return (grid,
+            np.interp(grid, ts, np.asarray(soil, dtype=np.float64)),
+            np.asarray(pump)[idx],
+            np.asarray(auto)[idx],
+            np.round(np.interp(grid, ts, np.asarray(rssi, dtype=np.float64))))
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    n = 86400  # 1 ngày, 1 reading / giây
+    t = 1_700_000_000 + np.arange(n, dtype=np.float64)
+    pump = ((t // 3600) % 12 == 6).astype(np.int8)          # tưới 1 giờ / 12 giờ
+    soil = 55 + np.cumsum(np.where(pump == 1, 0.004, -0.0003)) + rng.normal(0, 0.15, n)
+    points = [(t[i], float(soil[i]), int(pump[i]), 1, -55) for i in range(n)]
+
+    for deviation in (0.25, 0.5, 1.0):
+        kept = compress_batch(points, deviation=deviation, heartbeat=120)
+        kt = np.array([p[0] for p in kept])
+        ks = np.array([p[1] for p in kept])
+        kp = np.array([p[2] for p in kept])
+        _, rs, rp, _, _ = reconstruct(kt, ks, kp, np.ones(len(kt)), np.full(len(kt), -55), 1.0, 180)
+        err = np.abs(rs - soil).max()
+        print(f"📉 deviation={deviation}: {n} -> {len(kept)} điểm ({n / len(kept):.0f}x), "
+              f"sai số max {err:.2f}%, pump khớp: {bool((rp == pump).all())}")
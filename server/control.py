@@ -0,0 +1,45 @@
+import settings
+
+# ================= LOGIC ĐIỀU KHIỂN BƠM =================
+# Dùng chung cho scheduler_tick (app.py) và bộ replay (replay.py)
+
+
+def default_params():
+    return {
+        'soil_on': settings.SOIL_ON,    # Auto: bật bơm khi độ ẩm < soil_on
+        'soil_off': settings.SOIL_OFF,  # Auto: tắt bơm khi độ ẩm > soil_off
+    }
+
+
+def decide(cfg, current_soil, now_hm, params=None):
+    """
+    Quyết định của scheduler cho 1 lần kiểm tra
+
+    Args:
+        cfg: dict từ get_config() (auto, pump_cmd, use_schedule, start, end)
+        current_soil: độ ẩm mới nhất (%)
+        now_hm: giờ hiện tại dạng "HH:MM"
+        params: ngưỡng {'soil_on', 'soil_off'} (mặc định từ settings)
+
+    Returns:
+        (mode, pump_cmd) nếu cần đổi trạng thái bơm, ngược lại None
+    """
+    params = params or default_params()
+
+    # 1. Logic Hẹn Giờ (Ưu tiên cao nhất)
+    if cfg['use_schedule'] == 1:
+        if cfg['start'] <= now_hm <= cfg['end']:
+            if cfg['pump_cmd'] == 0:
+                return 'schedule', 1
+        else:
+            if cfg['pump_cmd'] == 1 and cfg['auto'] == 0:  # Chỉ tắt nếu không phải auto moisture
+                return 'schedule', 0
+
+    # 2. Logic Tự Động Theo Độ Ẩm (Khi không dùng lịch)
+    elif cfg['auto'] == 1:
+        if current_soil < params['soil_on'] and cfg['pump_cmd'] == 0:
+            return 'auto', 1
+        elif current_soil > params['soil_off'] and cfg['pump_cmd'] == 1:
+            return 'auto', 0
+
+    return None
@@ -0,0 +1,137 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+from flask import Response, request, render_template, abort
+
+try:
+    import brotli  # tuỳ chọn: pip install brotli
+except ImportError:
+    brotli = None
+
+# ================= PHÂN PHỐI DASHBOARD (NÉN + CACHE) =================
+# Đường truyền ngoài vườn chậm -> mỗi byte đều đáng kể:
+#   - CSS/JS tách khỏi template, URL có hash nội dung (js/index.<hash>.js)
+#     -> cache 1 năm (immutable), đổi code là đổi URL
+#   - Trang HTML chỉ là vỏ tĩnh, render 1 lần lúc khởi động; trạng thái
+#     (config, logs) do JS lấy qua /api/... -> không query DB khi tải trang
+#   - Nén sẵn gzip (+ brotli nếu cài) 1 lần, mỗi request chỉ chọn bản phù hợp
+#   - Response JSON lớn hơn ngưỡng được gzip lúc trả về
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"       # luôn hỏi lại server, 304 nếu ETag không đổi
+PAGES = ("index.html", "ml_dashboard.html")
+JSON_GZIP_LEVEL = 6           # nén lúc trả về: cân bằng CPU / kích thước
+
+
+class Asset:
+    """1 file đã nén sẵn: {encoding: bytes}"""
+
+    def __init__(self, data, mimetype):
+        self.mimetype = mimetype
+        self.hash = hashlib.sha256(data).hexdigest()[:12]
+        self.bodies = {"identity": data, "gzip": gzip.compress(data, 9, mtime=0)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(data, quality=11)
+        # Bản nén to hơn bản gốc (file rất nhỏ) thì bỏ
+        for enc in [e for e in self.bodies if len(self.bodies[e]) >= len(data) and e != "identity"]:
+            del self.bodies[enc]
+
+
+def _encoding(bodies):
+    """Encoding tốt nhất mà client chấp nhận (br > gzip > identity)"""
+    for enc in ("br", "gzip"):
+        if enc in bodies and request.accept_encodings[enc]:
+            return enc
+    return "identity"
+
+
+def send(asset, cache_control):
+    """Response cho asset: chọn bản nén, ETag theo encoding, 304 nếu client đã có"""
+    enc = _encoding(asset.bodies)
+    etag = f"{asset.hash}-{enc}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset.bodies[enc], mimetype=asset.mimetype)
+        if enc != "identity":
+            response.headers["Content-Encoding"] = enc
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+class AssetStore:
+    """
+    Nạp static/ + render vỏ HTML 1 lần (gọi trong create_app)
+
+    url('js/index.js') -> '/static/js/index.<hash>.js'
+    """
+
+    def __init__(self, static_dir):
+        self.static_dir = static_dir
+        self.assets = {}    # tên gốc -> Asset
+        self.hashed = {}    # tên có hash -> Asset
+        self.pages = {}     # template -> Asset
+
+    def load(self, app):
+        self.assets.clear()
+        self.hashed.clear()
+        for root, _, files in os.walk(self.static_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, self.static_dir).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    asset = Asset(f.read(), mimetypes.guess_type(name)[0] or "application/octet-stream")
+                self.assets[rel] = asset
+                self.hashed[self._hashed_name(rel, asset.hash)] = asset
+
+        # Vỏ trang không phụ thuộc request -> render 1 lần
+        with app.app_context():
+            self.pages = {page: Asset(render_template(page, asset_url=self.url).encode(), "text/html")
+                          for page in PAGES}
+        return self
+
+    @staticmethod
+    def _hashed_name(rel, digest):
+        base, ext = os.path.splitext(rel)
+        return f"{base}.{digest}{ext}"
+
+    def url(self, rel):
+        return "/static/" + self._hashed_name(rel, self.assets[rel].hash)
+
+    def static(self, filename):
+        """/static/<filename>: tên có hash -> cache vĩnh viễn, tên gốc -> revalidate"""
+        if filename in self.hashed:
+            return send(self.hashed[filename], IMMUTABLE)
+        if filename in self.assets:
+            return send(self.assets[filename], REVALIDATE)
+        abort(404)
+
+    def page(self, name):
+        return send(self.pages[name], REVALIDATE)
+
+
+def compress_json(response, min_size):
+    """
+    after_request: gzip response JSON >= min_size byte (vd /api/logs)
+
+    Bỏ qua response stream / đã nén / client không nhận gzip
+    """
+    if (min_size <= 0
+            or response.mimetype != "application/json"
+            or response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or not request.accept_encodings["gzip"]):
+        return response
+
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    response.set_data(gzip.compress(data, JSON_GZIP_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
@@ -0,0 +1,255 @@
+import io
+import sys
+import csv
+import json
+import heapq
+import argparse
+from datetime import datetime, timezone
+
+import storage
+from logger import get_logger
+
+log = get_logger('export')
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# ================= XUẤT LỊCH SỬ LOGS DẠNG STREAM =================
+# /api/logs chỉ trả 50 dòng; mở thẳng tuoi.db để lấy dữ liệu thì 1 câu SELECT
+# dài giữ khoá SHARED suốt lúc đọc -> append_log / thread ghi shard phải chờ.
+# Ở đây đọc theo con trỏ keyset trên index (device, ts_ms):
+#   - mỗi lần đọc tối đa `chunk` dòng của 1 thiết bị rồi kết thúc câu lệnh
+#     -> khoá chỉ giữ vài ms, luồng ghi chen vào được giữa 2 chunk
+#   - snapshot: DB ở chế độ WAL (migration 9) -> mở mọi file logs lúc bắt đầu,
+#     mỗi file giữ 1 read transaction suốt phiên: mọi chunk thấy cùng 1 phiên
+#     bản, kể cả khi bulk backfill sửa dòng (DELETE + INSERT, id mới) giữa 2
+#     chunk. WAL không chặn người ghi, chỉ hoãn checkpoint tới khi xuất xong.
+#     Không có WAL: chỉ còn mốc MAX(id) lúc bắt đầu (dòng ghi thêm không lẫn
+#     vào, nhưng dòng bị sửa giữa chừng sẽ thiếu) + cảnh báo
+#   - thiết bị duyệt lần lượt bằng MIN(device) > thiết bị trước (không nạp
+#     danh sách), trộn theo tên giữa các shard -> bộ nhớ cố định, kết quả
+#     sắp theo (device, ts_ms)
+# Định dạng: csv, ndjson, arrow (Arrow IPC stream, mỗi chunk 1 record batch,
+# cần pyarrow; đọc bằng pyarrow.ipc.open_stream / pandas / duckdb).
+
+CHUNK = 5000
+COLUMNS = ('device', 'ts', 'ts_ms', 'soil', 'pump', 'auto', 'wifi_connected', 'wifi_rssi')
+
+_SELECT = ("SELECT id, ts_ms, soil, pump, auto, wifi_connected, wifi_rssi FROM logs "
+           "WHERE device = ? AND id <= ? AND ts_ms >= ? AND ts_ms < ? AND (ts_ms, id) > (?, ?) "
+           "ORDER BY ts_ms, id LIMIT ?")
+_MIN_TS, _MAX_TS = -2 ** 63, 2 ** 63 - 1
+
+
+def parse_time(value):
+    """'1730000000000' (epoch ms) | '2025-11-01' | '2025-11-01T06:00' (giờ địa phương) | '...Z' -> epoch ms"""
+    if value is None or value == '':
+        return None
+    value = str(value).strip()
+    if value.lstrip('-').isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+class Export:
+    """
+    1 phiên xuất logs: chunks() trả về các list dòng
+    (device, ts_iso, ts_ms, soil, pump, auto, wifi_connected, wifi_rssi), tối đa ~chunk dòng
+
+    Args:
+        store: storage.Storage (biết file shard của từng thiết bị)
+        devices: danh sách thiết bị, None = mọi thiết bị có trong logs
+        start_ms / end_ms: khoảng [start, end) theo ts_ms, None = không giới hạn
+    """
+
+    def __init__(self, store, devices=None, start_ms=None, end_ms=None, chunk=CHUNK):
+        self.store = store
+        self.devices = sorted(set(devices)) if devices else None
+        self.start_ms = _MIN_TS if start_ms is None else start_ms
+        self.end_ms = _MAX_TS if end_ms is None else end_ms
+        self.chunk = max(1, chunk)
+        self.rows = 0
+        self._cons = {}
+        self._marks = {}
+
+    def _connect(self, path):
+        """Kết nối chỉ đọc tới 1 file logs + mốc snapshot (MAX(id) lúc mở)"""
+        con = self._cons.get(path)
+        if con is None:
+            con = self._cons[path] = storage.connect(path, readonly=True, paths=[])
+            mode = con.execute("PRAGMA journal_mode").fetchone()[0]
+            if mode == 'wal':
+                # Read transaction tới close(): snapshot chốt ở câu SELECT đầu tiên bên dưới
+                con.execute("BEGIN")
+            else:
+                log.warning("⚠️ %s không ở chế độ WAL (journal_mode=%s): dòng được sửa trong lúc "
+                            "xuất có thể bị thiếu, chạy migrations.py để bật WAL", path, mode)
+            self._marks[path] = con.execute("SELECT COALESCE(MAX(id), 0) FROM logs").fetchone()[0]
+        return con
+
+    def _devices_in(self, path):
+        """Thiết bị trong 1 file, tăng dần, mỗi lần 1 lượt tìm trên index (không quét bảng)"""
+        con = self._connect(path)
+        device = con.execute("SELECT MIN(device) FROM logs").fetchone()[0]
+        while device is not None:
+            yield device, path
+            device = con.execute("SELECT MIN(device) FROM logs WHERE device > ?", (device,)).fetchone()[0]
+
+    def _plan(self):
+        """(device, file) theo thứ tự tên thiết bị"""
+        if self.devices is not None:
+            return ((device, self.store.path_for(device)) for device in self.devices)
+        return heapq.merge(*[self._devices_in(path) for path in self.store.sources()])
+
+    def chunks(self):
+        try:
+            # Mở mọi file trước khi đọc chunk đầu: các shard chốt snapshot cùng lúc
+            for path in self.store.sources():
+                self._connect(path)
+            out = []
+            for device, path in self._plan():
+                con = self._connect(path)
+                mark = self._marks[path]
+                last = (self.start_ms, -1)
+                while True:
+                    rows = con.execute(_SELECT, (device, mark, self.start_ms, self.end_ms)
+                                       + last + (self.chunk,)).fetchall()
+                    out.extend((device, _iso(r[1])) + r[1:] for r in rows)
+                    if len(out) >= self.chunk:
+                        self.rows += len(out)
+                        yield out
+                        out = []
+                    if len(rows) < self.chunk:
+                        break
+                    last = (rows[-1][1], rows[-1][0])
+            if out:
+                self.rows += len(out)
+                yield out
+        finally:
+            self.close()
+
+    def close(self):
+        for con in self._cons.values():
+            con.close()
+        self._cons.clear()
+
+
+def _iso(ts_ms):
+    """Giờ địa phương kèm offset (vd 2025-11-01T06:00:00.000+07:00): cùng giờ với /api/logs, parse_time đọc lại đúng"""
+    return datetime.fromtimestamp(ts_ms / 1000, timezone.utc).astimezone().isoformat(timespec='milliseconds')
+
+
+# ================= ĐỊNH DẠNG =================
+def to_csv(chunks):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    writer.writerow(COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+
+def to_ndjson(chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + '\n' for row in rows).encode()
+
+
+class _Sink:
+    """File giả cho pyarrow: gom byte đã ghi, lấy ra sau mỗi record batch"""
+
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data, self.parts = b''.join(self.parts), []
+        return data
+
+
+def _arrow_schema():
+    return pa.schema([('device', pa.string()), ('ts', pa.timestamp('ms', tz='UTC')),
+                      ('soil', pa.float64()), ('pump', pa.int8()), ('auto', pa.int8()),
+                      ('wifi_connected', pa.int8()), ('wifi_rssi', pa.int16())])
+
+
+def to_arrow(chunks):
+    """Arrow IPC stream: cột ts kiểu timestamp (ms, UTC) thay cho ts + ts_ms"""
+    schema = _arrow_schema()
+    sink = _Sink()
+    writer = pa.ipc.new_stream(sink, schema)
+    yield sink.take()
+    for rows in chunks:
+        columns = list(zip(*rows))
+        del columns[1]   # ts ISO: Arrow giữ ts_ms dạng timestamp
+        writer.write_batch(pa.record_batch([pa.array(col, type=field.type)
+                                            for col, field in zip(columns, schema)], schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+# định dạng -> (hàm, mimetype, đuôi file)
+FORMATS = {
+    'csv': (to_csv, 'text/csv', 'csv'),
+    'ndjson': (to_ndjson, 'application/x-ndjson', 'ndjson'),
+    'arrow': (to_arrow, 'application/vnd.apache.arrow.stream', 'arrow'),
+}
+
+
+def available(fmt):
+    return fmt in FORMATS and (fmt != 'arrow' or pa is not None)
+
+
+def stream(export, fmt):
+    """Generator byte của cả phiên xuất (dùng làm body response HTTP)"""
+    if not available(fmt):
+        raise ValueError(f"unsupported format: {fmt}" + (" (pip install pyarrow)" if fmt == 'arrow' else ''))
+    return FORMATS[fmt][0](export.chunks())
+
+
+# ================= USAGE EXAMPLE =================
+if __name__ == "__main__":
+    import os
+    import time
+    import migrations
+    import settings
+
+    ap = argparse.ArgumentParser(description='Xuất logs dạng stream (không chặn server đang ghi)')
+    ap.add_argument('--db', default=settings.DB)
+    ap.add_argument('--format', default='csv', choices=sorted(FORMATS))
+    ap.add_argument('--device', action='append', help='lặp lại để chọn nhiều thiết bị (mặc định: tất cả)')
+    ap.add_argument('--start', help="epoch ms hoặc ISO ('2025-11-01', giờ địa phương)")
+    ap.add_argument('--end')
+    ap.add_argument('--chunk', type=int, default=CHUNK)
+    ap.add_argument('--out', help='file ghi ra (mặc định stdout)')
+    args = ap.parse_args()
+    if not os.path.exists(args.db):
+        ap.error(f"không tìm thấy {args.db}")
+    migrations.migrate(args.db)
+
+    export = Export(storage.Storage(args.db), args.device, parse_time(args.start), parse_time(args.end), args.chunk)
+    started = time.perf_counter()
+    out = open(args.out, 'wb') if args.out else sys.stdout.buffer
+    size = 0
+    try:
+        for data in stream(export, args.format):
+            out.write(data)
+            size += len(data)
+    finally:
+        if args.out:
+            out.close()
+    print(f"📤 {export.rows} dòng, {size / 1e6:.1f} MB, {time.perf_counter() - started:.2f}s", file=sys.stderr)
@@ -0,0 +1,17 @@
+import settings
+
+# gunicorn -c gunicorn.conf.py wsgi:app
+bind = f"{settings.HOST}:{settings.PORT}"
+workers = settings.WORKERS
+worker_class = "eventlet" if settings.SERVER_MODE == "eventlet" else (
+    "gevent" if settings.SERVER_MODE == "gevent" else "gthread")
+threads = 8 if worker_class == "gthread" else 1
+worker_connections = 1000
+timeout = 60
+keepalive = 5
+
+# Không preload: mỗi worker tự create_app(), worker giữ file lock sẽ chạy scheduler/MQTT
+preload_app = False
+accesslog = None
+errorlog = "-"
+loglevel = "info"
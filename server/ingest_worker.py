@@ -0,0 +1,471 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import settings
+import backfill
+import migrations
+import storage
+from logger import get_logger, fields
+from compression import Compressor
+from admission import Admission, THROTTLE_TOPIC, hint_payload
+from command_dispatcher import CommandDispatcher, DEFAULT_DEVICE
+
+log = get_logger('ingest')
+
+# ================= INGESTION MQTT ĐỘC LẬP (SHARED SUBSCRIPTION) =================
+# Chạy ngoài Flask, N process / N node cùng nhóm:
+#   $share/<group>/tuoicay/report, $share/<group>/tuoicay/+/bulk
+# Broker chia message cho các thành viên trong nhóm -> thêm process là thêm
+# throughput. Mỗi process là 1 pipeline 3 tầng:
+#   network thread (paho) -> chỉ xếp hàng, không decode / không chạm DB
+#   decode thread         -> json + kiểm tra payload
+#   writer thread         -> gom lô, 1 transaction / lô, rồi mới ack
+# At-least-once: subscribe QoS 1 + manual ack, PUBACK chỉ gửi sau khi lô đã
+# commit -> worker chết giữa chừng thì broker giao lại cho thành viên khác.
+# Điểm bộ nén còn giữ trong RAM (chưa vào logs) được ghi vào bảng ingest_held
+# trong cùng lượt, trước PUBACK; worker khởi động lại (cùng tên) hoặc bất kỳ
+# worker nào sau 2 x heartbeat sẽ chuyển chúng vào logs (_recover).
+# Ghi idempotent theo (device, device_ts): report có `ts` (giờ đo của ESP32,
+# xem backfill.parse_ts) và bulk giao lại không tạo dòng trùng. Report không
+# có `ts` lấy giờ nhận làm tròn xuống theo TUOI_REPORT_INTERVAL làm khoá.
+# Token bucket / thiết bị (admission.py) áp ở tầng decode: report vượt hạn mức
+# được ack rồi bỏ, không vào hàng đợi ghi -> 1 thiết bị gửi dồn không làm chậm
+# cả nhóm. Giới hạn đồng thời không cần ở đây (hàng đợi có hạn đã là backpressure).
+# Có shard (storage.py): 1 lô được chia theo thiết bị, các shard commit song song.
+
+REPORT_TOPIC = 'tuoicay/report'
+_STOP = object()
+
+
+def share(topic, group):
+    """Topic shared subscription (MQTT 5, Mosquitto / EMQX / HiveMQ hỗ trợ cả client 3.1.1)"""
+    return f'$share/{group}/{topic}'
+
+
+def decode(topic, payload, received=None, interval=settings.REPORT_INTERVAL):
+    """
+    Payload MQTT -> (kind, device, data)
+
+    - ('report', device, point): point = (ts_epoch, soil, pump, auto, rssi, device_ts)
+      report không có `ts` hợp lệ: ts = giờ nhận, device_ts = giờ nhận làm tròn
+      xuống bội số `interval` giây (thiết bị report tối đa 1 lần / interval)
+      -> giao lại trong cùng chu kỳ không tạo dòng trùng
+    - ('bulk', device, {'readings': [...], 'batch': ...})
+    - ('relay', device, None): server publish lại report HTTP, đã ghi rồi -> bỏ qua
+
+    Raises:
+        ValueError / TypeError / AttributeError khi payload hỏng
+    """
+    data = json.loads(payload)
+    if topic.endswith('/bulk'):
+        device = topic.split('/')[1]
+        readings = data.get('readings', []) if isinstance(data, dict) else data
+        if not isinstance(readings, list):
+            raise ValueError('readings must be a list')
+        return 'bulk', device, {'readings': readings[:backfill.MAX_BATCH],
+                                'batch': data.get('batch') if isinstance(data, dict) else None}
+
+    device = str(data.get('device', DEFAULT_DEVICE))
+    if data.get('relay'):
+        return 'relay', device, None
+    try:
+        device_ts = backfill.parse_ts(data.get('ts'))
+    except ValueError:
+        device_ts = None  # firmware cũ / chưa đồng bộ NTP
+    if device_ts is not None:
+        ts = device_ts / 1000
+    else:
+        ts = received or time.time()
+        step = max(1, int(interval * 1000))
+        device_ts = int(ts * 1000) // step * step
+    return 'report', device, (ts, float(data.get('soil', 0)), int(data.get('pump', 0)),
+                              int(data.get('auto', 1)), int(data.get('wifi_rssi', -50)), device_ts)
+
+
+class IngestWorker:
+    """
+    1 pipeline ingestion gắn với 1 MQTT client
+
+    client: paho Client(manual_ack=True) hoặc local_broker.LocalClient -
+    cần on_message, subscribe, publish, ack(mid, qos)
+    name: tên cố định của worker (mặc định client_id), khoá của các điểm
+    bộ nén đang giữ trong bảng ingest_held
+    """
+
+    def __init__(self, db_path, client, group=settings.INGEST_GROUP, batch_size=settings.INGEST_BATCH,
+                 queue_size=settings.INGEST_QUEUE, deviation=settings.COMPRESS_DEVIATION,
+                 heartbeat=settings.COMPRESS_HEARTBEAT, gate=None, name=None,
+                 interval=settings.REPORT_INTERVAL):
+        self.db_path = db_path
+        self.client = client
+        self.group = group
+        self.name = name or getattr(client, 'client_id', '') or socket.gethostname()
+        self.interval = interval
+        self.batch_size = batch_size
+        self.heartbeat = heartbeat
+        # Đầy -> put() chặn network thread -> broker giữ message (backpressure)
+        self.inbox = queue.Queue(queue_size)     # (msg, received_at)
+        self.decoded = queue.Queue(queue_size)   # (kind, device, data, msg)
+        # Trạng thái nén riêng của process (xem README: giới hạn khi nhiều worker)
+        self.compressor = Compressor(deviation, heartbeat)
+        self.gate = gate or Admission(rate=settings.REPORT_RATE, burst=settings.REPORT_BURST,
+                                      concurrency=0, interval=settings.REPORT_INTERVAL)
+        # publish=None: chỉ ghi device_state, process Flask gửi state qua resend_unacked()
+        self.dispatcher = CommandDispatcher(db_path)
+        self.storage = storage.Storage(db_path)
+        self.stats = {'received': 0, 'reports': 0, 'bulk': 0, 'relayed': 0,
+                      'rejected': 0, 'throttled': 0, 'rows': 0, 'batches': 0, 'recovered': 0}
+        self._threads = []
+        client.on_message = self.on_message
+
+    def topics(self):
+        return [(share(REPORT_TOPIC, self.group), 1), (share(backfill.BULK_WILDCARD, self.group), 1)]
+
+    def subscribe(self):
+        for topic, qos in self.topics():
+            self.client.subscribe(topic, qos)
+
+    def start(self):
+        for target in (self._decode_loop, self._write_loop):
+            t = threading.Thread(target=target, name=f'ingest-{target.__name__[1:-5]}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def drain(self):
+        """Chờ xử lý xong mọi message đã nhận (demo / kiểm tra)"""
+        self.inbox.join()
+        self.decoded.join()
+
+    def stop(self, timeout=30):
+        """Dừng êm: xử lý hết hàng đợi, ghi các điểm bộ nén đang giữ"""
+        self.inbox.put(_STOP)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    # ================= TẦNG 1: NETWORK THREAD =================
+    def on_message(self, client, userdata, msg):
+        """Callback của MQTT client: chỉ xếp hàng, trả về ngay"""
+        self.inbox.put((msg, time.time()))
+
+    # ================= TẦNG 2: DECODE =================
+    def _decode_loop(self):
+        while True:
+            item = self.inbox.get()
+            if item is _STOP:
+                self.inbox.task_done()
+                self.decoded.put(_STOP)
+                return
+            msg, received = item
+            try:
+                kind, device, data = decode(msg.topic, msg.payload, received, self.interval)
+            except (ValueError, TypeError, AttributeError) as e:
+                kind, device, data = 'rejected', None, None
+                log.warning("⚠️ Bỏ MQTT message lỗi: %s", e,
+                            extra=fields(topic=msg.topic, payload=msg.payload[:100]))
+            if kind == 'report':
+                kind = self._admit(device)
+            self.stats['received'] += 1
+            self.decoded.put((kind, device, data, msg))
+            self.inbox.task_done()
+
+    def _admit(self, device):
+        """'report' nếu thiết bị còn token, ngược lại 'throttled' (+ gợi ý giãn nhịp)"""
+        decision = self.gate.admit(device)
+        if decision.ok:
+            return 'report'
+        if self.gate.hint_due(device, decision):
+            self.client.publish(THROTTLE_TOPIC.format(device=device), json.dumps(hint_payload(decision)))
+        return 'throttled'
+
+    # ================= TẦNG 3: GHI DB =================
+    def _write_loop(self):
+        con = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            self._retry(self._recover, con)
+            while True:
+                # Lô = mọi message đang chờ (tối đa batch_size): tải cao -> lô lớn, tải thấp -> ghi ngay
+                batch = [self.decoded.get()]
+                while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.decoded.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = batch[-1] is _STOP
+                items = batch[:-1] if stop else batch
+                if items:
+                    self._write(con, items)
+                if stop:
+                    self._retry(self._insert, con, [self._row(device, p) for device, points
+                                                    in self.compressor.flush().items() for p in points])
+                    self._retry(self._release, con)
+                for _ in batch:
+                    self.decoded.task_done()
+                if stop:
+                    return
+        finally:
+            con.close()
+            self.storage.close()
+
+    @staticmethod
+    def _row(device, point):
+        ts, soil, pump, auto, rssi, device_ts = point
+        return int(round(ts * 1000)), soil, pump, auto, 1, rssi, device, device_ts
+
+    def _insert(self, con, rows):
+        # Chưa chia shard: ghi trên con của writer thread như trước
+        self.storage.insert(rows, con)
+
+    # ================= ĐIỂM BỘ NÉN ĐANG GIỮ =================
+    def _hold(self, con, devices):
+        """Ghi điểm bộ nén đang giữ của các thiết bị vừa report (trước khi PUBACK)"""
+        if not self.compressor.enabled or not devices:
+            return
+        now = int(time.time() * 1000)
+        held, released = [], []
+        for device in devices:
+            point = self.compressor.held(device)
+            if point is None:
+                released.append((self.name, device))
+            else:
+                ts_ms, soil, pump, auto, _, rssi, _, device_ts = self._row(device, point)
+                held.append((self.name, device, ts_ms, soil, pump, auto, rssi, device_ts, now))
+        con.executemany("INSERT OR REPLACE INTO ingest_held VALUES(?,?,?,?,?,?,?,?,?)", held)
+        con.executemany("DELETE FROM ingest_held WHERE worker=? AND device=?", released)
+        con.commit()
+
+    def _release(self, con):
+        """Dừng êm: bộ nén đã flush vào logs, không còn điểm nào đang giữ"""
+        con.execute("DELETE FROM ingest_held WHERE worker=?", (self.name,))
+        con.commit()
+
+    def _recover(self, con):
+        """
+        Lúc khởi động: ghi vào logs các điểm đang giữ của lần chạy trước
+        (process bị kill) và của worker khác không cập nhật quá 2 x heartbeat
+        (máy chết hẳn). Điểm của worker còn sống bị ghi sớm cũng vô hại: đó là
+        reading thật, trùng (device, device_ts) thì bỏ qua.
+        """
+        cutoff = int((time.time() - 2 * self.heartbeat) * 1000)
+        held = con.execute("SELECT worker, device, ts_ms, soil, pump, auto, wifi_rssi, device_ts "
+                           "FROM ingest_held WHERE worker=? OR updated_ms < ?", (self.name, cutoff)).fetchall()
+        if not held:
+            return
+        self._insert(con, [(ts_ms, soil, pump, auto, 1, rssi, device, device_ts)
+                           for _, device, ts_ms, soil, pump, auto, rssi, device_ts in held])
+        # Chỉ xoá dòng chưa bị worker khác cập nhật trong lúc đó
+        con.executemany("DELETE FROM ingest_held WHERE worker=? AND device=? AND ts_ms=?",
+                        [r[:3] for r in held])
+        con.commit()
+        self.stats['recovered'] += len(held)
+        log.info("♻️ Ghi lại điểm bộ nén còn giữ", extra=fields(worker=self.name, points=len(held)))
+
+    def _bulk(self, con, device, data):
+        rows, rejected = backfill.normalize(data['readings'])
+        if self.storage.sharded:
+            shard = self.storage.connect(device)
+            try:
+                stats, _ = backfill.upsert(shard, device, rows)
+            finally:
+                shard.close()
+        else:
+            stats, _ = backfill.upsert(con, device, rows)
+        stats['rejected'] = rejected
+        stats['batch'] = data['batch']
+        return stats
+
+    def _retry(self, fn, *args):
+        """DB bận / khoá: thử lại tới khi được (hàng đợi đầy dần -> backpressure lên broker)"""
+        delay = 0.1
+        while True:
+            try:
+                return fn(*args)
+            except sqlite3.OperationalError as e:
+                args[0].rollback()
+                log.error("❌ Ghi logs lỗi, thử lại sau %.1fs: %s", delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    def _write(self, con, items):
+        rows, bulks, devices, reported = [], [], set(), set()
+        for kind, device, data, msg in items:
+            if kind == 'report':
+                self.stats['reports'] += 1
+                rows.extend(self._row(device, p) for p in self.compressor.add(device, data))
+                devices.add(device)
+                reported.add(device)
+            elif kind == 'bulk':
+                self.stats['bulk'] += 1
+                bulks.append((device, data))
+                devices.add(device)
+            elif kind == 'relay':
+                self.stats['relayed'] += 1
+            elif kind == 'throttled':
+                self.stats['throttled'] += 1
+            else:
+                self.stats['rejected'] += 1
+
+        self._retry(self._insert, con, rows)
+        self._retry(self._hold, con, reported)
+        self.stats['rows'] += len(rows)
+        for device, data in bulks:
+            stats = self._retry(self._bulk, con, device, data)
+            self.stats['rows'] += stats['inserted'] + stats['updated']
+            # Thiết bị chỉ xoá dữ liệu đệm sau khi nhận bulk_ack
+            self.client.publish(backfill.BULK_ACK_TOPIC.format(device=device), json.dumps(stats), qos=1)
+        for device in devices:
+            self.dispatcher.register_device(device, defaults=self._defaults)
+        self.stats['batches'] += 1
+
+        # Đã commit (logs + ingest_held) -> PUBACK; message hỏng cũng ack (giao lại vẫn hỏng)
+        for *_, msg in items:
+            self.client.ack(msg.mid, msg.qos)
+
+    def _defaults(self):
+        """Cấu hình chung (bảng config) cho thiết bị mới"""
+        con = sqlite3.connect(self.db_path)
+        row = con.execute('SELECT auto, pump_cmd, use_schedule FROM config WHERE id=1').fetchone()
+        con.close()
+        return dict(zip(('auto', 'pump_cmd', 'use_schedule'), row)) if row else {}
+
+
+# ================= CHẠY VỚI BROKER THẬT =================
+def mqtt_client(client_id):
+    """paho Client cho worker: session bền (clean_session=False) + manual ack"""
+    import paho.mqtt.client as paho
+
+    client = paho.Client(paho.CallbackAPIVersion.VERSION2, client_id=client_id,
+                         clean_session=False, manual_ack=True)
+    if settings.MQTT_USERNAME:
+        client.username_pw_set(settings.MQTT_USERNAME, settings.MQTT_PASSWORD)
+    if settings.MQTT_TLS_ENABLED:
+        client.tls_set()
+    return client
+
+
+def run(index=0, db_path=settings.DB, group=settings.INGEST_GROUP):
+    """
+    1 process ingestion, chạy tới khi nhận SIGTERM / SIGINT
+
+    client_id cố định theo host + index: process khởi động lại nhận tiếp
+    các message QoS 1 chưa ack trong session cũ
+    """
+    client_id = f'{group}-{socket.gethostname()}-{index}'
+    client = mqtt_client(client_id)
+    worker = IngestWorker(db_path, client, group, name=client_id).start()
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            log.warning("⚠️ MQTT connect lỗi: %s", reason_code)
+            return
+        worker.subscribe()
+        log.info("✅ Ingest worker đã kết nối", extra=fields(index=index, group=group))
+
+    client.on_connect = on_connect
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    client.connect_async(settings.MQTT_BROKER_URL, settings.MQTT_BROKER_PORT, settings.MQTT_KEEPALIVE)
+    client.loop_start()
+    while not stopping.wait(60):
+        log.info("📊 Ingest", extra=fields(index=index, queued=worker.inbox.qsize(), **worker.stats))
+
+    # Ngừng nhận, xử lý + ack nốt phần đã nhận rồi mới ngắt kết nối
+    for topic, _ in worker.topics():
+        client.unsubscribe(topic)
+    worker.stop()
+    client.disconnect()
+    client.loop_stop()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Worker ingestion MQTT (shared subscription)')
+    ap.add_argument('--db', default=settings.DB)
+    ap.add_argument('--group', default=settings.INGEST_GROUP)
+    ap.add_argument('--processes', type=int, default=settings.INGEST_PROCESSES)
+    ap.add_argument('--local', action='store_true', help='demo với broker giả lập + DB tạm (local_broker.py)')
+    args = ap.parse_args(argv)
+    if args.local:
+        args.db = os.path.join(tempfile.mkdtemp(), 'demo.db')
+
+    # Schema (ts_ms, device_ts, device_state) phải có trước khi ghi
+    migrations.migrate(args.db)
+    CommandDispatcher(args.db).init_db()
+    storage.ensure(args.db, settings.SHARDS).close()
+
+    if args.local:
+        return demo(args.db)
+    if args.processes <= 1:
+        return run(0, args.db, args.group)
+
+    procs = [multiprocessing.Process(target=run, args=(i, args.db, args.group), name=f'ingest-{i}')
+             for i in range(args.processes)]
+    for p in procs:
+        p.start()
+
+    def forward(signum, frame):
+        for p in procs:
+            p.terminate()  # SIGTERM -> mỗi process dừng êm
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for p in procs:
+        p.join()
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+def demo(db_path, workers=3, devices=20, readings=50):
+    """3 worker chung nhóm trên broker giả lập, 1 worker mất PUBACK rồi rớt mạng"""
+    from local_broker import LocalBroker
+
+    broker = LocalBroker()
+    pool = []
+    for i in range(workers):
+        # rate=0: demo phát liền mọi reading, không giới hạn theo thiết bị
+        w = IngestWorker(db_path, broker.client(f'ingest-{i}', manual_ack=True), deviation=0,
+                         gate=Admission(rate=0)).start()
+        w.subscribe()
+        pool.append(w)
+    # Worker 0 đã ghi DB nhưng PUBACK không tới broker
+    pool[0].client.ack = lambda mid, qos: None
+
+    start = int(time.time()) - readings
+    for n in range(readings):
+        for d in range(devices):
+            dev = broker.client(f'esp-{d}')
+            dev.publish(REPORT_TOPIC, json.dumps({'device': f'esp-{d}', 'ts': start + n,
+                                                  'soil': 50 + (n * 7 + d) % 11, 'pump': 0, 'auto': 1}), qos=1)
+        if n == readings // 2:
+            pool[0].drain()
+            pool[0].client.disconnect()  # broker giao lại mọi message chưa ack cho worker 1, 2
+    # Report HTTP được server publish lại -> bỏ qua, không ghi 2 lần
+    broker.client('server').publish(REPORT_TOPIC, json.dumps({'device': 'esp-0', 'soil': 1, 'relay': 'http'}), qos=1)
+
+    for w in pool:
+        w.drain()
+        w.stop()
+    con = storage.connect(db_path)
+    total, distinct = con.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT device || '/' || device_ts) FROM logs WHERE device LIKE 'esp-%'").fetchone()
+    con.close()
+    for i, w in enumerate(pool):
+        print(f"👷 worker {i}: {w.stats}")
+    print(f"📥 Gửi {devices * readings} report -> logs có {total} dòng ({distinct} không trùng)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
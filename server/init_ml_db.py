@@ -1,64 +1,15 @@
-import sqlite3
+import settings
+import migrations
 
-DB = "tuoi.db"
+DB = settings.DB
 
 def extend_db():
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
-    
-    # 1. Add ML prediction columns to logs table
-    try:
-        cur.execute("ALTER TABLE logs ADD COLUMN predicted_soil REAL")
-        cur.execute("ALTER TABLE logs ADD COLUMN prediction_error REAL")
-        cur.execute("ALTER TABLE logs ADD COLUMN weather_temp REAL")
-        cur.execute("ALTER TABLE logs ADD COLUMN weather_humidity INTEGER")
-        cur.execute("ALTER TABLE logs ADD COLUMN weather_rain REAL")
-        print("Added ML columns to logs table")
-    except sqlite3.OperationalError as e:
-        print(f"Columns may already exist: {e}")
-    
-    # 2. Create ML predictions table
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS ml_predictions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            prediction_time TEXT NOT NULL,
-            predicted_value REAL NOT NULL,
-            confidence REAL,
-            model_version TEXT
-        )
-    ''')
-    print("Created ml_predictions table")
-    
-    # 3. Create anomalies table
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS anomalies (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            type TEXT NOT NULL,
-            severity TEXT NOT NULL,
-            message TEXT,
-            details TEXT,
-            resolved INTEGER DEFAULT 0
-        )
-    ''')
-    print("Created anomalies table")
-    
-    # 4. Create weather cache table
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS weather_cache (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            location TEXT,
-            data TEXT,
-            expires_at TEXT
-        )
-    ''')
-    print("Created weather_cache table")
-    
-    con.commit()
-    con.close()
-    print("\n🎉 Database extended successfully!")
+    # Cột ML trong logs + bảng ml_predictions / anomalies / weather_cache
+    # giờ là migration có version (migrations.py): mỗi cột được kiểm tra riêng,
+    # chạy lại nhiều lần không lỗi
+    ran = migrations.migrate(DB)
+    print(f"Applied migrations: {ran or 'none'}")
+    print(f"\n🎉 Database extended successfully! (schema version {migrations.current_version(DB)})")
 
 if __name__ == "__main__":
-    extend_db()
\ No newline at end of file
+    extend_db()
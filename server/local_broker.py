@@ -0,0 +1,188 @@
+import threading
+import itertools
+from collections import defaultdict
+
+
+def topic_matches(pattern, topic):
+    """So khớp topic MQTT với pattern có wildcard '+' và '#'"""
+    p_parts = pattern.split('/')
+    t_parts = topic.split('/')
+
+    for i, p in enumerate(p_parts):
+        if p == '#':
+            return True
+        if i >= len(t_parts):
+            return False
+        if p != '+' and p != t_parts[i]:
+            return False
+
+    return len(p_parts) == len(t_parts)
+
+
+def split_share(pattern):
+    """'$share/<group>/<filter>' -> (group, filter); subscription thường -> (None, pattern)"""
+    if pattern.startswith('$share/'):
+        _, group, topic_filter = pattern.split('/', 2)
+        return group, topic_filter
+    return None, pattern
+
+
+class LocalMessage:
+    """Giống paho.mqtt.client.MQTTMessage (chỉ các field mà server dùng)"""
+
+    def __init__(self, topic, payload, qos=0, retain=False, mid=0, dup=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+        self.dup = dup
+
+
+class LocalBroker:
+    """
+    Broker MQTT chạy trong process (stand-in cho HiveMQ/Mosquitto)
+
+    Dùng cho benchmark và chạy thử không cần mạng:
+    - Subscribe với wildcard '+' / '#'
+    - Retained message (gửi lại cho subscriber mới)
+    - Shared subscription '$share/<group>/<filter>': mỗi message chỉ giao cho
+      1 client trong nhóm (round-robin), không gửi retained
+    - QoS 1 + manual ack: message chưa ack được giao lại (dup=True) cho
+      client khác trong nhóm khi client đang giữ nó disconnect
+    - Giao message đồng bộ trong thread của người publish
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._subs = defaultdict(list)   # pattern -> [client]
+        self._retained = {}              # topic -> LocalMessage
+        self._turn = defaultdict(int)    # pattern '$share/...' -> lượt round-robin
+        self._mid = itertools.count(1)
+        self.published = []              # (topic, payload, qos, retain) - để kiểm tra
+
+    def client(self, client_id='', manual_ack=False):
+        return LocalClient(self, client_id, manual_ack)
+
+    def retained(self, topic):
+        """Lấy retained message hiện tại của topic (hoặc None)"""
+        msg = self._retained.get(topic)
+        return msg.payload if msg else None
+
+    def _subscribe(self, client, pattern, qos):
+        with self._lock:
+            if client not in self._subs[pattern]:
+                self._subs[pattern].append(client)
+            group, _ = split_share(pattern)
+            retained = [] if group else [m for t, m in self._retained.items() if topic_matches(pattern, t)]
+
+        for msg in retained:
+            client._deliver(msg, pattern)
+
+    def _unsubscribe(self, client, pattern):
+        with self._lock:
+            if client in self._subs.get(pattern, []):
+                self._subs[pattern].remove(client)
+
+    def _disconnect(self, client):
+        """Client rời broker: bỏ mọi subscription, giao lại message QoS > 0 chưa ack"""
+        with self._lock:
+            for clients in self._subs.values():
+                if client in clients:
+                    clients.remove(client)
+            inflight, client._inflight = list(client._inflight.values()), {}
+
+        # Chỉ subscription shared mới chuyển cho client khác trong nhóm
+        for msg, pattern in inflight:
+            target = self._next_member(pattern)
+            if target is not None:
+                target._deliver(LocalMessage(msg.topic, msg.payload, msg.qos, msg.retain, msg.mid, dup=True),
+                                pattern)
+
+    def _next_member(self, pattern):
+        """Client kế tiếp (round-robin) của nhóm shared, None nếu nhóm rỗng / không phải shared"""
+        with self._lock:
+            clients = self._subs.get(pattern)
+            if not clients or split_share(pattern)[0] is None:
+                return None
+            turn = self._turn[pattern]
+            self._turn[pattern] = turn + 1
+            return clients[turn % len(clients)]
+
+    def _targets(self, topic):
+        """[(client, pattern)]: mọi subscriber thường + 1 client / nhóm shared"""
+        targets, seen = [], set()
+        with self._lock:
+            for pattern, clients in list(self._subs.items()):
+                if not clients or not topic_matches(split_share(pattern)[1], topic):
+                    continue
+                if split_share(pattern)[0]:
+                    clients = [self._next_member(pattern)]
+                for c in clients:
+                    if id(c) not in seen:
+                        seen.add(id(c))
+                        targets.append((c, pattern))
+        return targets
+
+    def _publish(self, topic, payload, qos, retain):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        elif payload is None:
+            payload = b''
+
+        mid = next(self._mid)
+        msg = LocalMessage(topic, payload, qos, retain, mid)
+
+        with self._lock:
+            self.published.append((topic, payload, qos, retain))
+            if retain:
+                # Payload rỗng = xoá retained (giống broker thật)
+                if payload:
+                    self._retained[topic] = msg
+                else:
+                    self._retained.pop(topic, None)
+
+        for c, pattern in self._targets(topic):
+            c._deliver(msg, pattern)
+
+        return mid
+
+
+class LocalClient:
+    """Client giả lập API của paho Client / flask_mqtt.Mqtt"""
+
+    def __init__(self, broker, client_id='', manual_ack=False):
+        self.broker = broker
+        self.client_id = client_id
+        self.manual_ack = manual_ack
+        self.on_message = None
+        self.connected = True
+        self._inflight = {}   # mid -> (LocalMessage, pattern) QoS > 0 chưa ack (manual_ack)
+
+    def subscribe(self, topic, qos=0):
+        self.broker._subscribe(self, topic, qos)
+        return 0, 0
+
+    def unsubscribe(self, topic):
+        self.broker._unsubscribe(self, topic)
+        return 0, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        mid = self.broker._publish(topic, payload, qos, retain)
+        return 0, mid
+
+    def ack(self, mid, qos):
+        """Giống paho Client.ack (manual_ack=True): xác nhận đã xử lý xong message"""
+        self._inflight.pop(mid, None)
+
+    def disconnect(self):
+        self.connected = False
+        self.broker._disconnect(self)
+
+    def _deliver(self, msg, pattern=None):
+        if not self.connected:
+            return
+        if self.manual_ack and msg.qos > 0:
+            self._inflight[msg.mid] = (msg, pattern)
+        if self.on_message is not None:
+            self.on_message(self, None, msg)
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+
+# ================= LOGGING CÓ CẤP ĐỘ + GIỚI HẠN TẦN SUẤT =================
+# TUOI_LOG_LEVEL=DEBUG|INFO|WARNING|ERROR   (mặc định INFO)
+# TUOI_LOG_FORMAT=text|json                 (mặc định text)
+# TUOI_LOG_RATE=20                          (tối đa 20 dòng giống nhau / 10 giây)
+
+RATE_WINDOW = 10  # seconds
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Giới hạn số dòng log cùng loại (logger + level + template) trong 1 cửa sổ.
+    Dòng đầu tiên của cửa sổ kế tiếp sẽ ghi kèm số dòng đã bị bỏ.
+    """
+
+    def __init__(self, rate, window=RATE_WINDOW):
+        super().__init__()
+        self.rate = rate
+        self.window = window
+        self._state = {}  # key -> [window_start, count, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                self._state[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+
+            state[1] += 1
+            if state[1] <= self.rate:
+                return True
+            state[2] += 1
+            return False
+
+
+class TextFormatter(logging.Formatter):
+    """2025-11-09T10:30:00 INFO  tuoi.app 📥 Report | device=esp32 soil=45.0"""
+
+    def format(self, record):
+        ts = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+        line = f"{ts} {record.levelname:<5} {record.name} {record.getMessage()}"
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' | ' + ' '.join(f'{k}={v}' for k, v in fields.items())
+        if getattr(record, 'suppressed', 0):
+            line += f' (+{record.suppressed} dòng tương tự đã bỏ qua)'
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        data.update(getattr(record, 'fields', None) or {})
+        if getattr(record, 'suppressed', 0):
+            data['suppressed'] = record.suppressed
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def configure():
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        _configured = True
+
+        root = logging.getLogger('tuoi')
+        root.setLevel(os.environ.get('TUOI_LOG_LEVEL', 'INFO').upper())
+        root.propagate = False
+
+        handler = logging.StreamHandler(sys.stdout)
+        if os.environ.get('TUOI_LOG_FORMAT', 'text') == 'json':
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(TextFormatter())
+        handler.addFilter(RateLimitFilter(int(os.environ.get('TUOI_LOG_RATE', 20))))
+        root.addHandler(handler)
+
+
+def get_logger(name):
+    configure()
+    return logging.getLogger(f'tuoi.{name}')
+
+
+def fields(**kwargs):
+    """Dùng với extra=: log.info("📥 Report", extra=fields(device=d, soil=s))"""
+    return {'fields': kwargs}
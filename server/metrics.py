@@ -0,0 +1,171 @@
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+# Bucket mặc định (giây): từ 0.5ms tới 10s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    body = ','.join(f'{k}="{v}"' for k, v in items)
+    return '{' + body + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.type = 'counter'
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), v) for key, v in self._values.items()]
+
+
+class Gauge(Counter):
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self.type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram:
+    """Histogram dạng Prometheus (bucket cộng dồn + sum + count)"""
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.type = 'histogram'
+        self.buckets = tuple(buckets)
+        self._values = {}  # key -> [bucket_counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(_label_key(labels))
+        return entry[2] if entry else 0
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, total, n) in self._values.items():
+                cumulative = 0
+                for b, c in zip(self.buckets, counts):
+                    cumulative += c
+                    out.append((self.name + '_bucket', key, (('le', repr(float(b))),), cumulative))
+                out.append((self.name + '_bucket', key, (('le', '+Inf'),), n))
+                out.append((self.name + '_sum', key, (), total))
+                out.append((self.name + '_count', key, (), n))
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, **kwargs)
+            return metric
+
+    def counter(self, name, help_text=''):
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name, help_text=''):
+        return self._get(Gauge, name, help_text)
+
+    def histogram(self, name, help_text='', buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def render(self):
+        """Xuất theo text format của Prometheus (version 0.0.4)"""
+        lines = []
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for sample_name, key, extra, value in metric.samples():
+                lines.append(f'{sample_name}{_format_labels(key, extra)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# ================= METRICS CỦA SERVER =================
+REPORTS = REGISTRY.counter('tuoi_reports_total', 'Số report nhận được theo nguồn và kết quả')
+REPORT_SECONDS = REGISTRY.histogram('tuoi_report_seconds', 'Thời gian xử lý 1 report')
+ADMISSION = REGISTRY.counter('tuoi_admission_total', 'Report theo nguồn và quyết định admission (accepted/throttled/overloaded)')
+REPORTS_IN_FLIGHT = REGISTRY.gauge('tuoi_reports_in_flight', 'Số report đang xử lý (giới hạn TUOI_REPORT_CONCURRENCY)')
+INGEST_READINGS = REGISTRY.counter('tuoi_ingest_readings_total', 'Số reading nhận được (trước khi nén)')
+INGEST_ROWS = REGISTRY.counter('tuoi_ingest_rows_total', 'Số dòng thực sự ghi vào logs (sau khi nén)')
+BULK_READINGS = REGISTRY.counter('tuoi_bulk_readings_total', 'Reading nhận qua bulk backfill theo kết quả (inserted/updated/duplicate/rejected)')
+DB_WRITE_SECONDS = REGISTRY.histogram('tuoi_db_write_seconds', 'Thời gian ghi SQLite')
+DB_ERRORS = REGISTRY.counter('tuoi_db_errors_total', 'Số lần ghi SQLite lỗi')
+SCHEDULER_SECONDS = REGISTRY.histogram('tuoi_scheduler_tick_seconds', 'Thời gian 1 vòng scheduler')
+SCHEDULER_DECISIONS = REGISTRY.counter('tuoi_scheduler_decisions_total', 'Quyết định bật/tắt bơm của scheduler')
+MQTT_PUBLISH = REGISTRY.counter('tuoi_mqtt_publish_total', 'Số message MQTT publish theo kết quả')
+MQTT_PUBLISH_SECONDS = REGISTRY.histogram('tuoi_mqtt_publish_seconds', 'Thời gian gọi publish MQTT')
+MQTT_DROPPED = REGISTRY.counter('tuoi_mqtt_dropped_total', 'Message MQTT bị bỏ do lỗi decode/xử lý')
+RULE_ALERTS = REGISTRY.counter('tuoi_rule_alerts_total', 'Số lần luật alert khớp theo mức độ (trước cooldown Telegram)')
+EXPORT_ROWS = REGISTRY.counter('tuoi_export_rows_total', 'Số dòng logs đã xuất qua /api/export theo định dạng')
+TELEGRAM = REGISTRY.counter('tuoi_telegram_total', 'Số tin Telegram theo kết quả')
+TELEGRAM_SECONDS = REGISTRY.histogram('tuoi_telegram_seconds', 'Thời gian gửi Telegram')
+ML_SECONDS = REGISTRY.histogram('tuoi_ml_inference_seconds', 'Thời gian chạy ML theo endpoint')
+ML_JOBS = REGISTRY.counter('tuoi_ml_jobs_total', 'Số job ML chạy trong process pool theo kết quả')
+ML_REQUESTS = REGISTRY.counter('tuoi_ml_requests_total', 'Request ML theo trạng thái cache (cached/coalesced/fresh/stale/pending)')
+
+
+def timed(histogram, **labels):
+    """Decorator đo thời gian hàm vào histogram"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
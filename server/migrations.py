@@ -0,0 +1,374 @@
+import sys
+import time
+import sqlite3
+import argparse
+from contextlib import contextmanager
+from command_dispatcher import DEFAULT_DEVICE
+from logger import get_logger, fields
+
+log = get_logger('migrations')
+
+# ================= MIGRATION SCHEMA CÓ VERSION =================
+# Mỗi thay đổi schema là 1 migration (version, tên, hàm). Bảng schema_version
+# ghi lại các version đã chạy -> khởi động chỉ chạy migration còn thiếu.
+#
+# Quy ước:
+#   - Migration phải idempotent: tuoi.db cũ có bảng/cột từ trước khi có
+#     schema_version, và nhiều worker gunicorn có thể migrate cùng lúc
+#     -> kiểm tra cột/bảng trước khi ALTER, mỗi bước trong BEGIN IMMEDIATE
+#   - Không sửa migration đã phát hành, thêm migration mới ở cuối
+#   - Dữ liệu lớn: cập nhật theo từng chunk (mỗi chunk 1 transaction ngắn)
+#     để process khác vẫn ghi được trong lúc migrate
+#
+#   python migrations.py            # chạy migration còn thiếu
+#   python migrations.py --status   # xem version hiện tại
+
+CHUNK = 5000   # số dòng / transaction khi chuyển dữ liệu
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+@contextmanager
+def _transaction(con):
+    """BEGIN IMMEDIATE: giữ khoá ghi ngay từ đầu -> 2 process không cùng kiểm tra rồi cùng ALTER"""
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        yield con
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+
+def _columns(con, table):
+    return {r[1] for r in con.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column(con, table, column, decl):
+    """Mỗi cột 1 lần kiểm tra -> cột đã có không làm bỏ qua các cột sau"""
+    if column not in _columns(con, table):
+        con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        return True
+    return False
+
+
+# ISO TEXT (giờ địa phương, datetime.now().isoformat()) -> epoch ms, tính trong SQLite
+_ISO_TO_MS = "CAST(round((julianday({col}, 'utc') - 2440587.5) * 86400000) AS INTEGER)"
+
+
+# ================= CÁC MIGRATION =================
+@migration(1, 'base_schema')
+def _base_schema(con):
+    with _transaction(con):
+        con.execute('''CREATE TABLE IF NOT EXISTS config(
+            id INTEGER PRIMARY KEY,
+            auto INTEGER DEFAULT 1,
+            use_schedule INTEGER DEFAULT 0,
+            start_time TEXT DEFAULT '06:00',
+            end_time TEXT DEFAULT '06:10',
+            pump_cmd INTEGER DEFAULT 0
+        )''')
+        con.execute('INSERT OR IGNORE INTO config(id, auto) VALUES(1, 1)')
+        con.execute('''CREATE TABLE IF NOT EXISTS logs(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts TEXT, soil REAL, pump INTEGER, auto INTEGER,
+            wifi_connected INTEGER DEFAULT 0, wifi_rssi INTEGER DEFAULT 0
+        )''')
+
+
+@migration(2, 'logs_device')
+def _logs_device(con):
+    with _transaction(con):
+        # Dữ liệu cũ (1 ESP32) -> gán cho thiết bị mặc định
+        if _add_column(con, 'logs', 'device', 'TEXT'):
+            con.execute("UPDATE logs SET device=?", (DEFAULT_DEVICE,))
+        # device_ts: thời điểm đo trên thiết bị (epoch ms), chỉ có ở dữ liệu bulk backfill
+        _add_column(con, 'logs', 'device_ts', 'INTEGER')
+        con.execute("DROP INDEX IF EXISTS idx_logs_device")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_logs_device_ts ON logs(device, ts)")
+        con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_logs_device_reading ON logs(device, device_ts)")
+
+
+@migration(3, 'ml_schema')
+def _ml_schema(con):
+    # Trước đây là init_ml_db.py (5 ALTER trong 1 try: ALTER đầu lỗi -> bỏ qua cả 4 cột sau)
+    with _transaction(con):
+        _add_column(con, 'logs', 'predicted_soil', 'REAL')
+        _add_column(con, 'logs', 'prediction_error', 'REAL')
+        _add_column(con, 'logs', 'weather_temp', 'REAL')
+        _add_column(con, 'logs', 'weather_humidity', 'INTEGER')
+        _add_column(con, 'logs', 'weather_rain', 'REAL')
+        con.execute('''CREATE TABLE IF NOT EXISTS ml_predictions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            prediction_time TEXT NOT NULL,
+            predicted_value REAL NOT NULL,
+            confidence REAL,
+            model_version TEXT
+        )''')
+        con.execute('''CREATE TABLE IF NOT EXISTS anomalies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            type TEXT NOT NULL,
+            severity TEXT NOT NULL,
+            message TEXT,
+            details TEXT,
+            resolved INTEGER DEFAULT 0
+        )''')
+        con.execute('''CREATE TABLE IF NOT EXISTS weather_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            location TEXT,
+            data TEXT,
+            expires_at TEXT
+        )''')
+
+
+# Bảng ML mới: (tên, cột cũ -> cột mới, schema mới, index)
+_ML_TABLES = (
+    ('ml_predictions', {'timestamp': 'ts_ms', 'prediction_time': 'prediction_ms'}, '''(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts_ms INTEGER NOT NULL,
+        prediction_ms INTEGER NOT NULL,
+        predicted_value REAL NOT NULL,
+        confidence REAL,
+        model_version TEXT
+    )''', "CREATE INDEX IF NOT EXISTS idx_ml_predictions_time ON ml_predictions(prediction_ms)"),
+    ('anomalies', {'timestamp': 'ts_ms'}, '''(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts_ms INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        severity TEXT NOT NULL,
+        message TEXT,
+        details TEXT,
+        resolved INTEGER DEFAULT 0
+    )''', "CREATE INDEX IF NOT EXISTS idx_anomalies_time ON anomalies(ts_ms)"),
+    ('weather_cache', {'timestamp': 'ts_ms', 'expires_at': 'expires_ms'}, '''(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts_ms INTEGER NOT NULL,
+        location TEXT,
+        data TEXT,
+        expires_ms INTEGER
+    )''', "CREATE INDEX IF NOT EXISTS idx_weather_cache_location ON weather_cache(location, expires_ms)"),
+)
+
+
+@migration(4, 'epoch_ms')
+def _epoch_ms(con):
+    """
+    Thời gian dạng số nguyên epoch ms thay cho ISO TEXT
+
+    logs.ts_ms: so sánh số nguyên trên index, không phải parse chuỗi khi đọc.
+    Dữ liệu cũ chuyển theo chunk (id giảm dần: dữ liệu gần đây - thứ ring
+    buffer / ML cần trước - xong trước), cột ts cũ được xoá về NULL để giải
+    phóng chỗ (dòng có ts không parse được giữ nguyên). Chạy lại sau khi bị
+    ngắt sẽ tiếp tục các dòng còn thiếu.
+    """
+    with _transaction(con):
+        _add_column(con, 'logs', 'ts_ms', 'INTEGER')
+        # Process chạy code cũ (rolling restart) vẫn ghi ts TEXT -> tự chuyển sang ts_ms
+        con.execute(f'''CREATE TRIGGER IF NOT EXISTS logs_ts_ms AFTER INSERT ON logs
+            WHEN NEW.ts_ms IS NULL AND julianday(NEW.ts) IS NOT NULL
+            BEGIN
+                UPDATE logs SET ts_ms = {_ISO_TO_MS.format(col='NEW.ts')}, ts = NULL WHERE id = NEW.id;
+            END''')
+
+    hi = con.execute("SELECT max(id) FROM logs").fetchone()[0] or 0
+    total, chunks, started = 0, 0, time.time()
+    while hi > 0:
+        # Range scan trên rowid, mỗi chunk 1 transaction ngắn
+        with _transaction(con):
+            cur = con.execute(
+                f"UPDATE logs SET ts_ms = {_ISO_TO_MS.format(col='ts')}, ts = NULL "
+                f"WHERE id > ? AND id <= ? AND ts_ms IS NULL AND julianday(ts) IS NOT NULL",
+                (hi - CHUNK, hi))
+        total += cur.rowcount
+        hi -= CHUNK
+        chunks += 1
+        if chunks % 20 == 0:
+            log.info("⏳ Migrate logs.ts_ms", extra=fields(rows=total, remaining_id=hi))
+
+    with _transaction(con):
+        con.execute("DROP INDEX IF EXISTS idx_logs_device_ts")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_logs_device_time ON logs(device, ts_ms)")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_logs_time ON logs(ts_ms)")
+
+        # Bảng ML nhỏ -> tạo lại bảng trong 1 transaction (SQLite không đổi được kiểu cột)
+        for table, renames, schema, index in _ML_TABLES:
+            old = _columns(con, table)
+            if old and not set(renames) <= old:
+                continue   # đã chuyển
+            con.execute(f"CREATE TABLE {table}_new {schema}")
+            if old:
+                sources = {new: _ISO_TO_MS.format(col=src) for src, new in renames.items()}
+                sources.update((c, c) for c in _columns(con, f'{table}_new') if c in old)
+                con.execute(f"INSERT INTO {table}_new({', '.join(sources)}) "
+                            f"SELECT {', '.join(sources.values())} FROM {table}")
+                con.execute(f"DROP TABLE {table}")
+            con.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+            con.execute(index)
+    log.info("✅ logs.ts_ms", extra=fields(rows=total, seconds=round(time.time() - started, 1)))
+
+
+@migration(5, 'ml_trials')
+def _ml_trials(con):
+    """Kết quả tìm hyperparameter LSTM (ml_models/lstm_tuning.py), 1 dòng / trial"""
+    with _transaction(con):
+        con.execute('''CREATE TABLE IF NOT EXISTS ml_trials(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            study TEXT NOT NULL,
+            model_version TEXT NOT NULL,
+            params TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'QUEUED',
+            curve TEXT,
+            epochs INTEGER,
+            val_loss REAL,
+            val_mae REAL,
+            n_params INTEGER,
+            seconds REAL,
+            predict_ms REAL,
+            ts_ms INTEGER NOT NULL
+        )''')
+        con.execute("CREATE INDEX IF NOT EXISTS idx_ml_trials_study ON ml_trials(study, state)")
+
+
+@migration(6, 'shards')
+def _shards(con):
+    """Danh sách file shard chứa logs (storage.py), rỗng = logs nằm ngay trong DB này"""
+    with _transaction(con):
+        con.execute('''CREATE TABLE IF NOT EXISTS shards(
+            idx INTEGER PRIMARY KEY,
+            path TEXT NOT NULL
+        )''')
+
+
+@migration(7, 'alert_rules')
+def _alert_rules(con):
+    """Luật cảnh báo / ngưỡng theo thiết bị, zone hoặc toàn hệ thống (rules.py)"""
+    with _transaction(con):
+        con.execute('''CREATE TABLE IF NOT EXISTS alert_rules(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            scope TEXT NOT NULL DEFAULT 'global',
+            target TEXT NOT NULL DEFAULT '',
+            condition TEXT NOT NULL,
+            action TEXT NOT NULL DEFAULT 'alert',
+            severity TEXT NOT NULL DEFAULT 'WARNING',
+            message TEXT,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            updated_ms INTEGER NOT NULL
+        )''')
+        con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_alert_rules_key ON alert_rules(scope, target, name)")
+
+
+@migration(8, 'ingest_held')
+def _ingest_held(con):
+    """
+    Điểm bộ nén của ingest_worker đang giữ trong RAM (chưa vào logs), 1 dòng /
+    (worker, thiết bị): ghi trước khi PUBACK -> worker chết không mất reading
+    """
+    with _transaction(con):
+        con.execute('''CREATE TABLE IF NOT EXISTS ingest_held(
+            worker TEXT NOT NULL,
+            device TEXT NOT NULL,
+            ts_ms INTEGER NOT NULL,
+            soil REAL,
+            pump INTEGER,
+            auto INTEGER,
+            wifi_rssi INTEGER,
+            device_ts INTEGER,
+            updated_ms INTEGER NOT NULL,
+            PRIMARY KEY(worker, device)
+        )''')
+
+
+@migration(9, 'wal')
+def _wal(con):
+    """
+    Chuyển sang WAL (lưu trong file, mọi kết nối sau đều dùng): người đọc giữ
+    1 snapshot (export.py) không chặn người ghi. Ngoài transaction: SQLite
+    không đổi journal_mode trong transaction. File trên ổ mạng / :memory:
+    không hỗ trợ WAL -> giữ journal cũ.
+    """
+    mode = con.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    if mode != 'wal':
+        log.warning("⚠️ Không bật được WAL, giữ journal_mode=%s", mode)
+
+
+# ================= CHẠY MIGRATION =================
+def _applied(con):
+    con.execute('''CREATE TABLE IF NOT EXISTS schema_version(
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_ms INTEGER
+    )''')
+    return {r[0] for r in con.execute("SELECT version FROM schema_version")}
+
+
+def current_version(db_path):
+    con = sqlite3.connect(db_path)
+    version = max(_applied(con), default=0)
+    con.close()
+    return version
+
+
+def migrate(db_path, target=None):
+    """
+    Chạy các migration còn thiếu theo thứ tự version
+
+    Returns:
+        list version vừa chạy
+    """
+    # isolation_level=None: migration tự quản lý transaction (_transaction)
+    con = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    ran = []
+    try:
+        for version, name, fn in sorted(MIGRATIONS):
+            if target is not None and version > target:
+                break
+            # Kiểm tra lại mỗi lần: worker khác có thể vừa chạy xong
+            if version in _applied(con):
+                continue
+            started = time.time()
+            fn(con)
+            con.execute("INSERT OR IGNORE INTO schema_version VALUES(?, ?, ?)",
+                        (version, name, int(time.time() * 1000)))
+            ran.append(version)
+            log.info("🧱 Migration", extra=fields(version=version, name=name,
+                                                  seconds=round(time.time() - started, 2)))
+    finally:
+        con.close()
+    return ran
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+if __name__ == "__main__":
+    import settings
+
+    ap = argparse.ArgumentParser(description='Migration schema database')
+    ap.add_argument('--db', default=settings.DB)
+    ap.add_argument('--status', action='store_true', help='chỉ in version hiện tại')
+    ap.add_argument('--target', type=int, help='dừng ở version này')
+    args = ap.parse_args()
+
+    if args.status:
+        con = sqlite3.connect(args.db)
+        done = _applied(con)
+        con.close()
+        for version, name, _ in sorted(MIGRATIONS):
+            print(f"{'✅' if version in done else '⏳'} {version:>3} {name}")
+        sys.exit(0)
+
+    ran = migrate(args.db, args.target)
+    print(f"🎉 {args.db}: schema version {current_version(args.db)}"
+          + (f" (vừa chạy {ran})" if ran else " (không có gì để chạy)"))
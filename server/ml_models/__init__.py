@@ -1,5 +1,20 @@
-from .soil_prediction import SoilMoistureLSTM
-from .weather_integration import WeatherService
-from .anomaly_detection import AnomalyDetector
+# Import lazy: AnomalyDetector / WeatherService không cần TensorFlow,
+# chỉ SoilMoistureLSTM mới import tensorflow khi được dùng tới
+_EXPORTS = {
+    'SoilMoistureLSTM': '.soil_prediction',
+    'WeatherService': '.weather_integration',
+    'AnomalyDetector': '.anomaly_detection',
+    'FleetAnomalyDetector': '.fleet_anomaly',
+    'FeatureStore': '.feature_store',
+    'ZoneForecaster': '.forecasters',
+}
 
-__all__ = ['SoilMoistureLSTM', 'WeatherService', 'AnomalyDetector']
\ No newline at end of file
+__all__ = ['SoilMoistureLSTM', 'WeatherService', 'AnomalyDetector', 'FleetAnomalyDetector', 'FeatureStore',
+           'ZoneForecaster']
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        from importlib import import_module
+        return getattr(import_module(_EXPORTS[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
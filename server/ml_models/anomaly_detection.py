@@ -1,10 +1,14 @@
 import numpy as np
 import pandas as pd
-import sqlite3
 from datetime import datetime, timedelta
+from dateutil.tz import tzlocal
 from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import StandardScaler
 import joblib
+from storage import connect
+from rules import RuleEngine
+from .feature_store import (FeatureStore, RECONSTRUCT_STEP, MAX_GAP_STEPS,
+                            reconstruct, isolation_matrix)
 
 class AnomalyDetector:
     """
@@ -16,37 +20,67 @@ class AnomalyDetector:
     5. Water leak (rò rỉ nước)
     """
     
-    def __init__(self, db_path='tuoi.db'):
+    def __init__(self, db_path='tuoi.db', analytics=None, features=None, rules=None):
+        """
+        Args:
+            analytics: (tuỳ chọn) analytics.Analytics -> quét / resample trong DuckDB
+            features: (tuỳ chọn) FeatureStore dùng chung trong process (feature IsolationForest)
+            rules: (tuỳ chọn) rules.RuleEngine -> ngưỡng theo thiết bị / zone
+        """
         self.db_path = db_path
+        self.analytics = analytics
+        self.features = features or FeatureStore(db_path)
         self.model = None
         self.scaler = StandardScaler()
         
-        # Thresholds
-        self.MOISTURE_DROP_THRESHOLD = 10  # % drop in 1 hour
-        self.MOISTURE_SPIKE_THRESHOLD = 15  # % spike in 1 hour
-        self.PUMP_MAX_RUNTIME = 30  # minutes continuous
-        self.DISCONNECT_THRESHOLD = 300  # seconds
-        
+        # Thresholds: luật threshold trong bảng alert_rules (rules.DEFAULT_RULES:
+        # moisture_drop 10%, moisture_spike 15%, pump_runtime 30 phút, disconnect 300 giây)
+        self.rules = rules or RuleEngine(db_path)
+        
+        # logs đã nén (compression.py): dựng lại chuỗi đều bước trước khi phân tích
+        self.RECONSTRUCT_STEP = RECONSTRUCT_STEP
+        self.MAX_GAP_STEPS = MAX_GAP_STEPS  # 36 x 5s = 180s; khoảng trống dài hơn = mất kết nối thật
+        
+    def thresholds(self, device=None):
+        """Ngưỡng áp cho thiết bị (luật của device > zone > global)"""
+        limit = self.rules.threshold
+        return {'moisture_drop': limit(device, 'moisture_drop', 10),
+                'moisture_spike': limit(device, 'moisture_spike', 15),
+                'pump_runtime': limit(device, 'pump_runtime', 30),
+                'disconnect': limit(device, 'disconnect', 300)}
+
     def load_recent_data(self, hours=24):
         """Load dữ liệu gần đây"""
-        con = sqlite3.connect(self.db_path)
-        cutoff = (datetime.now() - timedelta(hours=hours)).isoformat()
+        if self.analytics is not None:
+            data = self.analytics.reconstruct(hours, step=pd.Timedelta(self.RECONSTRUCT_STEP).total_seconds(),
+                                              limit=self.MAX_GAP_STEPS)
+            return pd.DataFrame(data)[['ts', 'soil', 'pump', 'auto', 'wifi_connected', 'wifi_rssi']]
+        
+        con = connect(self.db_path)   # có shard: `logs` gộp mọi shard
+        # ts_ms: epoch ms (số nguyên, idx_logs_time) -> không so sánh / parse chuỗi
+        cutoff = int((datetime.now() - timedelta(hours=hours)).timestamp() * 1000)
         
         query = """
-        SELECT ts, soil, pump, auto, wifi_connected, wifi_rssi
+        SELECT ts_ms AS ts, soil, pump, auto, wifi_connected, wifi_rssi
         FROM logs
-        WHERE ts >= ?
-        ORDER BY ts ASC
+        WHERE ts_ms >= ?
+        ORDER BY ts_ms ASC
         """
         
         df = pd.read_sql_query(query, con, params=(cutoff,))
         con.close()
         
         if len(df) > 0:
-            df['ts'] = pd.to_datetime(df['ts'])
+            # Giờ địa phương (naive) như datetime.now() trong các detector
+            df['ts'] = pd.to_datetime(df['ts'], unit='ms', utc=True).dt.tz_convert(tzlocal()).dt.tz_localize(None)
+            df = self.reconstruct(df)
         
         return df
     
+    def reconstruct(self, df):
+        """Nội suy các reading bị bỏ khi nén (soil, rssi tuyến tính; pump, auto giữ nguyên)"""
+        return reconstruct(df, self.RECONSTRUCT_STEP, self.MAX_GAP_STEPS)
+    
     def detect(self):
         """
         Chạy tất cả các detection methods
@@ -80,6 +114,151 @@ class AnomalyDetector:
         
         return anomalies
     
+    def detect_window(self, w, device=None):
+        """
+        Giống detect() nhưng chạy trực tiếp trên numpy window từ RingStore
+        (ring_buffer.Window: ts epoch, soil, pump, auto, rssi) - không query
+        SQLite, không tạo DataFrame. Chỉ xét các reading còn trong ring.
+        device: ngưỡng theo luật của thiết bị / zone (None -> luật global)
+        """
+        if w is None or len(w.ts) < 10:
+            return [{
+                'type': 'insufficient_data',
+                'severity': 'INFO',
+                'message': 'Không đủ dữ liệu để phân tích (< 10 records)',
+                'timestamp': datetime.now().isoformat()
+            }]
+
+        ts = w.ts
+        soil = w.soil.astype(np.float64)
+        pump = w.pump
+        now = datetime.now()
+        now_ts = now.timestamp()
+        iso = lambda t: datetime.fromtimestamp(float(t)).isoformat()
+        limits = self.thresholds(device)
+        anomalies = []
+
+        # 1. Sensor drift
+        if len(soil) >= 20:
+            recent = soil[-20:]
+            soil_std = float(recent.std(ddof=1))
+            if soil_std < 0.5:
+                anomalies.append({
+                    'type': 'sensor_drift',
+                    'severity': 'WARNING',
+                    'message': f'Cảm biến độ ẩm có thể bị lỗi (variance quá thấp: {soil_std:.2f}%)',
+                    'timestamp': now.isoformat(),
+                    'details': {'std_dev': soil_std, 'mean': float(recent.mean())}
+                })
+            if recent.min() == 0 and recent.max() == 0:
+                anomalies.append({
+                    'type': 'sensor_failure',
+                    'severity': 'CRITICAL',
+                    'message': 'Cảm biến độ ẩm báo 0% liên tục - có thể bị đứt dây',
+                    'timestamp': now.isoformat()
+                })
+            if recent.min() == 100 and recent.max() == 100:
+                anomalies.append({
+                    'type': 'sensor_failure',
+                    'severity': 'CRITICAL',
+                    'message': 'Cảm biến độ ẩm báo 100% liên tục - có thể bị ngập nước',
+                    'timestamp': now.isoformat()
+                })
+
+        # 2. Biến động độ ẩm (diff[i-1] = soil[i] - soil[i-1])
+        diff = np.diff(soil)
+        idx = int(diff.argmin()) + 1
+        max_drop = float(diff[idx - 1])
+        if max_drop < -limits['moisture_drop']:
+            anomalies.append({
+                'type': 'sudden_moisture_drop',
+                'severity': 'WARNING',
+                'message': f'Độ ẩm giảm đột ngột {abs(max_drop):.1f}% - kiểm tra rò rỉ',
+                'timestamp': iso(ts[idx]),
+                'details': {
+                    'drop_amount': abs(max_drop),
+                    'from': float(soil[idx - 1]),
+                    'to': float(soil[idx])
+                }
+            })
+        idx = int(diff.argmax()) + 1
+        max_spike = float(diff[idx - 1])
+        if max_spike > limits['moisture_spike'] and pump[idx] != 1:
+            anomalies.append({
+                'type': 'unexplained_moisture_spike',
+                'severity': 'WARNING',
+                'message': f'Độ ẩm tăng đột ngột {max_spike:.1f}% khi máy bơm tắt',
+                'timestamp': iso(ts[idx]),
+                'details': {'spike_amount': max_spike, 'pump_state': 'OFF'}
+            })
+
+        # 3. Máy bơm chạy quá lâu / không hiệu quả
+        change = np.diff(pump.astype(np.int16), prepend=pump[0])
+        on_starts = np.flatnonzero(change == 1)
+        on_ends = np.flatnonzero(change == -1)
+        # Mỗi lần bật -> lần tắt đầu tiên sau đó (searchsorted thay cho vòng lặp lọc)
+        end_pos = np.searchsorted(on_ends, on_starts, side='right')
+        for start_idx, pos in zip(on_starts, end_pos):
+            end_ts = ts[on_ends[pos]] if pos < len(on_ends) else now_ts
+            duration = float(end_ts - ts[start_idx]) / 60
+            if duration > limits['pump_runtime']:
+                anomalies.append({
+                    'type': 'pump_long_runtime',
+                    'severity': 'WARNING',
+                    'message': f'Máy bơm chạy liên tục {duration:.1f} phút (vượt {limits["pump_runtime"]:g} phút)',
+                    'timestamp': iso(ts[start_idx]),
+                    'details': {'duration_minutes': duration}
+                })
+        on_idx = np.flatnonzero(pump == 1)
+        if len(on_idx) > 5:
+            soil_change = float(soil[on_idx[-1]] - soil[on_idx[0]])
+            if soil_change < 2:
+                anomalies.append({
+                    'type': 'pump_ineffective',
+                    'severity': 'CRITICAL',
+                    'message': 'Máy bơm hoạt động nhưng độ ẩm không tăng - kiểm tra máy bơm/đường ống',
+                    'timestamp': iso(ts[on_idx[-1]]),
+                    'details': {'soil_change': soil_change}
+                })
+
+        # 4. Mất kết nối / WiFi yếu
+        time_since_update = now_ts - float(ts[-1])
+        if time_since_update > limits['disconnect']:
+            anomalies.append({
+                'type': 'system_disconnected',
+                'severity': 'CRITICAL',
+                'message': f'Mất kết nối với ESP32 ({time_since_update/60:.1f} phút)',
+                'timestamp': now.isoformat(),
+                'details': {'last_update': iso(ts[-1]), 'seconds_ago': time_since_update}
+            })
+        avg_rssi = float(w.rssi[-10:].mean())
+        if avg_rssi < -80:
+            anomalies.append({
+                'type': 'weak_wifi_signal',
+                'severity': 'WARNING',
+                'message': f'Tín hiệu WiFi yếu (RSSI: {avg_rssi:.0f} dBm)',
+                'timestamp': now.isoformat(),
+                'details': {'rssi': avg_rssi}
+            })
+
+        # 5. Rò rỉ nước: độ ẩm giảm nhanh khi bơm tắt
+        off_idx = np.flatnonzero(pump == 0)
+        if len(off_idx) > 5:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rate = np.diff(soil[off_idx]) / (np.diff(ts[off_idx]) / 3600)
+            abnormal = rate[rate < -5]
+            if len(abnormal) > 0:
+                worst = float(abnormal.min())
+                anomalies.append({
+                    'type': 'possible_water_leak',
+                    'severity': 'CRITICAL',
+                    'message': f'Độ ẩm giảm quá nhanh ({worst:.1f}%/h) khi máy bơm tắt - nghi rò rỉ',
+                    'timestamp': now.isoformat(),
+                    'details': {'rate_per_hour': worst}
+                })
+
+        return anomalies
+
     def detect_sensor_drift(self, df):
         """
         Phát hiện sensor drift (cảm biến trôi giá trị)
@@ -137,13 +316,15 @@ class AnomalyDetector:
         if len(df) < 2:
             return anomalies
         
+        limits = self.thresholds()
+
         # Calculate hourly changes
         df_sorted = df.sort_values('ts')
         df_sorted['soil_diff'] = df_sorted['soil'].diff()
         
         # Sudden drop
         max_drop = df_sorted['soil_diff'].min()
-        if max_drop < -self.MOISTURE_DROP_THRESHOLD:
+        if max_drop < -limits['moisture_drop']:
             idx = df_sorted['soil_diff'].idxmin()
             anomalies.append({
                 'type': 'sudden_moisture_drop',
@@ -159,7 +340,7 @@ class AnomalyDetector:
         
         # Sudden spike (không tự nhiên)
         max_spike = df_sorted['soil_diff'].max()
-        if max_spike > self.MOISTURE_SPIKE_THRESHOLD:
+        if max_spike > limits['moisture_spike']:
             idx = df_sorted['soil_diff'].idxmax()
             
             # Check if pump was on (spike is expected)
@@ -184,6 +365,7 @@ class AnomalyDetector:
         Phát hiện vấn đề máy bơm
         """
         anomalies = []
+        limits = self.thresholds()
         
         # Find continuous pump ON periods
         df_sorted = df.sort_values('ts')
@@ -205,11 +387,11 @@ class AnomalyDetector:
                 duration = (df_sorted.loc[end_idx, 'ts'] - df_sorted.loc[start_idx, 'ts']).total_seconds() / 60
             
             # Check if duration exceeds threshold
-            if duration > self.PUMP_MAX_RUNTIME:
+            if duration > limits['pump_runtime']:
                 anomalies.append({
                     'type': 'pump_long_runtime',
                     'severity': 'WARNING',
-                    'message': f'Máy bơm chạy liên tục {duration:.1f} phút (vượt {self.PUMP_MAX_RUNTIME} phút)',
+                    'message': f'Máy bơm chạy liên tục {duration:.1f} phút (vượt {limits["pump_runtime"]:g} phút)',
                     'timestamp': df_sorted.loc[start_idx, 'ts'].isoformat(),
                     'details': {
                         'duration_minutes': duration
@@ -240,13 +422,14 @@ class AnomalyDetector:
         Phát hiện mất kết nối
         """
         anomalies = []
+        limits = self.thresholds()
         
         # Check last update time
         if len(df) > 0:
             last_update = df['ts'].max()
             time_since_update = (datetime.now() - last_update).total_seconds()
             
-            if time_since_update > self.DISCONNECT_THRESHOLD:
+            if time_since_update > limits['disconnect']:
                 anomalies.append({
                     'type': 'system_disconnected',
                     'severity': 'CRITICAL',
@@ -314,39 +497,34 @@ class AnomalyDetector:
         
         return anomalies
     
-    def train_isolation_forest(self):
+    def isolation_features(self, df):
+        """Feature cho Isolation Forest từ DataFrame đã dựng lại (cùng định nghĩa với FeatureStore)"""
+        X = isolation_matrix(df['soil'], df['pump'], df['wifi_rssi'], df['ts'].dt.hour)
+        return X[~np.isnan(X).any(axis=1)]
+    
+    def train_isolation_forest(self, device=None):
         """
         Train Isolation Forest model cho general anomaly detection
         (Advanced - có thể bỏ qua nếu chưa đủ data)
         """
-        df = self.load_recent_data(hours=24*30)  # 30 days
+        # Feature 30 ngày đã tính sẵn trong FeatureStore (chỉ phần mới được cập nhật)
+        X = self.features.isolation(device, days=30)
         
-        if len(df) < 100:
+        if len(X) < 100:
             print("⚠️ Không đủ dữ liệu để train Isolation Forest")
             return
         
-        # Feature engineering
-        df['hour'] = df['ts'].dt.hour
-        df['soil_rolling_mean'] = df['soil'].rolling(window=5).mean()
-        df['soil_rolling_std'] = df['soil'].rolling(window=5).std()
-        
-        features = ['soil', 'pump', 'wifi_rssi', 'hour', 
-                   'soil_rolling_mean', 'soil_rolling_std']
-        
-        X = df[features].dropna()
-        
         # Train model
         self.model = IsolationForest(
             contamination=0.05,  # Expect 5% anomalies
             random_state=42
         )
         
-        X_scaled = self.scaler.fit_transform(X)
-        self.model.fit(X_scaled)
+        self.scaler = self.features.fit_scaler('anomaly_scaler', StandardScaler(), X)
+        self.model.fit(self.scaler.transform(X))
         
-        # Save model
+        # Save model (scaler đã lưu trong fit_scaler)
         joblib.dump(self.model, 'models/anomaly_detector.pkl')
-        joblib.dump(self.scaler, 'models/anomaly_scaler.pkl')
         
         print("✅ Isolation Forest model trained and saved!")
 
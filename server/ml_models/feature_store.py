@@ -0,0 +1,359 @@
+import os
+import time
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+import joblib
+from dateutil.tz import tzlocal
+from storage import Storage
+
+# ================= FEATURE STORE (DÙNG CHUNG TRAIN + SERVE) =================
+# Trước đây mỗi lần train / predict đều đọc lại logs rồi tự tính feature:
+# LSTM tính hour / day_of_week / is_weekend trên 7-60 ngày, IsolationForest
+# dựng lại lưới 5s 30 ngày để tính rolling mean / std.
+#
+# FeatureStore giữ sẵn ma trận feature theo từng thiết bị (trong RAM của
+# worker ML) và chỉ tính lại phần bị ảnh hưởng bởi dữ liệu mới:
+#   - sync(): đọc các dòng mới (id > watermark) -> thời điểm sớm nhất bị đổi
+#     của mỗi thiết bị (report mới, bulk backfill đến trễ, bản sửa); logs chia
+#     shard (storage.py) thì mỗi file 1 watermark
+#   - lần đọc sau chỉ tính lại từ điểm đó (thường là giờ hiện tại)
+#   - định nghĩa feature nằm ở 1 chỗ (hàm bên dưới), train và serve
+#     (kể cả window từ RingStore) dùng chung
+#   - scaler đã fit được cache theo tên, tự nạp lại khi file .pkl đổi
+#
+# device=None: mọi dòng logs (như load_data() cũ, trước khi có nhiều thiết bị)
+
+HOURLY_FEATURES = ('soil', 'pump', 'auto', 'wifi_rssi', 'hour', 'day_of_week', 'is_weekend')
+ISOLATION_FEATURES = ('soil', 'pump', 'wifi_rssi', 'hour', 'soil_rolling_mean', 'soil_rolling_std')
+
+RECONSTRUCT_STEP = '5s'   # lưới dựng lại logs đã nén cho anomaly
+MAX_GAP_STEPS = 36        # 36 x 5s = 180s; khoảng trống dài hơn = mất kết nối thật
+ROLLING = 5               # số điểm của rolling mean / std
+MODEL_DIR = 'models'
+
+
+# ================= ĐỊNH NGHĨA FEATURE =================
+def local_times(ts):
+    """epoch giây -> DatetimeIndex giờ địa phương"""
+    return pd.DatetimeIndex(pd.to_datetime(np.asarray(ts, dtype=np.float64), unit='s', utc=True)).tz_convert(tzlocal())
+
+
+def _epoch(index):
+    return ((index - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(seconds=1)).to_numpy(dtype=np.float64)
+
+
+def calendar(times):
+    """hour, day_of_week, is_weekend (float) từ DatetimeIndex giờ địa phương"""
+    day_of_week = np.asarray(times.dayofweek, dtype=np.float64)
+    return np.asarray(times.hour, dtype=np.float64), day_of_week, (day_of_week >= 5).astype(np.float64)
+
+
+def hourly_frame(df):
+    """
+    Trung bình theo giờ của reading (index = thời điểm, cột soil, pump, auto, wifi_rssi)
+
+    logs đã nén (chỉ lưu điểm quan trọng): nội suy về lưới 1 phút trước,
+    để trung bình theo giờ không lệch về các đoạn có nhiều điểm
+    """
+    minutes = df[['soil', 'pump', 'auto', 'wifi_rssi']].resample('1min').mean()
+    minutes = minutes.interpolate(method='time', limit=3, limit_area='inside')
+    return minutes.resample('1h').mean().ffill()
+
+
+def hourly_matrix(times, soil, pump, auto, rssi):
+    """Ma trận HOURLY_FEATURES (input của LSTM)"""
+    return np.column_stack([soil, pump, auto, rssi, *calendar(times)]).astype(np.float64)
+
+
+def reconstruct(df, step=RECONSTRUCT_STEP, limit=MAX_GAP_STEPS):
+    """Nội suy các reading bị bỏ khi nén (soil, rssi tuyến tính; pump, auto giữ nguyên)"""
+    columns = df.columns
+    resampled = df.set_index('ts').resample(step)
+    values = resampled[['soil', 'wifi_rssi']].mean().interpolate(
+        method='time', limit=limit, limit_area='inside')
+    states = resampled[['pump', 'auto', 'wifi_connected']].last().ffill(limit=limit)
+    df = pd.concat([values, states], axis=1).dropna().reset_index()
+    return df[columns]
+
+
+def isolation_matrix(soil, pump, rssi, hour, prev_soil=()):
+    """
+    Ma trận ISOLATION_FEATURES trên lưới đã dựng lại
+
+    prev_soil: tối đa ROLLING-1 giá trị soil ngay trước (tính tiếp rolling khi
+    chỉ thêm phần cuối); dòng chưa đủ ROLLING điểm có rolling = NaN
+    """
+    soil = np.asarray(soil, dtype=np.float64)
+    prev = np.asarray(prev_soil, dtype=np.float64)[-(ROLLING - 1):] if ROLLING > 1 else np.empty(0)
+    series = np.concatenate([np.full(ROLLING - 1 - len(prev), np.nan), prev, soil])
+    windows = np.lib.stride_tricks.sliding_window_view(series, ROLLING)
+    return np.column_stack([soil, pump, rssi, hour,
+                            windows.mean(axis=1), windows.std(axis=1, ddof=1)]).astype(np.float64)
+
+
+# ================= STORE =================
+class _Series:
+    """Feature của 1 thiết bị: ts (epoch giây, tăng dần) + ma trận; dirty = epoch ms cần tính lại từ đó"""
+
+    def __init__(self, width, dirty):
+        self.ts = np.empty(0)
+        self.X = np.empty((0, width))
+        self.dirty = dirty
+
+    def splice(self, after, ts, X):
+        """Giữ các dòng ts <= after, thay phần sau bằng (ts, X)"""
+        keep = int(np.searchsorted(self.ts, after, side='right'))
+        self.ts = np.concatenate([self.ts[:keep], ts])
+        self.X = np.vstack([self.X[:keep], X])
+
+    def trim(self, before):
+        cut = int(np.searchsorted(self.ts, before, side='left'))
+        if cut:
+            self.ts = self.ts[cut:]
+            self.X = self.X[cut:]
+
+    def since(self, ts):
+        start = int(np.searchsorted(self.ts, ts, side='left'))
+        return self.ts[start:], self.X[start:]
+
+
+class FeatureStore:
+    """
+    Ma trận feature theo thiết bị, cập nhật tăng dần khi logs có dòng mới
+
+    Mỗi worker ML giữ 1 store (ml_service._features), LSTM và AnomalyDetector
+    trong cùng process dùng chung.
+    """
+
+    def __init__(self, db_path, hourly_days=60, isolation_days=30, model_dir=MODEL_DIR):
+        self.db_path = db_path
+        self.hourly_days = hourly_days
+        self.isolation_days = isolation_days
+        self.model_dir = model_dir
+        self.storage = Storage(db_path)
+        self.watermarks = None   # file logs -> id lớn nhất đã thấy
+        self._hourly = {}      # device -> _Series(HOURLY_FEATURES)
+        self._isolation = {}   # device -> _Series(ISOLATION_FEATURES), chỉ khi được dùng tới
+        self._scalers = {}     # tên -> (mtime file, scaler)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Chỉ đọc: không giữ khoá ghi của luồng ingestion; có shard -> `logs` gộp mọi shard
+        return self.storage.connect(readonly=True)
+
+    @staticmethod
+    def _where(device):
+        return ("device = ? AND ", (device,)) if device is not None else ("", ())
+
+    def _before(self, con, device, ts_ms):
+        """ts_ms của reading ngay trước ts_ms (idx_logs_device_time / idx_logs_time)"""
+        where, params = self._where(device)
+        row = con.execute(f"SELECT MAX(ts_ms) FROM logs WHERE {where}ts_ms < ?", params + (ts_ms,)).fetchone()
+        return row[0]
+
+    def _read(self, con, device, since_ms):
+        where, params = self._where(device)
+        df = pd.read_sql_query(
+            f"SELECT ts_ms, soil, pump, auto, wifi_connected, wifi_rssi FROM logs "
+            f"WHERE {where}ts_ms >= ? ORDER BY ts_ms", con, params=params + (since_ms,))
+        df.insert(0, 'ts', pd.to_datetime(df.pop('ts_ms'), unit='ms', utc=True).dt.tz_convert(tzlocal()))
+        return df
+
+    # ================= ĐỒNG BỘ =================
+    def sync(self, con=None):
+        """
+        Đánh dấu phần feature bị đổi bởi các dòng mới (id > watermark)
+
+        Returns: số thiết bị có dữ liệu mới
+        """
+        first = self.watermarks is None
+        if first:
+            self.watermarks = {}
+        rows = []
+        for path in self.storage.sources():
+            # id chỉ tăng dần trong 1 file -> có shard thì đọc từng shard
+            src = con if con is not None and not self.storage.sharded else \
+                sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                if first:
+                    # Lần đầu: feature được tính đầy đủ khi thiết bị được đọc tới
+                    self.watermarks[path] = src.execute("SELECT COALESCE(MAX(id), 0) FROM logs").fetchone()[0]
+                    continue
+                # NOT INDEXED: GROUP BY device khiến SQLite quét cả idx_logs_device_time,
+                # ở đây chỉ cần range scan rowid > watermark
+                found = src.execute("SELECT device, MIN(ts_ms), MAX(id) FROM logs NOT INDEXED "
+                                    "WHERE id > ? GROUP BY device", (self.watermarks[path],)).fetchall()
+            finally:
+                if src is not con:
+                    src.close()
+            for device, ts_ms, last_id in found:
+                self.watermarks[path] = max(self.watermarks[path], last_id)
+                rows.append((device, ts_ms))
+        for device, ts_ms in rows:
+            for store in (self._hourly, self._isolation):
+                for key in (device, None):
+                    series = store.get(key)
+                    if series is not None:
+                        series.dirty = ts_ms if series.dirty is None else min(series.dirty, ts_ms)
+        return len(rows)
+
+    def _series(self, store, device, width, days, update):
+        with self._lock:
+            con = self._connect()
+            try:
+                self.sync(con)
+                since_ms = int((time.time() - days * 86400) * 1000)
+                series = store.get(device)
+                if series is None:
+                    series = store[device] = _Series(width, since_ms)
+                if series.dirty is not None:
+                    update(con, device, series)
+                    series.dirty = None
+                series.trim(since_ms / 1000)
+                return series
+            finally:
+                con.close()
+
+    def _update_hourly(self, con, device, series):
+        # Reading mới làm đổi phần nội suy từ reading ngay trước nó,
+        # giờ chứa điểm đó phải tính lại với đủ mọi reading trong giờ
+        start = self._before(con, device, series.dirty)
+        start = series.dirty if start is None else start
+        read_from = start - 3600 * 1000
+        prev = self._before(con, device, read_from)
+        df = self._read(con, device, read_from if prev is None else prev)
+        ts, X = np.empty(0), np.empty((0, len(HOURLY_FEATURES)))
+        if len(df):
+            frame = hourly_frame(df.set_index('ts'))
+            frame = frame[_epoch(frame.index) > read_from / 1000]   # giờ bị cắt dở ở đầu: giữ bản cũ
+            ts = _epoch(frame.index)
+            X = hourly_matrix(frame.index, frame['soil'], frame['pump'], frame['auto'], frame['wifi_rssi'])
+        series.splice(read_from / 1000, ts, X)
+
+    def _update_isolation(self, con, device, series):
+        step_ms = int(pd.Timedelta(RECONSTRUCT_STEP).total_seconds() * 1000)
+        start = self._before(con, device, series.dirty)
+        read_from = (series.dirty if start is None else start) - step_ms
+        df = self._read(con, device, read_from)
+        ts, X = np.empty(0), np.empty((0, len(ISOLATION_FEATURES)))
+        if len(df):
+            grid = reconstruct(df)
+            times = pd.DatetimeIndex(grid['ts'])
+            keep = _epoch(times) > read_from / 1000
+            grid, times = grid[keep], times[keep]
+            prev = series.X[:int(np.searchsorted(series.ts, read_from / 1000, side='right')), 0]
+            ts = _epoch(times)
+            X = isolation_matrix(grid['soil'], grid['pump'], grid['wifi_rssi'], calendar(times)[0],
+                                 prev_soil=prev[-(ROLLING - 1):])
+        series.splice(read_from / 1000, ts, X)
+
+    # ================= ĐỌC FEATURE =================
+    def hourly(self, device=None, days=None):
+        """
+        Feature theo giờ cho LSTM (tối đa hourly_days ngày)
+
+        Returns:
+            (ts epoch giây đầu giờ, ma trận HOURLY_FEATURES) - không được sửa
+        """
+        days = min(days or self.hourly_days, self.hourly_days)
+        series = self._series(self._hourly, device, len(HOURLY_FEATURES), self.hourly_days, self._update_hourly)
+        return series.since(time.time() - days * 86400)
+
+    def isolation(self, device=None, days=None):
+        """
+        Feature cho IsolationForest trên lưới 5s (tối đa isolation_days ngày)
+
+        Returns:
+            ma trận ISOLATION_FEATURES, bỏ các dòng chưa đủ ROLLING điểm
+        """
+        days = min(days or self.isolation_days, self.isolation_days)
+        series = self._series(self._isolation, device, len(ISOLATION_FEATURES),
+                              self.isolation_days, self._update_isolation)
+        _, X = series.since(time.time() - days * 86400)
+        return X[~np.isnan(X).any(axis=1)]
+
+    # ================= SCALER =================
+    def _scaler_path(self, name):
+        return os.path.join(self.model_dir, f'{name}.pkl')
+
+    def fit_scaler(self, name, scaler, X):
+        """Fit scaler trên ma trận train, lưu models/<name>.pkl và cache"""
+        scaler.fit(X)
+        os.makedirs(self.model_dir, exist_ok=True)
+        path = self._scaler_path(name)
+        joblib.dump(scaler, path)
+        self._scalers[name] = (os.path.getmtime(path), scaler)
+        return scaler
+
+    def scaler(self, name):
+        """Scaler đã fit (nạp từ file 1 lần, nạp lại nếu process khác train lại)"""
+        path = self._scaler_path(name)
+        mtime = os.path.getmtime(path)
+        cached = self._scalers.get(name)
+        if cached is None or cached[0] != mtime:
+            cached = self._scalers[name] = (mtime, joblib.load(path))
+        return cached[1]
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import migrations
+
+    db = os.path.join(tempfile.mkdtemp(), 'features.db')
+    migrations.migrate(db)
+
+    # 2 thiết bị, 10 ngày logs đã nén (1 dòng / 30-90s)
+    rng = np.random.default_rng(0)
+    now = time.time()
+    con = sqlite3.connect(db)
+
+    def insert(device, ts):
+        pump = ((ts // 3600) % 12 == 6).astype(int)
+        soil = 55 + 10 * np.sin(ts / 7200) + rng.normal(0, 0.3, len(ts))
+        con.executemany(
+            "INSERT INTO logs(ts_ms,soil,pump,auto,wifi_connected,wifi_rssi,device) VALUES(?,?,?,1,1,?,?)",
+            [(int(t * 1000), float(s), int(p), int(r), device)
+             for t, s, p, r in zip(ts, soil, pump, rng.integers(-80, -40, len(ts)))])
+        con.commit()
+
+    for device in ('esp32-a', 'esp32-b'):
+        insert(device, np.sort(now - 10 * 86400 + rng.uniform(0, 10 * 86400 - 600, 15000)))
+
+    store = FeatureStore(db, hourly_days=10, isolation_days=2)
+    t0 = time.perf_counter()
+    ts, X = store.hourly('esp32-a')
+    t_full = (time.perf_counter() - t0) * 1000
+    X_if = store.isolation('esp32-a')
+    print(f"📦 esp32-a: hourly {X.shape}, isolation {X_if.shape}, lần đầu {t_full:.0f} ms")
+
+    def update():
+        t0 = time.perf_counter()
+        out = store.hourly('esp32-a'), store.isolation('esp32-a')
+        return out, (time.perf_counter() - t0) * 1000
+
+    # Report mới: chỉ tính lại phần cuối
+    insert('esp32-a', now - 600 + np.arange(0, 600, 30.0))
+    _, t_tail = update()
+    # Lô backfill đến trễ (1 ngày trước): tính lại từ điểm đó
+    insert('esp32-a', now - 86400 + np.arange(0, 300, 10.0))
+    ((ts, X), X_if), t_late = update()
+    print(f"🔄 Report mới: {t_tail:.0f} ms, backfill 1 ngày trước: {t_late:.0f} ms")
+
+    fresh = FeatureStore(db, hourly_days=10, isolation_days=2)
+    fresh.sync()
+    ts_full, X_full = fresh.hourly('esp32-a')
+    X_if_full = fresh.isolation('esp32-a')
+    # Đầu chuỗi có thể lệch vài dòng (mốc cắt isolation_days khác nhau) -> so phần chung
+    n = min(len(X_if), len(X_if_full))
+    same = np.allclose(X, X_full, equal_nan=True) and np.allclose(X_if[-n:], X_if_full[-n:])
+    print(f"✅ Khớp với tính lại toàn bộ: {same}")
+    print(f"   Cột: {HOURLY_FEATURES}")
+    print(f"   Giờ cuối: {X[-1].round(2)}")
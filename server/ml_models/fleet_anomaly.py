@@ -0,0 +1,285 @@
+import time
+import sqlite3
+from collections import namedtuple
+from datetime import datetime
+import numpy as np
+from storage import connect
+
+# ================= BẤT THƯỜNG TƯƠNG QUAN TOÀN FLEET =================
+# AnomalyDetector xét từng thiết bị riêng lẻ: broker / WiFi của 1 vườn hỏng
+# là N thiết bị cùng báo system_disconnected + weak_wifi_signal, mưa là N
+# thiết bị cùng báo unexplained_moisture_spike. Ở đây dựng 1 ma trận
+# thiết bị x thời gian (mỗi cột STEP giây) rồi tính theo từng site
+# (device_state.group_name) bằng vài phép numpy trên cả ma trận:
+#   - site_outage:     >= SITE_FRACTION thiết bị của 1 site mất kết nối cùng lúc
+#   - fleet_outage:    >= FLEET_FRACTION toàn fleet, trên >= 2 site -> broker / server
+#   - site_weak_wifi:  >= SITE_FRACTION thiết bị đang online của site có RSSI yếu
+#   - regional_rain:   >= SITE_FRACTION thiết bị của site tăng độ ẩm mạnh khi bơm tắt
+# Chi phí O(số dòng + thiết bị x cột), không chạy lại 24h scan cho từng thiết bị.
+
+# Ma trận: devices/groups theo hàng; seen = thời điểm report gần nhất (epoch s,
+# -inf = chưa từng thấy), soil/pump/rssi = giá trị gần nhất (NaN = chưa có)
+Matrix = namedtuple('Matrix', ['devices', 'groups', 'start', 'step', 'seen', 'soil', 'pump', 'rssi'])
+
+DEFAULT_GROUP = 'default'  # như command_dispatcher.DEFAULT_GROUP
+
+
+def _ffill(values):
+    """Forward fill NaN theo trục thời gian (axis=1) cho cả ma trận"""
+    valid = ~np.isnan(values)
+    idx = np.where(valid, np.arange(values.shape[1]), 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    filled = np.take_along_axis(values, idx, axis=1)
+    # Trước giá trị đầu tiên của hàng: vẫn NaN
+    filled[~np.maximum.accumulate(valid, axis=1)] = np.nan
+    return filled
+
+
+def _runs(mask):
+    """[(start, end)] các đoạn True liên tiếp (end không tính)"""
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+class FleetAnomalyDetector:
+    """
+    Phát hiện sự cố chung của nhiều thiết bị và gom alert từng thiết bị
+    """
+
+    def __init__(self, db_path='tuoi.db', analytics=None):
+        """
+        Args:
+            analytics: (tuỳ chọn) analytics.Analytics -> quét logs trên bản sao DuckDB
+        """
+        self.db_path = db_path
+        self.analytics = analytics
+
+        self.STEP = 60                   # giây / cột ma trận
+        self.DISCONNECT_THRESHOLD = 300  # giây, như luật disconnect mặc định
+        self.WEAK_RSSI = -80             # dBm, như AnomalyDetector
+        self.SPIKE_THRESHOLD = 15        # % tăng trong 1 giờ, như luật moisture_spike mặc định
+        self.SITE_FRACTION = 0.6         # tỉ lệ thiết bị của site cùng bị
+        self.FLEET_FRACTION = 0.8        # tỉ lệ toàn fleet cùng mất kết nối
+        self.MIN_DEVICES = 2             # 1 thiết bị thì không phải sự cố chung
+
+    # ================= DỮ LIỆU =================
+    def _groups(self, con):
+        return dict(con.execute('SELECT device_id, group_name FROM device_state').fetchall())
+
+    def load_matrix(self, hours=24, now=None):
+        """logs trong `hours` giờ gần nhất -> Matrix (1 lần quét + numpy)"""
+        now = time.time() if now is None else now
+        start = now - hours * 3600
+        n_cols = max(int(np.ceil((now - start) / self.STEP)), 1)
+        sql = 'SELECT device, ts_ms, soil, pump, wifi_rssi FROM logs WHERE ts_ms >= ? ORDER BY ts_ms'
+
+        con = connect(self.db_path)   # có shard: `logs` gộp mọi shard, device_state của DB chính
+        try:
+            try:
+                groups = self._groups(con)
+            except sqlite3.OperationalError:
+                groups = {}  # chưa có device_state (DB cũ)
+            query = (self.analytics.query if self.analytics is not None
+                     else lambda q, params: con.execute(q, params).fetchall())
+            rows = query(sql, (int(start * 1000),))
+            # Report cuối trước cửa sổ: phân biệt "đã mất kết nối từ trước" với "thiết bị mới"
+            # (1 câu GROUP BY cho cả fleet, cùng nguồn với lần quét chính)
+            before = dict(query('SELECT device, MAX(ts_ms) FROM logs WHERE ts_ms < ? GROUP BY device',
+                                (int(start * 1000),)))
+            devices = sorted(set(groups) | {r[0] for r in rows})
+        finally:
+            con.close()
+
+        shape = (len(devices), n_cols)
+        seen = np.full(shape, -np.inf)
+        soil, pump, rssi = np.full(shape, np.nan), np.full(shape, np.nan), np.full(shape, np.nan)
+        if rows:
+            index = {d: i for i, d in enumerate(devices)}
+            dev = np.fromiter((index[r[0]] for r in rows), dtype=np.int64, count=len(rows))
+            data = np.array([r[1:] for r in rows], dtype=np.float64)
+            ts = data[:, 0] / 1000
+            col = np.clip(((ts - start) // self.STEP).astype(np.int64), 0, n_cols - 1)
+            # Nhiều reading trong 1 ô: lấy reading cuối (rows đã sắp theo thời gian)
+            flat = dev * n_cols + col
+            _, last = np.unique(flat[::-1], return_index=True)
+            last = len(flat) - 1 - last
+            cells = np.unravel_index(flat[last], shape)
+            seen[cells] = ts[last]
+            soil[cells], pump[cells], rssi[cells] = data[last, 1], data[last, 2], data[last, 3]
+
+        first = np.array([before[d] / 1000 if before.get(d) is not None else -np.inf for d in devices])
+        seen[:, 0] = np.maximum(seen[:, 0], first) if len(devices) else seen[:, 0]
+        np.maximum.accumulate(seen, axis=1, out=seen)
+        return Matrix(devices, [groups.get(d, DEFAULT_GROUP) for d in devices], start, self.STEP,
+                      seen, _ffill(soil), _ffill(pump), _ffill(rssi))
+
+    # ================= PHÁT HIỆN =================
+    def detect(self, hours=24, now=None):
+        """
+        Returns:
+            {'events': [...], 'offline': [thiết bị mất kết nối riêng lẻ], 'summary': {...}}
+        """
+        now = time.time() if now is None else now
+        return self.detect_matrix(self.load_matrix(hours, now), now)
+
+    def detect_matrix(self, m, now):
+        n_dev, n_cols = m.seen.shape
+        summary = {'devices': n_dev, 'sites': len(set(m.groups)), 'events': 0, 'offline': 0}
+        if n_dev == 0:
+            return {'events': [], 'offline': [], 'summary': summary}
+
+        ends = np.minimum(m.start + (np.arange(n_cols) + 1) * m.step, now)
+        known = np.isfinite(m.seen)                    # đã từng report
+        offline = known & (ends - m.seen > self.DISCONNECT_THRESHOLD)
+        online = known & ~offline
+        weak = online & (np.nan_to_num(m.rssi, nan=0) < self.WEAK_RSSI)
+
+        lag = max(int(3600 // m.step), 1)
+        spike = np.zeros_like(online)
+        if n_cols > lag:
+            rise = m.soil[:, lag:] - m.soil[:, :-lag]
+            spike[:, lag:] = (np.nan_to_num(rise, nan=0) > self.SPIKE_THRESHOLD) & (m.pump[:, lag:] == 0)
+            spike &= online
+
+        # One-hot site x thiết bị: đếm theo site cho mọi cột bằng 1 phép nhân ma trận
+        sites, site_idx = np.unique(np.array(m.groups, dtype=object), return_inverse=True)
+        onehot = np.zeros((len(sites), n_dev))
+        onehot[site_idx, np.arange(n_dev)] = 1
+        count = lambda mask: onehot @ mask.astype(np.float64)
+        n_known, n_online = count(known), count(online)
+
+        def correlated(mask, base):
+            hits = count(mask)
+            return (hits >= self.MIN_DEVICES) & (hits >= self.SITE_FRACTION * base)
+
+        events = []
+        fleet_off = offline.sum(axis=0)
+        sites_off = (count(offline) > 0).sum(axis=0)
+        fleet = ((fleet_off >= self.MIN_DEVICES) & (sites_off >= 2)
+                 & (fleet_off >= self.FLEET_FRACTION * known.sum(axis=0)))
+        events += self._events('fleet_outage', 'CRITICAL', 'toàn fleet', fleet, np.ones(n_dev, bool),
+                               offline, m, now, ['system_disconnected', 'weak_wifi_signal'],
+                               'Mất dữ liệu từ {n}/{total} thiết bị trên nhiều site cùng lúc - nghi broker MQTT / server')
+
+        site_out = correlated(offline, n_known)
+        weak_site = correlated(weak, n_online)
+        rain = correlated(spike, n_online)
+        for s, site in enumerate(sites):
+            members = site_idx == s
+            # Trong lúc cả fleet mất kết nối, sự cố site đã nằm trong fleet_outage
+            events += self._events('site_outage', 'CRITICAL', site, site_out[s] & ~fleet, members,
+                                   offline, m, now, ['system_disconnected', 'weak_wifi_signal'],
+                                   'Site {scope}: {n}/{total} thiết bị mất kết nối cùng lúc - kiểm tra WiFi / nguồn điện của site')
+            events += self._events('site_weak_wifi', 'WARNING', site, weak_site[s], members,
+                                   weak, m, now, ['weak_wifi_signal'],
+                                   'Site {scope}: {n}/{total} thiết bị có WiFi yếu (< {rssi} dBm) - kiểm tra router / repeater')
+            events += self._events('regional_rain', 'INFO', site, rain[s], members,
+                                   spike, m, now, ['unexplained_moisture_spike'],
+                                   'Site {scope}: {n}/{total} thiết bị tăng độ ẩm cùng lúc khi bơm tắt - nhiều khả năng do mưa')
+
+        # Thiết bị mất kết nối riêng lẻ (không thuộc sự cố chung đang diễn ra)
+        grouped = {d for e in events if e['ongoing'] and 'system_disconnected' in e['explains'] for d in e['devices']}
+        isolated = [m.devices[i] for i in np.flatnonzero(offline[:, -1]) if m.devices[i] not in grouped]
+
+        summary.update(events=len(events), offline=int(offline[:, -1].sum()))
+        return {'events': events, 'offline': isolated, 'summary': summary}
+
+    def _events(self, kind, severity, scope, active, members, affected, m, now, explains, message):
+        """Mỗi đoạn cột liên tiếp có `active` -> 1 event"""
+        events = []
+        for a, b in _runs(active):
+            hit = members & affected[:, a:b].any(axis=1)
+            devices = [m.devices[i] for i in np.flatnonzero(hit)]
+            start_ts = float(m.start + a * m.step)
+            ongoing = bool(b == len(active))
+            end_ts = float(now if ongoing else m.start + b * m.step)
+            events.append({
+                'id': f'{kind}:{scope}:{int(start_ts)}',
+                'type': kind,
+                'severity': severity,
+                'scope': scope,
+                'message': message.format(scope=scope, n=len(devices), total=int(members.sum()), rssi=self.WEAK_RSSI),
+                'timestamp': datetime.fromtimestamp(start_ts).isoformat(),
+                'start_ts': start_ts,
+                'end_ts': end_ts,
+                'ongoing': ongoing,
+                'devices': devices,
+                'explains': explains,
+            })
+        return events
+
+
+def group_alerts(device, anomalies, events):
+    """
+    Bỏ alert của 1 thiết bị đã được giải thích bởi sự cố chung, thay bằng
+    1 alert tham chiếu tới sự cố đó
+
+    Alert được giải thích khi: type nằm trong event['explains'], thiết bị
+    thuộc event và (event đang diễn ra hoặc timestamp của alert nằm trong event)
+    """
+    mine = [e for e in events if device in e['devices']]
+    if not mine:
+        return anomalies
+
+    kept, grouped = [], {}
+    for a in anomalies:
+        try:
+            at = datetime.fromisoformat(a['timestamp']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            at = None
+        event = next((e for e in mine if a['type'] in e['explains']
+                      and (e['ongoing'] or (at is not None and e['start_ts'] <= at <= e['end_ts']))), None)
+        if event is None:
+            kept.append(a)
+            continue
+        if event['id'] not in grouped:
+            grouped[event['id']] = {
+                'type': event['type'],
+                'severity': event['severity'],
+                'message': event['message'],
+                'timestamp': event['timestamp'],
+                'details': {'event_id': event['id'], 'scope': event['scope'],
+                            'devices': len(event['devices']), 'suppressed': []}
+            }
+        grouped[event['id']]['details']['suppressed'].append(a['type'])
+    return kept + list(grouped.values())
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+if __name__ == "__main__":
+    # Ma trận giả lập: 3 site x 400 thiết bị, 24h / cột 60s
+    rng = np.random.default_rng(0)
+    detector = FleetAnomalyDetector()
+    n_dev, n_cols, now = 1200, 1440, time.time()
+    start = now - n_cols * 60
+    ends = start + (np.arange(n_cols) + 1) * 60
+    groups = [f'vuon-{i % 3}' for i in range(n_dev)]
+    seen = np.tile(ends, (n_dev, 1)) - rng.uniform(0, 30, (n_dev, n_cols))
+    seen[0::3, 600:660] = seen[0::3, 599:600]      # vuon-0 mất WiFi 1 giờ
+    seen[:, 1000:1030] = seen[:, 999:1000]         # broker chết 30 phút
+    seen[1::3, 1380:] = seen[1::3, 1379:1380]      # vuon-1 đang mất kết nối
+    seen[5, 1300:] = seen[5, 1299]                 # 1 thiết bị hỏng riêng
+    np.maximum.accumulate(seen, axis=1, out=seen)
+    soil = 40 + rng.normal(0, 0.5, (n_dev, n_cols))
+    soil[2::3, 800:] += 20                         # mưa ở vuon-2
+    rssi = np.full((n_dev, n_cols), -60.0)
+    rssi[0::3, 1200:] = -85                        # WiFi vuon-0 yếu dần
+    m = Matrix([f'esp-{i}' for i in range(n_dev)], groups, start, 60, seen,
+               soil, np.zeros((n_dev, n_cols)), rssi)
+
+    t0 = time.perf_counter()
+    result = detector.detect_matrix(m, now)
+    print(f"⏱️ {n_dev} thiết bị x {n_cols} cột: {(time.perf_counter() - t0) * 1000:.0f} ms")
+    for e in result['events']:
+        print(f"   [{e['severity']}] {e['type']} ({e['scope']}, {len(e['devices'])} thiết bị,"
+              f" {'đang diễn ra' if e['ongoing'] else 'đã kết thúc'}): {e['message']}")
+    print(f"   Mất kết nối riêng lẻ: {result['offline']}")
+
+    alerts = [{'type': 'system_disconnected', 'severity': 'CRITICAL', 'timestamp': datetime.now().isoformat()},
+              {'type': 'weak_wifi_signal', 'severity': 'WARNING', 'timestamp': datetime.now().isoformat()},
+              {'type': 'pump_long_runtime', 'severity': 'WARNING', 'timestamp': datetime.now().isoformat()}]
+    print("📦 esp-1 alert sau khi gom:", [(a['type'], a.get('details', {}).get('suppressed'))
+                                        for a in group_alerts('esp-1', alerts, result['events'])])
@@ -0,0 +1,527 @@
+import os
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from .feature_store import HOURLY_FEATURES
+
+# ================= FORECASTER RẺ + TỰ CHỌN MODEL THEO ZONE =================
+# BiLSTM 3 tầng (SoilMoistureLSTM) tốn CPU để train / chạy cho từng zone, và
+# zone mới chưa có đủ 24 giờ lịch sử. Ở đây là các model rẻ (fit + dự đoán
+# vài ms trên ma trận HOURLY_FEATURES của FeatureStore), xếp theo chi phí:
+#   0. persistence:    giữ nguyên giá trị cuối
+#   1. holt:           exponential smoothing (Holt, trend tắt dần)
+#   2. drying_curve:   hồi quy tốc độ khô khi bơm tắt theo độ ẩm + giờ trong ngày
+#   3. lag_boosting:   gradient boosted trees trên lag 1/2/3/24 giờ
+#   4. lstm:           SoilMoistureLSTM (nếu có TensorFlow + model đã train trong model_dir)
+# ZoneForecaster backtest trên vài ngày cuối của từng zone, chọn model rẻ
+# nhất có MAE <= target (không model nào đạt -> MAE thấp nhất), chọn lại
+# sau mỗi RESELECT_HOURS giờ dữ liệu mới.
+#
+# Mọi model dự đoán khi KHÔNG tưới thêm (pump = 0), đúng câu hỏi của gợi ý
+# tưới. Backtest chỉ tính MAE trên các giờ trước lần bơm kế tiếp.
+
+SOIL = HOURLY_FEATURES.index('soil')
+PUMP = HOURLY_FEATURES.index('pump')
+HOUR = HOURLY_FEATURES.index('hour')
+HORIZON = 24
+
+
+def _clip(values):
+    return np.clip(values, 0.0, 100.0)
+
+
+def _hour_terms(hour):
+    angle = 2 * np.pi * np.asarray(hour, dtype=np.float64) / 24
+    return np.sin(angle), np.cos(angle)
+
+
+def _future_hours(X, horizon):
+    return (X[-1, HOUR] + np.arange(1, horizon + 1)) % 24
+
+
+class Forecaster:
+    """Giao diện chung: fit(X) trên ma trận HOURLY_FEATURES, forecast(X) -> độ ẩm `horizon` giờ tới"""
+
+    name = 'base'
+    cost = 0
+    min_rows = 1    # số giờ lịch sử tối thiểu để fit
+
+    def fit(self, X):
+        return self
+
+    def forecast(self, X, horizon=HORIZON):
+        raise NotImplementedError
+
+
+class Persistence(Forecaster):
+    name = 'persistence'
+    cost = 0
+
+    def forecast(self, X, horizon=HORIZON):
+        return np.full(horizon, X[-1, SOIL])
+
+
+class Holt(Forecaster):
+    """Exponential smoothing có trend tắt dần (damped), alpha/beta chọn theo lỗi 1 bước"""
+
+    name = 'holt'
+    cost = 1
+    min_rows = 3
+    GRID = [(a, b) for a in (0.2, 0.5, 0.8) for b in (0.05, 0.2)]
+
+    def __init__(self, phi=0.9):
+        self.phi = phi
+        self.alpha, self.beta = self.GRID[0]
+
+    def _run(self, soil, alpha, beta):
+        level, trend, sse = soil[0], soil[1] - soil[0], 0.0
+        for value in soil[1:]:
+            guess = level + self.phi * trend
+            sse += (value - guess) ** 2
+            new_level = alpha * value + (1 - alpha) * guess
+            trend = beta * (new_level - level) + (1 - beta) * self.phi * trend
+            level = new_level
+        return level, trend, sse
+
+    def fit(self, X):
+        soil = X[:, SOIL]
+        self.alpha, self.beta = min(self.GRID, key=lambda p: self._run(soil, *p)[2])
+        return self
+
+    def forecast(self, X, horizon=HORIZON):
+        level, trend, _ = self._run(X[:, SOIL], self.alpha, self.beta)
+        damp = np.cumsum(self.phi ** np.arange(1, horizon + 1))
+        return _clip(level + damp * trend)
+
+
+class DryingCurve(Forecaster):
+    """
+    Đường cong khô: Δsoil/giờ = a + b·soil + c·sin(giờ) + d·cos(giờ), fit trên
+    các cặp giờ liền nhau bơm tắt (bốc hơi nhanh hơn buổi trưa, chậm khi đất đã khô)
+    """
+
+    name = 'drying_curve'
+    cost = 2
+    min_rows = 12
+
+    def __init__(self):
+        self.coef = np.zeros(4)
+
+    @staticmethod
+    def _design(soil, hour):
+        sin, cos = _hour_terms(hour)
+        return np.column_stack([np.ones_like(soil), soil, sin, cos])
+
+    def fit(self, X):
+        soil, pump = X[:, SOIL], X[:, PUMP]
+        off = (pump[:-1] == 0) & (pump[1:] == 0)
+        if off.sum() < 6:
+            self.coef = np.zeros(4)
+            return self
+        A = self._design(soil[:-1][off], X[1:, HOUR][off])
+        self.coef, *_ = np.linalg.lstsq(A, np.diff(soil)[off], rcond=None)
+        return self
+
+    def forecast(self, X, horizon=HORIZON):
+        soil = X[-1, SOIL]
+        out = np.empty(horizon)
+        for i, hour in enumerate(_future_hours(X, horizon)):
+            soil = float(np.clip(soil + self._design(np.array([soil]), [hour])[0] @ self.coef, 0, 100))
+            out[i] = soil
+        return out
+
+
+class LagBoosting(Forecaster):
+    """Gradient boosted trees dự đoán Δsoil giờ tới từ lag 1/2/3/24 giờ, giờ trong ngày, trạng thái bơm"""
+
+    name = 'lag_boosting'
+    cost = 3
+    LAGS = (1, 2, 3, 24)
+    min_rows = 72
+
+    def __init__(self, max_iter=60, max_depth=3):
+        from sklearn.ensemble import HistGradientBoostingRegressor
+        self.model = HistGradientBoostingRegressor(max_iter=max_iter, max_depth=max_depth, random_state=0)
+
+    def _rows(self, soil, pump, hour):
+        """Feature tại mỗi t (đủ lag): soil_t, soil_t - soil_{t-lag}, sin/cos giờ t+1, pump_t"""
+        start = max(self.LAGS)
+        sin, cos = _hour_terms((hour[start:] + 1) % 24)
+        lags = [soil[start:] - soil[start - lag:len(soil) - lag] for lag in self.LAGS]
+        return np.column_stack([soil[start:], *lags, sin, cos, pump[start:]])
+
+    def fit(self, X):
+        soil, pump, hour = X[:, SOIL], X[:, PUMP], X[:, HOUR]
+        rows = self._rows(soil[:-1], pump[:-1], hour[:-1])
+        self.model.fit(rows, np.diff(soil)[max(self.LAGS):])
+        return self
+
+    def forecast(self, X, horizon=HORIZON):
+        soil = list(X[-(max(self.LAGS) + 1):, SOIL])
+        hour = X[-1, HOUR]
+        out = np.empty(horizon)
+        for i in range(horizon):
+            s = np.array(soil[-(max(self.LAGS) + 1):])
+            sin, cos = _hour_terms((hour + 1) % 24)
+            row = [s[-1], *[s[-1] - s[-1 - lag] for lag in self.LAGS], sin, cos, 0.0]
+            value = float(np.clip(s[-1] + self.model.predict(np.array([row]))[0], 0, 100))
+            soil.append(value)
+            out[i] = value
+            hour = (hour + 1) % 24
+        return out
+
+
+class LSTMTier(Forecaster):
+    """SoilMoistureLSTM đã train sẵn (không fit lại theo zone)"""
+
+    name = 'lstm'
+    cost = 4
+
+    def __init__(self, lstm):
+        self.lstm = lstm
+        self.min_rows = lstm.sequence_length
+
+    def forecast(self, X, horizon=HORIZON):
+        return self.lstm.forecast(X, horizon)
+
+
+TIERS = (Persistence, Holt, DryingCurve, LagBoosting)
+MODELS = {cls.name: cls for cls in TIERS}
+
+
+# ================= KẾT QUẢ =================
+LEVELS = ('NO_WATER', 'WATER_SOON', 'WATER_NOW')
+SWITCH_MARGIN = 0.2     # đổi action khi xác suất >= 0.5 + margin (chống nhảy qua lại)
+
+
+def to_predictions(values, paths=None):
+    """
+    Mảng độ ẩm -> list dict giống SoilMoistureLSTM.predict_next_24h
+
+    paths: (tuỳ chọn) các đường dự đoán có thể (mẫu x giờ) -> thêm dải p10 / p50 / p90 mỗi giờ
+    """
+    now = datetime.now()
+    bands = np.percentile(paths, [10, 50, 90], axis=0) if paths is not None and len(paths) > 1 else None
+    predictions = []
+    for i, v in enumerate(values):
+        p = {
+            'hour': i + 1,
+            'timestamp': now + timedelta(hours=i + 1),
+            'predicted_soil': round(float(v), 2),
+        }
+        if bands is not None:
+            p['p10'], p['p50'], p['p90'] = (round(float(b), 2) for b in bands[:, i])
+        predictions.append(p)
+    return predictions
+
+
+def _level_probabilities(paths):
+    """P(action) trên các đường dự đoán: tưới ngay nếu min < 40, sắp tưới nếu min < 50 và TB < 55"""
+    lows, avgs = paths.min(axis=1), paths.mean(axis=1)
+    now = float(np.mean(lows < 40))
+    soon = float(np.mean((lows >= 40) & (lows < 50) & (avgs < 55)))
+    return np.array([1 - now - soon, soon, now])
+
+
+def watering_recommendation(predictions, paths=None, previous=None, margin=SWITCH_MARGIN):
+    """
+    Gợi ý tưới nước dựa trên dự đoán 24h
+
+    Args:
+        paths: (tuỳ chọn) đường dự đoán (mẫu x giờ) -> quyết định theo xác suất, có confidence
+        previous: action lần trước của thiết bị -> chỉ đổi khi action mới đủ chắc chắn
+            (P(mức >= mới) hoặc P(mức <= mới) >= 0.5 + margin), tránh 1 dự đoán nhiễu
+            quanh ngưỡng làm gợi ý nhảy WATER_NOW <-> NO_WATER
+    """
+    values = np.array([p['predicted_soil'] for p in predictions])
+    single = paths is None or len(paths) < 2
+    probs = _level_probabilities(values[None, :] if single else np.asarray(paths))
+
+    # Mức cao nhất có P(mức >= k) >= 0.5 (1 đường dự đoán: đúng như so ngưỡng trực tiếp)
+    at_least = np.cumsum(probs[::-1])[::-1]
+    level = max(k for k in range(len(LEVELS)) if k == 0 or at_least[k] >= 0.5)
+    if previous in LEVELS and not single:
+        prev = LEVELS.index(previous)
+        if level > prev and at_least[level] < 0.5 + margin:
+            level = prev
+        elif level < prev and 1 - at_least[level + 1] < 0.5 + margin:
+            level = prev
+
+    min_moisture = values.min()
+    avg_moisture = values.mean()
+    action = LEVELS[level]
+    if action == 'WATER_NOW':
+        rec = {
+            'action': 'WATER_NOW',
+            'reason': f'Độ ẩm sẽ giảm xuống {min_moisture:.1f}% trong 24h tới',
+            'suggested_duration': '15 phút',
+            'urgency': 'HIGH'
+        }
+    elif action == 'WATER_SOON':
+        rec = {
+            'action': 'WATER_SOON',
+            'reason': f'Độ ẩm trung bình {avg_moisture:.1f}%, tối thiểu {min_moisture:.1f}%',
+            'suggested_duration': '10 phút',
+            'urgency': 'MEDIUM'
+        }
+    else:
+        rec = {
+            'action': 'NO_WATER',
+            'reason': f'Độ ẩm ổn định ở {avg_moisture:.1f}%',
+            'suggested_duration': '0 phút',
+            'urgency': 'LOW'
+        }
+    if not single:
+        lows = np.percentile(np.min(paths, axis=1), [10, 90])
+        rec['reason'] += f' (tối thiểu P10-P90: {lows[0]:.1f}-{lows[1]:.1f}%)'
+        rec['confidence'] = round(float(probs[level]), 2)
+        rec['probabilities'] = {name: round(float(p), 2) for name, p in zip(LEVELS, probs)}
+    return rec
+
+
+# ================= CHỌN MODEL THEO ZONE =================
+def pump_free_steps(actual):
+    """Số giờ đầu của `actual` trước lần bơm kế tiếp"""
+    pumped = np.flatnonzero(actual[:, PUMP] > 0)
+    return int(pumped[0]) if len(pumped) else len(actual)
+
+
+def horizon_errors(predicted, actual):
+    """Sai số (dự đoán - thực tế) từng giờ; NaN từ lần bơm kế tiếp (model giả định không tưới thêm)"""
+    errors = np.asarray(predicted, dtype=np.float64)[:len(actual)] - actual[:, SOIL]
+    errors[pump_free_steps(actual):] = np.nan
+    return errors
+
+
+def backtest(model_cls, X, origins=6, spacing=11, horizon=HORIZON, factory=None, start=0, paths=None):
+    """
+    MAE trung bình của dự đoán `horizon` giờ tại `origins` mốc cuối (cách nhau
+    `spacing` giờ -> mốc rơi vào nhiều giờ khác nhau trong ngày)
+
+    Chỉ tính các giờ trước lần bơm kế tiếp. None nếu chưa đủ dữ liệu cho mốc nào.
+    start: bỏ qua `start` mốc cuối (đã chấm); paths: list nhận vector sai số từng mốc
+    """
+    make = factory or model_cls
+    errors = []
+    for k in range(start, origins):
+        origin = len(X) - horizon - k * spacing
+        if origin < max(model_cls.min_rows, 2):
+            break
+        actual = X[origin:origin + horizon]
+        if pump_free_steps(actual) < 3:
+            continue
+        predicted = make().fit(X[:origin]).forecast(X[:origin], horizon)
+        error = horizon_errors(predicted, actual)
+        errors.append(np.nanmean(np.abs(error)))
+        if paths is not None:
+            paths.append(error)
+    return float(np.mean(errors)) if errors else None
+
+
+def error_paths(errors):
+    """
+    Vector sai số backtest (NaN sau lần bơm) -> ma trận đầy đủ: giữ sai số
+    cuối cùng đã biết cho các giờ sau (dùng làm các đường dự đoán có thể)
+    """
+    if not errors:
+        return None
+    errors = np.vstack(errors)
+    idx = np.where(np.isfinite(errors), np.arange(errors.shape[1]), 0)
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    return np.take_along_axis(errors, idx, axis=1)
+
+
+class _Choice:
+    def __init__(self, name, model, mae, scores, errors=None):
+        self.name = name
+        self.model = model
+        self.mae = mae
+        self.scores = scores    # tên model -> MAE backtest (None = chưa đủ dữ liệu)
+        self.errors = errors    # sai số backtest (mốc x giờ) -> dải dự đoán, None = chưa có
+        self.at = None          # ts giờ cuối lúc chọn
+        self.fitted = None      # ts giờ cuối lúc fit
+
+
+class ZoneForecaster:
+    """
+    Dự đoán 24h cho từng zone bằng model rẻ nhất đạt target MAE
+
+    Cùng giao diện với SoilMoistureLSTM (predict_next_24h / get_watering_recommendation)
+    -> ml_service dùng thay thế trực tiếp.
+    """
+
+    RESELECT_HOURS = 24
+    HISTORY_DAYS = 14
+    BACKTEST_ORIGINS = 6    # số mốc backtest khi chọn model
+    INTERVAL_ORIGINS = 12   # thêm mốc cho model được chọn -> sai số làm dải P10/P90
+
+    def __init__(self, features, target_mae=2.0, lstm=None, tiers=TIERS):
+        """
+        Args:
+            features: FeatureStore (ma trận theo giờ của từng zone)
+            target_mae: sai số tuyệt đối trung bình chấp nhận được (% độ ẩm)
+            lstm: (tuỳ chọn) SoilMoistureLSTM đã train -> tier đắt nhất
+        """
+        self.features = features
+        self.target_mae = target_mae
+        self.lstm = lstm
+        self.tiers = list(tiers)
+        self._choices = {}
+        self._actions = {}      # device -> action gợi ý lần trước (chống nhảy qua lại)
+
+    def _candidates(self):
+        candidates = [(cls.name, cls.cost, cls, cls) for cls in self.tiers]
+        if self.lstm is not None and os.path.exists(self.lstm.model_path):
+            tier = LSTMTier(self.lstm)
+            candidates.append((tier.name, tier.cost, tier, lambda: tier))
+        return sorted(candidates, key=lambda c: c[1])
+
+    def select(self, X):
+        """Backtest theo thứ tự chi phí, dừng ở model đầu tiên đạt target"""
+        usable = [c for c in self._candidates() if len(X) >= c[2].min_rows]
+        scores = {}
+        best = None
+        for name, _, spec, factory in usable:
+            errors = []
+            mae = backtest(spec, X, origins=self.BACKTEST_ORIGINS, factory=factory, paths=errors)
+            scores[name] = None if mae is None else round(mae, 3)
+            if mae is not None and (best is None or mae < best[1]):
+                best = (name, mae, spec, factory, errors)
+            if mae is not None and mae <= self.target_mae:
+                break
+        if best is None:
+            # Chưa đủ lịch sử để backtest: model rẻ nhất dùng được
+            name, _, spec, factory = usable[0]
+            best = (name, None, spec, factory, [])
+        name, mae, spec, factory, errors = best
+        backtest(spec, X, origins=self.INTERVAL_ORIGINS, factory=factory,
+                 start=self.BACKTEST_ORIGINS, paths=errors)
+        return _Choice(name, factory(), mae, scores, error_paths(errors))
+
+    def forecast(self, device=None):
+        """Độ ẩm 24 giờ tới của zone; chọn lại / fit lại khi có giờ dữ liệu mới"""
+        ts, X = self.features.hourly(device, days=self.HISTORY_DAYS)
+        if len(X) == 0:
+            raise ValueError('Chưa có dữ liệu cho thiết bị này')
+        choice = self._choices.get(device)
+        if choice is None or ts[-1] - choice.at >= self.RESELECT_HOURS * 3600:
+            choice = self._choices[device] = self.select(X)
+            choice.at = ts[-1]
+        if choice.fitted != ts[-1]:
+            choice.model.fit(X)
+            choice.fitted = ts[-1]
+        return choice.model.forecast(X)
+
+    def forecast_paths(self, device=None):
+        """
+        (dự đoán, các đường dự đoán có thể) - đường = dự đoán trừ sai số backtest
+        của model đã chọn tại các mốc gần đây (None khi zone chưa đủ lịch sử)
+        """
+        values = self.forecast(device)
+        return values, self._error_paths(values, device)
+
+    def _error_paths(self, values, device):
+        errors = self._choices[device].errors
+        if errors is None:
+            return None
+        return _clip(values[None, :] - errors[:, :len(values)])
+
+    def _paths(self, hourly, device):
+        """
+        Tier LSTM có window RingStore: dự đoán + đường MC dropout của LSTM; model
+        không có Dropout -> dải sai số backtest như model rẻ (không co về 1 đường)
+        """
+        if not self._lstm_window(hourly, device):
+            return self.forecast_paths(device)
+        values, paths = self.lstm.predict_paths(hourly=hourly, device=device)
+        if paths is None:
+            paths = self._error_paths(values, device)
+        return values, paths
+
+    def describe(self, device=None):
+        choice = self._choices.get(device)
+        if choice is None:
+            return None
+        out = {'name': choice.name, 'mae': None if choice.mae is None else round(choice.mae, 3),
+               'target_mae': self.target_mae, 'backtest': choice.scores}
+        if choice.name == 'lstm':
+            out['version'] = self.lstm.model_version
+        return out
+
+    def predict_next_24h(self, hourly=None, device=None):
+        """hourly (window RingStore) chỉ dùng cho tier LSTM; model rẻ đọc FeatureStore"""
+        return to_predictions(*self._paths(hourly, device))
+
+    def get_watering_recommendation(self, hourly=None, device=None):
+        values, paths = self._paths(hourly, device)
+        rec = watering_recommendation(to_predictions(values, paths), paths, previous=self._actions.get(device))
+        self._actions[device] = rec['action']
+        return rec
+
+    def _lstm_window(self, hourly, device):
+        return (hourly is not None and self.lstm is not None
+                and getattr(self._choices.get(device), 'name', None) == 'lstm')
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+if __name__ == "__main__":
+    import sys
+    import sqlite3
+    import tempfile
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import migrations
+    from .feature_store import FeatureStore
+
+    db = os.path.join(tempfile.mkdtemp(), 'forecast.db')
+    migrations.migrate(db)
+
+    # 40 zone, 2..14 ngày lịch sử: khô dần (nhanh hơn buổi trưa), tưới lúc 6h khi < 45%
+    rng = np.random.default_rng(0)
+    now = time.time()
+    con = sqlite3.connect(db)
+    for z in range(40):
+        days = int(rng.integers(1, 15)) if z else 0.5
+        rate = rng.uniform(0.3, 1.2)
+        ts = np.arange(now - days * 86400, now, 120.0)
+        soil, rows = 60.0, []
+        for t in ts:
+            hour = datetime.fromtimestamp(t).hour
+            pump = int(hour == 6 and soil < 45)
+            soil += (20.0 if pump else -rate * (0.5 + np.sin(np.pi * max(hour - 6, 0) / 12) ** 2)) / 30
+            soil = min(max(soil + rng.normal(0, 0.05), 0), 100)
+            rows.append((int(t * 1000), soil, pump, -60, f'zone-{z:02d}'))
+        con.executemany("INSERT INTO logs(ts_ms,soil,pump,auto,wifi_connected,wifi_rssi,device) "
+                        "VALUES(?,?,?,1,1,?,?)", rows)
+    con.commit()
+    con.close()
+
+    store = FeatureStore(db)
+    zones = [f'zone-{z:02d}' for z in range(40)]
+    t0 = time.perf_counter()
+    for zone in zones:
+        store.hourly(zone)
+    build = (time.perf_counter() - t0) * 1000 / len(zones)
+    LagBoosting()   # import sklearn trước khi đo
+
+    forecaster = ZoneForecaster(store, target_mae=1.5)
+    picked = {}
+    t0 = time.perf_counter()
+    for zone in zones:
+        forecaster.forecast(zone)
+        name = forecaster.describe(zone)['name']
+        picked[name] = picked.get(name, 0) + 1
+    first = (time.perf_counter() - t0) * 1000 / len(zones)
+    t0 = time.perf_counter()
+    for zone in zones:
+        forecaster.forecast(zone)
+    again = (time.perf_counter() - t0) * 1000 / len(zones)
+
+    print(f"📦 FeatureStore lần đầu: {build:.1f} ms/zone")
+    print(f"🌱 {len(zones)} zone: backtest + chọn + fit {first:.1f} ms/zone, dự đoán lại {again:.1f} ms/zone")
+    print(f"📊 Model được chọn: {picked}")
+    print(f"🔎 zone-05: {forecaster.describe('zone-05')}")
+    print(f"💡 {forecaster.get_watering_recommendation(device='zone-05')}")
+    print(f"🆕 zone-00 (12 giờ lịch sử): {forecaster.describe('zone-00')}")
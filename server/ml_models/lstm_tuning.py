@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import sqlite3
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+# ================= TÌM HYPERPARAMETER CHO SoilMoistureLSTM =================
+# sequence_length, số unit từng tầng, dropout, learning rate... trước đây cố
+# định (BiLSTM 128/64/32). Ở đây mỗi trial là 1 bộ tham số, chạy trong process
+# pool (spawn, mỗi worker vài thread TensorFlow):
+#   - Ma trận feature đã scale ghi 1 lần ra .npy; worker mở bằng mmap và tạo
+#     sequence bằng view trượt (không copy) -> N worker dùng chung 1 bản trong
+#     page cache, sequence_length khác nhau không phải chuẩn bị lại
+#   - Mọi trial chấm trên CÙNG các giờ validation (20% cuối theo thời gian)
+#   - Sau mỗi epoch, val_loss ghi vào bảng ml_trials; trial tệ hơn median của
+#     các trial khác ở cùng epoch (sau `warmup` epoch) bị dừng sớm (PRUNED)
+#   - Trial 0 luôn là cấu hình hiện tại (không bị prune) làm mốc so sánh;
+#     kết quả: model nhỏ nhất / dự đoán nhanh nhất có val MAE <= mốc * (1 + tolerance)
+# Mỗi bộ tham số có model_version (vd lstm-s12-32x16-3f9a1c) ghi trong
+# ml_trials và models/lstm_params.json (model đang dùng).
+
+MODEL_DIR = 'models'
+MODEL_FILE = 'lstm_best.h5'
+PARAMS_FILE = 'lstm_params.json'
+
+DEFAULT_PARAMS = {
+    'sequence_length': 24,
+    'units': [128, 64, 32],
+    'bidirectional': True,
+    'dropout': [0.3, 0.3, 0.2],
+    'dense': 16,
+    'learning_rate': 0.001,
+    'batch_size': 32,
+}
+
+SPACE = {
+    'sequence_length': [6, 12, 24, 48],
+    'units': [[128, 64, 32], [64, 32], [32, 16], [64], [32], [16]],
+    'bidirectional': [True, False],
+    # Không có 0.0: dải P10-P90 của LSTM là MC dropout, model không có Dropout
+    # -> mọi mẫu giống nhau, dải co về 1 đường
+    'dropout': [0.1, 0.2, 0.3],
+    'dense': [0, 8, 16],
+    'learning_rate': [0.0003, 0.001, 0.003],
+    'batch_size': [16, 32, 64],
+}
+
+
+# ================= THAM SỐ + VERSION =================
+def model_version(params):
+    """Tên ngắn + hash của bộ tham số, vd lstm-s24-bi128x64x32-1a2b3c"""
+    p = {**DEFAULT_PARAMS, **params}
+    digest = hashlib.sha1(json.dumps(p, sort_keys=True).encode()).hexdigest()[:6]
+    units = 'x'.join(str(u) for u in p['units'])
+    return f"lstm-s{p['sequence_length']}-{'bi' if p['bidirectional'] else ''}{units}-{digest}"
+
+
+def model_path(model_dir=MODEL_DIR):
+    """File model đang dùng (models/lstm_best.h5)"""
+    return os.path.join(model_dir, MODEL_FILE)
+
+
+def load_params(model_dir=MODEL_DIR):
+    """Tham số của model đang dùng (models/lstm_params.json), mặc định nếu chưa tune"""
+    try:
+        with open(os.path.join(model_dir, PARAMS_FILE)) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return dict(DEFAULT_PARAMS)
+    return {**DEFAULT_PARAMS, **saved.get('params', {})}
+
+
+def save_params(params, model_dir=MODEL_DIR):
+    os.makedirs(model_dir, exist_ok=True)
+    with open(os.path.join(model_dir, PARAMS_FILE), 'w') as f:
+        json.dump({'model_version': model_version(params), 'params': params}, f, indent=2)
+
+
+def sample(n, space=SPACE, seed=42, baseline=DEFAULT_PARAMS):
+    """n bộ tham số khác nhau, bộ đầu = baseline"""
+    rng = random.Random(seed)
+    trials = [dict(baseline)]
+    seen = {model_version(baseline)}
+    for _ in range(n * 50):
+        if len(trials) >= n:
+            break
+        params = {key: rng.choice(values) for key, values in space.items()}
+        if model_version(params) not in seen:
+            seen.add(model_version(params))
+            trials.append(params)
+    return trials
+
+
+# ================= DỮ LIỆU =================
+def sequences(scaled, sequence_length, target=0):
+    """
+    (X, y, chỉ số dòng của y): X[i] = scaled[i:i+L], y[i] = scaled[i+L, target]
+
+    X là view trượt trên `scaled` (kể cả memmap) -> không copy dữ liệu
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(scaled[:-1], sequence_length, axis=0)
+    return windows.transpose(0, 2, 1), scaled[sequence_length:, target], np.arange(sequence_length, len(scaled))
+
+
+def prepare(features, workdir, split=0.8):
+    """
+    Scale (fit trên phần train) + ghi .npy float32 cho worker mmap
+
+    Returns: (đường dẫn, dòng đầu tiên của validation, khoảng giá trị soil để đổi MAE ra %)
+    """
+    from sklearn.preprocessing import MinMaxScaler
+    split_row = int(len(features) * split)
+    scaler = MinMaxScaler(feature_range=(0, 1)).fit(features[:split_row])
+    path = os.path.join(workdir, 'features.npy')
+    np.save(path, scaler.transform(features).astype(np.float32))
+    return path, split_row, float(scaler.data_range_[0])
+
+
+def should_prune(curve, others, warmup=4, min_trials=3):
+    """
+    Median pruning: val_loss tốt nhất tới epoch hiện tại của trial này tệ hơn
+    median của các trial khác (cùng số epoch) -> dừng
+
+    curve: val_loss từng epoch của trial; others: curve của các trial khác
+    """
+    epoch = len(curve)
+    if epoch <= warmup:
+        return False
+    best = [min(c[:epoch]) for c in others if len(c) >= epoch]
+    if len(best) < min_trials:
+        return False
+    return min(curve) > float(np.median(best))
+
+
+# ================= TRIAL (CHẠY TRONG WORKER) =================
+def _init(threads):
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def _trial(task):
+    (db_path, study, trial_id, params, data_path, split_row, soil_range,
+     epochs, patience, warmup, prune) = task
+    from tensorflow import keras
+    from .soil_prediction import SoilMoistureLSTM
+
+    con = sqlite3.connect(db_path, timeout=30)
+    curve, state = [], ['COMPLETE']
+
+    class Pruning(keras.callbacks.Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            curve.append(float(logs['val_loss']))
+            with con:
+                con.execute("UPDATE ml_trials SET curve=?, epochs=? WHERE id=?",
+                            (json.dumps(curve), len(curve), trial_id))
+            if not prune:
+                return
+            others = [json.loads(r[0]) for r in con.execute(
+                "SELECT curve FROM ml_trials WHERE study=? AND id != ? AND curve IS NOT NULL",
+                (study, trial_id))]
+            if should_prune(curve, others, warmup):
+                state[0] = 'PRUNED'
+                self.model.stop_training = True
+
+    row = {'state': 'FAILED'}
+    try:
+        with con:
+            con.execute("UPDATE ml_trials SET state='RUNNING' WHERE id=?", (trial_id,))
+        # Mọi worker đọc cùng file (page cache), sequence là view -> không copy
+        scaled = np.load(data_path, mmap_mode='r')
+        X, y, rows = sequences(scaled, params['sequence_length'])
+        n = int(np.searchsorted(rows, split_row))
+        train, val = slice(0, n), slice(n, None)
+
+        t0 = time.perf_counter()
+        lstm = SoilMoistureLSTM(db_path=db_path, params=params)
+        model = lstm.build_model(input_shape=X.shape[1:], summary=False)
+        model.fit(X[train], y[train], epochs=epochs, batch_size=params['batch_size'],
+                  validation_data=(X[val], y[val]), verbose=0,
+                  callbacks=[keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience,
+                                                           restore_best_weights=True), Pruning()])
+        seconds = time.perf_counter() - t0
+        _, mae = model.evaluate(X[val], y[val], verbose=0)
+
+        # Chi phí 1 lần dự đoán 24h (24 bước đệ quy như SoilMoistureLSTM.forecast)
+        x = np.ascontiguousarray(X[val][-1:])
+        model.predict_on_batch(x)
+        t0 = time.perf_counter()
+        for _ in range(24):
+            model.predict_on_batch(x)
+        predict_ms = (time.perf_counter() - t0) * 1000
+
+        row = {'state': state[0], 'epochs': len(curve), 'val_loss': min(curve),
+               'val_mae': float(mae) * soil_range, 'n_params': int(model.count_params()),
+               'seconds': seconds, 'predict_ms': predict_ms}
+    except Exception as e:
+        row['error'] = f"{type(e).__name__}: {e}"
+    with con:
+        con.execute("UPDATE ml_trials SET state=?, epochs=?, val_loss=?, val_mae=?, n_params=?, seconds=?, "
+                    "predict_ms=? WHERE id=?",
+                    (row['state'], row.get('epochs', len(curve)), row.get('val_loss'), row.get('val_mae'),
+                     row.get('n_params'), row.get('seconds'), row.get('predict_ms'), trial_id))
+    con.close()
+    return trial_id, row
+
+
+# ================= SEARCH =================
+def search(db_path, trials=20, workers=None, epochs=40, patience=6, warmup=4, device=None, days=60,
+           seed=42, study=None, space=SPACE):
+    """
+    Chạy `trials` bộ tham số song song, kết quả trong bảng ml_trials (cần migration 5)
+
+    Returns: tên study
+    """
+    from .feature_store import FeatureStore
+    study = study or time.strftime('tune-%Y%m%d-%H%M%S')
+    _, features = FeatureStore(db_path).hourly(device, days=days)
+    if len(features) < 2 * max(space['sequence_length']):
+        raise ValueError(f'Chưa đủ dữ liệu để tune ({len(features)} giờ)')
+
+    workers = max(1, min(workers or os.cpu_count() or 1, trials))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    workdir = tempfile.mkdtemp(prefix='lstm-tune-')
+    try:
+        data_path, split_row, soil_range = prepare(features, workdir)
+        con = sqlite3.connect(db_path, timeout=30)
+        tasks = []
+        with con:
+            for i, params in enumerate(sample(trials, space, seed)):
+                cur = con.execute("INSERT INTO ml_trials(study, model_version, params, ts_ms) VALUES(?,?,?,?)",
+                                  (study, model_version(params), json.dumps(params), int(time.time() * 1000)))
+                tasks.append((db_path, study, cur.lastrowid, params, data_path, split_row, soil_range,
+                              epochs, patience, warmup, i > 0))
+        con.close()
+
+        print(f"🔧 Study {study}: {len(tasks)} trial, {workers} worker x {threads} thread, "
+              f"{len(features)} giờ dữ liệu")
+        # spawn: TensorFlow không an toàn sau fork
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init, initargs=(threads,)) as pool:
+            futures = {pool.submit(_trial, task): task for task in tasks}
+            for future in as_completed(futures):
+                trial_id, row = future.result()
+                version = model_version(futures[future][3])
+                if row['state'] == 'FAILED':
+                    print(f"   ❌ #{trial_id} {version}: {row['error']}")
+                else:
+                    print(f"   {'✂️' if row['state'] == 'PRUNED' else '✅'} #{trial_id} {version}: "
+                          f"{row['epochs']} epoch, val MAE {row['val_mae']:.2f}%, {row['n_params']} params")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return study
+
+
+def results(db_path, study):
+    con = sqlite3.connect(db_path)
+    con.row_factory = sqlite3.Row
+    try:
+        rows = [dict(r) for r in con.execute("SELECT * FROM ml_trials WHERE study=? ORDER BY id", (study,))]
+    finally:
+        con.close()
+    for r in rows:
+        r['params'] = json.loads(r['params'])
+    return rows
+
+
+def pick(rows, tolerance=0.05):
+    """
+    Model nhỏ nhất (rồi dự đoán nhanh nhất) có val MAE <= baseline * (1 + tolerance)
+
+    Returns: (trial được chọn, trial baseline) - None nếu baseline chưa xong
+    """
+    done = [r for r in rows if r['state'] == 'COMPLETE']
+    baseline = next((r for r in done if r['model_version'] == model_version(DEFAULT_PARAMS)), None)
+    if baseline is None:
+        return None, None
+    ok = [r for r in done if r['val_mae'] <= baseline['val_mae'] * (1 + tolerance)]
+    return min(ok, key=lambda r: (r['n_params'], r['predict_ms'])), baseline
+
+
+def apply(db_path, params, epochs=100, device=None):
+    """Train lại bộ tham số đã chọn trên toàn bộ dữ liệu -> models/lstm_best.h5 + lstm_params.json"""
+    from .soil_prediction import SoilMoistureLSTM
+    SoilMoistureLSTM(db_path=db_path, params=params).train(epochs=epochs, device=device)
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Tìm hyperparameter cho SoilMoistureLSTM')
+    ap.add_argument('--db', default='tuoi.db')
+    ap.add_argument('--device', help='chỉ dữ liệu của thiết bị này (mặc định: tất cả)')
+    ap.add_argument('--days', type=int, default=60)
+    ap.add_argument('--trials', type=int, default=20)
+    ap.add_argument('--workers', type=int, help='số process (mặc định = số CPU)')
+    ap.add_argument('--epochs', type=int, default=40, help='số epoch tối đa / trial')
+    ap.add_argument('--patience', type=int, default=6, help='early stopping')
+    ap.add_argument('--warmup', type=int, default=4, help='số epoch trước khi được prune')
+    ap.add_argument('--tolerance', type=float, default=0.05, help='val MAE chấp nhận = baseline x (1 + tolerance)')
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--study', help='chỉ in kết quả của study đã chạy')
+    ap.add_argument('--apply', action='store_true', help='train lại + lưu model được chọn')
+    args = ap.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import migrations
+    migrations.migrate(args.db)
+
+    study = args.study or search(args.db, args.trials, args.workers, args.epochs, args.patience,
+                                 args.warmup, args.device, args.days, args.seed)
+    rows = results(args.db, study)
+    print(f"\n{'model_version':<34}{'state':>10}{'epoch':>7}{'val MAE %':>11}{'params':>10}{'dự đoán ms':>12}{'train s':>9}")
+    for r in sorted(rows, key=lambda r: (r['val_mae'] is None, r['val_mae'] or 0)):
+        fmt = lambda v, spec: '-' if v is None else format(v, spec)
+        print(f"{r['model_version']:<34}{r['state']:>10}{fmt(r['epochs'], 'd'):>7}{fmt(r['val_mae'], '.3f'):>11}"
+              f"{fmt(r['n_params'], 'd'):>10}{fmt(r['predict_ms'], '.1f'):>12}{fmt(r['seconds'], '.1f'):>9}")
+
+    best, baseline = pick(rows, args.tolerance)
+    if best is None:
+        print("⚠️ Baseline chưa chạy xong, không chọn được model")
+        return 1
+    print(f"\n📏 Baseline {baseline['model_version']}: val MAE {baseline['val_mae']:.3f}%, "
+          f"{baseline['n_params']} params, {baseline['predict_ms']:.1f} ms / dự đoán 24h")
+    print(f"🏆 Chọn {best['model_version']}: val MAE {best['val_mae']:.3f}%, {best['n_params']} params, "
+          f"{best['predict_ms']:.1f} ms / dự đoán 24h")
+    print(f"   {json.dumps(best['params'])}")
+    if args.apply:
+        apply(args.db, best['params'], device=args.device)
+        print(f"💾 Saved {model_path()} + {PARAMS_FILE} ({best['model_version']})")
+    return 0
+
+
+if __name__ == "__main__":
+    # python -m ml_models.lstm_tuning --db tuoi.db --trials 24 --workers 4
+    # python -m ml_models.lstm_tuning --db tuoi.db --study tune-20250101-120000 --apply
+    sys.exit(main())
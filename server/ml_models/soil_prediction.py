@@ -7,110 +7,129 @@ from tensorflow import keras
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import LSTM, Dense, Dropout, Bidirectional
 from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
-import joblib
-import sqlite3
 from datetime import datetime, timedelta
+from dateutil.tz import tzlocal
+from storage import connect
+from .feature_store import FeatureStore, HOURLY_FEATURES, hourly_frame, hourly_matrix, local_times
+from .forecasters import to_predictions, watering_recommendation
+from .lstm_tuning import load_params, save_params, model_path, model_version, sequences
 
 class SoilMoistureLSTM:
-    def __init__(self, db_path='tuoi.db', sequence_length=24):
+    def __init__(self, db_path='tuoi.db', sequence_length=None, analytics=None, features=None, params=None,
+                 samples=32):
         """
         Args:
             db_path: Đường dẫn database SQLite
-            sequence_length: Số timesteps để dự đoán (default: 24 = 24 giờ)
+            sequence_length: Số timesteps để dự đoán (default: theo params, 24 = 24 giờ)
+            analytics: (tuỳ chọn) analytics.Analytics -> load_data resample theo giờ trong DuckDB
+            features: (tuỳ chọn) FeatureStore dùng chung trong process (train + predict)
+            params: (tuỳ chọn) hyperparameter (xem lstm_tuning.DEFAULT_PARAMS);
+                mặc định = models/lstm_params.json của model đã train
+            samples: số đường MC dropout cho dải dự đoán (1 = chỉ dự đoán điểm)
         """
         self.db_path = db_path
-        self.sequence_length = sequence_length
+        self.analytics = analytics
+        self.features = features or FeatureStore(db_path)
+        self.model_path = model_path(self.features.model_dir)
+        self.params = {**load_params(self.features.model_dir), **(params or {})}
+        if sequence_length:
+            self.params['sequence_length'] = sequence_length
+        self.sequence_length = self.params['sequence_length']
+        self.model_version = model_version(self.params)
+        self.samples = samples
         self.model = None
+        self._actions = {}  # device -> action gợi ý lần trước (chống nhảy qua lại)
         self.scaler = MinMaxScaler(feature_range=(0, 1))
         
     def load_data(self, days=30):
         """Load dữ liệu từ database"""
-        con = sqlite3.connect(self.db_path)
+        if self.analytics is not None:
+            hourly = self.analytics.hourly(days=days)
+            df_hourly = pd.DataFrame({
+                'soil': hourly.soil, 'pump': hourly.pump, 'auto': hourly.auto, 'wifi_rssi': hourly.rssi,
+            }, index=pd.DatetimeIndex([datetime.fromtimestamp(float(t)) for t in hourly.ts], name='ts'))
+            print(f"✅ Loaded {len(df_hourly)} hourly records (DuckDB)")
+            return df_hourly
+        
+        con = connect(self.db_path)   # có shard: `logs` gộp mọi shard
         
         # Lấy dữ liệu 30 ngày gần nhất
-        cutoff_date = (datetime.now() - timedelta(days=days)).isoformat()
+        cutoff_ms = int((datetime.now() - timedelta(days=days)).timestamp() * 1000)
         
         query = """
         SELECT 
-            ts,
+            ts_ms AS ts,
             soil,
             pump,
             auto,
             wifi_rssi
         FROM logs 
-        WHERE ts >= ?
-        ORDER BY ts ASC
+        WHERE ts_ms >= ?
+        ORDER BY ts_ms ASC
         """
         
-        df = pd.read_sql_query(query, con, params=(cutoff_date,))
+        df = pd.read_sql_query(query, con, params=(cutoff_ms,))
         con.close()
         
-        # Convert timestamp to datetime
-        df['ts'] = pd.to_datetime(df['ts'])
+        # Epoch ms -> datetime giờ địa phương
+        df['ts'] = pd.to_datetime(df['ts'], unit='ms', utc=True).dt.tz_convert(tzlocal()).dt.tz_localize(None)
         
-        # Resample to hourly average (giảm noise)
-        df.set_index('ts', inplace=True)
-        df_hourly = df.resample('1H').mean().fillna(method='ffill')
+        # Resample to hourly average (giảm noise), cùng định nghĩa với FeatureStore
+        df_hourly = hourly_frame(df.set_index('ts'))
         
         print(f"✅ Loaded {len(df_hourly)} hourly records")
         return df_hourly
     
     def create_sequences(self, data, target_col='soil'):
-        """Tạo sequences cho LSTM"""
-        X, y = [], []
-        
-        for i in range(len(data) - self.sequence_length):
-            X.append(data[i:i + self.sequence_length])
-            y.append(data[i + self.sequence_length, data.columns.get_loc(target_col)])
-        
-        return np.array(X), np.array(y)
+        """Tạo sequences cho LSTM (view trượt, không copy từng window)"""
+        X, y, _ = sequences(np.asarray(data, dtype=np.float64), self.sequence_length,
+                            data.columns.get_loc(target_col))
+        return X, y
     
-    def build_model(self, input_shape):
-        """Xây dựng LSTM model"""
-        model = Sequential([
-            # Bidirectional LSTM layer 1
-            Bidirectional(LSTM(128, return_sequences=True), 
-                         input_shape=input_shape),
-            Dropout(0.3),
-            
-            # LSTM layer 2
-            LSTM(64, return_sequences=True),
-            Dropout(0.3),
-            
-            # LSTM layer 3
-            LSTM(32),
-            Dropout(0.2),
-            
-            # Dense layers
-            Dense(16, activation='relu'),
-            Dense(1)  # Output: soil moisture prediction
-        ])
+    def build_model(self, input_shape, summary=True):
+        """Xây dựng LSTM model theo self.params (mặc định: BiLSTM 128 -> LSTM 64 -> LSTM 32)"""
+        units = self.params['units']
+        dropout = self.params['dropout']
+        if not isinstance(dropout, (list, tuple)):
+            dropout = [dropout] * len(units)
+        
+        layers = [keras.Input(shape=input_shape)]
+        for i, n in enumerate(units):
+            layer = LSTM(n, return_sequences=i < len(units) - 1)
+            # Chỉ tầng đầu là Bidirectional
+            layers.append(Bidirectional(layer) if i == 0 and self.params['bidirectional'] else layer)
+            if dropout[i]:
+                layers.append(Dropout(dropout[i]))
+        
+        # Dense layers
+        if self.params['dense']:
+            layers.append(Dense(self.params['dense'], activation='relu'))
+        layers.append(Dense(1))  # Output: soil moisture prediction
+        model = Sequential(layers)
         
         model.compile(
-            optimizer=keras.optimizers.Adam(learning_rate=0.001),
+            optimizer=keras.optimizers.Adam(learning_rate=self.params['learning_rate']),
             loss='mse',
             metrics=['mae']
         )
         
-        print("🏗️ Model Architecture:")
-        model.summary()
+        if summary:
+            print(f"🏗️ Model Architecture ({self.model_version}):")
+            model.summary()
         
         return model
     
-    def train(self, epochs=100, batch_size=32, validation_split=0.2):
-        """Train model"""
-        print("📊 Loading and preprocessing data...")
+    def train(self, epochs=100, batch_size=None, validation_split=0.2, device=None):
+        """Train model (device=None: mọi thiết bị, batch_size=None: theo params)"""
+        print("📊 Loading features...")
         
-        # Load data
-        df = self.load_data(days=60)  # Dùng 60 ngày data
+        # Feature đã tính sẵn trong FeatureStore (60 ngày)
+        _, features = self.features.hourly(device, days=60)
+        df = pd.DataFrame(features, columns=HOURLY_FEATURES)
         
-        # Feature engineering
-        df['hour'] = df.index.hour
-        df['day_of_week'] = df.index.dayofweek
-        df['is_weekend'] = (df['day_of_week'] >= 5).astype(int)
-        
-        # Normalize data
-        scaled_data = self.scaler.fit_transform(df)
+        # Normalize data (scaler được lưu + cache trong FeatureStore)
+        self.scaler = self.features.fit_scaler('scaler', MinMaxScaler(feature_range=(0, 1)), df.to_numpy())
+        scaled_data = self.scaler.transform(df.to_numpy())
         
         # Create sequences
         X, y = self.create_sequences(pd.DataFrame(scaled_data, columns=df.columns))
@@ -133,7 +152,7 @@ class SoilMoistureLSTM:
         )
         
         checkpoint = ModelCheckpoint(
-            'models/lstm_best.h5',
+            self.model_path,
             monitor='val_loss',
             save_best_only=True
         )
@@ -143,7 +162,7 @@ class SoilMoistureLSTM:
         history = self.model.fit(
             X_train, y_train,
             epochs=epochs,
-            batch_size=batch_size,
+            batch_size=batch_size or self.params['batch_size'],
             validation_data=(X_test, y_test),
             callbacks=[early_stop, checkpoint],
             verbose=1
@@ -154,57 +173,99 @@ class SoilMoistureLSTM:
         print(f"\n✅ Test Loss: {loss:.4f}")
         print(f"✅ Test MAE: {mae:.4f}%")
         
-        # Save scaler
-        joblib.dump(self.scaler, 'models/scaler.pkl')
-        print("💾 Model and scaler saved!")
+        # Tham số đi kèm lstm_best.h5 -> predict dựng đúng sequence_length, ghi model_version
+        save_params(self.params, self.features.model_dir)
+        print(f"💾 Model and scaler saved! ({self.model_version})")
         
         return history
     
-    def predict_next_24h(self):
-        """Dự đoán độ ẩm 24 giờ tới"""
+    def features_from_hourly(self, hourly):
+        """
+        Ma trận HOURLY_FEATURES (cùng định nghĩa với FeatureStore)
+        từ window trung bình theo giờ của RingStore (ring_buffer.Window)
+        """
+        return hourly_matrix(local_times(hourly.ts), hourly.soil, hourly.pump, hourly.auto, hourly.rssi)
+    
+    def _load(self):
         if self.model is None:
             # Load model
-            self.model = keras.models.load_model('models/lstm_best.h5')
-            self.scaler = joblib.load('models/scaler.pkl')
-        
-        # Get recent data
-        df = self.load_data(days=7)
+            # compile=False: chỉ dự đoán; Keras 3 không deserialize được loss 'mse' trong file .h5
+            self.model = keras.models.load_model(self.model_path, compile=False)
+            self.scaler = self.features.scaler('scaler')
+            # Độ dài sequence theo model đã lưu (train với params khác -> không lệch)
+            self.sequence_length = self.model.input_shape[1]
+            # MC dropout: dropout bật lúc dự đoán, mọi mẫu chạy chung 1 batch
+            # (tf.function: 1 graph cho cả batch, không chạy eager từng op)
+            self._mc_step = tf.function(lambda x: self.model(x, training=True), reduce_retracing=True)
+            self._stochastic = any(isinstance(layer, Dropout) for layer in self.model.layers)
+            if not self._stochastic and self.samples > 1:
+                print(f"⚠️ {self.model_path} không có Dropout: không có dải MC dropout "
+                      f"(ZoneForecaster dùng dải sai số backtest thay thế)")
+    
+    def _rollout(self, features, horizon, samples, step):
+        """Dự đoán đệ quy `horizon` giờ cho `samples` đường cùng lúc -> (samples x horizon) % độ ẩm"""
+        self._load()
+        if len(features) < self.sequence_length:
+            raise ValueError(f'LSTM cần ít nhất {self.sequence_length} giờ dữ liệu '
+                             f'(mới có {len(features)}), dùng ZoneForecaster cho zone mới')
+        
+        # Get last sequence (chỉ scale sequence_length dòng cuối), lặp lại cho từng mẫu
+        sequence = self.scaler.transform(features[-self.sequence_length:]).astype(np.float32)
+        sequence = np.repeat(sequence[None], samples, axis=0)
+        values = np.empty((samples, horizon))
+        
+        for hour in range(horizon):
+            # 1 lần gọi model cho mọi mẫu
+            pred_scaled = np.asarray(step(sequence)).reshape(samples)
+            values[:, hour] = pred_scaled
+            
+            # Update sequence (sliding window): lặp dòng cuối, thay soil = dự đoán
+            sequence = np.concatenate([sequence[:, 1:], sequence[:, -1:]], axis=1)
+            sequence[:, -1, 0] = pred_scaled
         
-        # Feature engineering
-        df['hour'] = df.index.hour
-        df['day_of_week'] = df.index.dayofweek
-        df['is_weekend'] = (df['day_of_week'] >= 5).astype(int)
+        # Inverse transform cột soil (cột 0): MinMaxScaler x = (x_scaled - min_) / scale_
+        return (values - self.scaler.min_[0]) / self.scaler.scale_[0]
+    
+    def forecast(self, features, horizon=24):
+        """
+        Độ ẩm `horizon` giờ tới từ ma trận HOURLY_FEATURES (>= sequence_length dòng)
         
-        # Get last sequence
-        scaled_data = self.scaler.transform(df)
-        last_sequence = scaled_data[-self.sequence_length:]
+        Returns: numpy array (giao diện chung với ml_models.forecasters)
+        """
+        # predict() dựng lại pipeline mỗi lần gọi: ~140 ms / bước, predict_on_batch ~8 ms
+        return self._rollout(features, horizon, 1, lambda x: self.model.predict_on_batch(x))[0]
+    
+    def forecast_samples(self, features, horizon=24, samples=None):
+        """
+        MC dropout: `samples` đường dự đoán có thể (numpy samples x horizon),
+        None nếu model không có Dropout (mọi mẫu giống nhau)
+        """
+        self._load()
+        if not self._stochastic:
+            return None
+        return self._rollout(features, horizon, samples or self.samples, self._mc_step)
+    
+    def predict_paths(self, hourly=None, device=None):
+        """(dự đoán 24h, các đường MC dropout - None khi samples = 1 / model không có Dropout)"""
+        if hourly is not None:
+            df = self.features_from_hourly(hourly)
+        else:
+            # Feature đã tính sẵn, chỉ phần cuối được cập nhật khi có dữ liệu mới
+            _, df = self.features.hourly(device, days=7)
         
-        predictions = []
-        current_sequence = last_sequence.copy()
+        paths = self.forecast_samples(df) if self.samples > 1 else None
+        values = self.forecast(df) if paths is None else np.median(paths, axis=0)
+        return values, paths
+    
+    def predict_next_24h(self, hourly=None, device=None):
+        """
+        Dự đoán độ ẩm 24 giờ tới (kèm dải p10 / p50 / p90 khi samples > 1)
         
-        # Predict next 24 hours
-        for hour in range(24):
-            # Reshape for prediction
-            X_pred = current_sequence.reshape(1, self.sequence_length, -1)
-            
-            # Predict
-            pred_scaled = self.model.predict(X_pred, verbose=0)[0][0]
-            
-            # Inverse transform to get actual value
-            dummy = np.zeros((1, df.shape[1]))
-            dummy[0, 0] = pred_scaled  # soil is first column
-            pred_actual = self.scaler.inverse_transform(dummy)[0, 0]
-            
-            predictions.append({
-                'hour': hour + 1,
-                'timestamp': datetime.now() + timedelta(hours=hour+1),
-                'predicted_soil': round(pred_actual, 2)
-            })
-            
-            # Update sequence (sliding window)
-            new_row = current_sequence[-1].copy()
-            new_row[0] = pred_scaled  # Update soil moisture
-            current_sequence = np.vstack([current_sequence[1:], new_row])
+        Args:
+            hourly: (tuỳ chọn) window theo giờ từ RingStore -> không cần query SQLite
+            device: thiết bị khi không có window (feature lấy từ FeatureStore)
+        """
+        predictions = to_predictions(*self.predict_paths(hourly, device))
         
         print(f"🔮 Predicted next 24h:")
         for p in predictions[:5]:  # Show first 5
@@ -212,36 +273,12 @@ class SoilMoistureLSTM:
         
         return predictions
     
-    def get_watering_recommendation(self):
-        """Gợi ý tưới nước dựa trên dự đoán"""
-        predictions = self.predict_next_24h()
-        
-        # Analyze predictions
-        min_moisture = min(p['predicted_soil'] for p in predictions)
-        avg_moisture = np.mean([p['predicted_soil'] for p in predictions])
-        
-        # Decision logic
-        if min_moisture < 40:
-            recommendation = {
-                'action': 'WATER_NOW',
-                'reason': f'Độ ẩm sẽ giảm xuống {min_moisture:.1f}% trong 24h tới',
-                'suggested_duration': '15 phút',
-                'urgency': 'HIGH'
-            }
-        elif min_moisture < 50 and avg_moisture < 55:
-            recommendation = {
-                'action': 'WATER_SOON',
-                'reason': f'Độ ẩm trung bình {avg_moisture:.1f}%, tối thiểu {min_moisture:.1f}%',
-                'suggested_duration': '10 phút',
-                'urgency': 'MEDIUM'
-            }
-        else:
-            recommendation = {
-                'action': 'NO_WATER',
-                'reason': f'Độ ẩm ổn định ở {avg_moisture:.1f}%',
-                'suggested_duration': '0 phút',
-                'urgency': 'LOW'
-            }
+    def get_watering_recommendation(self, hourly=None, device=None):
+        """Gợi ý tưới nước dựa trên dự đoán (xác suất theo các đường MC dropout)"""
+        values, paths = self.predict_paths(hourly, device)
+        recommendation = watering_recommendation(to_predictions(values, paths), paths,
+                                                 previous=self._actions.get(device))
+        self._actions[device] = recommendation['action']
         
         print(f"\n💡 Recommendation: {recommendation['action']}")
         print(f"   Reason: {recommendation['reason']}")
@@ -254,7 +291,7 @@ class SoilMoistureLSTM:
 
 if __name__ == "__main__":
     # Initialize model
-    lstm = SoilMoistureLSTM(db_path='tuoi.db', sequence_length=24)
+    lstm = SoilMoistureLSTM(db_path='tuoi.db')  # params từ models/lstm_params.json (nếu đã tune)
     
     # Train model (chỉ chạy 1 lần hoặc khi cần retrain)
     # history = lstm.train(epochs=50, batch_size=16)
@@ -0,0 +1,291 @@
+import time
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import metrics
+import profiler
+import settings
+from logger import get_logger, fields
+
+log = get_logger('ml')
+
+
+# ================= JOB (CHẠY TRONG WORKER PROCESS) =================
+# Model được giữ lại trong mỗi worker -> TensorFlow chỉ load 1 lần / process
+_models = {}
+
+
+def _analytics(db_path):
+    """Bản sao DuckDB của logs (TUOI_ANALYTICS=1), None -> pandas + SQLite"""
+    key = ('analytics', db_path)
+    if key not in _models:
+        _models[key] = None
+        if settings.ANALYTICS:
+            try:
+                from analytics import Analytics
+                _models[key] = Analytics(db_path, retention_days=settings.ANALYTICS_DAYS)
+            except RuntimeError as e:
+                log.warning("⚠️ Analytics tắt: %s", e)
+    return _models[key]
+
+
+def _features(db_path):
+    """FeatureStore dùng chung cho LSTM + AnomalyDetector trong worker (cập nhật tăng dần)"""
+    store = _models.get(('features', db_path))
+    if store is None:
+        from ml_models.feature_store import FeatureStore
+        store = _models[('features', db_path)] = FeatureStore(db_path)
+    return store
+
+
+def _lstm(db_path):
+    model = _models.get(('lstm', db_path))
+    if model is None:
+        from ml_models.soil_prediction import SoilMoistureLSTM
+        model = _models[('lstm', db_path)] = SoilMoistureLSTM(db_path=db_path, analytics=_analytics(db_path),
+                                                              features=_features(db_path),
+                                                              samples=settings.FORECAST_SAMPLES)
+    return model
+
+
+def _forecaster(db_path):
+    """
+    TUOI_FORECAST=auto: ZoneForecaster chọn model rẻ theo zone (LSTM là tier cuối nếu có)
+    TUOI_FORECAST=lstm: luôn dùng SoilMoistureLSTM
+    """
+    model = _models.get(('forecast', db_path))
+    if model is None:
+        if settings.FORECAST == 'lstm':
+            return _lstm(db_path)
+        from ml_models.forecasters import ZoneForecaster
+        try:
+            lstm = _lstm(db_path)
+        except ImportError:
+            lstm = None   # chưa cài TensorFlow: chỉ dùng model rẻ
+        model = _models[('forecast', db_path)] = ZoneForecaster(
+            _features(db_path), target_mae=settings.FORECAST_MAE, lstm=lstm)
+    return model
+
+
+def _detector(db_path):
+    model = _models.get(('anomaly', db_path))
+    if model is None:
+        from ml_models.anomaly_detection import AnomalyDetector
+        from rules import RuleEngine
+        model = _models[('anomaly', db_path)] = AnomalyDetector(db_path=db_path, analytics=_analytics(db_path),
+                                                                features=_features(db_path),
+                                                                rules=RuleEngine(db_path, settings.RULES_RELOAD))
+    return model
+
+
+def _fleet_detector(db_path):
+    model = _models.get(('fleet_anomaly', db_path))
+    if model is None:
+        from ml_models.fleet_anomaly import FleetAnomalyDetector
+        model = _models[('fleet_anomaly', db_path)] = FleetAnomalyDetector(db_path, analytics=_analytics(db_path))
+    return model
+
+
+def system_health(anomalies):
+    severities = {a['severity'] for a in anomalies}
+    if 'CRITICAL' in severities:
+        return 'CRITICAL'
+    if 'WARNING' in severities:
+        return 'WARNING'
+    return 'GOOD'
+
+
+def job_predict(db_path, device=None, window=None):
+    # window: trung bình theo giờ từ RingStore (None -> model tự đọc SQLite)
+    forecaster = _forecaster(db_path)
+    predictions = forecaster.predict_next_24h(hourly=window, device=device)
+    values = [float(p['predicted_soil']) for p in predictions]
+    result = {
+        'predictions': [{
+            'hour': p['hour'],
+            'timestamp': p['timestamp'].isoformat(),
+            'predicted_soil': float(p['predicted_soil']),
+            # Dải dự đoán (có khi model cho được độ bất định)
+            **{band: float(p[band]) for band in ('p10', 'p50', 'p90') if band in p}
+        } for p in predictions],
+        'summary': {
+            'min': round(min(values), 1) if values else 0,
+            'max': round(max(values), 1) if values else 0,
+            'avg': round(sum(values) / len(values), 1) if values else 0
+        }
+    }
+    if predictions and 'p10' in predictions[0]:
+        result['summary']['min_p10'] = round(min(p['p10'] for p in predictions), 1)
+    if hasattr(forecaster, 'describe'):
+        result['model'] = forecaster.describe(device)
+    return result
+
+
+def job_recommendation(db_path, device=None, window=None):
+    rec = _forecaster(db_path).get_watering_recommendation(hourly=window, device=device)
+    # confidence = xác suất của action theo dải dự đoán; chưa có dải (zone mới) -> mặc định
+    rec.setdefault('confidence', 0.8)
+    return {'recommendation': rec}
+
+
+def job_anomaly(db_path, device=None, window=None):
+    # window: các reading gần nhất từ RingStore (None -> đọc 24h từ SQLite)
+    detector = _detector(db_path)
+    anomalies = detector.detect() if window is None else detector.detect_window(window, device)
+    return {'anomalies': anomalies, 'system_health': system_health(anomalies)}
+
+
+def job_fleet(db_path, hours=24, window=None):
+    # Báo cáo toàn bộ thiết bị: DuckDB nếu bật, không thì cùng câu SQL trên SQLite
+    from analytics import fleet_report
+    return {'devices': fleet_report(db_path, hours, _analytics(db_path),
+                                    max_gap=settings.COMPRESS_HEARTBEAT * 1.5)}
+
+
+def job_fleet_anomaly(db_path, hours=24, window=None):
+    # 1 lần quét cho cả fleet: sự cố chung theo site (ml_models/fleet_anomaly.py)
+    return _fleet_detector(db_path).detect(hours)
+
+
+JOBS = {
+    'predict': job_predict,
+    'recommendation': job_recommendation,
+    'anomaly': job_anomaly,
+    'fleet': job_fleet,
+    'fleet_anomaly': job_fleet_anomaly,
+}
+
+
+# ================= SERVICE (CHẠY TRONG FLASK PROCESS) =================
+class _Entry:
+    def __init__(self, result, error, version):
+        self.result = result
+        self.error = error
+        self.version = version
+        self.at = time.monotonic()
+
+
+class MLService:
+    """
+    Chạy ML (TensorFlow / pandas) trong process pool riêng
+
+    - Request Flask chỉ chờ Future -> không giữ GIL, không chặn /api/report
+    - Coalescing: nhiều request giống nhau cùng lúc dùng chung 1 lần tính
+    - Cache: kết quả giữ tới khi có dữ liệu mới (notify_new_data). Có dữ
+      liệu mới thì lần gọi sau tính lại, trừ khi kết quả mới hơn min_refresh
+      giây (debounce, TUOI_ML_MIN_REFRESH): ESP32 report mỗi giây không kéo
+      theo 1 job ML / report. Không có dữ liệu mới -> giữ mãi
+    - Lỗi (job lỗi, worker chết) chỉ giữ ERROR_TTL giây: đủ để không dồn job
+      hỏng liên tục, nhưng lỗi tạm thời không dính tới lần có dữ liệu mới
+    """
+
+    ERROR_TTL = 5     # seconds
+
+    def __init__(self, db_path='tuoi.db', workers=1, timeout=2.0, min_refresh=settings.ML_MIN_REFRESH):
+        self.db_path = db_path
+        self.workers = workers
+        self.timeout = timeout
+        self.min_refresh = min_refresh
+        self._pool = None
+        # RLock: add_done_callback có thể gọi _done ngay khi đang giữ lock
+        self._lock = threading.RLock()
+        self._cache = {}
+        self._inflight = {}
+        self._version = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            # spawn: an toàn với TensorFlow và các thread của Flask/MQTT
+            ctx = multiprocessing.get_context('spawn')
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+            atexit.register(self.shutdown)
+            log.info("🧠 ML pool started", extra=fields(workers=self.workers))
+        return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def notify_new_data(self):
+        """Gọi từ ingestion: đánh dấu cache cũ (rất rẻ, không khoá)"""
+        self._version += 1
+
+    def _fresh(self, entry):
+        age = time.monotonic() - entry.at
+        if entry.error is not None:
+            return age < self.ERROR_TTL
+        return entry.version == self._version or age < self.min_refresh
+
+    def _done(self, key, version, future):
+        try:
+            entry = _Entry(future.result(), None, version)
+            metrics.ML_JOBS.inc(kind=key[0], result='ok')
+        except BrokenProcessPool as e:
+            # Worker chết (OOM...) -> tạo pool mới ở lần gọi sau
+            entry = _Entry(None, str(e) or 'worker crashed', version)
+            metrics.ML_JOBS.inc(kind=key[0], result='crashed')
+            self._pool = None
+        except Exception as e:
+            entry = _Entry(None, str(e), version)
+            metrics.ML_JOBS.inc(kind=key[0], result='error')
+            log.warning("⚠️ ML job %s lỗi: %s", key[0], e)
+        with self._lock:
+            self._inflight.pop(key, None)
+            self._cache[key] = entry
+
+    @profiler.traced(lambda self, kind, *args, **kwargs: f"ml.{kind}")
+    def get(self, kind, *args, data=None):
+        """
+        Args:
+            args: phần của cache key, truyền tiếp cho job (vd device)
+            data: hàm trả về dữ liệu đầu vào cho job (vd window từ RingStore),
+                  chỉ được gọi khi thật sự submit job mới
+
+        Returns:
+            (result, error, state) với state = 'cached' | 'fresh' | 'stale' | 'pending'
+        """
+        key = (kind,) + args
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and self._fresh(entry):
+                metrics.ML_REQUESTS.inc(kind=kind, state='cached')
+                return entry.result, entry.error, 'cached'
+
+            future = self._inflight.get(key)
+
+        if future is None:
+            # Lấy window NGOÀI lock: data() đọc RingStore / DB, không được chặn
+            # các request khác (kể cả request chỉ cần kết quả cache)
+            version = self._version
+            window = data() if data is not None else None
+            with self._lock:
+                # Request khác có thể đã submit trong lúc lấy window -> dùng chung
+                future = self._inflight.get(key)
+                if future is None:
+                    future = self._get_pool().submit(JOBS[kind], self.db_path, *args, window=window)
+                    self._inflight[key] = future
+                    future.add_done_callback(lambda f: self._done(key, version, f))
+                else:
+                    metrics.ML_REQUESTS.inc(kind=kind, state='coalesced')
+        else:
+            metrics.ML_REQUESTS.inc(kind=kind, state='coalesced')
+
+        try:
+            result = future.result(timeout=self.timeout)
+            error = None
+        except TimeoutError:
+            # Đang tính: trả kết quả cũ nếu có, không bắt client chờ
+            if entry is not None:
+                metrics.ML_REQUESTS.inc(kind=kind, state='stale')
+                return entry.result, entry.error, 'stale'
+            metrics.ML_REQUESTS.inc(kind=kind, state='pending')
+            return None, None, 'pending'
+        except Exception as e:
+            result, error = None, str(e) or type(e).__name__
+
+        metrics.ML_REQUESTS.inc(kind=kind, state='fresh')
+        return result, error, 'fresh'
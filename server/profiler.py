@@ -0,0 +1,310 @@
+import gc
+import os
+import sys
+import json
+import time
+import _thread
+import threading
+from collections import Counter as _Counter
+from functools import wraps
+from logger import get_logger, fields
+
+try:
+    from greenlet import greenlet as _greenlet
+except ImportError:
+    _greenlet = None
+
+log = get_logger('profiler')
+
+# ================= SAMPLING PROFILER (BẬT KHI CẦN) =================
+# Khi scheduler_loop chạy chậm / /api/report bị trễ: bật trong N giây
+# (POST /api/admin/profile hoặc `kill -USR2 <pid>`), 1 thread riêng lấy mẫu
+# stack của MỌI thread (request Flask, thread mạng MQTT, scheduler, Telegram)
+# qua sys._current_frames() -> collapsed stack cho flamegraph.pl / speedscope.
+# Lấy mẫu theo wall-clock: thread đang chờ DB / lock / mạng cũng được đếm.
+# Với eventlet / gevent mọi green thread chung 1 thread OS: sys._current_frames()
+# chỉ thấy green thread đang chạy -> lấy thêm frame của các greenlet đang chờ
+# (tìm qua gc, làm mới ~1 lần / giây), ghi dưới tên 'greenlet'.
+# Hàm gắn @traced (append_log, get_config, ML...) được đo thời gian từng lần gọi.
+# Khi tắt: không có thread nào chạy, @traced chỉ tốn 1 phép so sánh None.
+
+MAX_SECONDS = 60
+MAX_HZ = 1000
+MAX_CALLS = 100000     # số lần đo tối đa / hàm / phiên (giới hạn RAM)
+
+_session = None        # Session đang chạy, None = tắt
+_lock = threading.Lock()
+
+
+def _native():
+    """
+    (start_new_thread, sleep) của OS: sau eventlet/gevent monkey_patch,
+    threading / time.sleep là green thread -> sampler không chạy song song được
+    """
+    try:
+        from eventlet import patcher
+        if patcher.is_monkey_patched('thread'):
+            return patcher.original('_thread').start_new_thread, patcher.original('time').sleep
+    except ImportError:
+        pass
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            return monkey.get_original('_thread', 'start_new_thread'), monkey.get_original('time', 'sleep')
+    except ImportError:
+        pass
+    return _thread.start_new_thread, time.sleep
+
+
+def _green():
+    """True nếu thread đã bị eventlet / gevent monkey patch (request chạy trên greenlet)"""
+    if _greenlet is None:
+        return False
+    try:
+        from eventlet import patcher
+        if patcher.is_monkey_patched('thread'):
+            return True
+    except ImportError:
+        pass
+    try:
+        from gevent import monkey
+        return monkey.is_module_patched('threading')
+    except ImportError:
+        return False
+
+
+class Session:
+    """1 lần profile: stack đã lấy mẫu + thời gian các hàm @traced"""
+
+    def __init__(self, seconds, hz):
+        self.seconds = seconds
+        self.hz = hz
+        self.stacks = _Counter()    # (thread, frame gốc, ..., frame lá) -> số mẫu
+        self.calls = {}             # tên hàm -> [thời gian (s)]
+        self.samples = 0
+        self.started = time.time()
+        self.elapsed = 0.0
+        self.done = threading.Event()
+        self._labels = {}           # code object -> 'file.py:Class.func'
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = (f"{os.path.basename(code.co_filename)}:"
+                                          f"{getattr(code, 'co_qualname', code.co_name)}")
+        return label
+
+    def record(self, name, seconds):
+        calls = self.calls.setdefault(name, [])
+        if len(calls) < MAX_CALLS:
+            calls.append(seconds)
+
+    def _stack(self, frame, root):
+        stack = []
+        while frame is not None:
+            stack.append(self._label(frame.f_code))
+            frame = frame.f_back
+        stack.append(root)
+        self.stacks[tuple(reversed(stack))] += 1
+
+    def sample_loop(self, sleep, green=False):
+        # Nhận ra thread của chính sampler qua frame: sau monkey patch,
+        # _thread.get_ident() trả id greenlet chứ không phải id thread OS
+        me = sys._getframe()
+        interval = 1.0 / self.hz
+        t0 = time.perf_counter()
+        names = {}
+        greenlets = []
+        # Thread đang chạy Python giữ GIL tới 5ms/lần -> sampler chỉ chen vào khi
+        # thread kia nhả GIL (mẫu lệch về lúc chờ I/O). Rút ngắn trong lúc profile.
+        switch = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch, interval / 10))
+        try:
+            while self.samples == 0 or time.perf_counter() - t0 < self.seconds:
+                tick = time.perf_counter()
+                if self.samples % 50 == 0:
+                    # Tên thread (vd paho-mqtt-client-..., scheduler); làm mới thưa cho rẻ
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                if green and self.samples % self.hz == 0:
+                    # Quét gc tốn vài ms -> chỉ ~1 lần / giây, greenlet mới sinh sau đó chưa thấy
+                    greenlets = [g for g in gc.get_objects() if isinstance(g, _greenlet)]
+                for ident, frame in sys._current_frames().items():
+                    if frame is not me:
+                        self._stack(frame, names.get(ident, f'thread-{ident}'))
+                for g in greenlets:
+                    # gr_frame: frame đang chờ; None = greenlet đang chạy (đã có ở trên) / đã xong
+                    frame = g.gr_frame
+                    if frame is not None:
+                        self._stack(frame, 'greenlet')
+                self.samples += 1
+                sleep(max(interval - (time.perf_counter() - tick), 0))
+        finally:
+            sys.setswitchinterval(switch)
+            self.elapsed = time.perf_counter() - t0
+            self.done.set()
+
+    # ================= KẾT QUẢ =================
+    def collapsed(self):
+        """Định dạng collapsed stack: 'thread;frame;...;frame <số mẫu>' (flamegraph.pl, speedscope)"""
+        return ''.join(f"{';'.join(stack)} {n}\n" for stack, n in self.stacks.most_common())
+
+    def timings(self):
+        out = {}
+        for name, calls in sorted(self.calls.items()):
+            values = sorted(calls)
+            pick = lambda p: values[min(int(len(values) * p), len(values) - 1)] * 1000
+            out[name] = {'calls': len(values), 'total_ms': round(sum(values) * 1000, 3),
+                         'avg_ms': round(sum(values) / len(values) * 1000, 3),
+                         'p50_ms': round(pick(0.5), 3), 'p99_ms': round(pick(0.99), 3),
+                         'max_ms': round(values[-1] * 1000, 3)}
+        return out
+
+    def summary(self, top=25):
+        """Thống kê: số mẫu theo thread, hàm tốn nhiều mẫu nhất (self / tổng), timing @traced"""
+        threads, own, total = _Counter(), _Counter(), _Counter()
+        for stack, n in self.stacks.items():
+            threads[stack[0]] += n
+            own[stack[-1]] += n
+            for frame in set(stack[1:]):
+                total[frame] += n
+        return {
+            'seconds': round(self.elapsed, 3),
+            'hz': self.hz,
+            'samples': self.samples,
+            'started': self.started,
+            'threads': dict(threads.most_common()),
+            'self': dict(own.most_common(top)),
+            'total': dict(total.most_common(top)),
+            'timings': self.timings(),
+        }
+
+
+def active():
+    return _session is not None
+
+
+def start(seconds=10, hz=100):
+    """
+    Bắt đầu 1 phiên profile chạy nền (tối đa MAX_SECONDS)
+
+    Returns:
+        Session, hoặc None nếu đang có phiên khác
+    """
+    global _session
+    seconds = min(max(float(seconds), 0.1), MAX_SECONDS)
+    hz = min(max(int(hz), 1), MAX_HZ)
+    with _lock:
+        if _session is not None:
+            return None
+        session = _session = Session(seconds, hz)
+
+    start_thread, sleep = _native()
+    green = _green()
+
+    def run():
+        global _session
+        try:
+            session.sample_loop(sleep, green)
+        finally:
+            with _lock:
+                _session = None
+
+    start_thread(run, ())
+    log.info("🔬 Profiling", extra=fields(seconds=seconds, hz=hz))
+    return session
+
+
+def profile(seconds=10, hz=100):
+    """Chạy 1 phiên và chờ xong (gọi từ request admin). None nếu đang bận."""
+    session = start(seconds, hz)
+    if session is None:
+        return None
+    # Chờ bằng sleep của thread hiện tại (green thread nếu có eventlet) -> không chặn hub
+    while not session.done.is_set():
+        time.sleep(0.05)
+    return session
+
+
+def profile_to_file(directory, seconds=10, hz=100):
+    """Phiên chạy nền, ghi <directory>/profile-<pid>-<time>.collapsed + .json khi xong (signal)"""
+    session = start(seconds, hz)
+    if session is None:
+        log.warning("⚠️ Đang có phiên profile khác")
+        return None
+    start_thread, _ = _native()
+
+    def write():
+        session.done.wait()
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, time.strftime(f'profile-{os.getpid()}-%Y%m%d-%H%M%S',
+                                                     time.localtime(session.started)))
+        with open(base + '.collapsed', 'w') as f:
+            f.write(session.collapsed())
+        with open(base + '.json', 'w') as f:
+            json.dump(session.summary(), f, indent=2)
+        log.info("🔬 Profile đã ghi", extra=fields(path=base, samples=session.samples))
+
+    start_thread(write, ())
+    return session
+
+
+def install_signal(signum, directory, seconds=10, hz=100):
+    """
+    `kill -<signum> <pid>` -> profile N giây, ghi file (chỉ gọi từ main thread)
+
+    Handler chạy chen vào main thread ở bất kỳ dòng nào, có thể đúng lúc main
+    thread đang giữ _lock hoặc lock của logging -> handler không lấy lock,
+    không log, chỉ mở 1 thread OS chạy profile_to_file. Hàm mở thread được
+    lấy sẵn ở đây (sau monkey patch), handler không phải import gì.
+    """
+    import signal
+    start_thread, _ = _native()
+    signal.signal(signum, lambda *_: start_thread(profile_to_file, (directory, seconds, hz)))
+
+
+def traced(name):
+    """
+    Decorator đo thời gian từng lần gọi trong lúc đang profile
+
+    name: chuỗi, hoặc hàm(*args, **kwargs) -> chuỗi (vd theo loại job ML)
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            session = _session
+            if session is None:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                session.record(name(*args, **kwargs) if callable(name) else name, time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+if __name__ == "__main__":
+    @traced('busy')
+    def busy(n):
+        return sum(i * i for i in range(n))
+
+    def worker():
+        for _ in range(200):
+            busy(20000)
+            time.sleep(0.005)
+
+    t = threading.Thread(target=worker, name='worker')
+    t.start()
+    session = profile(seconds=1, hz=200)
+    t.join()
+
+    s = session.summary(top=5)
+    print(f"🔬 {s['samples']} mẫu trong {s['seconds']}s, thread: {s['threads']}")
+    print("🔥 Self:", s['self'])
+    print("⏱️ Timing:", s['timings'])
+    print("📄 Collapsed (3 dòng đầu):")
+    print(''.join(session.collapsed().splitlines(True)[:3]))
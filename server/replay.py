@@ -0,0 +1,328 @@
+"""
+Replay nhanh logic scheduler trên dữ liệu lịch sử / giả lập để tinh chỉnh ngưỡng
+
+- Đồng hồ ảo, bước = CHECK_INTERVAL (5s) giống scheduler_loop
+- Mô hình độ ẩm vòng kín: độ ẩm giảm theo tốc độ khô thực tế trong log
+  (đã loại bỏ các lần tưới cũ) + tăng khi bơm (do quyết định MỚI) bật
+- Vector hoá theo bộ tham số: 1 lần duyệt thời gian chạy cả trăm bộ ngưỡng
+- Sweep song song trên nhiều CPU (process pool)
+
+    python replay.py --synthetic 30 --sweep soil_on=35:50:5 soil_off=55:70:5
+    python replay.py --db tuoi.db --days 14 --sweep soil_on=40,45 --workers 4
+    python replay.py --synthetic 3 --verify        # so với control.decide() từng bước
+"""
+import os
+import sys
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+
+import control
+import migrations
+import settings
+import storage
+
+FLOW_L_PER_MIN = 10.0      # giống SmartWateringCalculator: 10 lít/phút mỗi zone
+DRY_ALERT_SOIL = 20        # như luật cảnh báo 'dry' mặc định (rules.py)
+WET_RATE_PER_MIN = 1.5     # % độ ẩm tăng mỗi phút bơm (khi không ước lượng được từ log)
+SWEEP_KEYS = ('soil_on', 'soil_off', 'auto', 'use_schedule', 'start', 'end')
+
+
+# ================= DỮ LIỆU =================
+class Trace:
+    """Chuỗi thời gian đều bước dt: phút trong ngày + độ ẩm tự nhiên thay đổi mỗi bước"""
+
+    def __init__(self, t0, dt, minute_of_day, drive, soil0, wet_rate):
+        self.t0 = t0
+        self.dt = dt
+        self.minute_of_day = minute_of_day   # int16[T]
+        self.drive = drive                   # float[T]: % thay đổi mỗi bước khi bơm tắt
+        self.soil0 = soil0
+        self.wet_rate = wet_rate             # % tăng mỗi bước khi bơm bật
+
+    def __len__(self):
+        return len(self.drive)
+
+    @property
+    def seconds(self):
+        return len(self) * self.dt
+
+
+def local_minute(epoch):
+    """
+    Phút trong ngày theo giờ địa phương (như scheduler: datetime.now().strftime('%H:%M')),
+    không phải giờ UTC. Độ lệch múi giờ lấy theo từng giờ (đúng cả khi đổi giờ mùa hè).
+    """
+    hours, index = np.unique(np.floor(epoch / 3600), return_inverse=True)
+    offset = np.array([time.localtime(h * 3600).tm_gmtoff for h in hours])[index]
+    return (((epoch + offset) // 60) % 1440).astype(np.int16)
+
+
+def load_trace(db_path, days=None, dt=None):
+    """Đọc bảng logs và đưa về lưới thời gian đều"""
+    dt = dt or settings.CHECK_INTERVAL
+    con = storage.connect(db_path)   # có shard: `logs` gộp mọi shard
+    query = "SELECT ts_ms, soil, pump FROM logs WHERE ts_ms IS NOT NULL"
+    params = ()
+    if days:
+        query += " AND ts_ms >= ?"
+        params = (int((datetime.now() - timedelta(days=days)).timestamp() * 1000),)
+    rows = con.execute(query + " ORDER BY ts_ms", params).fetchall()
+    con.close()
+    if len(rows) < 2:
+        raise ValueError("Không đủ dữ liệu trong logs để replay")
+
+    ts = np.array([r[0] for r in rows], dtype=np.int64) / 1000.0
+    soil = np.array([r[1] for r in rows], dtype=float)
+    pump = np.array([r[2] or 0 for r in rows], dtype=np.int8)
+
+    grid = np.arange(ts[0], ts[-1], dt)
+    soil_g = np.interp(grid, ts, soil)
+    pump_g = pump[np.clip(np.searchsorted(ts, grid, side='right') - 1, 0, len(ts) - 1)]
+
+    diff = np.diff(soil_g, prepend=soil_g[0])
+    dry = diff[pump_g == 0]
+    dry_rate = float(np.median(dry)) if len(dry) else -0.01
+    wet = diff[pump_g == 1]
+    wet_rate = float(np.median(wet)) - dry_rate if len(wet) else WET_RATE_PER_MIN * dt / 60
+    if wet_rate <= 0:
+        wet_rate = WET_RATE_PER_MIN * dt / 60
+
+    # Loại ảnh hưởng của các lần tưới trong quá khứ: thay bằng tốc độ khô trung vị
+    drive = np.where(pump_g == 1, dry_rate, diff)
+
+    return Trace(grid[0], dt, local_minute(grid), drive, float(soil_g[0]), wet_rate)
+
+
+def synthetic_trace(days=7, dt=None, seed=42, soil0=55.0):
+    """Giả lập: khô theo chu kỳ ngày/đêm + mưa ngẫu nhiên + nhiễu cảm biến"""
+    dt = dt or settings.CHECK_INTERVAL
+    rng = np.random.default_rng(seed)
+    n = int(days * 86400 / dt)
+    t = np.arange(n) * dt
+    hour = (t / 3600) % 24
+
+    # Bốc hơi: 0.8%/h ban đêm, tới 2%/h buổi trưa
+    dry_per_h = 0.8 + 1.2 * np.clip(np.sin((hour - 6) / 12 * np.pi), 0, None)
+    drive = -dry_per_h * dt / 3600
+
+    # Mưa: trung bình 1 trận / 3 ngày, +15% trong 1 giờ
+    rain_starts = rng.random(n) < dt / (3 * 86400)
+    rain_len = int(3600 / dt)
+    rain = np.convolve(rain_starts.astype(float), np.ones(rain_len), mode='full')[:n]
+    drive = drive + np.clip(rain, 0, 1) * 15 / rain_len
+    drive = drive + rng.normal(0, 0.02, n)
+
+    # t = 0 là 0h giờ địa phương (chu kỳ ngày/đêm ở trên cũng tính theo t)
+    minute = ((t // 60) % 1440).astype(np.int16)
+    return Trace(0.0, dt, minute, drive, soil0, WET_RATE_PER_MIN * dt / 60)
+
+
+# ================= THAM SỐ =================
+def hm_to_min(hm):
+    h, m = hm.split(':')
+    return int(h) * 60 + int(m)
+
+
+def parse_sweep(specs):
+    """['soil_on=35:50:5', 'soil_off=55,60'] -> list các dict tham số"""
+    axes = {}
+    for spec in specs or []:
+        key, values = spec.split('=', 1)
+        if key not in SWEEP_KEYS:
+            raise ValueError(f"Tham số không hỗ trợ: {key} (chọn {', '.join(SWEEP_KEYS)})")
+        if key in ('start', 'end'):
+            axes[key] = values.split(',')
+        elif ':' in values:
+            lo, hi, step = (float(v) for v in values.split(':'))
+            axes[key] = list(np.arange(lo, hi + step / 2, step))
+        else:
+            axes[key] = [float(v) for v in values.split(',')]
+
+    keys = list(axes)
+    grid = []
+    for combo in itertools.product(*(axes[k] for k in keys)):
+        p = {'soil_on': settings.SOIL_ON, 'soil_off': settings.SOIL_OFF,
+             'auto': 1, 'use_schedule': 0, 'start': '06:00', 'end': '06:10'}
+        p.update(zip(keys, combo))
+        grid.append(p)
+    return grid
+
+
+# ================= ENGINE =================
+def simulate(trace, params, target=40.0, flow=FLOW_L_PER_MIN):
+    """
+    Chạy vector hoá: P bộ tham số song song, 1 vòng lặp theo thời gian.
+    Logic quyết định phải giống control.decide() (xem verify()).
+    """
+    P = len(params)
+    on = np.array([p['soil_on'] for p in params], dtype=float)
+    off = np.array([p['soil_off'] for p in params], dtype=float)
+    auto = np.array([int(p['auto']) for p in params], dtype=bool)
+    use_sched = np.array([int(p['use_schedule']) for p in params], dtype=bool)
+    start = np.array([hm_to_min(p['start']) for p in params])
+    end = np.array([hm_to_min(p['end']) for p in params])
+    auto_mode = ~use_sched & auto
+
+    soil = np.full(P, trace.soil0)
+    pump = np.zeros(P, dtype=bool)
+    pump_ticks = np.zeros(P, dtype=np.int64)
+    below_ticks = np.zeros(P, dtype=np.int64)
+    switches = np.zeros(P, dtype=np.int64)
+    dry_alerts = np.zeros(P, dtype=np.int64)
+    in_alert = np.zeros(P, dtype=bool)
+    wet = trace.wet_rate
+
+    for i in range(len(trace)):
+        m = trace.minute_of_day[i]
+        in_window = (start <= m) & (m <= end)
+
+        turn_on = (use_sched & in_window & ~pump) | (auto_mode & (soil < on) & ~pump)
+        turn_off = (use_sched & ~in_window & pump & ~auto) | (auto_mode & (soil > off) & pump)
+        new_pump = (pump | turn_on) & ~turn_off
+        switches += new_pump != pump
+        pump = new_pump
+
+        soil = np.clip(soil + trace.drive[i] + pump * wet, 0, 100)
+        pump_ticks += pump
+        below_ticks += soil < target
+
+        alert = (soil < DRY_ALERT_SOIL) & ~pump & auto
+        dry_alerts += alert & ~in_alert
+        in_alert = alert
+
+    minutes = trace.dt / 60
+    results = []
+    for k, p in enumerate(params):
+        pump_min = pump_ticks[k] * minutes
+        results.append({
+            **p,
+            'pump_on_min': round(pump_min, 1),
+            'water_l': round(pump_min * flow, 1),
+            'below_target_min': round(below_ticks[k] * minutes, 1),
+            'alerts': int(switches[k] + dry_alerts[k]),   # mỗi lần bật/tắt + cảnh báo khô = 1 tin Telegram
+            'switches': int(switches[k]),
+            'dry_alerts': int(dry_alerts[k])
+        })
+    return results
+
+
+def simulate_scalar(trace, p, target=40.0):
+    """Chạy từng bước với control.decide() (chậm, dùng để kiểm chứng)"""
+    cfg = {'auto': int(p['auto']), 'use_schedule': int(p['use_schedule']),
+           'start': p['start'], 'end': p['end'], 'pump_cmd': 0}
+    soil = trace.soil0
+    pump_ticks = below = switches = 0
+    for i in range(len(trace)):
+        m = int(trace.minute_of_day[i])
+        decision = control.decide(cfg, soil, f"{m // 60:02d}:{m % 60:02d}", p)
+        if decision is not None:
+            cfg['pump_cmd'] = decision[1]
+            switches += 1
+        soil = min(100.0, max(0.0, soil + trace.drive[i] + cfg['pump_cmd'] * trace.wet_rate))
+        pump_ticks += cfg['pump_cmd']
+        below += soil < target
+    return {'pump_ticks': pump_ticks, 'below_ticks': below, 'switches': switches}
+
+
+def verify(trace, params, target=40.0):
+    """So sánh engine vector với control.decide() trên từng bộ tham số"""
+    vec = simulate(trace, params, target)
+    minutes = trace.dt / 60
+    ok = True
+    for p, v in zip(params, vec):
+        s = simulate_scalar(trace, p, target)
+        same = (abs(s['pump_ticks'] * minutes - v['pump_on_min']) < 0.1 and
+                abs(s['below_ticks'] * minutes - v['below_target_min']) < 0.1 and
+                s['switches'] == v['switches'])
+        ok &= same
+        print(f"   {'✅' if same else '❌'} {fmt_params(p)}")
+    return ok
+
+
+def _run_chunk(args):
+    trace, chunk, target, flow = args
+    return simulate(trace, chunk, target, flow)
+
+
+def sweep(trace, grid, workers=None, target=40.0, flow=FLOW_L_PER_MIN):
+    """Chia lưới tham số cho nhiều process, mỗi process chạy vector hoá 1 phần"""
+    workers = workers or os.cpu_count() or 1
+    workers = max(1, min(workers, len(grid)))
+    if workers == 1:
+        return simulate(trace, grid, target, flow)
+
+    chunks = [grid[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(_run_chunk, [(trace, c, target, flow) for c in chunks]))
+    return [r for part in parts for r in part]
+
+
+# ================= CLI =================
+def fmt_params(p):
+    s = f"on<{p['soil_on']:g} off>{p['soil_off']:g}"
+    if int(p['use_schedule']):
+        s += f" lịch {p['start']}-{p['end']}"
+    if not int(p['auto']):
+        s += " manual"
+    return s
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--db', help='đọc logs từ database này')
+    ap.add_argument('--days', type=float, help='chỉ lấy N ngày gần nhất')
+    ap.add_argument('--synthetic', type=float, help='dùng dữ liệu giả lập N ngày')
+    ap.add_argument('--sweep', nargs='*', default=[], help='vd soil_on=35:50:5 soil_off=55,60,65')
+    ap.add_argument('--target', type=float, default=40.0, help='độ ẩm mục tiêu (tính thời gian dưới mục tiêu)')
+    ap.add_argument('--flow', type=float, default=FLOW_L_PER_MIN, help='lưu lượng bơm (lít/phút)')
+    ap.add_argument('--workers', type=int, help='số process (mặc định = số CPU)')
+    ap.add_argument('--top', type=int, default=20)
+    ap.add_argument('--csv', help='ghi toàn bộ kết quả ra CSV')
+    ap.add_argument('--verify', action='store_true', help='kiểm chứng với control.decide()')
+    ap.add_argument('--seed', type=int, default=42)
+    args = ap.parse_args(argv)
+
+    if args.db:
+        if not os.path.exists(args.db):
+            ap.error(f"không tìm thấy {args.db}")
+        # DB cũ (vd tuoi.db trong repo) chưa có ts_ms / device: nâng schema trước khi đọc
+        migrations.migrate(args.db)
+        trace = load_trace(args.db, args.days)
+    else:
+        trace = synthetic_trace(args.synthetic or 7, seed=args.seed)
+    grid = parse_sweep(args.sweep)
+
+    print(f"📼 Trace: {len(trace)} bước x {trace.dt}s = {trace.seconds / 86400:.1f} ngày, "
+          f"{len(grid)} bộ tham số")
+
+    if args.verify:
+        return 0 if verify(trace, grid[:10], args.target) else 1
+
+    t0 = time.perf_counter()
+    results = sweep(trace, grid, args.workers, args.target, args.flow)
+    wall = time.perf_counter() - t0
+    speed = trace.seconds * len(grid) / wall
+
+    # Ưu tiên: ít thời gian khô nhất, rồi ít nước nhất
+    results.sort(key=lambda r: (r['below_target_min'], r['water_l']))
+    print(f"\n{'tham số':<32}{'bơm (phút)':>12}{'nước (L)':>12}{'< mục tiêu (phút)':>20}{'cảnh báo':>10}")
+    for r in results[:args.top]:
+        print(f"{fmt_params(r):<32}{r['pump_on_min']:>12}{r['water_l']:>12}{r['below_target_min']:>20}{r['alerts']:>10}")
+    print(f"\n⚡ {wall:.2f}s wall, nhanh hơn thời gian thực {speed:,.0f} lần")
+
+    if args.csv:
+        import csv
+        with open(args.csv, 'w', newline='') as f:
+            w = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            w.writeheader()
+            w.writerows(results)
+        print(f"💾 Saved {args.csv}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
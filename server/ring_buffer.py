@@ -0,0 +1,312 @@
+import sqlite3
+import threading
+from collections import namedtuple
+import numpy as np
+from compression import reconstruct
+
+# Các cột của 1 window (mỗi field là 1 numpy array, read-only)
+Window = namedtuple('Window', ['ts', 'soil', 'pump', 'auto', 'rssi'])
+
+COLUMNS = (
+    ('ts', np.float64),     # epoch seconds
+    ('soil', np.float64),
+    ('pump', np.int8),
+    ('auto', np.int8),
+    ('rssi', np.int16),
+)
+HOURLY_COLUMNS = (
+    ('ts', np.float64),     # đầu giờ (epoch seconds)
+    ('soil', np.float64),   # trung bình trong giờ
+    ('pump', np.float64),
+    ('auto', np.float64),
+    ('rssi', np.float64),
+)
+
+
+class _Ring:
+    """
+    Ring buffer dạng cột, mỗi giá trị được ghi 2 lần (vị trí i và i + capacity)
+    -> N phần tử mới nhất luôn nằm liền nhau trong bộ nhớ, window() trả về
+    view (không copy) kể cả khi đã quay vòng.
+    """
+
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.total = 0
+        self.cols = {name: np.zeros(2 * capacity, dtype=dtype) for name, dtype in columns}
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def push(self, values):
+        pos = self.total % self.capacity
+        for name, v in zip(self.cols, values):
+            col = self.cols[name]
+            col[pos] = v
+            col[pos + self.capacity] = v
+        self.total += 1
+
+    def overwrite_last(self, values):
+        pos = (self.total - 1) % self.capacity
+        for name, v in zip(self.cols, values):
+            col = self.cols[name]
+            col[pos] = v
+            col[pos + self.capacity] = v
+
+    def last(self, name):
+        return self.cols[name][(self.total - 1) % self.capacity]
+
+    def window(self, n=None, copy=False):
+        size = len(self)
+        n = size if n is None else min(n, size)
+        end = (self.total - 1) % self.capacity + self.capacity + 1
+        views = []
+        for col in self.cols.values():
+            v = col[end - n:end]
+            if copy:
+                v = v.copy()
+            else:
+                v.flags.writeable = False
+            views.append(v)
+        return Window(*views)
+
+
+class DeviceSeries:
+    """Dữ liệu gần đây của 1 thiết bị: từng reading + trung bình theo giờ"""
+
+    def __init__(self, capacity, hourly_capacity):
+        self.raw = _Ring(capacity, COLUMNS)
+        self.hourly = _Ring(hourly_capacity, HOURLY_COLUMNS)
+        self._hour = None
+        self._acc = None   # [sum_soil, sum_pump, sum_auto, sum_rssi, count]
+
+    def append(self, ts, soil, pump, auto, rssi):
+        if self.raw.total and ts < self.raw.last('ts'):
+            return False  # dữ liệu cũ đến muộn: không đưa vào window gần đây
+
+        self.raw.push((ts, soil, pump, auto, rssi))
+
+        # Gộp theo giờ (giống resample('1H').mean().ffill() trong SoilMoistureLSTM.load_data)
+        hour = int(ts // 3600)
+        if self._hour is None or hour != self._hour:
+            if self._hour is not None:
+                # Giờ không có dữ liệu -> lặp lại giá trị giờ trước (ffill)
+                prev = [self.hourly.last(name) for name in self.hourly.cols]
+                gap = min(hour - self._hour - 1, self.hourly.capacity)
+                for h in range(hour - gap, hour):
+                    self.hourly.push([h * 3600.0] + prev[1:])
+            self._hour = hour
+            self._acc = [0.0, 0.0, 0.0, 0.0, 0]
+            self.hourly.push((hour * 3600.0, soil, pump, auto, rssi))
+
+        acc = self._acc
+        acc[0] += soil
+        acc[1] += pump
+        acc[2] += auto
+        acc[3] += rssi
+        acc[4] += 1
+        n = acc[4]
+        self.hourly.overwrite_last((hour * 3600.0, acc[0] / n, acc[1] / n, acc[2] / n, acc[3] / n))
+        return True
+
+
+class RingStore:
+    """
+    Bộ nhớ đệm time-series trong RAM cho mỗi thiết bị (N reading gần nhất)
+
+    - Được nạp từ luồng ingestion (append_log) -> reader không phải query SQLite
+    - window()/hourly() trả về numpy view zero-copy, không tạo DataFrame
+    - View có thể bị ghi đè khi có reading mới sau khi buffer quay vòng:
+      .copy() nếu cần giữ lâu
+    - Reader lấy cùng lock với append khi cắt window: các cột cùng 1 vị trí,
+      không có dòng "rách" (ts của reading này, soil của reading khác) khi
+      server chạy nhiều thread OS (threaded / gthread)
+    """
+
+    def __init__(self, capacity=4096, hourly_capacity=24 * 7, fill_step=None, max_gap=None):
+        self.capacity = capacity
+        self.hourly_capacity = hourly_capacity
+        # Dữ liệu đọc từ DB đã được nén (compression.py): lấp lại các khoảng
+        # <= max_gap giây bằng nội suy, bước fill_step giây
+        self.fill_step = fill_step
+        self.max_gap = max_gap
+        self._series = {}
+        self._lock = threading.Lock()
+        self.last_device = None
+        self.watermarks = {}   # file logs -> id lớn nhất đã nạp (catch_up); mỗi shard đánh id riêng
+
+    def _get(self, device):
+        s = self._series.get(device)
+        if s is None:
+            s = self._series[device] = DeviceSeries(self.capacity, self.hourly_capacity)
+        return s
+
+    def devices(self):
+        return list(self._series)
+
+    def clear(self):
+        with self._lock:
+            self._series = {}
+            self.last_device = None
+            self.watermarks = {}
+
+    def append(self, device, ts, soil, pump, auto, rssi):
+        with self._lock:
+            ok = self._get(device).append(ts, soil, pump, auto, rssi)
+            if ok:
+                self.last_device = device
+            return ok
+
+    def __len__(self):
+        return sum(len(s.raw) for s in self._series.values())
+
+    def size(self, device):
+        s = self._series.get(device)
+        return len(s.raw) if s else 0
+
+    def window(self, device=None, n=None, copy=False):
+        """
+        n reading mới nhất của thiết bị (None = thiết bị report gần nhất)
+        copy=True khi gửi sang process khác / giữ qua nhiều lần append
+        """
+        with self._lock:
+            s = self._series.get(device or self.last_device)
+            return s.raw.window(n, copy) if s else None
+
+    def hourly(self, device=None, n=24, copy=False):
+        """n giờ gần nhất (giờ cuối là giờ hiện tại, đang cộng dồn)"""
+        with self._lock:
+            s = self._series.get(device or self.last_device)
+            return s.hourly.window(n, copy) if s else None
+
+    def hours(self, device=None):
+        s = self._series.get(device or self.last_device)
+        return len(s.hourly) if s else 0
+
+    def latest(self, device=None):
+        with self._lock:
+            s = self._series.get(device or self.last_device)
+            if s is None or not s.raw.total:
+                return None
+            return {name: s.raw.last(name).item() for name in s.raw.cols}
+
+    # ================= NẠP TỪ DATABASE =================
+    _SELECT = "SELECT id, device, ts_ms, soil, pump, auto, wifi_rssi FROM logs "
+
+    def _append_filled(self, device, point):
+        """append 1 điểm đã nén, nội suy các reading bị bỏ giữa điểm trước và điểm này"""
+        s = self._series.get(device)
+        if self.fill_step and s is not None and s.raw.total:
+            gap = point[0] - s.raw.last('ts')
+            if self.fill_step < gap <= self.max_gap:
+                last = tuple(s.raw.last(name) for name in s.raw.cols)
+                grid = reconstruct(*zip(last, point), step=self.fill_step, max_gap=self.max_gap)
+                for values in zip(*(col[1:-1] for col in grid)):
+                    self.append(device, *values)
+        return self.append(device, *point)
+
+    def _ingest_rows(self, rows, source=None):
+        """
+        source: file logs của rows -> cập nhật watermark của file đó
+        Returns: các thiết bị có dòng đến trễ (ts cũ hơn ring) cần rebuild
+        """
+        stale = set()
+        for rowid, device, ts_ms, soil, pump, auto, rssi in rows:
+            if ts_ms is None:
+                continue
+            if not self._append_filled(device, (ts_ms / 1000, soil or 0, pump or 0, auto or 0, rssi or 0)):
+                stale.add(device)
+            if source is not None:
+                self.watermarks[source] = max(self.watermarks.get(source, 0), rowid)
+        return stale
+
+    def load_from_db(self, db_path, devices):
+        """Warm-up lúc khởi động: nạp `capacity` dòng gần nhất của mỗi thiết bị"""
+        con = sqlite3.connect(db_path)
+        for device in devices:
+            rows = con.execute(
+                self._SELECT + "WHERE device=? ORDER BY ts_ms DESC LIMIT ?", (device, self.capacity)).fetchall()
+            self._ingest_rows(reversed(rows), db_path)
+        row = con.execute("SELECT id, device, ts_ms FROM logs ORDER BY id DESC LIMIT 1").fetchone()
+        con.close()
+        if row:
+            self.watermarks[db_path] = max(self.watermarks.get(db_path, 0), row[0])
+            # Nhiều shard: thiết bị report gần nhất là dòng cuối mới nhất trong các file
+            current = self.latest()
+            if row[1] in self._series and (current is None or (row[2] or 0) / 1000 >= current['ts']):
+                self.last_device = row[1]
+
+    def _reset(self, device, first_ts):
+        """
+        Tạo lại series của thiết bị, giữ các giờ (rollup) trước first_ts
+        vì raw window không đủ dài để tính lại chúng
+        """
+        old = self._series.get(device)
+        new = DeviceSeries(self.capacity, self.hourly_capacity)
+        if old is not None and len(old.hourly):
+            first_hour = int(first_ts // 3600)
+            for values in zip(*old.hourly.window(copy=True)):
+                if int(values[0] // 3600) < first_hour:
+                    new.hourly.push(values)
+                    new._hour = int(values[0] // 3600)
+        with self._lock:
+            self._series[device] = new
+
+    def rebuild(self, db_path, device, max_id=None):
+        """Nạp lại 1 thiết bị từ DB (sau khi có dữ liệu đến trễ chen vào giữa window)"""
+        query, params = self._SELECT + "WHERE device=?", [device]
+        if max_id is not None:
+            # Dòng mới hơn watermark sẽ được catch_up nạp sau -> không nạp 2 lần
+            query += " AND id <= ?"
+            params.append(max_id)
+        con = sqlite3.connect(db_path)
+        rows = con.execute(query + " ORDER BY ts_ms DESC LIMIT ?", params + [self.capacity]).fetchall()
+        con.close()
+        last_device = self.last_device
+        if rows:
+            self._reset(device, rows[-1][2] / 1000)
+        self._ingest_rows(reversed(rows))
+        self.last_device = last_device or device
+
+    def merge(self, db_path, device, rows):
+        """
+        Đưa 1 lô reading (đã sắp theo thời gian, có thể đến trễ) vào ring
+
+        rows: [(ts_epoch, soil, pump, auto, rssi)]
+        - Mới hơn reading cuối -> append (rẻ)
+        - Cũ hơn toàn bộ window đã đầy -> bỏ qua (không ảnh hưởng window)
+        - Chen vào giữa window -> trộn với window hiện tại (giữ reading gốc,
+          rollup theo giờ tính lại từ điểm sớm nhất)
+        """
+        if not rows:
+            return 'noop'
+        s = self._series.get(device)
+        if s is None or not s.raw.total or rows[0][0] > s.raw.last('ts'):
+            for r in rows:
+                self._append_filled(device, r)
+            return 'append'
+        with self._lock:
+            current = s.raw.window(copy=True)
+        if len(s.raw) == self.capacity and rows[-1][0] < current.ts[0]:
+            return 'skip'
+        merged = {float(p[0]): tuple(p) for p in zip(*current)}
+        merged.update((float(r[0]), tuple(r)) for r in rows)
+        points = [merged[ts] for ts in sorted(merged)][-self.capacity:]
+        self._reset(device, points[0][0])
+        for p in points:
+            self._append_filled(device, p)
+        return 'merge'
+
+    def catch_up(self, db_path, limit=10000):
+        """
+        Nạp các dòng mới do process khác ghi (chế độ nhiều worker).
+        Chỉ đọc id > watermark -> 1 range scan trên rowid.
+        Có shard (storage.py): gọi cho từng file, mỗi file 1 watermark.
+        """
+        con = sqlite3.connect(db_path)
+        rows = con.execute(self._SELECT + "WHERE id > ? ORDER BY id LIMIT ?",
+                           (self.watermarks.get(db_path, 0), limit)).fetchall()
+        con.close()
+        for device in self._ingest_rows(rows, db_path):
+            self.rebuild(db_path, device, max_id=self.watermarks[db_path])
+        return len(rows)
@@ -0,0 +1,119 @@
+import os
+
+# ================= CẤU HÌNH TỪ BIẾN MÔI TRƯỜNG =================
+# Mặc định giữ nguyên giá trị cũ trong app.py, ghi đè bằng env khi deploy
+
+
+def _env(name, default):
+    return os.environ.get(name, default)
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _env_bool(name, default):
+    return os.environ.get(name, str(int(default))).lower() in ("1", "true", "yes", "on")
+
+
+DB = _env("TUOI_DB", "tuoi.db")
+CHECK_INTERVAL = _env_int("TUOI_CHECK_INTERVAL", 5)
+
+# Ngưỡng chế độ Auto (tinh chỉnh bằng replay.py), mặc định của luật pump_on / pump_off (rules.py)
+SOIL_ON = float(_env("TUOI_SOIL_ON", "45"))
+SOIL_OFF = float(_env("TUOI_SOIL_OFF", "60"))
+
+# Chỉ đọc từ biến môi trường; mặc định "YOUR_BOT_TOKEN" -> send_telegram tắt cảnh báo
+TELEGRAM_TOKEN = _env("TELEGRAM_TOKEN", "YOUR_BOT_TOKEN")
+TELEGRAM_CHAT_ID = _env("TELEGRAM_CHAT_ID", "")
+
+MQTT_BROKER_URL = _env("MQTT_BROKER_URL", "broker.hivemq.com")
+MQTT_BROKER_PORT = _env_int("MQTT_BROKER_PORT", 1883)
+MQTT_USERNAME = _env("MQTT_USERNAME", "")
+MQTT_PASSWORD = _env("MQTT_PASSWORD", "")
+MQTT_KEEPALIVE = _env_int("MQTT_KEEPALIVE", 5)
+MQTT_TLS_ENABLED = _env_bool("MQTT_TLS_ENABLED", False)
+
+# --- Chế độ chạy server (wsgi.py) ---
+HOST = _env("TUOI_HOST", "0.0.0.0")
+PORT = _env_int("TUOI_PORT", 5000)
+SERVER_MODE = _env("TUOI_SERVER", "eventlet")   # eventlet | gevent | threaded
+WORKERS = _env_int("TUOI_WORKERS", 1)           # số worker gunicorn
+DEBUG = _env_bool("TUOI_DEBUG", False)
+# 0 = worker chỉ phục vụ HTTP, không chạy scheduler/MQTT
+START_SERVICES = _env_bool("TUOI_START_SERVICES", True)
+
+# --- ML process pool (ml_service.py) ---
+ML_WORKERS = _env_int("TUOI_ML_WORKERS", 1)
+ML_TIMEOUT = float(_env("TUOI_ML_TIMEOUT", "2.0"))  # giây chờ tối đa trong 1 request
+ML_MIN_REFRESH = float(_env("TUOI_ML_MIN_REFRESH", "2"))  # giây tối thiểu giữa 2 lần tính lại khi có dữ liệu mới
+FORECAST = _env("TUOI_FORECAST", "auto")             # auto = model rẻ nhất đạt FORECAST_MAE / zone, lstm = luôn LSTM
+FORECAST_MAE = float(_env("TUOI_FORECAST_MAE", "2.0"))  # % độ ẩm: sai số backtest chấp nhận được
+FORECAST_SAMPLES = int(_env("TUOI_FORECAST_SAMPLES", "32"))  # số đường MC dropout (LSTM) cho dải P10-P90, 1 = tắt
+
+
+# --- Lịch tưới so le nhiều zone (zone_scheduler.py) ---
+# 0 = không giới hạn: mọi zone bật cùng lúc theo start_time (như cũ)
+MAX_PUMPS = _env_int("TUOI_MAX_PUMPS", 0)               # số bơm chạy cùng lúc
+MAX_FLOW = float(_env("TUOI_MAX_FLOW", "0"))            # lít/phút của đường ống chính
+ZONE_FLOW = float(_env("TUOI_ZONE_FLOW", "10"))         # lít/phút mỗi zone
+SCHEDULE_SPREAD = _env_int("TUOI_SCHEDULE_SPREAD", 360) # phút: zone cuối phải tắt trước start + spread
+
+# --- Nén dữ liệu lúc ghi (compression.py) ---
+COMPRESS_DEVIATION = float(_env("TUOI_COMPRESS_DEVIATION", "0.5"))  # % độ ẩm, 0 = lưu mọi reading
+COMPRESS_HEARTBEAT = _env_int("TUOI_COMPRESS_HEARTBEAT", 120)       # giây, tối thiểu 1 điểm / heartbeat
+REPORT_INTERVAL = float(_env("TUOI_REPORT_INTERVAL", "1"))          # giây giữa 2 report của ESP32
+
+# --- Ingestion MQTT (ingest_worker.py) ---
+# app = Flask nhận tuoicay/report + bulk như cũ
+# worker = N process ingest_worker.py nhận qua shared subscription, Flask chỉ đọc DB
+INGEST = _env("TUOI_INGEST", "app")
+INGEST_GROUP = _env("TUOI_INGEST_GROUP", "tuoi-ingest")  # tên nhóm $share/<group>/...
+INGEST_PROCESSES = _env_int("TUOI_INGEST_PROCESSES", 1)  # số process / node
+INGEST_BATCH = _env_int("TUOI_INGEST_BATCH", 500)        # message / transaction
+INGEST_QUEUE = _env_int("TUOI_INGEST_QUEUE", 10000)      # hàng đợi giữa các tầng (đầy -> chặn network thread)
+
+# --- Kiểm soát tải /api/report + MQTT report (admission.py) ---
+REPORT_RATE = float(_env("TUOI_REPORT_RATE", "2"))          # report / giây / thiết bị, 0 = không giới hạn
+REPORT_BURST = _env_int("TUOI_REPORT_BURST", 10)            # số report dồn tối đa / thiết bị
+REPORT_CONCURRENCY = _env_int("TUOI_REPORT_CONCURRENCY", 16)  # report xử lý cùng lúc / process, 0 = không giới hạn
+ALERT_COOLDOWN = _env_int("TUOI_ALERT_COOLDOWN", 300)       # giây giữa 2 cảnh báo Telegram cùng loại / thiết bị
+RULES_RELOAD = float(_env("TUOI_RULES_RELOAD", "5"))        # giây giữa 2 lần kiểm tra bảng alert_rules có đổi
+
+# --- Xuất lịch sử logs (export.py, /api/export) ---
+EXPORT_CHUNK = _env_int("TUOI_EXPORT_CHUNK", 5000)           # dòng / lần đọc (khoá SQLite chỉ giữ trong 1 lần đọc)
+EXPORT_CONCURRENCY = _env_int("TUOI_EXPORT_CONCURRENCY", 2)  # phiên xuất cùng lúc / process, quá thì 429
+
+# --- Chia logs ra nhiều file SQLite (storage.py) ---
+SHARDS = _env_int("TUOI_SHARDS", 1)   # số file shard cho logs, 1 = logs nằm trong TUOI_DB (như cũ)
+
+# --- Ring buffer trong RAM (ring_buffer.py) ---
+RING_CAPACITY = _env_int("TUOI_RING_CAPACITY", 4096)  # số reading gần nhất / thiết bị
+
+# --- Phân phối dashboard (delivery.py) ---
+GZIP_MIN_SIZE = _env_int("TUOI_GZIP_MIN_SIZE", 1024)  # byte: JSON lớn hơn thì gzip, 0 = tắt
+
+# --- Truy vấn phân tích DuckDB (analytics.py, cần `pip install duckdb`) ---
+ANALYTICS = _env_bool("TUOI_ANALYTICS", False)        # 1 = job ML / báo cáo quét bản sao DuckDB
+ANALYTICS_DAYS = _env_int("TUOI_ANALYTICS_DAYS", 60)  # số ngày giữ trong bản sao (LSTM train dùng 60)
+
+# --- Profiler theo yêu cầu (profiler.py) ---
+ADMIN_TOKEN = _env("TUOI_ADMIN_TOKEN", "")             # header X-Admin-Token cho /api/admin/*, rỗng = tắt
+PROFILE_DIR = _env("TUOI_PROFILE_DIR", "profiles")     # nơi ghi file khi bật bằng signal
+PROFILE_SIGNAL = _env("TUOI_PROFILE_SIGNAL", "SIGUSR2")  # `kill -USR2 <pid>`, rỗng = không cài
+PROFILE_SECONDS = _env_int("TUOI_PROFILE_SECONDS", 10)
+PROFILE_HZ = _env_int("TUOI_PROFILE_HZ", 100)
+
+
+def flask_config():
+    """Các key app.config cho Flask / flask_mqtt"""
+    return {
+        "TUOI_DB": DB,
+        "TUOI_START_SERVICES": START_SERVICES,
+        "MQTT_BROKER_URL": MQTT_BROKER_URL,
+        "MQTT_BROKER_PORT": MQTT_BROKER_PORT,
+        "MQTT_USERNAME": MQTT_USERNAME,
+        "MQTT_PASSWORD": MQTT_PASSWORD,
+        "MQTT_KEEPALIVE": MQTT_KEEPALIVE,
+        "MQTT_TLS_ENABLED": MQTT_TLS_ENABLED,
+    }
@@ -0,0 +1,682 @@
+// ============================================
+// GLOBAL STATE
+// ============================================
+let myChart = null;
+let chartInitialized = false;
+let currentTimeRange = 'realtime';
+let isEditingSchedule = false;  // Flag to prevent sync override during edit
+// Trang HTML là file tĩnh (cache được), trạng thái thật lấy từ /api/config khi tải trang
+let currentPumpState = false;
+let autoMoistureEnabled = false;
+let scheduleEnabled = false;
+
+// ============================================
+// 1. MAIN PUMP CONTROL - Nút chính bật/tắt
+// ============================================
+async function toggleMainPump() {
+  const mainBtn = document.getElementById('mainPumpBtn');
+  const loadingOverlay = document.getElementById('loadingOverlay');
+  
+  // Toggle state
+  const newState = !currentPumpState;
+  
+  try {
+    mainBtn.disabled = true;
+    loadingOverlay.classList.add('active');
+    
+    const response = await fetch('/api/set', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({pump_cmd: newState ? 1 : 0})
+    });
+    
+    if (response.ok) {
+      currentPumpState = newState;
+      updateMainPumpUI();
+      console.log(`✅ Máy bơm: ${newState ? 'BẬT' : 'TẮT'}`);
+    } else {
+      throw new Error('Failed to control pump');
+    }
+  } catch (error) {
+    console.error('❌ Lỗi:', error);
+    alert('Không thể điều khiển máy bơm!');
+  } finally {
+    loadingOverlay.classList.remove('active');
+    mainBtn.disabled = false;
+  }
+}
+
+function updateMainPumpUI() {
+  const mainBtn = document.getElementById('mainPumpBtn');
+  const icon = mainBtn.querySelector('.pump-icon-main i');
+  const text = mainBtn.querySelector('.pump-status-text');
+  
+  if (currentPumpState) {
+    mainBtn.classList.remove('off');
+    mainBtn.classList.add('on');
+    icon.className = 'fas fa-fan';
+    text.textContent = 'BẬT MÁY BƠM';
+  } else {
+    mainBtn.classList.remove('on');
+    mainBtn.classList.add('off');
+    icon.className = 'fas fa-power-off';
+    text.textContent = 'TẮT MÁY BƠM';
+  }
+  
+  // Update current mode display
+  updateModeDisplay();
+}
+
+function updateModeDisplay() {
+  const modeDisplay = document.getElementById('currentMode');
+  
+  if (scheduleEnabled) {
+    modeDisplay.innerHTML = '<i class="fas fa-calendar-clock"></i> CHỂ ĐỘ: TỰ ĐỘNG THEO LỊCH';
+    modeDisplay.style.background = 'linear-gradient(135deg, #f093fb 0%, #f5576c 100%)';
+  } else if (autoMoistureEnabled) {
+    modeDisplay.innerHTML = '<i class="fas fa-robot"></i> CHỂ ĐỘ: TỰ ĐỘNG ĐỘ ẨM';
+    modeDisplay.style.background = 'linear-gradient(135deg, #11998e 0%, #38ef7d 100%)';
+  } else {
+    modeDisplay.innerHTML = '<i class="fas fa-hand-pointer"></i> CHỂ ĐỘ: THỦ CÔNG';
+    modeDisplay.style.background = 'linear-gradient(135deg, #667eea 0%, #764ba2 100%)';
+  }
+}
+
+// ============================================
+// 2. AUTO MOISTURE MODE
+// ============================================
+async function toggleAutoMoisture(enabled) {
+  try {
+    const response = await fetch('/api/set', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({auto: enabled ? 1 : 0})
+    });
+    
+    if (response.ok) {
+      autoMoistureEnabled = enabled;
+      
+      // Nếu bật auto, tắt schedule
+      if (enabled) {
+        scheduleEnabled = false;
+        document.getElementById('scheduleToggle').checked = false;
+        updateScheduleStatus();
+      }
+      
+      console.log(`🤖 Auto moisture: ${enabled ? 'BẬT' : 'TẮT'}`);
+    }
+  } catch (error) {
+    console.error('❌ Lỗi auto moisture:', error);
+  }
+}
+
+// ============================================
+// 4. SCHEDULE MANAGER
+// ============================================
+async function toggleSchedule(enabled) {
+  try {
+    const response = await fetch('/api/set', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({use_schedule: enabled ? 1 : 0})
+    });
+    
+    if (response.ok) {
+      scheduleEnabled = enabled;
+      updateScheduleStatus();
+      
+      // Nếu bật schedule, tắt auto
+      if (enabled) {
+        autoMoistureEnabled = false;
+        document.getElementById('autoMoistureToggle').checked = false;
+      }
+      
+      console.log(`⏰ Schedule: ${enabled ? 'BẬT' : 'TẮT'}`);
+    }
+  } catch (error) {
+    console.error('❌ Lỗi schedule:', error);
+  }
+}
+
+function editSchedule() {
+  const form = document.getElementById('scheduleForm');
+  const list = document.getElementById('scheduleList');
+  
+  if (form.style.display === 'none') {
+    // Opening editor
+    form.style.display = 'block';
+    list.style.display = 'none';
+    isEditingSchedule = true;
+    console.log('📝 Editing schedule - sync paused');
+  } else {
+    // Closing editor
+    form.style.display = 'none';
+    list.style.display = 'block';
+    isEditingSchedule = false;
+    console.log('✅ Schedule editor closed - sync resumed');
+  }
+}
+
+async function saveSchedule() {
+  const start = document.getElementById('scheduleStart').value;
+  const end = document.getElementById('scheduleEnd').value;
+  const loadingOverlay = document.getElementById('loadingOverlay');
+  
+  if (!start || !end) {
+    alert('Vui lòng nhập đầy đủ thời gian!');
+    return;
+  }
+  
+  try {
+    loadingOverlay.classList.add('active');
+    
+    const response = await fetch('/api/set', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({
+        start: start, 
+        end: end
+      })
+    });
+    
+    if (response.ok) {
+      // Update display immediately (no page reload)
+      document.getElementById('scheduleTimeDisplay').textContent = `${start} - ${end}`;
+      
+      // Close form and reset editing flag
+      editSchedule(); // This will set isEditingSchedule = false
+      
+      loadingOverlay.classList.remove('active');
+      
+      console.log(`💾 Đã lưu lịch: ${start} - ${end}`);
+      
+      // Show success message briefly
+      const modeDisplay = document.getElementById('currentMode');
+      const originalHTML = modeDisplay.innerHTML;
+      const originalBg = modeDisplay.style.background;
+      
+      modeDisplay.innerHTML = '<i class="fas fa-check-circle"></i> ĐÃ LƯU LỊCH!';
+      modeDisplay.style.background = 'linear-gradient(135deg, #11998e 0%, #38ef7d 100%)';
+      
+      setTimeout(() => {
+        modeDisplay.innerHTML = originalHTML;
+        modeDisplay.style.background = originalBg;
+      }, 2000);
+    } else {
+      throw new Error('Failed to save');
+    }
+  } catch (error) {
+    console.error('❌ Lỗi save schedule:', error);
+    loadingOverlay.classList.remove('active');
+    alert('Không thể lưu lịch! Vui lòng thử lại.');
+  }
+}
+
+async function deleteSchedule() {
+  if (!confirm('Bạn có chắc muốn xóa lịch hẹn này?')) {
+    return;
+  }
+  
+  const loadingOverlay = document.getElementById('loadingOverlay');
+  
+  try {
+    loadingOverlay.classList.add('active');
+    
+    const response = await fetch('/api/set', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({start: '00:00', end: '00:00', use_schedule: 0})
+    });
+    
+    if (response.ok) {
+      document.getElementById('scheduleTimeDisplay').textContent = '00:00 - 00:00';
+      document.getElementById('scheduleStart').value = '00:00';
+      document.getElementById('scheduleEnd').value = '00:00';
+      document.getElementById('scheduleToggle').checked = false;
+      scheduleEnabled = false;
+      updateScheduleStatus();
+      updateModeDisplay();
+      
+      // Close form
+      editSchedule();
+      
+      loadingOverlay.classList.remove('active');
+      
+      console.log('🗑️ Đã xóa lịch');
+      alert('Đã xóa lịch hẹn thành công!');
+    } else {
+      throw new Error('Failed to delete');
+    }
+  } catch (error) {
+    console.error('❌ Lỗi delete schedule:', error);
+    loadingOverlay.classList.remove('active');
+    alert('Không thể xóa lịch! Vui lòng thử lại.');
+  }
+}
+
+function updateScheduleStatus() {
+  const statusElem = document.querySelector('.schedule-status');
+  if (scheduleEnabled) {
+    statusElem.className = 'schedule-status active';
+    statusElem.textContent = 'Đang hoạt động';
+  } else {
+    statusElem.className = 'schedule-status inactive';
+    statusElem.textContent = 'Chưa kích hoạt';
+  }
+}
+
+// ============================================
+// 4. SYNC STATE FROM SERVER
+// ============================================
+let isSyncing = false;
+
+async function syncState() {
+  if (isSyncing) return;
+  
+  try {
+    isSyncing = true;
+    const response = await fetch('/api/config');
+    const config = await response.json();
+    
+    // Sync pump state
+    const serverPumpState = config.pump_cmd === 1;
+    if (serverPumpState !== currentPumpState) {
+      console.log(`🔄 Pump state changed: ${serverPumpState ? 'ON' : 'OFF'}`);
+      currentPumpState = serverPumpState;
+      updateMainPumpUI();
+    }
+    
+    // Sync auto moisture
+    const serverAuto = config.auto === 1;
+    if (serverAuto !== autoMoistureEnabled) {
+      autoMoistureEnabled = serverAuto;
+      document.getElementById('autoMoistureToggle').checked = serverAuto;
+      updateModeDisplay();
+    }
+    
+    // Sync schedule
+    const serverSchedule = config.use_schedule === 1;
+    if (serverSchedule !== scheduleEnabled) {
+      scheduleEnabled = serverSchedule;
+      document.getElementById('scheduleToggle').checked = serverSchedule;
+      updateScheduleStatus();
+      updateModeDisplay();
+    }
+    
+    // Update schedule time display (only if not currently editing)
+    if (!isEditingSchedule) {
+      document.getElementById('scheduleTimeDisplay').textContent = `${config.start} - ${config.end}`;
+      document.getElementById('scheduleStart').value = config.start;
+      document.getElementById('scheduleEnd').value = config.end;
+    }
+    
+  } catch (error) {
+    console.error('Sync error:', error);
+  } finally {
+    isSyncing = false;
+  }
+}
+
+// Initialize UI on page load
+document.addEventListener('DOMContentLoaded', function() {
+  updateMainPumpUI();
+  updateScheduleStatus();
+  updateModeDisplay();
+  document.getElementById('autoMoistureToggle').checked = autoMoistureEnabled;
+  document.getElementById('scheduleToggle').checked = scheduleEnabled;
+  syncState();
+});
+
+// ============================================
+// Update WiFi Status Display
+// ============================================
+function updateWiFiStatus(wifiConnected, rssi) {
+  const wifiStatus = document.getElementById('wifiStatus');
+  const wifiText = document.getElementById('wifiText');
+  const wifiIcon = wifiStatus.querySelector('.wifi-icon i');
+  const rssiBar = document.getElementById('rssiBar');
+  const rssiBars = rssiBar.querySelectorAll('span');
+  
+  if (wifiConnected) {
+    // ESP32 connected
+    wifiStatus.classList.remove('disconnected');
+    wifiStatus.classList.add('connected');
+    wifiText.textContent = 'Connected';
+    wifiIcon.className = 'fas fa-wifi';
+    
+    // RSSI bars (dBm to signal strength)
+    // Excellent: > -50, Good: -50 to -60, Fair: -60 to -70, Weak: < -70
+    let activeBars = 0;
+    if (rssi > -50) activeBars = 5;
+    else if (rssi > -60) activeBars = 4;
+    else if (rssi > -70) activeBars = 3;
+    else if (rssi > -80) activeBars = 2;
+    else activeBars = 1;
+    
+    rssiBars.forEach((bar, index) => {
+      if (index < activeBars) {
+        bar.classList.add('active');
+      } else {
+        bar.classList.remove('active');
+      }
+    });
+    
+    console.log(`📶 WiFi: ${rssi} dBm (${activeBars}/5 bars)`);
+  } else {
+    // ESP32 disconnected
+    wifiStatus.classList.remove('connected');
+    wifiStatus.classList.add('disconnected');
+    wifiText.textContent = 'Offline';
+    wifiIcon.className = 'fas fa-wifi-slash';
+    
+    // Clear all bars
+    rssiBars.forEach(bar => bar.classList.remove('active'));
+  }
+}
+
+// Update moisture display
+function updateMoistureDisplay(moisture) {
+  const moistureValue = document.getElementById('moistureValue');
+  const moistureRing = document.getElementById('moistureRing');
+  const moistureStatus = document.getElementById('moistureStatus');
+  const lastUpdate = document.getElementById('lastUpdate');
+  
+  // Update number
+  moistureValue.textContent = moisture.toFixed(1);
+  
+  // Update ring (534 is circumference of circle with r=85)
+  const offset = 534 - (534 * moisture / 100);
+  moistureRing.style.strokeDashoffset = offset;
+  
+  // Update status text and color
+  let statusText = '';
+  let statusClass = '';
+  
+  if (moisture < 20) {
+    statusText = '🏜️ Rất khô - Cần tưới ngay!';
+    statusClass = 'dry';
+  } else if (moisture < 40) {
+    statusText = '🌵 Khô - Nên tưới nước';
+    statusClass = 'low';
+  } else if (moisture < 60) {
+    statusText = '🌿 Tối ưu - Độ ẩm tốt';
+    statusClass = 'optimal';
+  } else if (moisture < 80) {
+    statusText = '💧 Ẩm - Đủ nước';
+    statusClass = 'high';
+  } else {
+    statusText = '🌊 Rất ẩm - Ngừng tưới';
+    statusClass = 'wet';
+  }
+  
+  moistureStatus.innerHTML = statusText;
+  moistureStatus.className = 'moisture-status ' + statusClass;
+  
+  // Update last update time
+  const now = new Date();
+  lastUpdate.textContent = 'Cập nhật: ' + now.toLocaleTimeString('vi-VN');
+}
+
+// Initialize chart
+function initChart() {
+  const ctx = document.getElementById('chart').getContext('2d');
+  const gradient = ctx.createLinearGradient(0, 0, 0, 400);
+  gradient.addColorStop(0, 'rgba(102, 126, 234, 0.8)');
+  gradient.addColorStop(1, 'rgba(118, 75, 162, 0.1)');
+  
+  myChart = new Chart(ctx, {
+    type: 'line',
+    data: {
+      labels: [],
+      datasets: [{
+        label: 'Độ ẩm đất (%)',
+        data: [],
+        backgroundColor: gradient,
+        borderColor: '#667eea',
+        borderWidth: 3,
+        fill: true,
+        tension: 0.4,
+        pointRadius: 4,
+        pointBackgroundColor: '#667eea',
+        pointBorderColor: '#fff',
+        pointBorderWidth: 2,
+        pointHoverRadius: 6,
+        pointHoverBackgroundColor: '#764ba2',
+        pointHoverBorderColor: '#fff',
+        pointHoverBorderWidth: 3
+      }]
+    },
+    options: {
+      responsive: true,
+      maintainAspectRatio: false,
+      animation: {
+        duration: 750,
+        easing: 'easeInOutQuart'
+      },
+      plugins: {
+        legend: {
+          display: true,
+          position: 'top',
+          labels: {
+            font: {
+              size: 14,
+              weight: 'bold'
+            },
+            color: '#333',
+            padding: 15
+          }
+        },
+        tooltip: {
+          backgroundColor: 'rgba(0, 0, 0, 0.8)',
+          padding: 12,
+          titleFont: {
+            size: 14,
+            weight: 'bold'
+          },
+          bodyFont: {
+            size: 13
+          },
+          displayColors: false,
+          callbacks: {
+            label: function(context) {
+              return 'Độ ẩm: ' + context.parsed.y.toFixed(1) + '%';
+            }
+          }
+        }
+      },
+      scales: {
+        y: {
+          beginAtZero: true,
+          max: 100,
+          ticks: {
+            font: {
+              size: 12
+            },
+            color: '#666',
+            callback: function(value) {
+              return value + '%';
+            }
+          },
+          grid: {
+            color: 'rgba(0, 0, 0, 0.05)'
+          }
+        },
+        x: {
+          ticks: {
+            font: {
+              size: 11
+            },
+            color: '#666',
+            maxRotation: 45,
+            minRotation: 45
+          },
+          grid: {
+            display: false
+          }
+        }
+      }
+    }
+  });
+  
+  chartInitialized = true;
+}
+
+// Update chart with new data (smooth update)
+async function updateChart() {
+  try {
+    // Call API with time range parameter
+    const res = await fetch(`/api/logs?range=${currentTimeRange}`);
+    let data = await res.json();
+    
+    console.log(`📊 Received ${data.length} records for ${currentTimeRange}`);
+    if (data.length > 0) {
+      console.log('  📅 First:', data[0].ts, '- Soil:', data[0].soil);
+      console.log('  📅 Last:', data[data.length-1].ts, '- Soil:', data[data.length-1].soil);
+    }
+    
+    if (data.length === 0) {
+      console.log(`⚠️ No data available for ${currentTimeRange} range`);
+      updateWiFiStatus(false, 0);
+      
+      // Show "no data" message on chart
+      if (myChart) {
+        myChart.data.labels = ['Không có dữ liệu'];
+        myChart.data.datasets[0].data = [0];
+        myChart.update('none');
+      }
+      return;
+    }
+    
+    // Get latest data point
+    const latest = data[data.length - 1];
+    
+    // Update moisture display
+    updateMoistureDisplay(latest.soil);
+    
+    // Update WiFi status
+    const wifiConnected = latest.wifi_connected === 1;
+    const rssi = latest.wifi_rssi || 0;
+    updateWiFiStatus(wifiConnected, rssi);
+    
+    // Prepare chart data with different label formats based on time range
+    const labels = data.map(d => {
+      const date = new Date(d.ts);
+      
+      if (currentTimeRange === 'realtime') {
+        // HH:MM:SS for realtime
+        return date.toLocaleTimeString('vi-VN', {
+          hour: '2-digit', 
+          minute: '2-digit', 
+          second: '2-digit'
+        });
+      } else if (currentTimeRange === 'hour') {
+        // HH:MM:SS for 1 hour
+        return date.toLocaleTimeString('vi-VN', {
+          hour: '2-digit', 
+          minute: '2-digit', 
+          second: '2-digit'
+        });
+      } else if (currentTimeRange === 'day') {
+        // HH:MM for 1 day (no seconds, too many points)
+        return date.toLocaleTimeString('vi-VN', {
+          hour: '2-digit', 
+          minute: '2-digit'
+        });
+      } else if (currentTimeRange === 'week') {
+        // DD/MM HH:MM for 1 week
+        return date.toLocaleDateString('vi-VN', {
+          day: '2-digit', 
+          month: '2-digit'
+        }) + ' ' + date.toLocaleTimeString('vi-VN', {
+          hour: '2-digit', 
+          minute: '2-digit'
+        });
+      }
+      
+      return date.toLocaleString('vi-VN');
+    });
+    const vals = data.map(d => d.soil);
+    
+    // Initialize chart if not done yet
+    if (!chartInitialized) {
+      initChart();
+    }
+    
+    // Update chart data smoothly
+    if (myChart) {
+      myChart.data.labels = labels;
+      myChart.data.datasets[0].data = vals;
+      myChart.update('none');
+    }
+    
+    // Log data count for debugging
+    console.log(`📊 Chart updated: ${data.length} data points (${currentTimeRange})`);
+  } catch (error) {
+    console.error('Error updating chart:', error);
+    updateWiFiStatus(false, 0);
+  }
+}
+
+// ============================================
+// 5. TIME RANGE FILTER FOR CHART
+// ============================================
+function changeTimeRange(range) {
+  currentTimeRange = range;
+  
+  // Update button states
+  document.querySelectorAll('.filter-btn').forEach(btn => {
+    btn.classList.remove('active');
+  });
+  document.querySelector(`[data-range="${range}"]`).classList.add('active');
+  
+  // Update chart immediately with new range
+  updateChart();
+  
+  // Adjust update interval based on range
+  startUpdates();
+  
+  console.log(`📊 Changed time range to: ${range}`);
+}
+
+// ============================================
+// SYSTEM INITIALIZATION
+// ============================================
+
+// Initial load
+updateChart();
+
+// Refresh intervals based on time range
+let updateInterval = null;
+
+function startUpdates() {
+  if (updateInterval) clearInterval(updateInterval);
+  
+  let interval;
+  
+  switch(currentTimeRange) {
+    case 'realtime':
+      interval = 2000;  // Update every 2s for realtime
+      break;
+    case 'hour':
+      interval = 5000;  // Update every 5s for 1 hour view
+      break;
+    case 'day':
+      interval = 30000; // Update every 30s for 1 day view
+      break;
+    case 'week':
+      interval = 60000; // Update every 60s for 1 week view
+      break;
+    default:
+      interval = 5000;
+  }
+  
+  updateInterval = setInterval(updateChart, interval);
+  console.log(`⏱️ Chart update interval: ${interval/1000}s`);
+}
+
+startUpdates();
+
+// Sync state every 3 seconds
+setInterval(syncState, 3000);
+
+console.log('✅ Hệ thống tưới cây đã sẵn sàng!');
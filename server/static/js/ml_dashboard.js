@@ -0,0 +1,396 @@
+let predictionChart = null;
+
+// ============================================
+// 1. LOAD ML RECOMMENDATION
+// ============================================
+async function loadRecommendation() {
+  try {
+    const response = await fetch('/api/ml/recommendation');
+    const data = await response.json();
+
+    if (data.status === 'success') {
+      const rec = data.recommendation;
+      const actionClass = rec.action.toLowerCase().replace('_', '-');
+
+      let icon = '';
+      if (rec.action === 'WATER_NOW') {
+        icon = '<i class="fas fa-faucet-drip"></i>';
+      } else if (rec.action === 'WATER_SOON') {
+        icon = '<i class="fas fa-clock"></i>';
+      } else {
+        icon = '<i class="fas fa-check-circle"></i>';
+      }
+
+      document.getElementById('recommendationContent').innerHTML = `
+        <div class="recommendation-box ${actionClass}">
+          <div class="recommendation-icon">${icon}</div>
+          <div class="recommendation-action">${rec.action.replace('_', ' ')}</div>
+          <div class="recommendation-reason">${rec.reason}</div>
+          <div class="recommendation-reason" style="margin-top: 10px;">
+            <i class="fas fa-info-circle"></i> ${rec.suggested_duration}
+          </div>
+          <div class="confidence-score">
+            <i class="fas fa-brain"></i> Confidence: ${(rec.confidence * 100).toFixed(0)}%
+          </div>
+        </div>
+        <div style="text-align: center; color: #666; font-size: 0.9rem;">
+          <i class="fas fa-sync-alt"></i> Updated: ${new Date().toLocaleTimeString('vi-VN')}
+        </div>
+      `;
+    }
+  } catch (error) {
+    console.error('Error loading recommendation:', error);
+    document.getElementById('recommendationContent').innerHTML = `
+      <p style="color: #dc3545; text-align: center;">
+        <i class="fas fa-exclamation-circle"></i> Không thể tải recommendation
+      </p>
+    `;
+  }
+}
+
+// ============================================
+// 2. LOAD 24H PREDICTIONS
+// ============================================
+async function loadPredictions() {
+  try {
+    const response = await fetch('/api/ml/predict');
+    const data = await response.json();
+
+    if (data.status === 'success') {
+      const predictions = data.predictions.slice(0, 8); // First 8 hours
+      const summary = data.summary;
+
+      let html = `
+        <div style="display: grid; grid-template-columns: repeat(3, 1fr); gap: 10px; margin-bottom: 20px;">
+          <div style="text-align: center; padding: 10px; background: #f0f0f0; border-radius: 8px;">
+            <div style="font-size: 0.8rem; color: #666;">MIN</div>
+            <div style="font-size: 1.3rem; font-weight: bold; color: #dc3545;">${summary.min}%</div>
+          </div>
+          <div style="text-align: center; padding: 10px; background: #f0f0f0; border-radius: 8px;">
+            <div style="font-size: 0.8rem; color: #666;">AVG</div>
+            <div style="font-size: 1.3rem; font-weight: bold; color: #667eea;">${summary.avg}%</div>
+          </div>
+          <div style="text-align: center; padding: 10px; background: #f0f0f0; border-radius: 8px;">
+            <div style="font-size: 0.8rem; color: #666;">MAX</div>
+            <div style="font-size: 1.3rem; font-weight: bold; color: #28a745;">${summary.max}%</div>
+          </div>
+        </div>
+        <div class="prediction-timeline">
+      `;
+
+      predictions.forEach(p => {
+        const width = p.predicted_soil;
+        const time = new Date(p.timestamp).toLocaleTimeString('vi-VN', { hour: '2-digit', minute: '2-digit' });
+
+        html += `
+          <div class="prediction-item">
+            <div class="prediction-time">+${p.hour}h<br>${time}</div>
+            <div class="prediction-bar">
+              <div class="prediction-bar-fill" style="width: ${width}%"></div>
+            </div>
+            <div class="prediction-value">${p.predicted_soil}%${p.p10 != null ? `<br><small>${p.p10}–${p.p90}%</small>` : ''}</div>
+          </div>
+        `;
+      });
+
+      html += '</div>';
+      document.getElementById('predictionContent').innerHTML = html;
+    }
+  } catch (error) {
+    console.error('Error loading predictions:', error);
+    document.getElementById('predictionContent').innerHTML = `
+      <p style="color: #dc3545; text-align: center;">
+        <i class="fas fa-exclamation-circle"></i> Không thể tải predictions
+      </p>
+    `;
+  }
+}
+
+// ============================================
+// 3. LOAD WEATHER
+// ============================================
+async function loadWeather() {
+  try {
+    const response = await fetch('/api/ml/weather');
+    const data = await response.json();
+
+    if (data.status === 'success') {
+      const current = data.current;
+      const impact = data.irrigation_impact;
+
+      let alertClass = 'success';
+      if (impact.should_skip) {
+        alertClass = 'danger';
+      } else if (impact.rain_probability > 50) {
+        alertClass = 'warning';
+      }
+
+      document.getElementById('weatherContent').innerHTML = `
+        <div class="weather-current">
+          <div class="weather-item">
+            <i class="fas fa-temperature-high"></i>
+            <div class="weather-value">${current.temp}°C</div>
+            <div class="weather-label">Nhiệt độ</div>
+          </div>
+          <div class="weather-item">
+            <i class="fas fa-tint"></i>
+            <div class="weather-value">${current.humidity}%</div>
+            <div class="weather-label">Độ ẩm KK</div>
+          </div>
+          <div class="weather-item">
+            <i class="fas fa-cloud-rain"></i>
+            <div class="weather-value">${impact.rain_probability}%</div>
+            <div class="weather-label">Xác suất mưa</div>
+          </div>
+          <div class="weather-item">
+            <i class="fas fa-wind"></i>
+            <div class="weather-value">${current.wind_speed}m/s</div>
+            <div class="weather-label">Gió</div>
+          </div>
+        </div>
+        
+        <div class="weather-alert ${alertClass}">
+          <strong><i class="fas fa-info-circle"></i> Impact Analysis:</strong>
+          <div style="margin-top: 8px;">${impact.reason}</div>
+          <div style="margin-top: 8px; font-weight: 600;">
+            <i class="fas fa-lightbulb"></i> ${impact.recommendation}
+          </div>
+        </div>
+      `;
+    }
+  } catch (error) {
+    console.error('Error loading weather:', error);
+    document.getElementById('weatherContent').innerHTML = `
+      <p style="color: #dc3545; text-align: center;">
+        <i class="fas fa-exclamation-circle"></i> Không thể tải weather data
+      </p>
+    `;
+  }
+}
+
+// ============================================
+// 4. LOAD ANOMALIES
+// ============================================
+async function loadAnomalies() {
+  try {
+    const response = await fetch('/api/ml/anomaly');
+    const data = await response.json();
+
+    if (data.status === 'success') {
+      const anomalies = data.anomalies;
+      const health = data.system_health;
+
+      let healthBadge = '';
+      if (health === 'GOOD') {
+        healthBadge = '<span class="status-badge good"><i class="fas fa-check-circle"></i> System Healthy</span>';
+      } else if (health === 'WARNING') {
+        healthBadge = '<span class="status-badge warning"><i class="fas fa-exclamation-triangle"></i> Warnings Detected</span>';
+      } else {
+        healthBadge = '<span class="status-badge critical"><i class="fas fa-times-circle"></i> Critical Issues</span>';
+      }
+
+      let html = `
+        <div style="text-align: center; margin-bottom: 20px;">
+          ${healthBadge}
+        </div>
+      `;
+
+      if (anomalies.length === 0) {
+        html += `
+          <div style="text-align: center; padding: 30px; color: #28a745;">
+            <i class="fas fa-shield-alt" style="font-size: 3rem; margin-bottom: 15px;"></i>
+            <div style="font-size: 1.2rem; font-weight: 600;">Không phát hiện vấn đề</div>
+            <div style="font-size: 0.9rem; margin-top: 5px; opacity: 0.8;">Hệ thống hoạt động bình thường</div>
+          </div>
+        `;
+      } else {
+        html += '<div class="anomaly-list">';
+        anomalies.forEach(a => {
+          const severityClass = a.severity.toLowerCase();
+          const icon = {
+            'INFO': 'fa-info-circle',
+            'WARNING': 'fa-exclamation-triangle',
+            'CRITICAL': 'fa-times-circle'
+          }[a.severity] || 'fa-question-circle';
+
+          const time = new Date(a.timestamp).toLocaleString('vi-VN');
+
+          html += `
+            <div class="anomaly-item ${severityClass}">
+              <div class="anomaly-header">
+                <div class="anomaly-type">
+                  <i class="fas ${icon}"></i> ${a.type.replace(/_/g, ' ').toUpperCase()}
+                </div>
+                <div class="anomaly-severity ${severityClass}">${a.severity}</div>
+              </div>
+              <div class="anomaly-message">${a.message}</div>
+              <div class="anomaly-time"><i class="fas fa-clock"></i> ${time}</div>
+            </div>
+          `;
+        });
+        html += '</div>';
+      }
+
+      document.getElementById('anomalyContent').innerHTML = html;
+    }
+  } catch (error) {
+    console.error('Error loading anomalies:', error);
+    document.getElementById('anomalyContent').innerHTML = `
+      <p style="color: #dc3545; text-align: center;">
+        <i class="fas fa-exclamation-circle"></i> Không thể tải anomaly data
+      </p>
+    `;
+  }
+}
+
+// ============================================
+// 5. PREDICTION CHART
+// ============================================
+async function initPredictionChart() {
+  try {
+    // Get actual data
+    const actualResponse = await fetch('/api/logs?range=realtime');
+    const actualData = await actualResponse.json();
+
+    // Get predictions
+    const predResponse = await fetch('/api/ml/predict');
+    const predData = await predResponse.json();
+
+    if (predData.status === 'success') {
+      const ctx = document.getElementById('predictionChart').getContext('2d');
+
+      // Prepare data
+      const actualLabels = actualData.map(d => {
+        const date = new Date(d.ts);
+        return date.toLocaleTimeString('vi-VN', { hour: '2-digit', minute: '2-digit' });
+      });
+
+      const actualValues = actualData.map(d => d.soil);
+
+      const predLabels = predData.predictions.map(p => {
+        const date = new Date(p.timestamp);
+        return date.toLocaleTimeString('vi-VN', { hour: '2-digit', minute: '2-digit' });
+      });
+
+      const predValues = predData.predictions.map(p => p.predicted_soil);
+      const hasBands = predData.predictions.length > 0 && predData.predictions[0].p10 != null;
+
+      // Combine labels
+      const allLabels = [...actualLabels, ...predLabels];
+
+      predictionChart = new Chart(ctx, {
+        type: 'line',
+        data: {
+          labels: allLabels,
+          datasets: [
+            {
+              label: 'Actual (Past)',
+              data: [...actualValues, ...Array(predValues.length).fill(null)],
+              borderColor: '#667eea',
+              backgroundColor: 'rgba(102, 126, 234, 0.1)',
+              borderWidth: 3,
+              tension: 0.4,
+              pointRadius: 4,
+              pointBackgroundColor: '#667eea',
+              fill: true
+            },
+            ...(hasBands ? [
+              {
+                label: 'P90',
+                data: [...Array(actualValues.length).fill(null), ...predData.predictions.map(p => p.p90)],
+                borderColor: 'rgba(240, 147, 251, 0.4)',
+                borderWidth: 1,
+                pointRadius: 0,
+                fill: false
+              },
+              {
+                label: 'P10',
+                data: [...Array(actualValues.length).fill(null), ...predData.predictions.map(p => p.p10)],
+                borderColor: 'rgba(240, 147, 251, 0.4)',
+                backgroundColor: 'rgba(240, 147, 251, 0.15)',
+                borderWidth: 1,
+                pointRadius: 0,
+                fill: '-1'
+              }
+            ] : []),
+            {
+              label: 'Predicted (Future)',
+              data: [...Array(actualValues.length).fill(null), ...predValues],
+              borderColor: '#f093fb',
+              backgroundColor: 'rgba(240, 147, 251, 0.1)',
+              borderWidth: 3,
+              borderDash: [5, 5],
+              tension: 0.4,
+              pointRadius: 4,
+              pointBackgroundColor: '#f093fb',
+              fill: true
+            }
+          ]
+        },
+        options: {
+          responsive: true,
+          maintainAspectRatio: false,
+          plugins: {
+            legend: {
+              position: 'top',
+              labels: {
+                font: { size: 14, weight: 'bold' },
+                padding: 15
+              }
+            },
+            tooltip: {
+              backgroundColor: 'rgba(0,0,0,0.8)',
+              padding: 12,
+              callbacks: {
+                label: function (context) {
+                  return context.dataset.label + ': ' + context.parsed.y.toFixed(1) + '%';
+                }
+              }
+            }
+          },
+          scales: {
+            y: {
+              beginAtZero: true,
+              max: 100,
+              ticks: {
+                callback: function (value) {
+                  return value + '%';
+                }
+              }
+            }
+          }
+        }
+      });
+    }
+  } catch (error) {
+    console.error('Error creating chart:', error);
+  }
+}
+
+// ============================================
+// INITIALIZE
+// ============================================
+async function initialize() {
+  console.log('🤖 Initializing ML Dashboard...');
+
+  await Promise.all([
+    loadRecommendation(),
+    loadPredictions(),
+    loadWeather(),
+    loadAnomalies(),
+    initPredictionChart()
+  ]);
+
+  console.log('✅ ML Dashboard loaded!');
+}
+
+// Load on page load
+initialize();
+
+// Refresh every 30 seconds
+setInterval(() => {
+  loadRecommendation();
+  loadPredictions();
+  loadWeather();
+  loadAnomalies();
+}, 30000);
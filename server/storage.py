@@ -0,0 +1,447 @@
+import os
+import sys
+import zlib
+import heapq
+import queue
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logger import get_logger, fields
+
+log = get_logger('storage')
+
+# ================= CHIA LOGS RA NHIỀU FILE SQLITE (SHARD) =================
+# Mọi thứ nằm trong 1 tuoi.db = 1 khoá ghi: logs, config, device_state và bảng
+# ML chờ nhau, gom lô tốt tới đâu thì throughput ghi của cả fleet vẫn bị chặn.
+# Với TUOI_SHARDS=N (> 1):
+#   - logs của mỗi thiết bị nằm cố định trong 1 file tuoi.shard<k>.db
+#     (k = crc32(device) % N) -> N khoá ghi độc lập
+#   - tuoi.db giữ phần điều khiển (config, device_state, bảng ML) và danh sách
+#     shard (bảng shards) -> mọi process / công cụ tự biết layout khi mở DB
+#   - Mỗi shard có 1 thread ghi riêng, gom các lô đang chờ thành 1 transaction
+#     (group commit); các shard commit song song
+#   - Đọc: connect() trả về kết nối tới tuoi.db với `logs` là TEMP VIEW gộp
+#     (UNION ALL) mọi shard -> code đọc cũ chạy nguyên; báo cáo fleet chạy
+#     fan_out() song song trên từng shard rồi trộn kết quả
+#   - `id` chỉ duy nhất trong 1 shard: watermark theo id phải giữ riêng từng
+#     file (RingStore, FeatureStore, Analytics dùng sources())
+# N = 1 (mặc định): logs nằm ngay trong tuoi.db như trước, không có thread ghi.
+#
+#   python storage.py --status          # layout hiện tại + số dòng mỗi file
+#   python storage.py --shards 4        # chia lại (dừng server trước), chuyển dòng logs
+#   python storage.py --shards 1        # gộp về 1 file
+
+MAX_SHARDS = 10        # SQLite mặc định ATTACH tối đa 10 DB (view gộp)
+CHUNK = 5000           # số dòng / transaction khi chuyển dữ liệu giữa các shard
+GROUP_COMMIT = 64      # số lô tối đa gom vào 1 transaction của thread ghi
+LOG_COLUMNS = 'ts, ts_ms, soil, pump, auto, wifi_connected, wifi_rssi, device, device_ts'
+# Row = (ts_ms, soil, pump, auto, wifi_connected, wifi_rssi, device, device_ts)
+INSERT = ("INSERT INTO logs(ts_ms,soil,pump,auto,wifi_connected,wifi_rssi,device,device_ts) "
+          "VALUES(?,?,?,?,?,?,?,?) ON CONFLICT(device, device_ts) DO NOTHING")
+_STOP = object()
+
+
+# ================= LAYOUT =================
+def shard_paths(db_path, shards):
+    """tuoi.db, 4 -> [tuoi.shard0.db, ..., tuoi.shard3.db]; shards <= 1 -> [] (logs trong tuoi.db)"""
+    if shards <= 1:
+        return []
+    if shards > MAX_SHARDS:
+        raise ValueError(f'tối đa {MAX_SHARDS} shard')
+    root, ext = os.path.splitext(db_path)
+    return [f"{root}.shard{k}{ext or '.db'}" for k in range(shards)]
+
+
+def shard_index(device, shards):
+    """Cùng thiết bị -> luôn cùng shard (crc32 giống nhau giữa các process, hash() thì không)"""
+    return zlib.crc32(str(device or '').encode()) % shards if shards > 1 else 0
+
+
+def read_layout(db_path):
+    """Các file shard ghi trong bảng shards của db_path ([] = chưa chia)"""
+    if not os.path.exists(db_path):
+        return []
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = con.execute("SELECT path FROM shards ORDER BY idx").fetchall()
+    except sqlite3.OperationalError:
+        rows = []   # DB chưa migrate, hoặc chính là 1 file shard
+    finally:
+        con.close()
+    # Lưu đường dẫn tương đối -> chuyển cả thư mục sang máy khác vẫn mở được
+    base = os.path.dirname(os.path.abspath(db_path))
+    return [os.path.join(base, r[0]) for r in rows]
+
+
+def _write_layout(db_path, paths):
+    base = os.path.dirname(os.path.abspath(db_path))
+    con = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("DELETE FROM shards")
+        con.executemany("INSERT INTO shards(idx, path) VALUES(?, ?)",
+                        [(k, os.path.relpath(os.path.abspath(p), base)) for k, p in enumerate(paths)])
+        con.execute("COMMIT")
+    finally:
+        con.close()
+
+
+def _open(path, readonly=False):
+    # uri=True cả khi ghi: ATTACH 'file:...?mode=ro' cần kết nối mở với URI
+    return sqlite3.connect(f"file:{path}{'?mode=ro' if readonly else ''}", uri=True)
+
+
+def connect(db_path, readonly=False, paths=None):
+    """
+    Thay cho sqlite3.connect(db_path) ở code đọc logs
+
+    Chưa chia shard: kết nối thường. Có shard: `logs` là TEMP VIEW gộp mọi
+    shard (chỉ đọc, WHERE device / ts_ms vẫn dùng index của từng shard),
+    các bảng khác (config, device_state, bảng ML) là của db_path.
+    """
+    paths = read_layout(db_path) if paths is None else paths
+    if not paths:
+        return _open(db_path, readonly) if readonly else sqlite3.connect(db_path)
+    con = _open(db_path, readonly)
+    for k, path in enumerate(paths):
+        con.execute(f"ATTACH DATABASE ? AS s{k}", (f"file:{path}?mode=ro",))
+    con.execute("CREATE TEMP VIEW logs AS " + " UNION ALL ".join(
+        f"SELECT * FROM s{k}.logs" for k in range(len(paths))))
+    return con
+
+
+# ================= GHI =================
+class _Job:
+    __slots__ = ('rows', 'done', 'error')
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+def _offload():
+    """
+    Hàm chạy 1 lệnh chặn trên thread OS, None nếu không cần: sau eventlet / gevent
+    monkey_patch, thread ghi là green thread -> commit SQLite chặn cả hub (mọi
+    request) và các shard không commit song song được
+    """
+    # Chỉ xét module đã import: chưa import thì không thể đã monkey_patch (import
+    # eventlet trong thread ghi làm greenlet giữ thread state -> join() treo tới timeout)
+    patcher = sys.modules.get('eventlet.patcher')
+    if patcher is not None and patcher.is_monkey_patched('thread'):
+        from eventlet import tpool
+        return tpool.execute
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        from gevent import get_hub
+        return lambda fn, *args: get_hub().threadpool.apply(fn, args)
+    return None
+
+
+class _Writer:
+    """
+    1 thread ghi / shard: các lô đang chờ được ghi chung 1 transaction (group commit)
+
+    Dưới eventlet / gevent: vòng gom lô chạy trên greenlet, còn executemany +
+    commit chạy trên threadpool OS (tpool) -> không chặn hub, shard commit song song
+    """
+
+    def __init__(self, path, group=GROUP_COMMIT):
+        self.path = path
+        self.group = group
+        self.queue = queue.Queue()
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, rows):
+        job = _Job(rows)
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True,
+                                               name=f'writer-{os.path.basename(self.path)}')
+                self.thread.start()
+            self.queue.put(job)
+        return job
+
+    def stop(self, timeout=10):
+        with self._lock:
+            thread, self.thread = self.thread, None
+            if thread is not None:
+                self.queue.put(_STOP)
+        if thread is not None:
+            thread.join(timeout)
+
+    def _loop(self):
+        offload = _offload()
+        # Thread OS của tpool đổi theo từng lần commit (chỉ 1 lần commit / shard tại 1 thời điểm)
+        con = sqlite3.connect(self.path, timeout=30, check_same_thread=offload is None)
+        try:
+            while True:
+                jobs = [self.queue.get()]
+                while jobs[-1] is not _STOP and len(jobs) < self.group:
+                    try:
+                        jobs.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = jobs[-1] is _STOP
+                if stop:
+                    jobs.pop()
+                if jobs:
+                    if offload is None:
+                        self._commit(con, jobs)
+                    else:
+                        offload(self._commit, con, jobs)
+                    # Báo xong trên thread ghi (Event green không set được từ thread OS)
+                    for job in jobs:
+                        job.done.set()
+                if stop:
+                    return
+        finally:
+            con.close()
+
+    @staticmethod
+    def _commit(con, jobs):
+        try:
+            con.executemany(INSERT, [row for job in jobs for row in job.rows])
+            con.commit()
+        except Exception as e:
+            con.rollback()
+            for job in jobs:
+                job.error = e
+
+
+class Storage:
+    """
+    Định tuyến logs theo thiết bị tới file shard (hoặc tuoi.db nếu chưa chia)
+
+    Args:
+        db_path: DB chính (config, device_state, bảng ML, bảng shards)
+        paths: danh sách shard, None = đọc từ bảng shards của db_path
+    """
+
+    def __init__(self, db_path, paths=None):
+        self.db_path = db_path
+        self.paths = read_layout(db_path) if paths is None else list(paths)
+        self._writers = {}
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def sharded(self):
+        return bool(self.paths)
+
+    def sources(self):
+        """Các file có bảng logs cần đọc (watermark theo id giữ riêng từng file)"""
+        return self.paths or [self.db_path]
+
+    def path_for(self, device):
+        return self.paths[shard_index(device, len(self.paths))] if self.paths else self.db_path
+
+    def connect(self, device=None, readonly=False):
+        """device: file chứa logs của thiết bị đó; None: DB chính, `logs` gộp mọi shard"""
+        if device is not None and self.paths:
+            return _open(self.path_for(device), readonly) if readonly else sqlite3.connect(self.path_for(device))
+        return connect(self.db_path, readonly, self.paths)
+
+    def insert(self, rows, con=None):
+        """
+        Ghi các dòng logs (Row, xem INSERT), chờ tới khi đã commit
+
+        Chưa chia shard: ghi thẳng trên con (hoặc kết nối mới) như trước.
+        Có shard: chia theo thiết bị, mỗi shard 1 lô cho thread ghi của nó.
+        """
+        if not rows:
+            return
+        if not self.paths:
+            own = con is None
+            con = sqlite3.connect(self.db_path) if own else con
+            try:
+                con.executemany(INSERT, rows)
+                con.commit()
+            finally:
+                if own:
+                    con.close()
+            return
+        groups = {}
+        for row in rows:
+            groups.setdefault(self.path_for(row[6]), []).append(row)
+        jobs = [self._writer(path).submit(group) for path, group in groups.items()]
+        for job in jobs:
+            job.wait()
+
+    def _writer(self, path):
+        writer = self._writers.get(path)
+        if writer is None:
+            with self._lock:
+                writer = self._writers.setdefault(path, _Writer(path))
+        return writer
+
+    # ================= ĐỌC FAN-OUT =================
+    def fan_out(self, sql, params=(), key=None):
+        """
+        Chạy cùng 1 câu SQL trên từng file logs song song rồi gộp kết quả
+
+        Mỗi thiết bị chỉ nằm trong 1 shard -> GROUP BY device / PARTITION BY
+        device cho kết quả đúng khi nối các shard lại. key: mỗi shard trả về
+        đã sắp theo key -> trộn (heapq.merge) giữ thứ tự.
+        """
+        def run(path):
+            con = _open(path, readonly=True)
+            try:
+                return con.execute(sql, params).fetchall()
+            finally:
+                con.close()
+
+        sources = self.sources()
+        if len(sources) == 1:
+            return run(sources[0])
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(len(sources), thread_name_prefix='shard-read')
+        results = list(self._pool.map(run, sources))
+        if key is not None:
+            return list(heapq.merge(*results, key=key))
+        return [row for rows in results for row in rows]
+
+    def devices(self):
+        return sorted(r[0] for r in self.fan_out("SELECT DISTINCT device FROM logs WHERE device IS NOT NULL"))
+
+    def close(self):
+        for writer in list(self._writers.values()):
+            writer.stop()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+# ================= CHIA LẠI SHARD =================
+def _move_rows(source, target):
+    """Chuyển logs của các thiết bị không thuộc `source` sang file đúng của chúng"""
+    con = sqlite3.connect(source, timeout=30, isolation_level=None)
+    attached = {}
+    moved = 0
+    try:
+        devices = [r[0] for r in con.execute("SELECT DISTINCT device FROM logs")]
+        for device in devices:
+            dest = target.path_for(device)
+            if os.path.abspath(dest) == os.path.abspath(source):
+                continue
+            if dest not in attached:
+                attached[dest] = f"d{len(attached)}"
+                con.execute(f"ATTACH DATABASE ? AS {attached[dest]}", (dest,))
+            alias = attached[dest]
+            while True:
+                # Mỗi chunk 1 transaction trên cả 2 file (ghi + xoá cùng commit)
+                con.execute("BEGIN IMMEDIATE")
+                try:
+                    hi = con.execute("SELECT MAX(id) FROM (SELECT id FROM main.logs WHERE device IS ? "
+                                     "ORDER BY id LIMIT ?)", (device, CHUNK)).fetchone()[0]
+                    if hi is None:
+                        con.execute("COMMIT")
+                        break
+                    # Trùng (device, device_ts) ở shard đích = đã chuyển ở lần chạy bị ngắt trước
+                    con.execute(f"INSERT OR IGNORE INTO {alias}.logs({LOG_COLUMNS}) SELECT {LOG_COLUMNS} "
+                                f"FROM main.logs WHERE device IS ? AND id <= ? ORDER BY id", (device, hi))
+                    cur = con.execute("DELETE FROM main.logs WHERE device IS ? AND id <= ?", (device, hi))
+                    con.execute("COMMIT")
+                except Exception:
+                    con.execute("ROLLBACK")
+                    raise
+                moved += cur.rowcount
+    finally:
+        con.close()
+    return moved
+
+
+def reshard(db_path, shards):
+    """
+    Đổi số shard: tạo file mới, chuyển dòng logs về đúng file, ghi layout
+
+    Chạy khi server / ingest_worker đã dừng (process đang chạy giữ layout cũ).
+    Chạy lại sau khi bị ngắt sẽ tiếp tục phần còn thiếu.
+
+    Returns:
+        số dòng đã chuyển
+    """
+    import migrations   # chỉ cần khi tạo shard (code đọc logs không kéo theo)
+
+    migrations.migrate(db_path)
+    new = shard_paths(db_path, shards)
+    old = read_layout(db_path)
+    for path in new:
+        migrations.migrate(path)
+    target = Storage(db_path, new)
+    moved = 0
+    # tuoi.db (dữ liệu trước khi chia) + shard cũ + shard mới (đổi N thì thiết bị đổi file)
+    for source in dict.fromkeys([db_path] + old + new):
+        if os.path.exists(source):
+            n = _move_rows(source, target)
+            if n:
+                log.info("📦 Chuyển logs", extra=fields(source=source, rows=n))
+            moved += n
+    _write_layout(db_path, new)
+    for path in set(old) - set(new):
+        log.info("ℹ️ Shard cũ không còn dùng (đã trống, có thể xoá)", extra=fields(path=path))
+    return moved
+
+
+def ensure(db_path, shards):
+    """
+    Lúc khởi động (init_db): đúng layout TUOI_SHARDS thì mở, DB chưa có logs
+    thì tạo layout mới; còn lại giữ layout cũ + cảnh báo (phải chạy reshard)
+    """
+    import migrations
+
+    paths = read_layout(db_path)
+    if len(paths) == (shards if shards > 1 else 0):
+        for path in paths:
+            migrations.migrate(path)
+        return Storage(db_path, paths)
+    if not Storage(db_path, paths).fan_out("SELECT 1 FROM logs LIMIT 1"):
+        reshard(db_path, shards)
+        return Storage(db_path)
+    log.warning("⚠️ TUOI_SHARDS=%s nhưng DB đang có %s shard: chạy `python storage.py --shards %s` "
+                "khi server dừng", shards, len(paths) or 1, shards)
+    return Storage(db_path, paths)
+
+
+def status(db_path):
+    """[(file, số dòng logs)]"""
+    rows = []
+    for path in Storage(db_path).sources():
+        con = _open(path, readonly=True)
+        rows.append((path, con.execute("SELECT COUNT(*) FROM logs").fetchone()[0]))
+        con.close()
+    return rows
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+def main(argv=None):
+    import settings
+
+    ap = argparse.ArgumentParser(description='Chia logs ra nhiều file SQLite (shard)')
+    ap.add_argument('--db', default=settings.DB)
+    ap.add_argument('--shards', type=int, help='số shard mới (1 = gộp về 1 file)')
+    ap.add_argument('--status', action='store_true', help='chỉ in layout hiện tại')
+    args = ap.parse_args(argv)
+
+    if args.shards is not None and not args.status:
+        moved = reshard(args.db, args.shards)
+        print(f"✅ {max(args.shards, 1)} shard, đã chuyển {moved} dòng logs")
+    for path, count in status(args.db):
+        print(f"🗄️ {path}: {count} dòng")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
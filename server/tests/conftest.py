@@ -0,0 +1,26 @@
+import os
+import sys
+import time
+
+import pytest
+
+# Chạy test không cần mạng: không gửi Telegram, không bật MQTT / scheduler
+os.environ["TELEGRAM_TOKEN"] = "YOUR_BOT_TOKEN"
+os.environ["TUOI_START_SERVICES"] = "0"
+os.environ.setdefault("TUOI_LOG_LEVEL", "WARNING")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def vietnam():
+    """Múi giờ địa phương = Asia/Ho_Chi_Minh (UTC+7) trong 1 test"""
+    old = os.environ.get('TZ')
+    os.environ['TZ'] = 'Asia/Ho_Chi_Minh'
+    time.tzset()
+    yield
+    if old is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = old
+    time.tzset()
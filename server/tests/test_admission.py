@@ -0,0 +1,128 @@
+import pytest
+
+from admission import Admission, TokenBucket, hint_payload
+
+
+class Clock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=2, burst=3, now=0.0)
+    assert [bucket.take(0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(0.0) == pytest.approx(0.5)      # 1 token / 0.5 giây
+    assert bucket.take(0.25) == pytest.approx(0.25)
+    assert bucket.take(0.5) == 0.0
+    # Nạp lại không vượt burst
+    bucket.take(100.0)
+    assert bucket.tokens == pytest.approx(2.0)
+
+
+def test_admit_throttles_per_device():
+    clock = Clock()
+    gate = Admission(rate=1, burst=2, interval=0.5, clock=clock)
+    assert gate.admit('noisy').ok and gate.admit('noisy').ok
+    decision = gate.admit('noisy')
+    assert not decision.ok and decision.reason == 'throttled'
+    assert decision.retry_after == pytest.approx(1.0)
+    # Gợi ý giãn nhịp theo đúng rate
+    assert decision.report_interval == 1.0
+    # Thiết bị khác không bị ảnh hưởng
+    decision = gate.admit('normal')
+    assert decision.ok and decision.report_interval == 0.5
+
+    clock.now = 1.0
+    assert gate.admit('noisy').ok
+
+
+def test_admit_unlimited_when_rate_zero():
+    gate = Admission(rate=0, clock=Clock())
+    assert all(gate.admit('esp').ok for _ in range(1000))
+    assert gate.stats()['devices'] == 0
+
+
+def test_bucket_lru_is_bounded():
+    gate = Admission(rate=1, burst=1, max_devices=3, clock=Clock())
+    for i in range(10):
+        gate.admit(f'fake-{i}')
+    assert gate.stats()['devices'] == 3
+    # Bucket cũ bị bỏ -> thiết bị đó có lại burst đầy
+    assert gate.admit('fake-0').ok
+
+
+def test_acquire_is_bounded_and_non_blocking():
+    gate = Admission(concurrency=2, interval=1.0, clock=Clock())
+    assert [gate.acquire() for _ in range(3)] == [True, True, False]
+    assert gate.load() == 1.0
+    decision = gate.overloaded()
+    assert not decision.ok and decision.reason == 'overloaded'
+    assert decision.retry_after == 1.0
+    # Server gần đầy -> gợi ý chu kỳ gấp đôi
+    assert decision.report_interval == 2.0
+    gate.release()
+    assert gate.acquire()
+    assert [Admission(concurrency=0).acquire() for _ in range(100)] == [True] * 100
+
+
+def test_alert_and_hint_cooldown():
+    clock = Clock()
+    gate = Admission(rate=1, burst=1, alert_cooldown=300, clock=clock)
+    assert gate.alert_allowed('esp', 'low_soil')
+    assert not gate.alert_allowed('esp', 'low_soil')
+    assert gate.alert_allowed('esp', 'disconnect')
+
+    gate.admit('esp')
+    decision = gate.admit('esp')
+    assert gate.hint_due('esp', decision) and not gate.hint_due('esp', decision)
+    clock.now = 301
+    assert gate.alert_allowed('esp', 'low_soil')
+    assert gate.hint_due('esp', decision)
+    assert hint_payload(decision) == {'report_interval': 1.0, 'retry_after': 1.0, 'reason': 'throttled'}
+
+
+@pytest.fixture
+def client(tmp_path):
+    import app
+    flask_app = app.create_app({'TUOI_DB': str(tmp_path / 'tuoi.db'), 'TUOI_START_SERVICES': False})
+    gate = app.gate
+    saved = {k: getattr(gate, k) for k in ('rate', 'burst', 'concurrency', 'interval', 'clock')}
+    clock = Clock()
+    gate.configure(rate=1, burst=2, concurrency=4, interval=1.0, clock=clock)
+    yield flask_app.test_client(), gate, clock
+    gate.configure(**saved)
+
+
+def test_api_report_429_when_throttled(client):
+    client, gate, clock = client
+    report = lambda device: client.post('/api/report', json={'device': device, 'soil': 55, 'pump': 0})
+    assert [report('esp-1').status_code for _ in range(2)] == [200, 200]
+
+    response = report('esp-1')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert response.get_json() == {'status': 'throttled', 'reason': 'throttled',
+                                   'retry_after': 1.0, 'report_interval': 1.0}
+    assert report('esp-2').status_code == 200
+    assert gate.in_flight == 0      # slot đã trả, kể cả khi bị từ chối
+
+    clock.now = 1.0
+    assert report('esp-1').status_code == 200
+
+
+def test_api_report_429_when_overloaded(client):
+    client, gate, _ = client
+    held = [gate.acquire() for _ in range(4)]
+    try:
+        response = client.post('/api/report', json={'device': 'esp-1', 'soil': 55})
+        assert response.status_code == 429
+        assert response.get_json()['status'] == 'overloaded'
+        assert response.get_json()['report_interval'] == 2.0
+    finally:
+        for _ in held:
+            gate.release()
+    response = client.post('/api/report', json={'device': 'esp-1', 'soil': 55})
+    assert response.status_code == 200 and gate.in_flight == 0
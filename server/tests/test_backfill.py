@@ -0,0 +1,146 @@
+import time
+
+import pytest
+
+import backfill
+import migrations
+import storage
+
+START = int(time.time()) - 3600
+
+
+def reading(i, soil=40.0, **extra):
+    return dict({'ts': START + i * 10, 'soil': soil, 'pump': 0, 'auto': 1, 'wifi_rssi': -60}, **extra)
+
+
+def rows_of(store):
+    return sorted(store.fan_out('SELECT device, device_ts, soil, pump FROM logs'))
+
+
+def upsert(store, device, readings):
+    rows, rejected = backfill.normalize(readings)
+    con = store.connect(device)
+    try:
+        stats, applied = backfill.upsert(con, device, rows)
+    finally:
+        con.close()
+    return stats, applied, rejected
+
+
+@pytest.fixture
+def store(tmp_path):
+    db = str(tmp_path / 'tuoi.db')
+    migrations.migrate(db)
+    s = storage.ensure(db, 1)
+    yield s
+    s.close()
+
+
+def test_normalize_rejects_bad_readings_and_keeps_last_duplicate():
+    rows, rejected = backfill.normalize([
+        reading(2),
+        reading(1, soil=30.0),
+        reading(1, soil=35.0),            # trùng ts trong lô -> giữ bản cuối
+        {'soil': 40},                     # thiếu ts
+        reading(3, soil=120),             # soil ngoài [0, 100]
+        reading(4, soil='abc'),
+        {'ts': 1000000000, 'soil': 40},   # trước khi đồng bộ NTP
+        {'ts': time.time() + 3600, 'soil': 40},
+        'not a dict',
+    ])
+    assert rejected == 6
+    assert [r[1] for r in rows] == [35.0, 40.0]
+    assert [r[0] for r in rows] == [(START + 10) * 1000, (START + 20) * 1000]
+
+
+def test_parse_ts_accepts_seconds_ms_and_iso():
+    ms = START * 1000
+    assert backfill.parse_ts(START) == ms
+    assert backfill.parse_ts(ms) == ms
+    iso = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(START))
+    assert backfill.parse_ts(iso) == ms
+
+
+def test_resend_is_idempotent(store):
+    batch = [reading(i, soil=40.0 + i) for i in range(20)]
+    stats, applied, _ = upsert(store, 'esp-1', batch)
+    assert stats == {'inserted': 20, 'updated': 0, 'duplicates': 0}
+    assert len(applied) == 20
+    before = rows_of(store)
+
+    stats, applied, _ = upsert(store, 'esp-1', batch)
+    assert stats == {'inserted': 0, 'updated': 0, 'duplicates': 20}
+    assert applied == []
+    assert rows_of(store) == before
+
+
+def test_same_ts_other_device_is_new_row(store):
+    upsert(store, 'esp-1', [reading(0)])
+    stats, _, _ = upsert(store, 'esp-2', [reading(0)])
+    assert stats['inserted'] == 1
+    assert len(rows_of(store)) == 2
+
+
+def test_changed_value_updates_row(store):
+    upsert(store, 'esp-1', [reading(i) for i in range(5)])
+    stats, applied, _ = upsert(store, 'esp-1', [reading(2, soil=55.0), reading(3), reading(5)])
+    assert stats == {'inserted': 1, 'updated': 1, 'duplicates': 1}
+    assert [r[1] for r in applied] == [55.0, 40.0]
+    rows = rows_of(store)
+    assert len(rows) == 6
+    assert rows[2] == ('esp-1', (START + 20) * 1000, 55.0, 0)
+
+
+def test_rejected_readings_are_not_written(store):
+    stats, _, rejected = upsert(store, 'esp-1', [reading(0), reading(1, soil=-5), {'ts': 'yesterday'}])
+    assert rejected == 2
+    assert stats['inserted'] == 1
+    assert len(rows_of(store)) == 1
+
+
+@pytest.fixture(params=['app', 'ingest_worker'])
+def append_bulk(request, tmp_path):
+    """Hàm ghi lô qua đường thật (nén bật sẵn), trả về (stats, logs)"""
+    db = str(tmp_path / 'tuoi.db')
+    if request.param == 'app':
+        import app
+        app.create_app({'TUOI_DB': db, 'TUOI_START_SERVICES': False})
+        write = app.append_bulk
+    else:
+        import sqlite3
+        from ingest_worker import IngestWorker
+        from local_broker import LocalBroker
+        migrations.migrate(db)
+        worker = IngestWorker(db, LocalBroker().client('ingest-test'), deviation=0.5)
+
+        def write(device, readings):
+            con = sqlite3.connect(db, isolation_level=None)
+            try:
+                return worker._bulk(con, device, {'readings': readings, 'batch': None})
+            finally:
+                con.close()
+
+    def logs():
+        s = storage.Storage(db)
+        try:
+            return sorted(s.fan_out('SELECT device, device_ts, soil FROM logs'))
+        finally:
+            s.close()
+    return write, logs
+
+
+def test_rechunked_resend_keeps_row_set(append_bulk):
+    write, logs = append_bulk
+    # Độ ẩm giảm đều: bộ nén theo lô sẽ bỏ phần lớn điểm giữa
+    readings = [reading(i, soil=60 - 0.05 * i) for i in range(51)]
+    stats = write('esp-1', readings)
+    assert stats['inserted'] == 51
+    before = logs()
+    assert len(before) == 51
+
+    # Gửi lại theo các lô chồng lấn, cắt khác lần đầu
+    for lo, hi in ((0, 7), (5, 30), (29, 51), (10, 12), (40, 51)):
+        stats = write('esp-1', readings[lo:hi])
+        assert stats['inserted'] == 0 and stats['updated'] == 0
+        assert stats['duplicates'] == hi - lo
+    assert logs() == before
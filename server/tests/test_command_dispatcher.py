@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+from command_dispatcher import CommandDispatcher, STATE_TOPIC, ACK_TOPIC, ACK_WILDCARD
+from local_broker import LocalBroker
+
+
+@pytest.fixture
+def broker():
+    return LocalBroker()
+
+
+@pytest.fixture
+def dispatcher(broker, tmp_path):
+    server = broker.client('server')
+    d = CommandDispatcher(str(tmp_path / 'tuoi.db'), publish=server.publish)
+    d.init_db()
+    server.on_message = lambda c, u, m: d.handle_ack(m.topic.split('/')[1], m.payload)
+    server.subscribe(ACK_WILDCARD, 1)
+    return d
+
+
+def state_msgs(broker):
+    return [(t, json.loads(p)) for t, p, qos, retain in broker.published if t.endswith('/state')]
+
+
+def device(broker, name, ack=True):
+    """Thiết bị giả: ghi lại state nhận được, trả ACK nếu ack=True"""
+    dev = broker.client(name)
+    dev.received = []
+
+    def on_message(client, userdata, msg):
+        state = json.loads(msg.payload)
+        dev.received.append(state)
+        if ack:
+            client.publish(ACK_TOPIC.format(device=name), json.dumps({'seq': state['seq']}), 1)
+
+    dev.on_message = on_message
+    dev.subscribe(STATE_TOPIC.format(device=name), 1)
+    return dev
+
+
+def test_state_retained_per_device_and_only_on_change(broker, dispatcher):
+    dispatcher.register_device('zone-1')
+    dispatcher.register_device('zone-2')
+
+    assert dispatcher.set_state(['zone-1'], pump_cmd=1) == ['zone-1']
+    retained = json.loads(broker.retained(STATE_TOPIC.format(device='zone-1')))
+    assert retained['pump_cmd'] == 1 and retained['seq'] == 2
+    assert json.loads(broker.retained(STATE_TOPIC.format(device='zone-2')))['pump_cmd'] == 0
+
+    before = len(broker.published)
+    assert dispatcher.set_state(['zone-1'], pump_cmd=1) == []
+    assert len(broker.published) == before
+    assert all(retain for t, p, qos, retain in broker.published if t.endswith('/state'))
+
+    # Thiết bị kết nối sau vẫn nhận ngay trạng thái mới nhất (retained)
+    late = device(broker, 'zone-1')
+    assert [s['seq'] for s in late.received] == [2]
+
+
+def test_group_and_broadcast_fan_out(broker, dispatcher):
+    for i in range(3):
+        dispatcher.register_device(f'rau-{i}', group='vuon-rau')
+    dispatcher.register_device('hoa-0', group='vuon-hoa')
+    devs = {name: device(broker, name) for name in ('rau-0', 'rau-1', 'rau-2', 'hoa-0')}
+
+    assert sorted(dispatcher.set_group('vuon-rau', pump_cmd=1)) == ['rau-0', 'rau-1', 'rau-2']
+    assert devs['hoa-0'].received[-1]['pump_cmd'] == 0
+    assert all(devs[f'rau-{i}'].received[-1]['pump_cmd'] == 1 for i in range(3))
+
+    # Broadcast chỉ gửi cho thiết bị có trạng thái thật sự đổi
+    assert dispatcher.broadcast(pump_cmd=1) == ['hoa-0']
+    assert [t for t, s in state_msgs(broker)][-1] == STATE_TOPIC.format(device='hoa-0')
+    assert {r['device_id']: r['group'] for r in dispatcher.devices('vuon-hoa')} == {'hoa-0': 'vuon-hoa'}
+
+
+def test_ack_tracking_and_resend(broker, dispatcher):
+    dispatcher.register_device('zone-ok')
+    dispatcher.register_device('zone-mat')
+    ok = device(broker, 'zone-ok')
+    lost = device(broker, 'zone-mat', ack=False)
+
+    dispatcher.broadcast(pump_cmd=1)
+    assert [r['device_id'] for r in dispatcher.pending()] == ['zone-mat']
+    assert {r['device_id']: r['acked'] for r in dispatcher.devices()} == {'zone-mat': False, 'zone-ok': True}
+
+    # Chưa quá timeout -> không gửi lại
+    assert dispatcher.resend_unacked() == 0
+    sent = len(lost.received)
+    assert dispatcher.resend_unacked(timeout=0) == 1
+    assert len(lost.received) == sent + 1 and lost.received[-1]['seq'] == lost.received[-2]['seq']
+    assert len(ok.received) == 2
+
+    # ACK cũ / hỏng không làm lùi acked_seq
+    assert dispatcher.handle_ack('zone-mat', json.dumps({'seq': lost.received[-1]['seq']}))
+    assert not dispatcher.handle_ack('zone-mat', json.dumps({'seq': 1}))
+    assert not dispatcher.handle_ack('zone-mat', b'not json')
+    assert dispatcher.pending() == []
+    assert dispatcher.resend_unacked(timeout=0) == 0
@@ -0,0 +1,77 @@
+import json
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import backfill
+import export
+import migrations
+import storage
+
+START = 1730000000000
+
+
+def upsert(store, device, rows):
+    con = store.connect(device)
+    try:
+        return backfill.upsert(con, device, rows)[0]
+    finally:
+        con.close()
+
+
+@pytest.fixture(params=[1, 2], ids=['1-file', '2-shards'])
+def store(request, tmp_path):
+    db = str(tmp_path / 'tuoi.db')
+    migrations.migrate(db)
+    s = storage.ensure(db, request.param)
+    yield s
+    s.close()
+
+
+def test_database_in_wal_mode(store):
+    for path in store.sources():
+        con = sqlite3.connect(path)
+        assert con.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        con.close()
+
+
+def test_correction_during_export_keeps_snapshot(store):
+    readings = [(START + i * 1000, 40.0 + i, 0, 1, -60) for i in range(5)]
+    upsert(store, 'esp-1', readings)
+    upsert(store, 'esp-2', readings[:2])
+
+    chunks = export.Export(store, chunk=2).chunks()
+    first = next(chunks)
+    # Bulk backfill sửa reading thứ 4 (DELETE + INSERT -> id mới) và thêm reading mới giữa 2 chunk
+    stats = upsert(store, 'esp-1', [(START + 3000, 99.0, 1, 1, -60), (START + 9000, 50.0, 0, 1, -60)])
+    assert stats['updated'] == 1 and stats['inserted'] == 1
+    rows = first + [row for chunk in chunks for row in chunk]
+
+    assert [(r[0], r[2], r[3]) for r in rows] == \
+        [('esp-1', ts, soil) for ts, soil, *_ in readings] + [('esp-2', ts, soil) for ts, soil, *_ in readings[:2]]
+
+    # Phiên sau thấy bản sửa
+    after = [row for chunk in export.Export(store, ['esp-1']).chunks() for row in chunk]
+    assert [r[3] for r in after] == [40.0, 41.0, 42.0, 99.0, 44.0, 50.0]
+
+
+def test_formats(store):
+    upsert(store, 'esp-1', [(START, 40.0, 0, 1, -60)])
+    csv = b''.join(export.stream(export.Export(store), 'csv')).decode().splitlines()
+    assert csv[0] == ','.join(export.COLUMNS) and csv[1].startswith('esp-1,')
+    assert b'"soil": 40.0' in b''.join(export.stream(export.Export(store), 'ndjson'))
+
+
+def test_ts_is_local_time_with_offset(vietnam, store):
+    start = export.parse_time('2025-11-01T06:00')            # giờ VN, như ?start= của API
+    upsert(store, 'esp-1', [(start, 40.0, 0, 1, -60)])
+    row = next(iter(export.Export(store).chunks()))[0]
+    assert row[1] == '2025-11-01T06:00:00.000+07:00'
+    assert export.parse_time(row[1]) == row[2] == start
+    # Cùng giờ trên đồng hồ với /api/logs (datetime.fromtimestamp, không offset)
+    assert row[1].startswith(datetime.fromtimestamp(start / 1000).isoformat())
+
+    line = b''.join(export.stream(export.Export(store), 'ndjson')).decode()
+    assert json.loads(line)['ts'] == row[1]
+    assert row[1] in b''.join(export.stream(export.Export(store), 'csv')).decode()
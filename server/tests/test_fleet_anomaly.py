@@ -0,0 +1,62 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import migrations
+import storage
+from analytics import Analytics
+from command_dispatcher import CommandDispatcher
+from ml_models.fleet_anomaly import FleetAnomalyDetector
+
+NOW = 1730000000
+
+
+def row(device, ts, soil=40.0):
+    return (int(ts * 1000), soil, 0, 1, 1, -60, device, None)
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = str(tmp_path / 'tuoi.db')
+    migrations.migrate(db)
+    CommandDispatcher(db).init_db()
+    con = sqlite3.connect(db)
+    con.executemany("INSERT INTO device_state(device_id, group_name) VALUES(?, 'vuon-1')",
+                    [('esp-old',), ('esp-live',), ('esp-new',)])
+    con.commit()
+    con.close()
+    s = storage.ensure(db, 1)
+    start = NOW - 3600
+    s.insert([
+        row('esp-old', start - 7200), row('esp-old', start - 600),   # chỉ có report trước cửa sổ
+        row('esp-live', start - 300), row('esp-live', NOW - 30),
+        row('esp-new', NOW - 120),                                  # thiết bị mới trong cửa sổ
+    ])
+    s.close()
+    return db
+
+
+@pytest.fixture(params=['sqlite', 'duckdb'])
+def detector(request, db):
+    analytics = Analytics(db, retention_days=100000) if request.param == 'duckdb' else None
+    return FleetAnomalyDetector(db, analytics=analytics)
+
+
+def test_last_report_before_window_seeds_seen(detector):
+    m = detector.load_matrix(hours=1, now=NOW)
+    seen = dict(zip(m.devices, m.seen))
+    # esp-old mất kết nối từ trước cửa sổ: seen = report cuối, không phải -inf
+    assert np.all(seen['esp-old'] == NOW - 3600 - 600)
+    assert seen['esp-live'][0] == NOW - 3600 - 300 and seen['esp-live'][-1] == NOW - 30
+    assert np.isneginf(seen['esp-new'][0]) and seen['esp-new'][-1] == NOW - 120
+
+
+def test_single_grouped_query_for_last_report(db, monkeypatch):
+    # Không quét MAX(ts_ms) lại cho từng thiết bị, cùng nguồn (DuckDB) với lần quét chính
+    detector = FleetAnomalyDetector(db, analytics=Analytics(db, retention_days=100000))
+    calls = []
+    query = detector.analytics.query
+    monkeypatch.setattr(detector.analytics, 'query', lambda sql, params=(): calls.append(sql) or query(sql, params))
+    detector.load_matrix(hours=1, now=NOW)
+    assert len(calls) == 2 and 'GROUP BY device' in calls[1]
@@ -0,0 +1,179 @@
+import numpy as np
+import pytest
+
+from ml_models.feature_store import HOURLY_FEATURES
+from ml_models.forecasters import (
+    PUMP, SOIL, TIERS, Forecaster, Persistence, ZoneForecaster,
+    backtest, error_paths, horizon_errors, to_predictions, watering_recommendation,
+)
+
+START = 1730000000
+
+
+def hourly(soil, pump=None):
+    """Ma trận HOURLY_FEATURES từ chuỗi độ ẩm theo giờ"""
+    soil = np.asarray(soil, dtype=np.float64)
+    X = np.zeros((len(soil), len(HOURLY_FEATURES)))
+    X[:, SOIL] = soil
+    X[:, PUMP] = 0 if pump is None else pump
+    X[:, HOURLY_FEATURES.index('hour')] = np.arange(len(soil)) % 24
+    return X
+
+
+class Features:
+    """FeatureStore giả: trả thẳng ma trận theo giờ"""
+
+    def __init__(self, X):
+        self.X = X
+
+    def hourly(self, device=None, days=14):
+        return START + np.arange(len(self.X)) * 3600, self.X
+
+
+def offset_model(name, cost, offset):
+    """Model giả: luôn dự đoán giá trị cuối + offset -> MAE = offset trên chuỗi phẳng"""
+    def forecast(self, X, horizon=24):
+        return np.full(horizon, X[-1, SOIL] + offset)
+    return type(name, (Forecaster,), {'name': name, 'cost': cost, 'forecast': forecast})
+
+
+FAKE = (offset_model('cheap', 0, 3.0), offset_model('mid', 1, 1.0), offset_model('dear', 2, 0.5))
+
+
+def test_select_cheapest_model_meeting_target():
+    choice = ZoneForecaster(Features(None), target_mae=2.0, tiers=FAKE).select(hourly(np.full(200, 50.0)))
+    assert choice.name == 'mid'
+    assert choice.mae == pytest.approx(1.0)
+    # Dừng ở model đầu tiên đạt target: không backtest model đắt hơn
+    assert choice.scores == {'cheap': 3.0, 'mid': 1.0}
+
+
+def test_select_lowest_mae_when_none_meets_target():
+    choice = ZoneForecaster(Features(None), target_mae=0.1, tiers=FAKE).select(hourly(np.full(200, 50.0)))
+    assert choice.name == 'dear'
+    assert choice.scores == {'cheap': 3.0, 'mid': 1.0, 'dear': 0.5}
+
+
+def test_select_real_tiers_on_drying_curve():
+    # Khô đều 0.3%/giờ, không bơm: persistence lệch nhiều nhất, Holt (trend tắt dần)
+    # đạt target lỏng, DryingCurve khớp đúng nhưng chỉ được xét khi target chặt hơn
+    X = hourly(90 - 0.3 * np.arange(150))
+    choice = ZoneForecaster(Features(X), target_mae=3.0).select(X)
+    assert choice.name == 'holt'
+    assert choice.scores['persistence'] > 3.0 >= choice.scores['holt']
+    assert 'drying_curve' not in choice.scores
+    choice = ZoneForecaster(Features(X), target_mae=1.0).select(X)
+    assert choice.name == 'drying_curve' and choice.mae < 0.01
+    assert 'lag_boosting' not in choice.scores
+
+
+def test_short_history_falls_back_to_cheapest_usable_model():
+    X = hourly(np.linspace(60, 55, 10))      # 10 giờ: chưa đủ cho mốc backtest 24 giờ nào
+    forecaster = ZoneForecaster(Features(X), target_mae=1.0)
+    choice = forecaster.select(X)
+    assert choice.name == 'persistence'
+    assert choice.mae is None and choice.errors is None
+    assert set(choice.scores) == {'persistence', 'holt'}   # min_rows: DryingCurve / LagBoosting bị loại
+    assert all(v is None for v in choice.scores.values())
+
+    values, paths = forecaster.forecast_paths('zone-1')
+    assert paths is None
+    assert np.all(values == 55.0)
+    assert forecaster.describe('zone-1')['mae'] is None
+
+
+def test_backtest_mae_and_skips_short_windows():
+    X = hourly(90 - 0.5 * np.arange(100))
+    # Persistence trên chuỗi khô đều: sai số giờ h = 0.5h -> MAE = 0.5 * 12.5
+    assert backtest(Persistence, X, origins=3) == pytest.approx(6.25)
+    assert backtest(Persistence, X[:20]) is None
+
+    # Bơm ngay giờ thứ 2 sau mốc cuối: < 3 giờ không bơm -> bỏ mốc đó; mốc trước
+    # (sớm hơn 11 giờ) chỉ chấm 12 giờ trước lần bơm -> MAE = 0.5 * 6.5
+    pump = np.zeros(100)
+    pump[100 - 24 + 1] = 1
+    errors = []
+    assert backtest(Persistence, hourly(X[:, SOIL], pump), origins=2, paths=errors) == pytest.approx(3.25)
+    assert len(errors) == 1 and np.isnan(errors[0][12:]).all()
+
+
+def test_horizon_errors_and_error_paths_after_pump():
+    pump = np.zeros(24)
+    pump[5] = 1
+    actual = hourly(np.arange(24, dtype=float), pump)
+    errors = horizon_errors(np.full(24, 10.0), actual)
+    assert np.allclose(errors[:5], 10 - np.arange(5))
+    assert np.all(np.isnan(errors[5:]))
+
+    paths = error_paths([errors, np.ones(24)])
+    assert paths.shape == (2, 24)
+    # Sau lần bơm: giữ sai số cuối cùng đã biết
+    assert np.all(paths[0, 4:] == 6.0) and np.all(paths[1] == 1.0)
+    assert error_paths([]) is None
+
+
+def paths_with(low_fraction, n=10):
+    """n đường: `low_fraction` đường xuống 35% (WATER_NOW), còn lại ở 70% (NO_WATER)"""
+    low = int(round(low_fraction * n))
+    return np.vstack([np.full(24, 35.0)] * low + [np.full(24, 70.0)] * (n - low))
+
+
+def recommend(paths, previous=None):
+    values = np.median(paths, axis=0)
+    return watering_recommendation(to_predictions(values, paths), paths, previous=previous)['action']
+
+
+def test_hysteresis_keeps_previous_action_near_threshold():
+    # 60% đường dưới 40%: đủ cho WATER_NOW khi chưa có lịch sử ...
+    assert recommend(paths_with(0.6)) == 'WATER_NOW'
+    # ... nhưng chưa đủ chắc (< 0.5 + margin) để đổi từ NO_WATER
+    assert recommend(paths_with(0.6), previous='NO_WATER') == 'NO_WATER'
+    assert recommend(paths_with(0.8), previous='NO_WATER') == 'WATER_NOW'
+    # Chiều ngược lại cũng vậy
+    assert recommend(paths_with(0.4), previous='WATER_NOW') == 'WATER_NOW'
+    assert recommend(paths_with(0.2), previous='WATER_NOW') == 'NO_WATER'
+
+
+def test_single_path_ignores_previous_action():
+    predictions = to_predictions(np.full(24, 35.0))
+    assert watering_recommendation(predictions, previous='NO_WATER')['action'] == 'WATER_NOW'
+
+
+def test_recommendation_history_is_per_device():
+    forecaster = ZoneForecaster(Features(hourly(np.full(200, 70.0))), target_mae=1.0, tiers=TIERS[:1])
+    assert forecaster.get_watering_recommendation(device='zone-1')['action'] == 'NO_WATER'
+    assert forecaster._actions == {'zone-1': 'NO_WATER'}
+
+
+class FakeLSTM:
+    """SoilMoistureLSTM giả, model không có Dropout (predict_paths không có đường MC)"""
+
+    sequence_length = 24
+    model_version = 'lstm-fake'
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+
+    def forecast(self, X, horizon=24):
+        return np.full(horizon, X[-1, SOIL] + 0.05)
+
+    def predict_paths(self, hourly=None, device=None):
+        return np.full(24, 50.05), None
+
+
+def test_lstm_without_dropout_uses_backtest_error_bands(tmp_path):
+    path = tmp_path / 'lstm_best.h5'
+    X = hourly(np.full(200, 50.0))
+    forecaster = ZoneForecaster(Features(X), target_mae=0.1, lstm=FakeLSTM(str(path)), tiers=FAKE)
+    # Chưa có file model trong model_dir -> không có tier lstm
+    assert forecaster.select(X).name == 'dear'
+
+    path.write_bytes(b'')
+    forecaster.forecast('zone-1')
+    assert forecaster.describe('zone-1')['name'] == 'lstm'
+    predictions = forecaster.predict_next_24h(hourly=object(), device='zone-1')
+    assert predictions[0]['predicted_soil'] == 50.05
+    # Dải không co về 1 đường: dự đoán trừ sai số backtest (+0.05) của LSTM
+    assert predictions[0]['p10'] == predictions[0]['p90'] == 50.0
+    rec = forecaster.get_watering_recommendation(hourly=object(), device='zone-1')
+    assert rec['action'] == 'NO_WATER' and rec['confidence'] == 1.0
@@ -0,0 +1,96 @@
+import json
+import time
+import sqlite3
+
+import pytest
+
+import migrations
+from admission import Admission
+from command_dispatcher import CommandDispatcher
+from ingest_worker import IngestWorker, REPORT_TOPIC, decode
+from local_broker import LocalBroker
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / 'tuoi.db')
+    migrations.migrate(path)
+    CommandDispatcher(path).init_db()
+    return path
+
+
+def worker(db, broker, name, **kwargs):
+    kwargs.setdefault('gate', Admission(rate=0))
+    w = IngestWorker(db, broker.client(name, manual_ack=True), name=name, **kwargs).start()
+    w.subscribe()
+    return w
+
+
+def report(broker, device, **fields):
+    broker.client(device).publish(REPORT_TOPIC, json.dumps(dict(device=device, pump=0, auto=1, **fields)), qos=1)
+
+
+def logs(db):
+    con = sqlite3.connect(db)
+    rows = con.execute("SELECT device, ts_ms, soil, device_ts FROM logs ORDER BY device, ts_ms").fetchall()
+    con.close()
+    return rows
+
+
+def test_report_without_ts_gets_dedup_key():
+    point = decode(REPORT_TOPIC, b'{"device": "esp-1", "soil": 40}', received=1000.7, interval=1)[2]
+    assert point[0] == 1000.7 and point[5] == 1000000
+    # Giao lại trong cùng chu kỳ report -> cùng khoá
+    assert decode(REPORT_TOPIC, b'{"device": "esp-1", "soil": 40}', received=1000.2, interval=1)[2][5] == 1000000
+
+
+def test_redelivery_between_two_workers_no_loss_no_duplicate(db):
+    broker = LocalBroker()
+    # interval lớn: report không `ts` giao lại vẫn cùng khoá dù tới muộn
+    a = worker(db, broker, 'ingest-a', deviation=0, interval=3600)
+    b = worker(db, broker, 'ingest-b', deviation=0, interval=3600)
+    # Worker a ghi DB nhưng PUBACK không tới broker, rồi rớt mạng
+    a.client.ack = lambda mid, qos: None
+
+    start = int(time.time()) - 100
+    devices, readings = 4, 20
+    for n in range(readings):
+        for d in range(devices):
+            report(broker, f'esp-{d}', ts=start + n, soil=50 + n % 7)
+        if n == readings // 2:
+            for d in range(devices):
+                report(broker, f'esp-{d}', soil=10)   # firmware cũ, không có ts
+            a.drain()
+            a.client.disconnect()
+    for w in (a, b):
+        w.drain()
+        w.stop()
+
+    rows = logs(db)
+    assert a.stats['reports'] > 0 and b.stats['reports'] == devices * (readings + 1)
+    assert len(rows) == devices * (readings + 1)
+    assert len({(device, device_ts) for device, _, _, device_ts in rows}) == len(rows)
+    assert b.client._inflight == {}
+
+
+def test_held_point_survives_crash_after_ack(db):
+    broker = LocalBroker()
+    a = worker(db, broker, 'ingest-a', deviation=0.5)
+    start = int(time.time()) - 100
+    for n in range(10):
+        report(broker, 'esp-1', ts=start + n, soil=50)
+    a.drain()
+
+    # Mọi message đã PUBACK, bộ nén chỉ ghi điểm đầu, điểm cuối đang giữ
+    assert a.client._inflight == {}
+    assert [r[1] for r in logs(db)] == [start * 1000]
+    # Process bị kill: không stop(), không flush
+    a.client.disconnect()
+
+    again = worker(db, broker, 'ingest-a', deviation=0.5)
+    again.drain()
+    again.stop()
+    assert [r[1] for r in logs(db)] == [start * 1000, (start + 9) * 1000]
+    con = sqlite3.connect(db)
+    assert con.execute("SELECT COUNT(*) FROM ingest_held").fetchone()[0] == 0
+    con.close()
@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import ml_service
+from ml_service import MLService
+
+
+@pytest.fixture
+def service(monkeypatch, tmp_path):
+    calls = []
+
+    def job_flaky(db_path, device, window=None):
+        calls.append(window)
+        if len(calls) == 1:
+            raise RuntimeError('model chưa sẵn sàng')
+        return {'device': device, 'n': len(calls)}
+
+    monkeypatch.setitem(ml_service.JOBS, 'flaky', job_flaky)
+    svc = MLService(str(tmp_path / 'tuoi.db'))
+    # Thread pool thay cho process pool spawn: job là closure, kiểm tra cache / lock
+    svc._pool = ThreadPoolExecutor(max_workers=2)
+    svc.calls = calls
+    yield svc
+    svc.shutdown()
+
+
+def test_error_not_cached_like_result(service):
+    result, error, state = service.get('flaky', 'esp32')
+    assert (result, state) == (None, 'fresh') and 'chưa sẵn sàng' in error
+
+    # Trong ERROR_TTL: trả lỗi từ cache, không dồn job
+    assert service.get('flaky', 'esp32')[1:] == (error, 'cached')
+    assert len(service.calls) == 1
+
+    service.ERROR_TTL = 0
+    result, error, state = service.get('flaky', 'esp32')
+    assert (result, error, state) == ({'device': 'esp32', 'n': 2}, None, 'fresh')
+
+    # Kết quả đúng thì giữ tới khi có dữ liệu mới
+    assert service.get('flaky', 'esp32')[2] == 'cached'
+    assert len(service.calls) == 2
+
+
+def test_window_built_outside_lock(service):
+    seen = []
+
+    def data():
+        # Request khác (thread khác) trong lúc đang dựng window -> không bị chặn
+        other = threading.Thread(target=service.get, args=('flaky', 'khac'))
+        other.start()
+        other.join(timeout=2)
+        seen.append(not other.is_alive())
+        return [1, 2, 3]
+
+    service.get('flaky', 'esp32', data=data)
+    assert seen == [True]
+    assert [1, 2, 3] in service.calls
+
+
+def test_new_data_invalidates_after_debounce(service):
+    service.ERROR_TTL = 0
+    service.get('flaky', 'esp32')                 # lần 1 lỗi, không giữ
+    assert service.get('flaky', 'esp32')[0]['n'] == 2
+
+    # Có dữ liệu mới nhưng kết quả còn trong khoảng debounce -> dùng cache
+    service.min_refresh = 60
+    service.notify_new_data()
+    assert service.get('flaky', 'esp32')[2] == 'cached'
+
+    # Hết debounce -> tính lại ngay, không đợi 60 giây
+    service.min_refresh = 0
+    result, error, state = service.get('flaky', 'esp32')
+    assert (result['n'], state) == (3, 'fresh')
+    # Không có dữ liệu mới -> giữ mãi
+    assert service.get('flaky', 'esp32')[2] == 'cached'
+    assert len(service.calls) == 3
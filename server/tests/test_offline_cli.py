@@ -0,0 +1,36 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import backtest
+import replay
+
+SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def old_db(tmp_path):
+    """Bản sao tuoi.db trong repo: schema cũ (logs chưa có ts_ms / device)"""
+    path = str(tmp_path / 'tuoi.db')
+    shutil.copy(os.path.join(SERVER, 'tuoi.db'), path)
+    con = sqlite3.connect(path)
+    assert 'ts_ms' not in [r[1] for r in con.execute("PRAGMA table_info(logs)")]
+    con.close()
+    return path
+
+
+def test_replay_migrates_old_db(old_db, capsys):
+    assert replay.main(['--db', old_db, '--top', '1', '--workers', '1']) in (0, None)
+    assert 'Trace' in capsys.readouterr().out
+
+
+def test_backtest_migrates_old_db(old_db):
+    assert backtest.main(['--db', old_db, '--models', 'holt', '--workers', '1']) in (0, 1, None)
+
+
+def test_missing_db_is_an_error(tmp_path):
+    with pytest.raises(SystemExit):
+        replay.main(['--db', str(tmp_path / 'khong-co.db')])
+    assert not os.path.exists(tmp_path / 'khong-co.db')
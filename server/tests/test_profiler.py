@@ -0,0 +1,52 @@
+import glob
+import signal
+import threading
+import time
+
+import pytest
+
+import profiler
+
+
+@pytest.fixture
+def usr2():
+    old = signal.getsignal(signal.SIGUSR2)
+    yield signal.SIGUSR2
+    signal.signal(signal.SIGUSR2, old)
+
+
+def test_signal_handler_takes_no_lock(usr2, tmp_path):
+    profiler.install_signal(usr2, str(tmp_path), seconds=0.1, hz=50)
+    handler = signal.getsignal(usr2)
+
+    # Signal tới đúng lúc đang giữ _lock (vd giữa start()) -> handler không được chờ lock
+    with profiler._lock:
+        t = threading.Thread(target=handler, args=(usr2, None))
+        t.start()
+        t.join(2)
+        assert not t.is_alive()
+
+    deadline = time.time() + 5
+    while not glob.glob(str(tmp_path / '*.json')) and time.time() < deadline:
+        time.sleep(0.05)
+    assert glob.glob(str(tmp_path / 'profile-*.collapsed'))
+    assert glob.glob(str(tmp_path / 'profile-*.json'))
+
+
+@pytest.mark.skipif(profiler._greenlet is None, reason='cần greenlet (eventlet / gevent)')
+def test_waiting_greenlets_are_sampled():
+    main = profiler._greenlet.getcurrent()
+
+    def parked():
+        main.switch()   # dừng ở đây như green thread đang chờ I/O
+
+    g = profiler._greenlet(parked)
+    g.switch()
+    session = profiler.Session(0.05, 100)
+    session.sample_loop(time.sleep, green=True)
+
+    parked_stacks = [s for s in session.stacks if s[0] == 'greenlet' and s[-1].endswith('parked')]
+    assert parked_stacks
+    # Không tự lấy mẫu thread của sampler
+    assert not any(s[-1].endswith('Session.sample_loop') for s in session.stacks)
+    g.throw(profiler._greenlet.GreenletExit)
@@ -0,0 +1,21 @@
+from datetime import datetime
+
+import migrations
+import replay
+import storage
+
+
+def test_trace_minute_is_local_time(vietnam, tmp_path):
+    db = str(tmp_path / 'tuoi.db')
+    migrations.migrate(db)
+    start = int(datetime(2025, 11, 1, 6, 30).timestamp())   # 6:30 giờ VN = 23:30 UTC
+    store = storage.Storage(db)
+    store.insert([((start + i * 60) * 1000, 50.0 - i * 0.1, 0, 1, 1, -60, 'esp32', None) for i in range(120)])
+    store.close()
+
+    trace = replay.load_trace(db, dt=60)
+    assert trace.minute_of_day[0] == 6 * 60 + 30
+    assert trace.minute_of_day[90] == 8 * 60
+    # Lịch tưới 07:00-07:10 trong replay khớp với giờ scheduler thấy
+    assert datetime.fromtimestamp(trace.t0 + 30 * 60).strftime('%H:%M') == '07:00'
+    assert trace.minute_of_day[30] == replay.hm_to_min('07:00')
@@ -0,0 +1,45 @@
+import sys
+import threading
+
+import numpy as np
+
+from ring_buffer import RingStore
+
+
+def test_window_is_view_of_latest():
+    store = RingStore(capacity=4)
+    for i in range(6):
+        store.append('esp32', float(i), 50.0 + i, 0, 1, -60)
+    w = store.window('esp32')
+    assert list(w.ts) == [2.0, 3.0, 4.0, 5.0] and list(w.soil) == [52.0, 53.0, 54.0, 55.0]
+    assert not w.ts.flags.writeable
+    assert store.latest()['soil'] == 55.0
+
+
+def test_no_torn_rows_with_concurrent_append():
+    # Đổi thread thường xuyên để reader hay bị chen giữa 2 cột
+    old = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    store = RingStore(capacity=8)
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            # soil = ts: mọi dòng đọc ra phải có 2 cột bằng nhau
+            store.append('esp32', float(i), float(i), 0, 1, -60)
+            i += 1
+
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        torn = 0
+        for _ in range(20000):
+            w = store.window('esp32', copy=True)
+            if w is not None and not np.array_equal(w.ts, w.soil):
+                torn += 1
+    finally:
+        stop.set()
+        t.join()
+        sys.setswitchinterval(old)
+    assert torn == 0
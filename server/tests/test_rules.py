@@ -0,0 +1,188 @@
+import sqlite3
+
+import pytest
+
+import migrations
+import settings
+from command_dispatcher import CommandDispatcher
+from rules import Compiled, Rule, RuleEngine, _Bucket, parse
+
+DRY = {'soil': 0.0, 'pump': 0, 'auto': 1}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / 'tuoi.db')
+    migrations.migrate(path)
+    CommandDispatcher(path).init_db()
+    con = sqlite3.connect(path)
+    con.executemany("INSERT INTO device_state(device_id, group_name) VALUES(?, ?)",
+                    [('esp-1', 'vuon-a'), ('esp-2', 'vuon-a'), ('esp-3', 'vuon-b')])
+    con.commit()
+    con.close()
+    return path
+
+
+@pytest.fixture
+def engine(db):
+    engine = RuleEngine(db, reload_interval=5, clock=Clock())
+    engine.reload(force=True)
+    return engine
+
+
+def fired(engine, device, soil, **reading):
+    return [(c.name, c.rule.scope) for c in engine.evaluate(device, dict(DRY, soil=soil, **reading))]
+
+
+def insert_rule(db, name, condition, scope='global', target='', action='alert', enabled=1, updated_ms=1):
+    con = sqlite3.connect(db)
+    with con:
+        con.execute('INSERT INTO alert_rules(name, scope, target, condition, action, enabled, updated_ms) '
+                    'VALUES(?, ?, ?, ?, ?, ?, ?)', (name, scope, target, condition, action, enabled, updated_ms))
+    con.close()
+
+
+def test_device_beats_zone_beats_global(engine):
+    engine.save({'name': 'dry', 'scope': 'zone', 'target': 'vuon-a', 'condition': 'soil < 30 and pump == 0'})
+    engine.save({'name': 'dry', 'scope': 'device', 'target': 'esp-1', 'condition': 'soil < 40'})
+
+    assert fired(engine, 'esp-1', 35) == [('dry', 'device')]
+    assert fired(engine, 'esp-1', 10) == [('dry', 'device')]      # mỗi tên tối đa 1 luật
+    assert fired(engine, 'esp-1', 45) == []
+    assert fired(engine, 'esp-2', 35) == []                       # luật zone che luật global
+    assert fired(engine, 'esp-2', 25) == [('dry', 'zone')]
+    assert fired(engine, 'esp-3', 25) == []
+    assert fired(engine, 'esp-3', 15) == [('dry', 'global')]
+    assert fired(engine, 'esp-3', 15, pump=1) == []
+
+
+def test_disabled_device_rule_hides_global(engine):
+    engine.save({'name': 'dry', 'scope': 'device', 'target': 'esp-1', 'condition': 'soil < 40', 'enabled': 0})
+    assert fired(engine, 'esp-1', 5) == []
+    assert fired(engine, 'esp-2', 5) == [('dry', 'global')]
+    # Luật khác tên vẫn chạy
+    engine.save({'name': 'very_dry', 'scope': 'global', 'condition': 'soil < 10'})
+    assert fired(engine, 'esp-1', 5) == [('very_dry', 'global')]
+
+
+def test_threshold_scopes_and_disabled_infinity(engine):
+    assert engine.control_params('esp-1') == {'soil_on': settings.SOIL_ON, 'soil_off': settings.SOIL_OFF}
+    engine.save({'name': 'pump_on', 'scope': 'zone', 'target': 'vuon-a', 'condition': 'soil < 35',
+                 'action': 'threshold'})
+    engine.save({'name': 'pump_on', 'scope': 'device', 'target': 'esp-1', 'condition': 'soil < 50',
+                 'action': 'threshold', 'enabled': 0})
+    engine.save({'name': 'pump_off', 'scope': 'device', 'target': 'esp-1', 'condition': 'soil > 70',
+                 'action': 'threshold', 'enabled': 0})
+
+    # Tắt: điều kiện 'soil < x' / 'soil > x' không bao giờ đúng
+    assert engine.threshold('esp-1', 'pump_on') == float('-inf')
+    assert engine.threshold('esp-1', 'pump_off') == float('inf')
+    assert engine.threshold('esp-2', 'pump_on') == 35
+    assert engine.threshold('esp-3', 'pump_on') == settings.SOIL_ON
+    assert engine.threshold('esp-3', 'moisture_drop') == 10
+    assert engine.threshold('esp-3', 'missing', default=7) == 7
+
+
+def test_bisect_candidates_only_reachable_rules():
+    bucket = _Bucket()
+    conditions = ['soil < 10', 'soil < 30', 'soil <= 50', 'soil > 60', 'soil >= 90',
+                  'pump == 1 and auto == 1', 'auto != 1', 'wifi_rssi < -80']
+    for condition in conditions:
+        bucket.add(Compiled(Rule(None, condition, 'global', '', condition, 'alert', 'INFO', None, 1)))
+    bucket.freeze()
+
+    def names(reading):
+        return sorted(c.name for c in bucket.candidates(reading))
+
+    # Ngưỡng bằng giá trị vẫn là ứng viên, predicate quyết định (< / <=)
+    assert names({'soil': 30}) == ['soil < 30', 'soil <= 50']
+    assert [c.name for c in bucket.match({'soil': 30}, {'soil'})] == ['soil <= 50']
+    assert names({'soil': 5}) == ['soil < 10', 'soil < 30', 'soil <= 50']
+    assert names({'soil': 50}) == ['soil <= 50']
+    assert names({'soil': 95}) == ['soil > 60', 'soil >= 90']
+    assert names({'soil': 55}) == []
+    assert names({'pump': 1}) == ['pump == 1 and auto == 1']
+    assert names({'pump': 0, 'auto': 0}) == ['auto != 1']
+    # Ứng viên rồi mới kiểm tra đủ mệnh đề: thiếu field -> không khớp
+    reading = {'pump': 1, 'soil': 70}
+    assert [c.name for c in bucket.match(reading, reading.keys())] == ['soil > 60']
+
+
+def test_hot_reload_by_signature(db, engine):
+    clock = engine.clock
+    engine.maybe_reload()                            # lần kiểm tra đầu: t = 0
+    reloads = engine.reloads
+    insert_rule(db, 'flood', 'soil > 95')
+    assert fired(engine, 'esp-1', 99) == []          # chưa tới reload_interval
+    clock.now = 5
+    assert fired(engine, 'esp-1', 99) == [('flood', 'global')]
+    assert engine.reloads == reloads + 1
+
+    clock.now = 10
+    assert not engine.maybe_reload()                 # bảng không đổi -> không biên dịch lại
+    assert engine.reloads == reloads + 1
+
+    # Sửa luật (updated_ms mới) -> chữ ký đổi
+    con = sqlite3.connect(db)
+    with con:
+        con.execute("UPDATE alert_rules SET condition='soil > 80', updated_ms=2 WHERE name='flood'")
+    con.close()
+    clock.now = 15
+    assert fired(engine, 'esp-1', 85) == [('flood', 'global')]
+
+    # Xoá -> COUNT đổi
+    con = sqlite3.connect(db)
+    with con:
+        con.execute("DELETE FROM alert_rules")
+    con.close()
+    clock.now = 20
+    assert fired(engine, 'esp-1', 99) == []
+    assert engine.reloads == reloads + 3
+
+
+@pytest.mark.parametrize('condition', [
+    'foo < 1',
+    'soil ~ 2',
+    'soil < abc',
+    'soil < 1 or pump == 0',
+    "__import__('os').system('id') < 1",
+    'soil < 1; pump == 0',
+    'r["soil"] < 1',
+    '',
+])
+def test_invalid_conditions_rejected(engine, condition):
+    with pytest.raises(ValueError):
+        parse(condition)
+    with pytest.raises(ValueError):
+        engine.save({'name': 'bad', 'condition': condition})
+    assert engine.rules() == []
+
+
+@pytest.mark.parametrize('data', [
+    {'name': 'x', 'condition': 'soil < 1', 'scope': 'site'},
+    {'name': 'x', 'condition': 'soil < 1', 'action': 'exec'},
+    {'name': 'x', 'condition': 'soil < 1', 'severity': 'LOUD'},
+    {'name': 'x', 'condition': 'soil < 1', 'scope': 'device'},
+    {'name': '', 'condition': 'soil < 1'},
+    {'name': 'x', 'condition': 'soil < 1 and pump == 0', 'action': 'threshold'},
+    {'name': 'x', 'condition': 'pump == 1', 'action': 'threshold'},
+])
+def test_invalid_rules_rejected(engine, data):
+    with pytest.raises(ValueError):
+        engine.save(data)
+
+
+def test_bad_rule_in_db_is_skipped(db, engine):
+    insert_rule(db, 'broken', 'soil <<< 1')
+    insert_rule(db, 'wet', 'soil > 90')
+    engine.reload(force=True)
+    assert fired(engine, 'esp-1', 95) == [('wet', 'global')]
+    assert 'broken' not in {c.name for c in engine._state.named.values()}
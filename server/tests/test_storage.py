@@ -0,0 +1,101 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import migrations
+import storage
+
+SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def rows(n_devices=12, per_device=30):
+    return [(1730000000000 + i * 1000, 40.0 + i % 7, i % 2, 1, 1, -60, f'esp-{d}', 1730000000000 + i * 1000)
+            for d in range(n_devices) for i in range(per_device)]
+
+
+def snapshot(db):
+    s = storage.Storage(db)
+    try:
+        return sorted(s.fan_out(f'SELECT {storage.LOG_COLUMNS} FROM logs'))
+    finally:
+        s.close()
+
+
+def test_reshard_round_trip_keeps_rows(tmp_path):
+    db = str(tmp_path / 'tuoi.db')
+    migrations.migrate(db)
+    s = storage.ensure(db, 1)
+    s.insert(rows())
+    s.close()
+    before = snapshot(db)
+    assert len(before) == 360
+
+    assert storage.reshard(db, 4) == 360
+    assert storage.read_layout(db) == storage.shard_paths(db, 4)
+    assert snapshot(db) == before
+    counts = dict(storage.status(db))
+    assert len(counts) == 4 and sum(counts.values()) == 360 and 0 not in counts.values()
+    # Mỗi thiết bị nằm đúng shard của nó
+    s = storage.ensure(db, 4)
+    for path in s.sources():
+        devices = {r[0] for r in storage._open(path, readonly=True).execute('SELECT DISTINCT device FROM logs')}
+        assert all(s.path_for(d) == path for d in devices)
+    # Ghi qua thread ghi của shard, gửi lại không trùng
+    s.insert(rows(per_device=31))
+    s.close()
+    sharded = snapshot(db)
+    assert len(sharded) == 372
+
+    assert storage.reshard(db, 1) == 372
+    assert storage.read_layout(db) == []
+    assert storage.status(db) == [(db, 372)]
+    assert snapshot(db) == sharded
+
+
+def test_ensure_keeps_existing_layout(tmp_path):
+    db = str(tmp_path / 'tuoi.db')
+    migrations.migrate(db)
+    storage.ensure(db, 1).insert(rows(2, 5))
+    # DB đã có logs: không tự chia, phải chạy reshard
+    assert not storage.ensure(db, 4).sharded
+    # DB trống: tạo layout mới
+    empty = str(tmp_path / 'empty.db')
+    migrations.migrate(empty)
+    assert len(storage.ensure(empty, 4).paths) == 4
+
+
+def test_writer_commits_off_the_eventlet_hub(tmp_path):
+    pytest.importorskip('eventlet')
+    script = textwrap.dedent(f'''
+        import eventlet
+        eventlet.monkey_patch()
+        from eventlet import patcher
+        import migrations, storage
+
+        native = patcher.original('_thread').get_ident
+        main = native()
+        threads = set()
+        commit = storage._Writer._commit
+
+        def traced(con, jobs):
+            threads.add(native())
+            commit(con, jobs)
+        storage._Writer._commit = staticmethod(traced)
+
+        db = {str(tmp_path / 'tuoi.db')!r}
+        migrations.migrate(db)
+        s = storage.ensure(db, 4)
+        pool = eventlet.GreenPool()
+        for d in range(8):
+            pool.spawn(s.insert, [(1730000000000 + i, 40.0, 0, 1, 1, -60, 'esp-%d' % d, 1730000000000 + i)
+                                  for i in range(50)])
+        pool.waitall()
+        s.close()
+        print(len(storage.Storage(db).fan_out('SELECT 1 FROM logs')), main in threads, len(threads) > 0)
+    ''')
+    out = subprocess.run([sys.executable, '-c', script], cwd=SERVER, capture_output=True, text=True, timeout=60)
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.split() == ['400', 'False', 'True']
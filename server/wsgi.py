@@ -0,0 +1,65 @@
+"""
+Entry point production (không debug, không dùng Werkzeug dev server)
+
+    # 1 process, eventlet green threads (khuyên dùng)
+    python wsgi.py
+
+    # Nhiều worker: scheduler + MQTT chỉ chạy ở 1 worker (file lock)
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Cấu hình qua biến môi trường: xem settings.py
+"""
+import settings
+
+if __name__ == "__main__":
+    # Monkey patch phải chạy TRƯỚC khi import app (socket, threading, time)
+    if settings.SERVER_MODE == "eventlet":
+        import eventlet
+        eventlet.monkey_patch()
+    elif settings.SERVER_MODE == "gevent":
+        from gevent import monkey
+        monkey.patch_all()
+
+_app = None
+
+
+def get_app():
+    """
+    Tạo app lần đầu được gọi. KHÔNG tạo lúc import: pool ML (ml_service.py)
+    dùng spawn, process con import lại module __main__ (tên '__mp_main__')
+    -> create_app() ở cấp module sẽ chạy migration, nạp ring buffer, giành
+    leader lock... trong từng worker ML, lại không có monkey patch
+    """
+    global _app
+    if _app is None:
+        from app import create_app
+        _app = create_app()
+    return _app
+
+
+def __getattr__(name):
+    # gunicorn wsgi:app -> getattr(module, 'app') -> tạo app trong worker gunicorn
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def main():
+    app = get_app()
+    addr = (settings.HOST, settings.PORT)
+    print(f"🚀 Production server ({settings.SERVER_MODE}) tại http://{addr[0]}:{addr[1]}")
+
+    if settings.SERVER_MODE == "eventlet":
+        import eventlet.wsgi
+        eventlet.wsgi.server(eventlet.listen(addr), app, log_output=settings.DEBUG)
+    elif settings.SERVER_MODE == "gevent":
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(addr, app, log=None).serve_forever()
+    else:
+        # threaded: mỗi request 1 thread, không cần eventlet/gevent
+        from werkzeug.serving import make_server
+        make_server(addr[0], addr[1], app, threaded=True).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import math
+import numpy as np
+
+# ================= LỊCH TƯỚI NHIỀU ZONE (CHIA SẺ NGUỒN NƯỚC) =================
+# Nhiều zone cùng 1 đường ống chính: bật đồng loạt lúc start_time làm tụt áp.
+# Xếp lịch so le sao cho tại mọi thời điểm:
+#   - số bơm đang chạy <= max_concurrent
+#   - tổng lưu lượng <= max_flow (lít/phút)
+#   - mỗi zone chạy trọn trong khung giờ cho phép [earliest, latest]
+# Heuristic: list scheduling theo hạn chót sớm nhất (EDF) + đặt vào chỗ trống
+# sớm nhất. Độ chiếm dụng theo từng phút là numpy array -> tìm chỗ trống
+# bằng cumsum, vài nghìn zone trong < 1 giây.
+
+DEFAULT_FLOW = 10.0        # lít/phút mỗi zone (giống SmartWateringCalculator)
+DEFAULT_AREA = 10.0        # m² mỗi zone
+HORIZON = 2 * 1440         # phút: cho phép lịch tràn sang ngày hôm sau
+
+
+def to_minutes(value):
+    """'HH:MM' hoặc số phút -> số phút tính từ 0h"""
+    if isinstance(value, str):
+        h, m = value.split(':')
+        return int(h) * 60 + int(m)
+    return int(value)
+
+
+def fmt_minutes(minutes):
+    """Số phút -> 'HH:MM' (+1 nếu sang ngày hôm sau)"""
+    day, rest = divmod(int(minutes), 1440)
+    text = f'{rest // 60:02d}:{rest % 60:02d}'
+    return text + (f' (+{day})' if day else '')
+
+
+def duration_from_need(water_needed_mm, area_m2=DEFAULT_AREA, flow=DEFAULT_FLOW):
+    """Lượng nước cần (mm, từ SmartWateringCalculator) -> số phút bơm"""
+    return int(math.ceil(water_needed_mm * area_m2 / flow)) if water_needed_mm > 0 else 0
+
+
+class Plan:
+    """Kết quả xếp lịch: timeline từng zone + độ chiếm dụng theo phút"""
+
+    def __init__(self, entries, skipped, unscheduled, pumps, flow):
+        self.entries = entries            # [{id, start, end, duration, flow}]
+        self.skipped = skipped            # [{id, reason}] (mưa, không cần tưới)
+        self.unscheduled = unscheduled    # [{id, reason}] (không đủ chỗ trong khung giờ)
+        self.pumps = pumps                # số bơm chạy tại mỗi phút
+        self.flow = flow                  # tổng lưu lượng tại mỗi phút
+        self._starts = np.array([e['start'] for e in entries], dtype=np.int32)
+        self._ends = np.array([e['end'] for e in entries], dtype=np.int32)
+
+    def active_at(self, minute):
+        """Các zone phải đang bơm tại phút `minute`"""
+        idx = np.flatnonzero((self._starts <= minute) & (minute < self._ends))
+        return {self.entries[i]['id'] for i in idx}
+
+    def events(self):
+        """Dòng lệnh theo thời gian: [(phút, 'start'|'stop', zone_id)]"""
+        out = [(e['start'], 'start', e['id']) for e in self.entries]
+        out += [(e['end'], 'stop', e['id']) for e in self.entries]
+        # Tắt trước khi bật trong cùng 1 phút -> không vượt giới hạn
+        return sorted(out, key=lambda ev: (ev[0], ev[1] == 'start'))
+
+    def summary(self):
+        return {
+            'scheduled': len(self.entries),
+            'skipped': len(self.skipped),
+            'unscheduled': len(self.unscheduled),
+            'peak_pumps': int(self.pumps.max()) if len(self.pumps) else 0,
+            'peak_flow': float(self.flow.max()) if len(self.flow) else 0.0,
+            'first_start': fmt_minutes(self._starts.min()) if len(self.entries) else None,
+            'last_end': fmt_minutes(self._ends.max()) if len(self.entries) else None,
+        }
+
+    def to_dict(self):
+        return {
+            'summary': self.summary(),
+            'timeline': [dict(e, start_hm=fmt_minutes(e['start']), end_hm=fmt_minutes(e['end']))
+                         for e in sorted(self.entries, key=lambda e: (e['start'], str(e['id'])))],
+            'skipped': self.skipped,
+            'unscheduled': self.unscheduled,
+        }
+
+
+def schedule(zones, max_concurrent=None, max_flow=None, rain_skip=False, horizon=HORIZON):
+    """
+    Xếp lịch so le cho các zone
+
+    Args:
+        zones: list dict, mỗi zone:
+            id            - id thiết bị / zone
+            duration      - số phút bơm (hoặc water_needed_mm [+ area_m2])
+            flow          - lít/phút (mặc định 10)
+            earliest      - 'HH:MM' / phút, sớm nhất được bật (mặc định 0)
+            latest        - 'HH:MM' / phút, phải tắt trước (mặc định hết horizon);
+                            nhỏ hơn earliest = qua đêm
+            priority      - cao hơn được xếp trước khi cùng hạn chót
+            rain_exposed  - False = nhà kính, không bỏ qua khi mưa (mặc định True)
+        max_concurrent: số bơm tối đa chạy cùng lúc (None/0 = không giới hạn)
+        max_flow: tổng lưu lượng tối đa của đường ống chính (None/0 = không giới hạn)
+        rain_skip: True hoặc kết quả WeatherService.analyze_irrigation_impact()
+
+    Returns:
+        Plan
+    """
+    if isinstance(rain_skip, dict):
+        rain_skip = bool(rain_skip.get('should_skip'))
+    max_concurrent = max_concurrent or len(zones) or 1
+    max_flow = max_flow or float('inf')
+
+    skipped, jobs = [], []
+    for z in zones:
+        flow = float(z.get('flow', DEFAULT_FLOW))
+        if 'duration' in z:
+            duration = int(math.ceil(z['duration']))
+        else:
+            duration = duration_from_need(z.get('water_needed_mm', 0), z.get('area_m2', DEFAULT_AREA), flow)
+        if rain_skip and z.get('rain_exposed', True):
+            skipped.append({'id': z['id'], 'reason': 'rain'})
+            continue
+        if duration <= 0:
+            skipped.append({'id': z['id'], 'reason': 'no_water_needed'})
+            continue
+        earliest = to_minutes(z.get('earliest', 0))
+        latest = to_minutes(z['latest']) if 'latest' in z else horizon
+        if latest <= earliest:
+            latest += 1440
+        jobs.append((min(latest, horizon), -z.get('priority', 0), -duration * flow,
+                     earliest, duration, flow, z['id']))
+
+    # EDF: zone có hạn chót sớm xếp trước; cùng hạn -> ưu tiên cao, zone "nặng" trước
+    jobs.sort(key=lambda j: j[:3])
+
+    pumps = np.zeros(horizon, dtype=np.int32)
+    flows = np.zeros(horizon, dtype=np.float64)
+    entries, unscheduled = [], []
+    for latest, _, _, earliest, duration, flow, zone_id in jobs:
+        if flow > max_flow:
+            unscheduled.append({'id': zone_id, 'reason': 'flow_exceeds_main'})
+            continue
+        if latest - earliest < duration:
+            unscheduled.append({'id': zone_id, 'reason': 'window_too_short'})
+            continue
+
+        # Phút còn chỗ cho zone này, rồi tìm đoạn liên tiếp dài `duration` đầu tiên
+        free = (pumps[earliest:latest] < max_concurrent) & (flows[earliest:latest] + flow <= max_flow + 1e-9)
+        run = np.concatenate(([0], np.cumsum(free, dtype=np.int32)))
+        fits = (run[duration:] - run[:-duration]) == duration
+        if not fits.any():
+            unscheduled.append({'id': zone_id, 'reason': 'no_capacity'})
+            continue
+
+        start = earliest + int(fits.argmax())
+        end = start + duration
+        pumps[start:end] += 1
+        flows[start:end] += flow
+        entries.append({'id': zone_id, 'start': start, 'end': end, 'duration': duration, 'flow': flow})
+
+    return Plan(entries, skipped, unscheduled, pumps, flows)
+
+
+# ============================================
+# USAGE EXAMPLE
+# ============================================
+
+if __name__ == "__main__":
+    import time
+    import random
+
+    random.seed(42)
+    zones = [{
+        'id': f'zone-{i:04d}',
+        'water_needed_mm': random.uniform(0, 15),
+        'flow': random.choice([6, 8, 10, 12]),
+        'earliest': random.choice(['05:00', '06:00', '17:00']),
+        'latest': random.choice(['09:00', '10:00', '22:00', '02:00']),
+        'priority': random.randint(0, 3),
+        'rain_exposed': random.random() < 0.9,
+    } for i in range(5000)]
+
+    t0 = time.perf_counter()
+    plan = schedule(zones, max_concurrent=400, max_flow=3000)
+    elapsed = time.perf_counter() - t0
+
+    print(f"📋 {len(zones)} zones xếp lịch trong {elapsed*1000:.0f} ms")
+    for k, v in plan.summary().items():
+        print(f"   {k}: {v}")
+    for e in plan.to_dict()['timeline'][:5]:
+        print(f"   {e['id']}: {e['start_hm']} -> {e['end_hm']} ({e['flow']} L/phút)")
+
+    rainy = schedule(zones, max_concurrent=400, max_flow=3000, rain_skip={'should_skip': True})
+    print(f"🌧️ Mưa: bỏ qua {len(rainy.skipped)} zone ngoài trời, còn {len(rainy.entries)} zone nhà kính")